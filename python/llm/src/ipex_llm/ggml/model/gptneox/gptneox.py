@@ -53,66 +53,41 @@ import math
 import multiprocessing
 import ctypes
 from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
+import numpy as np
 from collections import deque, OrderedDict
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.model.generation import GenerationMixin
+from ipex_llm.ggml.model.logits_buffer import LogitsBuffer, logits_as_array
+from ipex_llm.ggml.model.prompt_cache import PromptStateCache, model_namespace
 from . import gptneox_cpp
 from .gptneox_types import *
 
 
-class GptneoxCache:
-    """Cache for a gptneox.cpp model."""
+class GptneoxCache(PromptStateCache):
+    """Cache for a gptneox.cpp model.
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
-        self.cache_state: OrderedDict[
-            Tuple[gptneox_cpp.gptneox_token, ...], "GptneoxState"
-        ] = OrderedDict()
-        self.capacity_bytes = capacity_bytes
+    :param capacity_bytes: max size of the states kept in memory.
+    :param spill_dir: directory to spill the states evicted from memory to, which
+           can be reused by the same model after the process restarts.
+           None to drop evicted states.
+    :param spill_capacity_bytes: max size of the states kept in `spill_dir`.
+    """
 
-    @property
-    def cache_size(self):
-        return sum([state.gptneox_state_size for state in self.cache_state.values()])
+    def _get_native_state(self, state: "GptneoxState"):
+        return state.gptneox_state, state.gptneox_state_size
 
-    def _find_longest_prefix_key(
-        self,
-        key: Tuple[gptneox_cpp.gptneox_token, ...],
-    ) -> Optional[Tuple[gptneox_cpp.gptneox_token, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Gptneox.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
-
-    def __getitem__(self, key: Sequence[gptneox_cpp.gptneox_token]) -> "GptneoxState":
-        key = tuple(key)
-        _key = self._find_longest_prefix_key(key)
-        invalidInputError(_key is not None, "Key not found.")
-        value = self.cache_state[_key]
-        self.cache_state.move_to_end(_key)
-        return value
-
-    def __contains__(self, key: Sequence[gptneox_cpp.gptneox_token]) -> bool:
-        return self._find_longest_prefix_key(tuple(key)) is not None
-
-    def __setitem__(self, key: Sequence[gptneox_cpp.gptneox_token], value: "GptneoxState"):
-        key = tuple(key)
-        if key in self.cache_state:
-            del self.cache_state[key]
-        self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+    def _make_state(self, eval_tokens, eval_logits, native_state, native_state_size):
+        return GptneoxState(eval_tokens=eval_tokens,
+                            eval_logits=eval_logits,
+                            gptneox_state=native_state,
+                            gptneox_state_size=native_state_size)
 
 
 class GptneoxState:
     def __init__(
         self,
         eval_tokens: Deque[gptneox_cpp.gptneox_token],
-        eval_logits: Deque[List[float]],
+        eval_logits: LogitsBuffer,
         gptneox_state,  # type: gptneox_cpp.Array[gptneox_cpp.c_uint8]
         gptneox_state_size: int,
     ):
@@ -192,7 +167,7 @@ class Gptneox(GenerationMixin):
         self.last_n_tokens_size = last_n_tokens_size
         self.n_batch = min(n_ctx, n_batch)
         self.eval_tokens: Deque[gptneox_cpp.gptneox_token] = deque(maxlen=n_ctx)
-        self.eval_logits: Deque[List[float]] = deque(maxlen=n_ctx if logits_all else 1)
+        self.eval_logits = LogitsBuffer(maxlen=n_ctx if logits_all else 1)
 
         self.cache: Optional[GptneoxCache] = None
 
@@ -284,6 +259,12 @@ class Gptneox(GenerationMixin):
         Args:
             cache: The cache to set.
         """
+        if cache is not None:
+            # states of another model, or of another context size, can't be restored
+            cache.set_namespace(model_namespace(self.model_path,
+                                                n_ctx=int(gptneox_cpp.gptneox_n_ctx(self.ctx)),
+                                                n_vocab=int(gptneox_cpp.gptneox_n_vocab(self.ctx)),
+                                                f16_kv=bool(self.params.f16_kv)))
         self.cache = cache
 
     def reset(self):
@@ -318,10 +299,7 @@ class Gptneox(GenerationMixin):
             n_vocab = gptneox_cpp.gptneox_n_vocab(self.ctx)
             cols = int(n_vocab)
             logits_view = gptneox_cpp.gptneox_get_logits(self.ctx)
-            logits: List[List[float]] = [
-                [logits_view[i * cols + j] for j in range(cols)] for i in range(rows)
-            ]
-            self.eval_logits.extend(logits)
+            self.eval_logits.extend(logits_as_array(logits_view, rows, cols))
 
     def _sample(
         self,
@@ -361,7 +339,7 @@ class Gptneox(GenerationMixin):
         #     size=size,
         #     sorted=sorted,
         # )
-        logits = (ctypes.c_float * n_vocab)(*logits)
+        logits = np.ctypeslib.as_ctypes(np.ascontiguousarray(logits, dtype=np.float32))
         candidates = gptneox_cpp.gptneox_get_candidates(
             ctx=self.ctx,
             n_vocab=n_vocab,
@@ -550,10 +528,8 @@ class Gptneox(GenerationMixin):
                 tokens = tokens[longest_prefix:]
                 for _ in range(len(self.eval_tokens) - longest_prefix):
                     self.eval_tokens.pop()
-                    try:
+                    if len(self.eval_logits) > 0:
                         self.eval_logits.pop()
-                    except IndexError:
-                        pass
 
         if reset:
             self.reset()
@@ -682,8 +658,8 @@ class Gptneox(GenerationMixin):
                               "logprobs is not supported for models created with logits_all=False")
 
         if self.cache:
-            try:
-                cache_item = self.cache[prompt_tokens]
+            cache_item = self.cache.get(prompt_tokens)
+            if cache_item is not None:
                 cache_prefix_len = Gptneox.longest_token_prefix(
                     cache_item.eval_tokens, prompt_tokens
                 )
@@ -694,9 +670,8 @@ class Gptneox(GenerationMixin):
                     self.load_state(cache_item)
                     if self.verbose:
                         print("Gptneox._create_completion: cache hit", file=sys.stderr)
-            except KeyError:
-                if self.verbose:
-                    print("Gptneox._create_completion: cache miss", file=sys.stderr)
+            elif self.verbose:
+                print("Gptneox._create_completion: cache miss", file=sys.stderr)
 
         finish_reason = "length"
         multibyte_fix = 0
@@ -833,7 +808,7 @@ class Gptneox(GenerationMixin):
                 for token in all_tokens
             ]
             all_logprobs = [
-                Gptneox.logits_to_logprobs(list(map(float, row)))
+                Gptneox.logits_to_logprobs(row).tolist()
                 for row in self.eval_logits
             ]
             for token, token_str, logprobs_token in zip(
@@ -1201,9 +1176,12 @@ class Gptneox(GenerationMixin):
 
     def load_state(self, state: GptneoxState) -> None:
         invalidInputError(self.ctx is not None, "The attribute `ctx` of `Gptneox` object is None.")
+        state_size = state.gptneox_state_size
+        # a saved state is compacted to the used part of the context
+        invalidInputError(state_size <= gptneox_cpp.gptneox_get_state_size(self.ctx),
+                          "The gptneox state is larger than the state of this model.")
         self.eval_tokens = state.eval_tokens.copy()
         self.eval_logits = state.eval_logits.copy()
-        state_size = state.gptneox_state_size
         invalidInputError(gptneox_cpp.gptneox_set_state_data(self.ctx,
                                                              state.gptneox_state) == state_size,
                           "Failed to set gptneox state data.")
@@ -1219,10 +1197,10 @@ class Gptneox(GenerationMixin):
         return gptneox_cpp.gptneox_token_bos()
 
     @staticmethod
-    def logits_to_logprobs(logits: List[float]) -> List[float]:
-        exps = [math.exp(float(x)) for x in logits]
-        sum_exps = sum(exps)
-        return [math.log(x / sum_exps) for x in exps]
+    def logits_to_logprobs(logits: np.ndarray) -> np.ndarray:
+        logits = np.asarray(logits, dtype=np.float32)
+        max_logit = logits.max()
+        return logits - max_logit - np.log(np.exp(logits - max_logit).sum())
 
     @staticmethod
     def longest_token_prefix(
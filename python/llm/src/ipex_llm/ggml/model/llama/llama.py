@@ -53,64 +53,41 @@ import time
 import math
 import multiprocessing
 from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
+import numpy as np
 from collections import deque, OrderedDict
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.model.generation import GenerationMixin
+from ipex_llm.ggml.model.logits_buffer import LogitsBuffer, logits_as_array
+from ipex_llm.ggml.model.prompt_cache import PromptStateCache, model_namespace
 from . import llama_cpp
 from .llama_types import *
 
 
-class LlamaCache:
-    """Cache for a llama.cpp model."""
+class LlamaCache(PromptStateCache):
+    """Cache for a llama.cpp model.
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
-        self.cache_state: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
-        self.capacity_bytes = capacity_bytes
+    :param capacity_bytes: max size of the states kept in memory.
+    :param spill_dir: directory to spill the states evicted from memory to, which
+           can be reused by the same model after the process restarts.
+           None to drop evicted states.
+    :param spill_capacity_bytes: max size of the states kept in `spill_dir`.
+    """
 
-    @property
-    def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+    def _get_native_state(self, state: "LlamaState"):
+        return state.llama_state, state.llama_state_size
 
-    def _find_longest_prefix_key(
-        self,
-        key: Tuple[int, ...],
-    ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
-
-    def __getitem__(self, key: Sequence[int]) -> "LlamaState":
-        key = tuple(key)
-        _key = self._find_longest_prefix_key(key)
-        invalidInputError(_key is not None, "Key not found.")
-        value = self.cache_state[_key]
-        self.cache_state.move_to_end(_key)
-        return value
-
-    def __contains__(self, key: Sequence[int]) -> bool:
-        return self._find_longest_prefix_key(tuple(key)) is not None
-
-    def __setitem__(self, key: Sequence[int], value: "LlamaState"):
-        key = tuple(key)
-        if key in self.cache_state:
-            del self.cache_state[key]
-        self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+    def _make_state(self, eval_tokens, eval_logits, native_state, native_state_size):
+        return LlamaState(eval_tokens=eval_tokens,
+                          eval_logits=eval_logits,
+                          llama_state=native_state,
+                          llama_state_size=native_state_size)
 
 
 class LlamaState:
     def __init__(
         self,
         eval_tokens: Deque[int],
-        eval_logits: Deque[List[float]],
+        eval_logits: LogitsBuffer,
         llama_state,  # type: llama_cpp.Array[llama_cpp.c_uint8]
         llama_state_size: int,
     ):
@@ -189,7 +166,7 @@ class Llama(GenerationMixin):
         self.last_n_tokens_size = last_n_tokens_size
         self.n_batch = min(n_ctx, n_batch)
         self.eval_tokens: Deque[int] = deque(maxlen=n_ctx)
-        self.eval_logits: Deque[List[float]] = deque(maxlen=n_ctx if logits_all else 1)
+        self.eval_logits = LogitsBuffer(maxlen=n_ctx if logits_all else 1)
 
         self.cache: Optional[LlamaCache] = None
 
@@ -308,6 +285,12 @@ class Llama(GenerationMixin):
         Args:
             cache: The cache to set.
         """
+        if cache is not None:
+            # states of another model, or of another context size, can't be restored
+            cache.set_namespace(model_namespace(self.model_path,
+                                                n_ctx=int(llama_cpp.llama_n_ctx(self.ctx)),
+                                                n_vocab=int(llama_cpp.llama_n_vocab(self.ctx)),
+                                                f16_kv=bool(self.params.f16_kv)))
         self.cache = cache
 
     def reset(self):
@@ -342,10 +325,7 @@ class Llama(GenerationMixin):
             n_vocab = llama_cpp.llama_n_vocab(self.ctx)
             cols = int(n_vocab)
             logits_view = llama_cpp.llama_get_logits(self.ctx)
-            logits: List[List[float]] = [
-                [logits_view[i * cols + j] for j in range(cols)] for i in range(rows)
-            ]
-            self.eval_logits.extend(logits)
+            self.eval_logits.extend(logits_as_array(logits_view, rows, cols))
 
     def _sample(
         self,
@@ -566,10 +546,8 @@ class Llama(GenerationMixin):
                 tokens = tokens[longest_prefix:]
                 for _ in range(len(self.eval_tokens) - longest_prefix):
                     self.eval_tokens.pop()
-                    try:
+                    if len(self.eval_logits) > 0:
                         self.eval_logits.pop()
-                    except IndexError:
-                        pass
 
         if reset:
             self.reset()
@@ -712,8 +690,8 @@ class Llama(GenerationMixin):
                               "logprobs is not supported for models created with logits_all=False")
 
         if self.cache:
-            try:
-                cache_item = self.cache[prompt_tokens]
+            cache_item = self.cache.get(prompt_tokens)
+            if cache_item is not None:
                 cache_prefix_len = Llama.longest_token_prefix(
                     cache_item.eval_tokens, prompt_tokens
                 )
@@ -724,9 +702,8 @@ class Llama(GenerationMixin):
                     self.load_state(cache_item)
                     if self.verbose:
                         print("Llama._create_completion: cache hit", file=sys.stderr)
-            except KeyError:
-                if self.verbose:
-                    print("Llama._create_completion: cache miss", file=sys.stderr)
+            elif self.verbose:
+                print("Llama._create_completion: cache miss", file=sys.stderr)
 
         finish_reason = "length"
         multibyte_fix = 0
@@ -804,7 +781,7 @@ class Llama(GenerationMixin):
                         )
                         token_offset = len(prompt_tokens) + returned_tokens
                         logits = self.eval_logits[token_offset - 1]
-                        current_logprobs = Llama.logits_to_logprobs(logits)
+                        current_logprobs = Llama.logits_to_logprobs(logits).tolist()
                         sorted_logprobs = list(
                             sorted(
                                 zip(current_logprobs, range(len(current_logprobs))),
@@ -885,7 +862,7 @@ class Llama(GenerationMixin):
                     )
                     token_offset = len(prompt_tokens) + returned_tokens - 1
                     logits = self.eval_logits[token_offset]
-                    current_logprobs = Llama.logits_to_logprobs(logits)
+                    current_logprobs = Llama.logits_to_logprobs(logits).tolist()
                     sorted_logprobs = list(
                         sorted(
                             zip(current_logprobs, range(len(current_logprobs))),
@@ -983,9 +960,9 @@ class Llama(GenerationMixin):
                 for token in all_tokens
             ]
             all_logprobs = [
-                Llama.logits_to_logprobs(list(map(float, row)))
-                for row in self.eval_logits
-            ][token_offset:]
+                Llama.logits_to_logprobs(row).tolist()
+                for row in list(self.eval_logits)[token_offset:]
+            ]
             for token, token_str, logprobs_token in zip(
                 all_tokens, all_token_strs, all_logprobs
             ):
@@ -1365,9 +1342,12 @@ class Llama(GenerationMixin):
 
     def load_state(self, state: LlamaState) -> None:
         invalidInputError(self.ctx is not None, "The attribute `ctx` of `Llama` object is None.")
+        state_size = state.llama_state_size
+        # a saved state is compacted to the used part of the context
+        invalidInputError(state_size <= llama_cpp.llama_get_state_size(self.ctx),
+                          "The llama state is larger than the state of this model.")
         self.eval_tokens = state.eval_tokens.copy()
         self.eval_logits = state.eval_logits.copy()
-        state_size = state.llama_state_size
         invalidInputError(llama_cpp.llama_set_state_data(self.ctx,
                                                          state.llama_state) == state_size,
                           "Failed to set llama state data.")
@@ -1403,10 +1383,10 @@ class Llama(GenerationMixin):
         return llama_cpp.llama_token_nl()
 
     @staticmethod
-    def logits_to_logprobs(logits: List[float]) -> List[float]:
-        exps = [math.exp(float(x)) for x in logits]
-        sum_exps = sum(exps)
-        return [math.log(x / sum_exps) for x in exps]
+    def logits_to_logprobs(logits: np.ndarray) -> np.ndarray:
+        logits = np.asarray(logits, dtype=np.float32)
+        max_logit = logits.max()
+        return logits - max_logit - np.log(np.exp(logits - max_logit).sum())
 
     @staticmethod
     def longest_token_prefix(a: Sequence[int], b: Sequence[int]):
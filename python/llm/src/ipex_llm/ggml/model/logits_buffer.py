@@ -0,0 +1,96 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import ctypes
+from typing import Iterator, Optional
+
+import numpy as np
+from ipex_llm.utils.common import invalidInputError
+
+
+def logits_as_array(logits_p, rows: int, cols: int) -> np.ndarray:
+    """View the float logits returned by the native library as a [rows, cols] array.
+
+    The memory is owned by the native context and is overwritten by the next eval,
+    so the array should be copied before that.
+    """
+    return np.ctypeslib.as_array(ctypes.cast(logits_p, ctypes.POINTER(ctypes.c_float)),
+                                 shape=(rows, cols))
+
+
+class LogitsBuffer:
+    """A ring buffer of the logits of the last `maxlen` evaluated tokens.
+
+    It behaves like a `deque(maxlen=maxlen)` of logits rows, but the rows are stored
+    in one preallocated float32 matrix, and every row is a view of that matrix.
+    """
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self._data: Optional[np.ndarray] = None
+        self._start = 0
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _row(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        invalidInputError(0 <= index < self._len, "LogitsBuffer index out of range.")
+        return (self._start + index) % self.maxlen
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self._data[self._row(index)]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(self._len):
+            yield self._data[(self._start + i) % self.maxlen]
+
+    def extend(self, logits: np.ndarray):
+        """Append the rows of a [n, n_vocab] array, dropping the oldest rows if full."""
+        if self._data is None:
+            self._data = np.empty((self.maxlen, logits.shape[1]), dtype=np.float32)
+        invalidInputError(logits.shape[1] == self._data.shape[1],
+                          f"Expect logits of {self._data.shape[1]} tokens, "
+                          f"but got {logits.shape[1]}.")
+        logits = logits[-self.maxlen:]
+        n = logits.shape[0]
+        end = (self._start + self._len) % self.maxlen
+        first = min(n, self.maxlen - end)
+        self._data[end:end + first] = logits[:first]
+        self._data[:n - first] = logits[first:]
+        dropped = max(0, self._len + n - self.maxlen)
+        self._start = (self._start + dropped) % self.maxlen
+        self._len = min(self._len + n, self.maxlen)
+
+    def pop(self) -> np.ndarray:
+        """Remove and return the newest row."""
+        row = self[-1]
+        self._len -= 1
+        return row
+
+    def clear(self):
+        self._start = 0
+        self._len = 0
+
+    def copy(self) -> "LogitsBuffer":
+        new_buffer = LogitsBuffer(self.maxlen)
+        if self._data is not None:
+            new_buffer._data = self._data.copy()
+            new_buffer._start = self._start
+            new_buffer._len = self._len
+        return new_buffer
@@ -0,0 +1,326 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Cache of model states keyed by the tokens evaluated to reach them.
+#
+# States are kept in memory up to `capacity_bytes`, the least recently used
+# ones are evicted first. If `spill_dir` is given, evicted states are written
+# to that directory instead of being dropped, one `<name>.state` file with the
+# native state and one `<name>.npy` file with the logits per state, and are
+# memory-mapped back when they are hit. The index of the spilled states is kept
+# in `index.json`, so they are still hit after the process restarts. It is written
+# when states are spilled or removed, and by `close`, which also saves the order
+# in which the spilled states were last hit.
+#
+# A native state can only be restored to the model which saved it, so the states
+# are spilled to a sub folder of `spill_dir` named by the identity of the model,
+# set by `set_namespace` when the cache is attached to a model. Nothing is spilled
+# before that.
+
+import ctypes
+import hashlib
+import json
+import mmap
+import os
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.ggml.model.logits_buffer import LogitsBuffer
+
+INDEX_NAME = "index.json"
+
+
+def model_namespace(model_path: str, **kwargs) -> dict:
+    """Identify a model by its file, or checkpoint folder, and the parameters its states
+    depend on."""
+    namespace = {"model_path": os.path.abspath(model_path), **kwargs}
+    if os.path.isfile(model_path):
+        stat = os.stat(model_path)
+        namespace["model_size"] = stat.st_size
+        namespace["model_mtime"] = stat.st_mtime
+    elif os.path.isdir(model_path):
+        # e.g. a transformers checkpoint, changed if any of its files is
+        stats = [entry.stat() for entry in os.scandir(model_path) if entry.is_file()]
+        namespace["model_size"] = sum(stat.st_size for stat in stats)
+        namespace["model_mtime"] = max((stat.st_mtime for stat in stats), default=0)
+    return namespace
+
+
+class _TrieNode:
+    __slots__ = ["children", "is_key", "num_keys"]
+
+    def __init__(self):
+        self.children: Dict[int, "_TrieNode"] = {}
+        self.is_key = False
+        # number of keys ending in the subtree of this node
+        self.num_keys = 0
+
+
+class TokenTrie:
+    """A trie of token sequences for longest common prefix lookup."""
+
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def insert(self, key: Tuple[int, ...]):
+        node = self.root
+        path = [node]
+        for token in key:
+            node = node.children.setdefault(token, _TrieNode())
+            path.append(node)
+        if not node.is_key:
+            node.is_key = True
+            for n in path:
+                n.num_keys += 1
+
+    def remove(self, key: Tuple[int, ...]):
+        path = [self.root]
+        for token in key:
+            node = path[-1].children.get(token)
+            if node is None:
+                return
+            path.append(node)
+        if not path[-1].is_key:
+            return
+        path[-1].is_key = False
+        for n in path:
+            n.num_keys -= 1
+        # prune the branch which has no key any more
+        for i in range(len(key), 0, -1):
+            if path[i].num_keys == 0:
+                del path[i - 1].children[key[i - 1]]
+            else:
+                break
+
+    def longest_prefix(self, key: Sequence[int]) -> Tuple[Optional[Tuple[int, ...]], int]:
+        """Find a stored key sharing the longest common prefix with `key`.
+
+        :return: the stored key and the length of the common prefix,
+                 or (None, 0) if no stored key shares a prefix with `key`.
+        """
+        node = self.root
+        prefix_len = 0
+        for token in key:
+            child = node.children.get(token)
+            if child is None or child.num_keys == 0:
+                break
+            node = child
+            prefix_len += 1
+        if prefix_len == 0:
+            return None, 0
+        # every key below `node` shares the same prefix, take the shortest one
+        found = list(key[:prefix_len])
+        while not node.is_key:
+            token, node = next((t, n) for t, n in node.children.items() if n.num_keys > 0)
+            found.append(token)
+        return tuple(found), prefix_len
+
+
+class PromptStateCache:
+    """Cache of model states, looked up by the longest common prefix of their tokens.
+
+    Subclasses define how the native state of their model is stored by
+    `_get_native_state` and `_make_state`.
+
+    :param capacity_bytes: max size of the native states kept in memory.
+    :param spill_dir: directory to spill the states evicted from memory to,
+           None to drop them.
+    :param spill_capacity_bytes: max size of the native states kept in `spill_dir`
+           for a model.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30), spill_dir: Optional[str] = None,
+                 spill_capacity_bytes: int = (16 << 30)):
+        self.cache_state: OrderedDict[Tuple[int, ...], Any] = OrderedDict()
+        self.capacity_bytes = capacity_bytes
+        self._cache_size = 0
+        self._trie = TokenTrie()
+
+        self.spill_dir = spill_dir
+        self.spill_capacity_bytes = spill_capacity_bytes
+        self.namespace: Optional[dict] = None
+        # sub folder of `spill_dir` of the model set by `set_namespace`
+        self._spill_folder: Optional[str] = None
+        # spilled key -> the file name, size and number of eval tokens of the spilled state
+        self._spilled: OrderedDict[Tuple[int, ...], Dict[str, Any]] = OrderedDict()
+        self._spilled_size = 0
+        self._spilled_trie = TokenTrie()
+        # whether the order of `_spilled` changed since the index was saved
+        self._index_dirty = False
+
+    def set_namespace(self, namespace: dict):
+        """Set the identity of the model whose states are cached, see `model_namespace`.
+
+        The states cached for another model are dropped, and the states spilled for
+        this model are loaded.
+        """
+        if namespace == self.namespace:
+            return
+        self.close()
+        self.namespace = namespace
+        self.cache_state.clear()
+        self._cache_size = 0
+        self._trie = TokenTrie()
+        self._spilled.clear()
+        self._spilled_size = 0
+        self._spilled_trie = TokenTrie()
+        if self.spill_dir is not None:
+            namespace_str = json.dumps(namespace, sort_keys=True, default=str)
+            name = hashlib.sha256(namespace_str.encode("utf-8")).hexdigest()[:16]
+            self._spill_folder = os.path.join(self.spill_dir, name)
+            os.makedirs(self._spill_folder, exist_ok=True)
+            self._load_index()
+
+    def _get_native_state(self, state) -> Tuple[Any, int]:
+        """Return the native state data (a ctypes uint8 array) and its size."""
+        invalidInputError(False, "_get_native_state is not implemented.")
+
+    def _make_state(self, eval_tokens, eval_logits, native_state, native_state_size):
+        invalidInputError(False, "_make_state is not implemented.")
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    def get(self, key: Sequence[int]):
+        """Return the state sharing the longest common prefix with `key`, or None."""
+        key = tuple(key)
+        cached_key, prefix_len = self._trie.longest_prefix(key)
+        spilled_key, spilled_prefix_len = self._spilled_trie.longest_prefix(key)
+        if spilled_key is not None and spilled_prefix_len > prefix_len:
+            return self._load_spilled(spilled_key)
+        if cached_key is None:
+            return None
+        self.cache_state.move_to_end(cached_key)
+        return self.cache_state[cached_key]
+
+    def __getitem__(self, key: Sequence[int]):
+        value = self.get(key)
+        invalidInputError(value is not None, "Key not found.")
+        return value
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        key = tuple(key)
+        return self._trie.longest_prefix(key)[0] is not None or \
+            self._spilled_trie.longest_prefix(key)[0] is not None
+
+    def __setitem__(self, key: Sequence[int], value):
+        key = tuple(key)
+        if key in self.cache_state:
+            self._cache_size -= self._get_native_state(self.cache_state.pop(key))[1]
+        self.cache_state[key] = value
+        self._trie.insert(key)
+        self._cache_size += self._get_native_state(value)[1]
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            self._trie.remove(evicted_key)
+            self._cache_size -= self._get_native_state(evicted)[1]
+            if self._spill_folder is not None:
+                self._spill(evicted_key, evicted)
+
+    def _spill(self, key, state):
+        native_state, size = self._get_native_state(state)
+        num_eval_tokens = len(state.eval_tokens)
+        # only the number of eval tokens is saved, as they are the key, or the key but its
+        # last sampled token if that one was not evaluated. States whose eval tokens were
+        # truncated to the context are not spilled.
+        if size > self.spill_capacity_bytes or \
+                tuple(state.eval_tokens) != key[:num_eval_tokens]:
+            return
+        name = hashlib.sha1(np.asarray(key, dtype=np.int64).tobytes()).hexdigest()
+        path = os.path.join(self._spill_folder, name)
+        with open(path + ".state", "wb") as f:
+            f.write(memoryview(native_state)[:size])
+        logits = list(state.eval_logits)
+        np.save(path + ".npy", np.stack(logits) if len(logits) > 0
+                else np.empty((0, 0), dtype=np.float32))
+
+        if key in self._spilled:
+            self._spilled_size -= self._spilled.pop(key)["size"]
+        self._spilled[key] = {
+            "name": name,
+            "size": size,
+            "num_eval_tokens": num_eval_tokens,
+            "eval_tokens_maxlen": state.eval_tokens.maxlen,
+            "eval_logits_maxlen": state.eval_logits.maxlen,
+        }
+        self._spilled_trie.insert(key)
+        self._spilled_size += size
+        while self._spilled_size > self.spill_capacity_bytes:
+            self._remove_spilled(next(iter(self._spilled)))
+        self._save_index()
+
+    def _remove_spilled(self, key):
+        info = self._spilled.pop(key)
+        self._spilled_trie.remove(key)
+        self._spilled_size -= info["size"]
+        self._index_dirty = True
+        for suffix in [".state", ".npy"]:
+            path = os.path.join(self._spill_folder, info["name"] + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load_spilled(self, key):
+        info = self._spilled[key]
+        self._spilled.move_to_end(key)
+        # saved with the next spill or by `close`
+        self._index_dirty = True
+        path = os.path.join(self._spill_folder, info["name"])
+        with open(path + ".state", "rb") as f:
+            # a private mapping is writable for ctypes without touching the file
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        native_state = (ctypes.c_uint8 * info["size"]).from_buffer(buffer)
+        eval_logits = LogitsBuffer(maxlen=info["eval_logits_maxlen"])
+        logits = np.load(path + ".npy", mmap_mode="r")
+        if logits.shape[0] > 0:
+            eval_logits.extend(logits)
+        eval_tokens = deque(key[:info["num_eval_tokens"]], maxlen=info["eval_tokens_maxlen"])
+        return self._make_state(eval_tokens, eval_logits, native_state, info["size"])
+
+    def _load_index(self):
+        index_path = os.path.join(self._spill_folder, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "r") as f:
+            entries = json.load(f)
+        for entry in entries:
+            if not os.path.exists(os.path.join(self._spill_folder, entry["name"] + ".state")):
+                continue
+            key = tuple(entry.pop("key"))
+            self._spilled[key] = entry
+            self._spilled_trie.insert(key)
+            self._spilled_size += entry["size"]
+        while self._spilled_size > self.spill_capacity_bytes:
+            self._remove_spilled(next(iter(self._spilled)))
+
+    def _save_index(self):
+        # from the least to the most recently used
+        entries = [{"key": list(key), **info} for key, info in self._spilled.items()]
+        index_path = os.path.join(self._spill_folder, INDEX_NAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(index_path + ".tmp", index_path)
+        self._index_dirty = False
+
+    def close(self):
+        """Save the order in which the spilled states were hit, if it changed."""
+        if self._index_dirty and self._spill_folder is not None:
+            self._save_index()
+
+    def __del__(self):
+        self.close()
@@ -52,6 +52,8 @@ from typing import Any, Dict, List, Optional
 from pydantic import BaseModel, Extra, Field, root_validator
 
 from langchain.embeddings.base import Embeddings
+from ipex_llm.ggml.model.prompt_cache import model_namespace
+from .cache import EmbeddingCache
 from .transformersembeddings import TransformersEmbeddings
 
 
@@ -117,6 +119,15 @@ class BigdlNativeEmbeddings(BaseModel, Embeddings):
     n_gpu_layers: Optional[int] = Field(0, alias="n_gpu_layers")
     """Number of layers to be loaded into gpu memory. Default None."""
 
+    cache_folder: Optional[str] = None
+    """Folder of the persistent cache of document embeddings, None to disable the cache."""
+
+    cache_max_entries: Optional[int] = None
+    """Max number of embeddings kept in the cache, None for no limit."""
+
+    embedding_cache: Any = None  #: :meta private:
+    """The persistent cache of document embeddings."""
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -185,9 +196,25 @@ class BigdlNativeEmbeddings(BaseModel, Embeddings):
         Returns:
             List of embeddings, one for each text.
         """
+        cache = self.get_embedding_cache()
+        if cache is not None:
+            return cache.embed_documents(texts, self._embed_documents)
+        return self._embed_documents(texts)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
         embeddings = [self.client.embed(text) for text in texts]
         return [list(map(float, e)) for e in embeddings]
 
+    def get_embedding_cache(self) -> Optional[EmbeddingCache]:
+        """Return the persistent cache of document embeddings, None if it is disabled."""
+        if self.embedding_cache is None and self.cache_folder is not None:
+            namespace = model_namespace(self.model_path,
+                                        model_family=self.model_family.lower(),
+                                        n_ctx=self.n_ctx)
+            self.embedding_cache = EmbeddingCache(self.cache_folder, namespace,
+                                                  self.cache_max_entries)
+        return self.embedding_cache
+
     def embed_query(self, text: str) -> List[float]:
         """Embed a query using the Llama model.
 
@@ -272,6 +299,15 @@ class _BaseEmbeddings(BaseModel, Embeddings):
     n_gpu_layers: Optional[int] = Field(0, alias="n_gpu_layers")
     """Number of layers to be loaded into gpu memory. Default None."""
 
+    cache_folder: Optional[str] = None
+    """Folder of the persistent cache of document embeddings, None to disable the cache."""
+
+    cache_max_entries: Optional[int] = None
+    """Max number of embeddings kept in the cache, None for no limit."""
+
+    embedding_cache: Any = None  #: :meta private:
+    """The persistent cache of document embeddings."""
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -342,12 +378,31 @@ class _BaseEmbeddings(BaseModel, Embeddings):
         Returns:
             List of embeddings, one for each text.
         """
+        cache = self.get_embedding_cache()
+        if cache is not None:
+            return cache.embed_documents(texts, self._embed_documents)
+        return self._embed_documents(texts)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
         if self.native:
             embeddings = [self.client.embed(text) for text in texts]
             return [list(map(float, e)) for e in embeddings]
         else:
             return self.client.embed_documents(texts)
 
+    def get_embedding_cache(self) -> Optional[EmbeddingCache]:
+        """Return the persistent cache of document embeddings, None if it is disabled."""
+        if self.embedding_cache is None and self.cache_folder is not None:
+            if self.native:
+                namespace = model_namespace(self.model_path,
+                                            model_family=self.ggml_model,
+                                            n_ctx=self.n_ctx)
+            else:
+                namespace = self.client.get_embedding_cache_namespace()
+            self.embedding_cache = EmbeddingCache(self.cache_folder, namespace,
+                                                  self.cache_max_entries)
+        return self.embedding_cache
+
     def embed_query(self, text: str) -> List[float]:
         """Embed a query using the optimized int4 model.
 
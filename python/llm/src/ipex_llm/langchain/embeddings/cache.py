@@ -0,0 +1,230 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A persistent cache of text embeddings shared by the processes embedding
+# with the same model.
+#
+# Every namespace (model, qtype and pooling of an embeddings object) owns a
+# sub folder of the cache folder with:
+#   embeddings.bin: the float16 matrix of embeddings, memory-mapped,
+#   index.sqlite:   maps the sha256 of a text to its row in the matrix.
+#
+# Readers copy the rows they need within a read transaction of the index, and
+# writers only change the matrix within an exclusive transaction, so readers
+# never see rows being written. New embeddings are always written to rows which
+# are unused in the committed index, so an interrupted writer can't corrupt
+# the cached embeddings.
+
+"""Persistent content-addressed cache of text embeddings."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+INDEX_NAME = "index.sqlite"
+MATRIX_NAME = "embeddings.bin"
+# SQLite limits the number of variables in a statement
+_MAX_VARIABLES = 500
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """A persistent cache of the embeddings of texts.
+
+    Args:
+        cache_folder: Folder of the cache, can be shared by different models.
+        namespace: Everything the embeddings depend on besides the text, e.g. the model id,
+                   qtype and pooling mode. Embeddings of different namespaces are kept apart.
+        max_entries: Max number of embeddings kept in the cache, the least recently used ones
+                     are evicted first. None for no limit.
+    """
+
+    def __init__(self, cache_folder: str, namespace: dict,
+                 max_entries: Optional[int] = None):
+        namespace = json.dumps(namespace, sort_keys=True, default=str)
+        self.folder = os.path.join(cache_folder,
+                                   hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:16])
+        os.makedirs(self.folder, exist_ok=True)
+        self.max_entries = max_entries
+        self.matrix_path = os.path.join(self.folder, MATRIX_NAME)
+        self._lock = threading.Lock()
+        # WAL would let writers commit while readers are copying rows
+        self._conn = sqlite3.connect(os.path.join(self.folder, INDEX_NAME), timeout=600,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                               "(name TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                               "(key TEXT PRIMARY KEY, row INTEGER, last_used REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used "
+                               "ON entries (last_used)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('namespace', ?)", (namespace,))
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('num_rows', '0')")
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        open(self.matrix_path, "ab").close()
+
+    def _get_meta(self, name):
+        row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, name, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, str(value)))
+
+    def _lookup_rows(self, keys):
+        rows = {}
+        for i in range(0, len(keys), _MAX_VARIABLES):
+            chunk = keys[i:i + _MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            rows.update(self._conn.execute(f"SELECT key, row FROM entries "
+                                           f"WHERE key IN ({placeholders})", chunk))
+        return rows
+
+    def get(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up the cached embeddings of texts.
+
+        Returns:
+            The float16 embedding of every text, None if the text is not cached.
+        """
+        keys = [_text_key(text) for text in texts]
+        results = [None] * len(texts)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                rows = self._lookup_rows(keys)
+                dim = self._get_meta("dim")
+                if len(rows) > 0 and dim is not None:
+                    dim = int(dim)
+                    num_rows = os.path.getsize(self.matrix_path) // (dim * 2)
+                    matrix = np.memmap(self.matrix_path, dtype=np.float16, mode="r",
+                                       shape=(num_rows, dim))
+                    for i, key in enumerate(keys):
+                        if key in rows:
+                            results[i] = np.array(matrix[rows[key]])
+                    del matrix
+            finally:
+                self._conn.execute("COMMIT")
+
+            if len(rows) > 0:
+                now = time.time()
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                           [(now, key) for key in rows])
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return results
+
+    def put(self, texts: List[str], embeddings: np.ndarray):
+        """Add the embeddings of texts to the cache, evicting the least recently used ones
+        if the cache is full."""
+        embeddings = np.asarray(embeddings, dtype=np.float16)
+        keys = list(dict.fromkeys(_text_key(text) for text in texts))
+        key_to_embedding = dict(zip([_text_key(text) for text in texts], embeddings))
+        if self.max_entries is not None:
+            keys = keys[len(keys) - self.max_entries:] if self.max_entries > 0 else []
+        if len(keys) == 0:
+            return
+
+        with self._lock:
+            # waits until no reader is copying rows
+            self._conn.execute("BEGIN EXCLUSIVE")
+            try:
+                dim = self._get_meta("dim")
+                if dim is None:
+                    dim = embeddings.shape[1]
+                    self._set_meta("dim", dim)
+                dim = int(dim)
+                # another process may have added some of them
+                existing = self._lookup_rows(keys)
+                keys = [key for key in keys if key not in existing]
+                if len(keys) == 0:
+                    self._conn.execute("COMMIT")
+                    return
+
+                free_rows = [row for row, in self._conn.execute(
+                    "SELECT row FROM free_rows LIMIT ?", (len(keys),))]
+                self._conn.executemany("DELETE FROM free_rows WHERE row = ?",
+                                       [(row,) for row in free_rows])
+                num_rows = int(self._get_meta("num_rows"))
+                new_rows = list(range(num_rows, num_rows + len(keys) - len(free_rows)))
+                num_rows += len(new_rows)
+                self._set_meta("num_rows", num_rows)
+                rows = free_rows + new_rows
+
+                if self.max_entries is not None:
+                    count, = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+                    num_evicted = count + len(keys) - self.max_entries
+                    if num_evicted > 0:
+                        evicted = self._conn.execute("SELECT key, row FROM entries "
+                                                     "ORDER BY last_used LIMIT ?",
+                                                     (num_evicted,)).fetchall()
+                        self._conn.executemany("DELETE FROM entries WHERE key = ?",
+                                               [(key,) for key, _ in evicted])
+                        # only reused by later writers, after this one has committed
+                        self._conn.executemany("INSERT INTO free_rows VALUES (?)",
+                                               [(row,) for _, row in evicted])
+
+                with open(self.matrix_path, "r+b") as f:
+                    if os.path.getsize(self.matrix_path) < num_rows * dim * 2:
+                        f.truncate(num_rows * dim * 2)
+                matrix = np.memmap(self.matrix_path, dtype=np.float16, mode="r+",
+                                   shape=(num_rows, dim))
+                for key, row in zip(keys, rows):
+                    matrix[row] = key_to_embedding[key]
+                matrix.flush()
+                del matrix
+
+                now = time.time()
+                self._conn.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                                       [(key, row, now) for key, row in zip(keys, rows)])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def embed_documents(self, texts: List[str],
+                        embed_fn: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """Embed texts, only running `embed_fn` on the texts which are not cached.
+
+        The embeddings are returned with float16 precision whether they are cached or not,
+        so the results don't depend on the state of the cache.
+        """
+        embeddings = self.get(texts)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings)
+                                     if embedding is None))
+        if len(missing) > 0:
+            missing_embeddings = np.asarray(embed_fn(missing), dtype=np.float16)
+            self.put(missing, missing_embeddings)
+            missing_embeddings = dict(zip(missing, missing_embeddings))
+            embeddings = [missing_embeddings[text] if embedding is None else embedding
+                          for text, embedding in zip(texts, embeddings)]
+        return [embedding.astype(np.float32).tolist() for embedding in embeddings]
@@ -45,15 +45,33 @@
 # THE SOFTWARE.
 
 """Wrapper around BigdlLLM embedding models."""
+import multiprocessing
+import os
 import torch
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 import numpy as np
 
 from pydantic import BaseModel, Extra, Field
 
 from langchain.embeddings.base import Embeddings
+from ipex_llm.ggml.model.prompt_cache import model_namespace
+from .cache import EmbeddingCache
 
 DEFAULT_MODEL_NAME = "gpt2"
+# Texts are sorted by length within windows of this many batches
+SORT_WINDOW_BATCHES = 16
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(args):
+    texts, encode_kwargs = args
+    return [_worker_tokenizer.encode(text, **encode_kwargs) for text in texts]
 
 
 class TransformersEmbeddings(BaseModel, Embeddings):
@@ -78,6 +96,17 @@ class TransformersEmbeddings(BaseModel, Embeddings):
     """Keyword arguments to pass to the model."""
     encode_kwargs: Dict[str, Any] = Field(default_factory=dict)
     """Keyword arguments to pass when calling the `encode` method of the model."""
+    batch_size: int = 32
+    """Number of texts embedded together in one forward by `embed_documents`."""
+    num_tokenizer_workers: int = 0
+    """Number of processes tokenizing the next texts while the model embeds the
+    current ones in `embed_documents`, 0 to tokenize in this process."""
+    cache_folder: Optional[str] = None
+    """Folder of the persistent cache of document embeddings, None to disable the cache."""
+    cache_max_entries: Optional[int] = None
+    """Max number of embeddings kept in the cache, None for no limit."""
+    embedding_cache: Any = None  #: :meta private:
+    """The persistent cache of document embeddings."""
 
     @classmethod
     def from_model_id(
@@ -150,16 +179,71 @@ class TransformersEmbeddings(BaseModel, Embeddings):
         Returns:
             List of embeddings, one for each text.
         """
-        input_ids = self.tokenizer.encode(text, return_tensors="pt", **kwargs)  # shape: [1, T]
-        input_ids = input_ids.to(self.model.device)
-        embeddings = self.model(input_ids, return_dict=False)[0].cpu()  # shape: [1, T, N]
-        embeddings = embeddings.squeeze(0).detach().numpy()
-        embeddings = np.mean(embeddings, axis=0)
-        return embeddings
+        input_ids = self.tokenizer.encode(text, **kwargs)
+        return self.embed_batch([input_ids])[0]
+
+    def pool(self, hidden_states, attention_mask):
+        """Pool the last hidden states of a batch into one embedding per text.
+
+        Args:
+            hidden_states: Last hidden states of shape [B, T, N].
+            attention_mask: Mask of the tokens of shape [B, T], 0 for padding.
+
+        Returns:
+            Embeddings of shape [B, N], the mean of the hidden states of all tokens.
+        """
+        mask = attention_mask.unsqueeze(-1).to(torch.float32)
+        return (hidden_states.to(torch.float32) * mask).sum(dim=1) / mask.sum(dim=1)
+
+    def pooling_mode(self) -> str:
+        """Name of the pooling of `pool`, which the cached embeddings depend on."""
+        return "mean"
+
+    def embed_batch(self, input_ids_list: List[List[int]]):
+        """Compute embeddings of a batch of tokenized texts in one forward.
+
+        Args:
+            input_ids_list: The token ids of every text.
+
+        Returns:
+            Array of shape [B, N], one embedding for each text.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        pad_token_id = pad_token_id if pad_token_id is not None else 0
+        max_len = max(len(input_ids) for input_ids in input_ids_list)
+        input_ids = torch.full((len(input_ids_list), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids_list), max_len), dtype=torch.long)
+        for i, ids in enumerate(input_ids_list):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+        with torch.inference_mode():
+            hidden_states = self.model(input_ids.to(self.model.device),
+                                       attention_mask=attention_mask.to(self.model.device),
+                                       return_dict=False)[0]  # shape: [B, T, N]
+            embeddings = self.pool(hidden_states.cpu(), attention_mask)
+        return embeddings.numpy()
+
+    def _tokenize_windows(self, texts: List[str]) -> Iterator[List[List[int]]]:
+        window_size = self.batch_size * SORT_WINDOW_BATCHES
+        windows = [texts[i:i + window_size] for i in range(0, len(texts), window_size)]
+        if self.num_tokenizer_workers > 0 and len(windows) > 1:
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(self.num_tokenizer_workers, initializer=_init_tokenizer_worker,
+                          initargs=(self.tokenizer,)) as pool:
+                # `imap` keeps tokenizing the next windows while this one is embedded
+                yield from pool.imap(_tokenize_in_worker,
+                                     [(window, self.encode_kwargs) for window in windows])
+        else:
+            for window in windows:
+                yield [self.tokenizer.encode(text, **self.encode_kwargs) for text in window]
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a HuggingFace transformer model.
 
+        Texts are embedded in batches of `batch_size`, texts of similar lengths are
+        batched together to reduce padding. If `cache_folder` is set, only texts which
+        are not in the cache are embedded.
+
         Args:
             texts: The list of texts to embed.
 
@@ -167,9 +251,49 @@ class TransformersEmbeddings(BaseModel, Embeddings):
             List of embeddings, one for each text.
         """
         texts = list(map(lambda x: x.replace("\n", " "), texts))
-        embeddings = [self.embed(text, **self.encode_kwargs).tolist() for text in texts]
+        cache = self.get_embedding_cache()
+        if cache is not None:
+            return cache.embed_documents(texts, self._embed_documents)
+        return self._embed_documents(texts)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for window in self._tokenize_windows(texts):
+            window_embeddings = [None] * len(window)
+            order = sorted(range(len(window)), key=lambda i: len(window[i]))
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                batch_embeddings = self.embed_batch([window[i] for i in batch])
+                for i, embedding in zip(batch, batch_embeddings):
+                    window_embeddings[i] = embedding.tolist()
+            embeddings.extend(window_embeddings)
         return embeddings
 
+    def get_embedding_cache_namespace(self) -> dict:
+        """Return everything the embeddings depend on besides the texts."""
+        config = getattr(self.model, "config", None)
+        kwargs = {
+            "qtype": getattr(config, "bigdl_transformers_low_bit", None),
+            "pooling": self.pooling_mode(),
+            "model_kwargs": self.model_kwargs,
+            "encode_kwargs": self.encode_kwargs,
+        }
+        if os.path.exists(self.model_id):
+            # a local checkpoint, which may be replaced in place
+            return model_namespace(self.model_id, **kwargs)
+        # a model of the huggingface hub, at the revision it was downloaded
+        return {"model_id": self.model_id,
+                "revision": getattr(config, "_commit_hash", None),
+                **kwargs}
+
+    def get_embedding_cache(self) -> Optional[EmbeddingCache]:
+        """Return the persistent cache of document embeddings, None if it is disabled."""
+        if self.embedding_cache is None and self.cache_folder is not None:
+            self.embedding_cache = EmbeddingCache(self.cache_folder,
+                                                  self.get_embedding_cache_namespace(),
+                                                  self.cache_max_entries)
+        return self.embedding_cache
+
     def embed_query(self, text: str) -> List[float]:
         """Compute query embeddings using a bigdl-llm transformer model.
 
@@ -187,9 +311,9 @@ class TransformersEmbeddings(BaseModel, Embeddings):
 # TODO: directly support HuggingFaceBgeEmbeddings
 class TransformersBgeEmbeddings(TransformersEmbeddings):
 
-    def embed(self, text: str, **kwargs):
-        input_ids = self.tokenizer.encode(text, return_tensors="pt", **kwargs)
-        input_ids = input_ids.to(self.model.device)
-        embeddings = self.model(input_ids, return_dict=False)[0].cpu()
-        embeddings = torch.nn.functional.normalize(embeddings[:, 0], p=2, dim=1)
-        return embeddings[0]
+    def pooling_mode(self) -> str:
+        return "cls"
+
+    def pool(self, hidden_states, attention_mask):
+        # normalized hidden states of the first ([CLS]) token
+        return torch.nn.functional.normalize(hidden_states[:, 0].to(torch.float32), p=2, dim=1)
@@ -23,9 +23,11 @@ import argparse
 import asyncio
 import atexit
 import json
+import queue
 from typing import List
 import uuid
 from threading import Thread
+import torch
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, JSONResponse
@@ -45,9 +47,247 @@ from fastchat.utils import get_context_length, is_partial_stop
 
 from ipex_llm.transformers.loader import load_model
 from transformers import TextIteratorStreamer
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
 
 app = FastAPI()
 
+# (batch dim, sequence dim) of the KV cache of the models not laid out as
+# [batch_size, num_heads, seq_len, head_dim]
+KV_CACHE_DIMS = {
+    "chatglm": (1, 0),
+    "qwen": (0, 1),
+    "gpt_bigcode": (0, 1),
+}
+
+
+def _map_kv_cache(past_key_values, fn, *others):
+    if isinstance(past_key_values, torch.Tensor):
+        return fn(past_key_values, *others)
+    return type(past_key_values)(_map_kv_cache(kv, fn, *[o[i] for o in others])
+                                 for i, kv in enumerate(past_key_values))
+
+
+class BatchRequest:
+    """A request decoded by `BatchingEngine`, its tokens are pushed to `streamer`."""
+
+    def __init__(self, input_ids, streamer, max_new_tokens, stop_token_ids,
+                 logits_processor, do_sample):
+        self.input_ids = input_ids
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.stop_token_ids = stop_token_ids
+        self.logits_processor = logits_processor
+        self.do_sample = do_sample
+        self.output_ids = []
+        self.cancelled = False
+        self.finished = False
+
+
+class BatchingEngine:
+    """
+    Decode concurrent requests together in a single background loop.
+
+    Requests queue up in `submit`. Between two decoding steps, the waiting ones are
+    prefilled together and merged into the running batch, which is left-padded to the
+    longest sequence. Every step then decodes one token for all running requests in one
+    forward, streams it to each request, and evicts the finished requests from the batch.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None \
+            else 0
+        self.kv_batch_dim, self.kv_seq_dim = KV_CACHE_DIMS.get(model.config.model_type, (0, 2))
+        self.waiting = queue.Queue()
+        # state of the running batch
+        self.requests = []
+        self.input_ids = None
+        self.attention_mask = None
+        self.past_key_values = None
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_ids, streamer, max_new_tokens, stop_token_ids,
+               temperature=1.0, repetition_penalty=1.0, top_p=1.0, top_k=0):
+        # like `generate`, only sample if the generation config of the model does
+        do_sample = getattr(self.model.generation_config, "do_sample", False)
+        logits_processor = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if do_sample:
+            if temperature != 1.0:
+                logits_processor.append(TemperatureLogitsWarper(temperature))
+            if top_k != 0:
+                logits_processor.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                logits_processor.append(TopPLogitsWarper(top_p))
+        request = BatchRequest(input_ids[0].cpu(), streamer, max_new_tokens,
+                               stop_token_ids, logits_processor, do_sample)
+        streamer.put(input_ids.cpu())
+        self.waiting.put(request)
+        return request
+
+    def cancel(self, request):
+        request.cancelled = True
+
+    def _loop(self):
+        while True:
+            new_requests = []
+            if len(self.requests) == 0:
+                new_requests.append(self.waiting.get())
+            while len(self.requests) + len(new_requests) < self.max_batch_size:
+                try:
+                    new_requests.append(self.waiting.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with torch.inference_mode():
+                    if len(new_requests) > 0:
+                        self._prefill(new_requests)
+                    elif len(self.requests) > 0:
+                        self._decode()
+                    self._evict()
+            except Exception as e:
+                logger.error(f"Batched generation failed: {e}")
+                for request in self.requests + new_requests:
+                    if not request.finished:
+                        request.finished = True
+                        request.streamer.end()
+                self.requests = []
+                self.input_ids = self.attention_mask = self.past_key_values = None
+
+    def _forward(self, input_ids, attention_mask, past_key_values):
+        model_kwargs = {"past_key_values": past_key_values,
+                        "attention_mask": attention_mask,
+                        "use_cache": True}
+        if past_key_values is not None:
+            # chatglm builds its position ids from the first forward otherwise
+            model_kwargs["is_first_forward"] = False
+        model_inputs = self.model.prepare_inputs_for_generation(input_ids, **model_kwargs)
+        output = self.model(**model_inputs, return_dict=True)
+        past_key_values = output.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        return output.logits[:, -1, :], past_key_values
+
+    def _prefill(self, requests):
+        max_len = max(request.input_ids.size(0) for request in requests)
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for i, request in enumerate(requests):
+            input_ids[i, max_len - request.input_ids.size(0):] = request.input_ids
+            attention_mask[i, max_len - request.input_ids.size(0):] = 1
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        logits, past_key_values = self._forward(input_ids, attention_mask, None)
+        # `input_ids` holds one more token than the KV cache, which is the next input
+        next_tokens = self._sample(logits, requests)
+        input_ids = torch.cat((input_ids, next_tokens.unsqueeze(-1)), dim=-1)
+
+        if self.past_key_values is None:
+            self.requests = requests
+            self.input_ids = input_ids
+            self.attention_mask = attention_mask
+            self.past_key_values = past_key_values
+            return
+        # left-pad the shorter one of the running and the new batch, then merge them
+        pad_len = self.attention_mask.size(1) - attention_mask.size(1)
+        if pad_len < 0:
+            self.input_ids = self._left_pad(self.input_ids, -pad_len, self.pad_token_id)
+            self.attention_mask = self._left_pad(self.attention_mask, -pad_len, 0)
+            self.past_key_values = _map_kv_cache(self.past_key_values,
+                                                 lambda kv: self._left_pad_kv(kv, -pad_len))
+        elif pad_len > 0:
+            input_ids = self._left_pad(input_ids, pad_len, self.pad_token_id)
+            attention_mask = self._left_pad(attention_mask, pad_len, 0)
+            past_key_values = _map_kv_cache(past_key_values,
+                                            lambda kv: self._left_pad_kv(kv, pad_len))
+        self.requests = self.requests + requests
+        self.input_ids = torch.cat((self.input_ids, input_ids), dim=0)
+        self.attention_mask = torch.cat((self.attention_mask, attention_mask), dim=0)
+        self.past_key_values = _map_kv_cache(
+            self.past_key_values,
+            lambda kv, new_kv: torch.cat((kv, new_kv.to(kv.dtype)), dim=self.kv_batch_dim),
+            past_key_values)
+
+    def _decode(self):
+        attention_mask = torch.cat((self.attention_mask,
+                                    self.attention_mask.new_ones(self.attention_mask.size(0), 1)),
+                                   dim=-1)
+        logits, self.past_key_values = self._forward(self.input_ids, attention_mask,
+                                                     self.past_key_values)
+        self.attention_mask = attention_mask
+        next_tokens = self._sample(logits, self.requests)
+        self.input_ids = torch.cat((self.input_ids, next_tokens.unsqueeze(-1)), dim=-1)
+
+    def _sample(self, logits, requests):
+        next_tokens = []
+        for i, request in enumerate(requests):
+            scores = logits[i:i+1].float()
+            all_ids = torch.cat((request.input_ids,
+                                 torch.tensor(request.output_ids, dtype=torch.long)))
+            scores = request.logits_processor(all_ids.unsqueeze(0).to(scores.device), scores)
+            if request.do_sample:
+                next_token = torch.multinomial(scores.softmax(-1), num_samples=1)[0, 0].item()
+            else:
+                next_token = scores[0].argmax().item()
+            request.output_ids.append(next_token)
+            request.streamer.put(torch.tensor([next_token]))
+            if next_token in request.stop_token_ids or \
+                    len(request.output_ids) >= request.max_new_tokens:
+                request.finished = True
+            next_tokens.append(next_token)
+        return torch.tensor(next_tokens, dtype=torch.long, device=logits.device)
+
+    def _evict(self):
+        keep = []
+        for i, request in enumerate(self.requests):
+            if request.cancelled and not request.finished:
+                request.finished = True
+            if request.finished:
+                request.streamer.end()
+            else:
+                keep.append(i)
+        if len(keep) == len(self.requests):
+            return
+        if len(keep) == 0:
+            self.requests = []
+            self.input_ids = self.attention_mask = self.past_key_values = None
+            return
+        self.requests = [self.requests[i] for i in keep]
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        self.input_ids = self.input_ids.index_select(0, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.past_key_values = _map_kv_cache(
+            self.past_key_values, lambda kv: kv.index_select(self.kv_batch_dim,
+                                                             index.to(kv.device)))
+        # drop the padding shared by all remaining requests
+        n_padding = (self.attention_mask.cumsum(-1) == 0).sum(-1).min().item()
+        if n_padding > 0:
+            self.input_ids = self.input_ids[:, n_padding:]
+            self.attention_mask = self.attention_mask[:, n_padding:]
+            # copied, so that no KV cache takes the freed space as room to grow in place
+            self.past_key_values = _map_kv_cache(
+                self.past_key_values,
+                lambda kv: kv.narrow(self.kv_seq_dim, n_padding,
+                                     kv.size(self.kv_seq_dim) - n_padding).clone())
+
+    @staticmethod
+    def _left_pad(tensor, pad_len, value):
+        return torch.cat((tensor.new_full((tensor.size(0), pad_len), value), tensor), dim=1)
+
+    def _left_pad_kv(self, kv, pad_len):
+        shape = list(kv.shape)
+        shape[self.kv_seq_dim] = pad_len
+        return torch.cat((kv.new_zeros(shape), kv), dim=self.kv_seq_dim)
+
 
 class BigDLLLMWorker(BaseModelWorker):
     def __init__(
@@ -64,6 +304,7 @@ class BigDLLLMWorker(BaseModelWorker):
         no_register: bool = False,
         trust_remote_code: bool = False,
         stream_interval: int = 4,
+        max_batch_size: int = 1,
     ):
         super().__init__(
             controller_addr,
@@ -90,6 +331,10 @@ class BigDLLLMWorker(BaseModelWorker):
         )
         self.stream_interval = stream_interval
         self.context_len = get_context_length(self.model.config)
+        self.engine = None
+        if max_batch_size > 1 and not self.model.config.is_encoder_decoder:
+            logger.info(f"Decoding up to {max_batch_size} requests in a batch")
+            self.engine = BatchingEngine(self.model, self.tokenizer, max_batch_size)
         if not no_register:
             self.init_heart_beat()
 
@@ -169,12 +414,27 @@ class BigDLLLMWorker(BaseModelWorker):
             top_k=top_k,
         )
 
-        def model_generate():
-            self.model.generate(input_ids, **generated_kwargs)
+        if self.engine is not None:
+            request = self.engine.submit(input_ids, stop_token_ids=stop_token_ids,
+                                         **generated_kwargs)
+        else:
+            request = None
 
-        t1 = Thread(target=model_generate)
-        t1.start()
+            def model_generate():
+                self.model.generate(input_ids, **generated_kwargs)
 
+            t1 = Thread(target=model_generate)
+            t1.start()
+
+        try:
+            yield from self._stream_output(streamer, prompt, input_echo_len,
+                                           max_new_tokens, echo, stop)
+        finally:
+            if request is not None:
+                # stop decoding the request on stop strings or disconnection
+                self.engine.cancel(request)
+
+    def _stream_output(self, streamer, prompt, input_echo_len, max_new_tokens, echo, stop):
         stopped = False
         finish_reason = None
         if echo:
@@ -321,6 +581,14 @@ if __name__ == "__main__":
         help="Trust remote code (e.g., from HuggingFace) when"
         "downloading the model and tokenizer.",
     )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=1,
+        help="Max number of concurrent requests decoded together in a batch, "
+        "1 to decode requests one by one. The batch is also capped by "
+        "--limit-worker-concurrency, which FastChat applies before requests reach the batch.",
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -335,5 +603,6 @@ if __name__ == "__main__":
         args.device,
         args.no_register,
         args.trust_remote_code,
+        max_batch_size=args.max_batch_size,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -188,12 +188,77 @@ def convert_gptq(module, awq=False, llm_awq=False):
     return ggml_weight
 
 
+class _ParallelQuantizer:
+    """Quantize the weights of low-bit linears on a thread pool.
+
+    The ggml quantization calls release the GIL, so layers are quantized
+    concurrently. Every weight being quantized holds a temporary fp32 copy,
+    so at most `max_inflight_bytes` of them are alive at the same time.
+    """
+
+    def __init__(self, num_threads, max_inflight_bytes):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=num_threads,
+                                           thread_name_prefix="ipex_llm_quantize")
+        self.max_inflight_bytes = max_inflight_bytes
+        # (future, bytes of the fp32 copy)
+        self.futures = []
+        self.inflight_bytes = 0
+
+    @classmethod
+    def create(cls):
+        # BIGDL_LLM_QUANTIZE_THREADS=1 quantizes layer by layer as before
+        num_threads = int(os.environ.get("BIGDL_LLM_QUANTIZE_THREADS", "0"))
+        if num_threads <= 0:
+            num_threads = min(os.cpu_count() or 1, 16)
+        if num_threads == 1:
+            return None
+        # size of the fp32 copies of the weights being quantized at once
+        max_inflight_mb = int(os.environ.get("BIGDL_LLM_QUANTIZE_MEMORY_MB", "1024"))
+        return cls(num_threads, max_inflight_mb << 20)
+
+    def _pop(self, index=0):
+        future, nbytes = self.futures.pop(index)
+        self.inflight_bytes -= nbytes
+        return future
+
+    def submit(self, params):
+        # drop finished futures, re-raising their exceptions early
+        for i in reversed(range(len(self.futures))):
+            if self.futures[i][0].done():
+                self._pop(i).result()
+        nbytes = params.numel() * 4
+        # a weight larger than the limit is quantized alone
+        while len(self.futures) > 0 and \
+                self.inflight_bytes + nbytes > self.max_inflight_bytes:
+            self._pop().result()
+        self.futures.append((self.executor.submit(params.quantize, "cpu"), nbytes))
+        self.inflight_bytes += nbytes
+
+    def wait(self):
+        """
+        Wait for all weights to be quantized without raising their exceptions, so that
+        they don't replace an exception already being raised by the caller.
+
+        :return: the first future failed to quantize, call its `result()` to re-raise
+                 the exception, or None if all weights are quantized.
+        """
+        failed = None
+        for future, _ in self.futures:
+            if future.exception() is not None and failed is None:
+                failed = future
+        self.futures = []
+        self.inflight_bytes = 0
+        self.executor.shutdown(wait=True)
+        return failed
+
+
 def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  convert_shape_only=False,
                                  cpu_embedding=False, prefix_name='',
                                  imatrix_data=None, embedding_qtype=None,
                                  model_type=None, torch_dtype=torch.float32,
-                                 enable_xetla=False):
+                                 enable_xetla=False, quantizer=None):
     from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
         FP16Linear, BF16Linear
     from ipex_llm.transformers.embedding import LLMEmbedding, LowBitEmbedding
@@ -273,7 +338,12 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                              qtype=cur_qtype,
                                              imatrix=cur_imatrix,
                                              in_features=in_features,
-                                             enable_xetla=enable_xetla).to(device)
+                                             enable_xetla=enable_xetla)
+                    if quantizer is not None and device.type == "cpu":
+                        # quantized in place by `FP4Params.quantize` on the pool
+                        quantizer.submit(paramsLowBit)
+                    else:
+                        paramsLowBit = paramsLowBit.to(device)
                     new_linear._parameters['weight'] = paramsLowBit
                     if module.bias is not None:
                         new_linear._parameters['bias'] = nn.Parameter(module.bias.data)\
@@ -381,6 +451,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                 model_type=model_type,
                 torch_dtype=torch_dtype,
                 enable_xetla=enable_xetla,
+                quantizer=quantizer,
             )
             has_been_replaced = _flag or has_been_replaced
     return model, has_been_replaced
@@ -525,6 +596,40 @@ def replace_with_low_bit_linear_for_module(model, qtype, module_name=None,
     return model
 
 
+def replace_with_quantized_linear_for_module(model, qtype, module_name, qweight):
+    """
+    Replace the linear owning the weight `module_name` with a LowBitLinear using `qweight`,
+    which is already quantized in the ggml block layout of `qtype`, e.g. read from a gguf file.
+    """
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params
+
+    parent_name, _, child_name = module_name[:-len(".weight")].rpartition(".")
+    parent_module = model.get_submodule(parent_name)
+    module = getattr(parent_module, child_name)
+    _, (in_features, out_features, mp_group) = is_linear_module(module)
+    with init_empty_weights():
+        new_linear = LowBitLinear(
+            in_features,
+            out_features,
+            qtype,
+            module.bias is not None,
+            mp_group=mp_group,
+        )
+    new_linear._parameters['weight'] = FP4Params(data=qweight.reshape(-1),
+                                                 requires_grad=False,
+                                                 quantized=True,
+                                                 _shape=(out_features, in_features),
+                                                 qtype=qtype,
+                                                 in_features=in_features)
+    if module.bias is not None:
+        new_linear._parameters['bias'] = module.bias
+    if not module.training:
+        new_linear.eval()
+    parent_module._modules[child_name] = new_linear
+    new_linear.requires_grad_(False)
+    return model
+
+
 def _optimize_pre(model):
     from transformers.modeling_utils import PreTrainedModel
     # All huggingface format models are inherited from `PreTrainedModel`
@@ -657,15 +762,22 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
         model_type = getattr(model.config, "model_type", None)
     else:
         model_type = None
-    model, has_been_replaced = _replace_with_low_bit_linear(
-        model, qtype, modules_to_not_convert,
-        convert_shape_only, cpu_embedding,
-        imatrix_data=imatrix_data,
-        embedding_qtype=embedding_qtype,
-        model_type=model_type,
-        torch_dtype=torch_dtype,
-        enable_xetla=enable_xetla,
-    )
+    quantizer = None if convert_shape_only else _ParallelQuantizer.create()
+    try:
+        model, has_been_replaced = _replace_with_low_bit_linear(
+            model, qtype, modules_to_not_convert,
+            convert_shape_only, cpu_embedding,
+            imatrix_data=imatrix_data,
+            embedding_qtype=embedding_qtype,
+            model_type=model_type,
+            torch_dtype=torch_dtype,
+            enable_xetla=enable_xetla,
+            quantizer=quantizer,
+        )
+    finally:
+        failed = quantizer.wait() if quantizer is not None else None
+    if failed is not None:
+        failed.result()
     if not has_been_replaced:
         warnings.warn(
             "No linear modules were found in "
@@ -877,6 +989,12 @@ def _optimize_post(model, lightweight_bmm=False):
             convert_forward(model,
                             module.ChatGLMModel,
                             chatglm2_model_forward)
+
+            def set_attention_config(sub_module):
+                # the attention uses the fp16 kv cache if the config sets the attention sink
+                if isinstance(sub_module, module.SelfAttention):
+                    sub_module.config = model.config
+            model.apply(set_attention_config)
             convert_forward(model,
                             module.RMSNorm,
                             chatglm_rms_norm_forward)
@@ -1327,4 +1445,12 @@ def _optimize_post(model, lightweight_bmm=False):
                         module.BertEncoder,
                         encoder_forward)
 
+    if model.can_generate() and \
+            type(model).generate is transformers.GenerationMixin.generate:
+        # kv caches of a generation are preallocated for its `max_new_tokens`,
+        # models with their own generate, e.g. qwen, are left as they are
+        import types
+        from ipex_llm.transformers.models.utils import generate_with_kv_cache_length_hint
+        model.generate = types.MethodType(generate_with_kv_cache_length_hint, model)
+
     return model
@@ -18,6 +18,7 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import mmap
 import struct
 import functools
 import torch
@@ -162,6 +163,22 @@ class GGUFTensorInfos:
         self.base_offset = base_offset
 
 
+# GGUF block types quantized the same way as the ipex_llm qtype of the same value:
+# q4_0 (sym_int4), q4_1 (asym_int4), q5_0 (sym_int5), q5_1 (asym_int5) and q8_0 (sym_int8).
+# Their blocks are only passed through if our kernels use blocks of the same size,
+# see `GGUFTensorLoader.can_pass_through`.
+GGUF_PASSTHROUGH_QTYPES = [2, 3, 6, 7, 8]
+
+
+class GGUFQuantizedTensor:
+    """Quantized blocks of a 2D GGUF tensor, laid out as [rows, bytes per row]."""
+
+    def __init__(self, data: torch.Tensor, qtype: int, dims: list):
+        self.data = data
+        self.qtype = qtype
+        self.shape = tuple(dims)
+
+
 class GGUFTensorLoader:
     def __init__(self, fpath: str, tensor_infos: GGUFTensorInfos):
         self.block_ne = {
@@ -193,10 +210,10 @@ class GGUFTensorLoader:
             7: 24,      # q5_1
             8: 34,      # q8_0
             9: 40,      # q8_1
-            10: 0,      # q2_k
-            11: 0,      # q3_k
-            12: 0,      # q4_k
-            13: 0,      # q5_k
+            10: 84,     # q2_k
+            11: 110,    # q3_k
+            12: 144,    # q4_k
+            13: 176,    # q5_k
             14: 210,    # q6_k
             15: 0,      # q8_k
             16: 1,      # i8
@@ -213,10 +230,10 @@ class GGUFTensorLoader:
             7: self.convert_q5_1_tensor,        # q5_1
             8: self.convert_q8_0_tensor,        # q8_0
             9: self.convert_unknown_tensor,     # q8_1
-            10: self.convert_unknown_tensor,    # q2_k
-            11: self.convert_unknown_tensor,    # q3_k
-            12: self.convert_unknown_tensor,    # q4_k
-            13: self.convert_unknown_tensor,    # q5_k
+            10: self.convert_q2_k_tensor,       # q2_k
+            11: self.convert_q3_k_tensor,       # q3_k
+            12: self.convert_q4_k_tensor,       # q4_k
+            13: self.convert_q5_k_tensor,       # q5_k
             14: self.convert_q6_k_tensor,       # q6_k
             15: self.convert_unknown_tensor,    # q8_k
             16: self.convert_unknown_tensor,    # i8
@@ -227,40 +244,55 @@ class GGUFTensorLoader:
         self.fpath = fpath
         self.infos = tensor_infos.infos
         self.base_offset = tensor_infos.base_offset
+        self.buffer = None
+
+    def can_pass_through(self, qtype: int):
+        """Whether the blocks of `qtype` are laid out the same as the blocks of our kernels."""
+        if qtype not in GGUF_PASSTHROUGH_QTYPES:
+            return False
+        # e.g. sym_int4 blocks hold 64 values on CPU, while q4_0 blocks hold 32
+        import ipex_llm.ggml.model.llama.llama_cpp as ggml
+        return ggml.ggml_qk_size(qtype) == self.block_ne[qtype] and \
+            ggml.ggml_type_size(qtype) == self.block_size[qtype]
+
+    def read_tensor(self, ndims: int, dims: list, qtype: int, offset: int):
+        """Return the raw bytes of a tensor as a view of the memory-mapped file."""
+        total_ne = functools.reduce(lambda x, y: x * y, dims)
+        invalidInputError(total_ne % self.block_ne[qtype] == 0,
+                          f"wrong elements num: {dims}")
+
+        size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
+        invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
+
+        if self.buffer is None:
+            with open(self.fpath, 'rb') as f:
+                # pages are shared with the page cache until they are written to
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        tensor = torch.frombuffer(self.buffer, dtype=torch.uint8, count=size,
+                                  offset=self.base_offset + offset)
+        return tensor, size
 
     def __iter__(self):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8).copy()
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                yield name, tensor
-
-    def load_while_process(self, process):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8)
-                tensor = torch.from_numpy(arr)
+        for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
+            tensor, size = self.read_tensor(ndims, dims, qtype, offset)
+            tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
+            yield name, tensor
+
+    def load_while_process(self, process, passthrough=None):
+        """
+        Call `process(name, tensor)` on every tensor of the file.
+
+        :param passthrough: optional function of (name, qtype, dims), for the tensors it
+            returns True, `process` receives their quantized blocks as a `GGUFQuantizedTensor`
+            instead of the dequantized tensor. Only the types `can_pass_through` accepts
+            are passed through, the others are always dequantized.
+        """
+        for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
+            tensor, size = self.read_tensor(ndims, dims, qtype, offset)
+            if passthrough is not None and ndims == 2 and \
+                    self.can_pass_through(qtype) and passthrough(name, qtype, dims):
+                process(name, GGUFQuantizedTensor(tensor.reshape(dims[0], -1), qtype, dims))
+            else:
                 tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
                 process(name, tensor)
 
@@ -341,6 +373,102 @@ class GGUFTensorLoader:
         result = (data * scales).reshape(dims)
         return result
 
+    @staticmethod
+    def _k_quant_scales_min(scales: torch.Tensor):
+        # unpack the 6-bit scales and mins of the 8 sub-blocks of q4_k and q5_k, see
+        # get_scale_min_k4 in https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
+        scales = scales.to(torch.int32)
+        sc = torch.cat([scales[:, 0:4] & 63,
+                        (scales[:, 8:12] & 0xF) | ((scales[:, 0:4] >> 6) << 4)], dim=-1)
+        mn = torch.cat([scales[:, 4:8] & 63,
+                        (scales[:, 8:12] >> 4) | ((scales[:, 4:8] >> 6) << 4)], dim=-1)
+        return sc, mn
+
+    def convert_q2_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q2_K in https://github.com/ggerganov/llama.cpp/blob
+        # /master/ggml-quants.c
+
+        block_size = self.block_size[10]
+        tensor = tensor.reshape((-1, block_size))
+        scales, qs, d, dmin = (tensor[:, :16], tensor[:, 16:80],
+                               tensor[:, 80:82], tensor[:, 82:84])
+        d = d.clone().view(torch.half).float()
+        dmin = dmin.clone().view(torch.half).float()
+        # [blocks, 2 halves, 4 shifts, 32 values] with 16 values sharing a scale
+        shift = torch.arange(0, 8, 2, dtype=torch.uint8).reshape(1, 1, 4, 1)
+        data = (qs.reshape(-1, 2, 1, 32) >> shift) & 3
+        data = data.reshape(-1, 16, 16).float()
+        sc = (scales & 0xF).float().unsqueeze(-1)
+        mn = (scales >> 4).float().unsqueeze(-1)
+        result = d.unsqueeze(-1) * sc * data - dmin.unsqueeze(-1) * mn
+        return result.reshape(dims)
+
+    def convert_q3_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q3_K in https://github.com/ggerganov/llama.cpp/blob
+        # /master/ggml-quants.c
+
+        block_size = self.block_size[11]
+        tensor = tensor.reshape((-1, block_size))
+        hmask, qs, scales, d = (tensor[:, :32], tensor[:, 32:96],
+                                tensor[:, 96:108], tensor[:, 108:110])
+        d = d.clone().view(torch.half).float()
+        # unpack the 16 6-bit scales
+        scales = scales.to(torch.int32)
+        low, high = scales[:, 0:8], scales[:, 8:12]
+        sc = torch.cat([(low[:, 0:4] & 0xF) | ((high & 3) << 4),
+                        (low[:, 4:8] & 0xF) | (((high >> 2) & 3) << 4),
+                        (low[:, 0:4] >> 4) | (((high >> 4) & 3) << 4),
+                        (low[:, 4:8] >> 4) | (((high >> 6) & 3) << 4)], dim=-1) - 32
+        # [blocks, 2 halves, 4 shifts, 32 values], the high bit of the value at
+        # (half, shift, l) is bit (half * 4 + shift) of hmask[l]
+        shift = torch.arange(0, 8, 2, dtype=torch.uint8).reshape(1, 1, 4, 1)
+        low_bits = ((qs.reshape(-1, 2, 1, 32) >> shift) & 3).to(torch.int8)
+        bit = torch.arange(0, 8, dtype=torch.uint8).reshape(1, 2, 4, 1)
+        high_bits = ((hmask.reshape(-1, 1, 1, 32) >> bit) & 1).to(torch.int8)
+        data = (low_bits - 4 * (1 - high_bits)).reshape(-1, 16, 16).float()
+        result = d.unsqueeze(-1) * sc.float().unsqueeze(-1) * data
+        return result.reshape(dims)
+
+    def convert_q4_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q4_K in https://github.com/ggerganov/llama.cpp/blob
+        # /master/ggml-quants.c
+
+        block_size = self.block_size[12]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qs = (tensor[:, :2], tensor[:, 2:4],
+                               tensor[:, 4:16], tensor[:, 16:])
+        d = d.clone().view(torch.half).float()
+        dmin = dmin.clone().view(torch.half).float()
+        sc, mn = self._k_quant_scales_min(scales)
+        # [blocks, 4 groups, low/high nibble, 32 values]
+        qs = qs.reshape(-1, 4, 1, 32)
+        data = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape(-1, 8, 32).float()
+        result = d.unsqueeze(-1) * sc.float().unsqueeze(-1) * data \
+            - dmin.unsqueeze(-1) * mn.float().unsqueeze(-1)
+        return result.reshape(dims)
+
+    def convert_q5_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q5_K in https://github.com/ggerganov/llama.cpp/blob
+        # /master/ggml-quants.c
+
+        block_size = self.block_size[13]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qh, qs = (tensor[:, :2], tensor[:, 2:4], tensor[:, 4:16],
+                                   tensor[:, 16:48], tensor[:, 48:])
+        d = d.clone().view(torch.half).float()
+        dmin = dmin.clone().view(torch.half).float()
+        sc, mn = self._k_quant_scales_min(scales)
+        # [blocks, 4 groups, low/high nibble, 32 values], the fifth bit of the
+        # value of sub-block j is bit j of qh
+        qs = qs.reshape(-1, 4, 1, 32)
+        low_bits = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape(-1, 8, 32)
+        bit = torch.arange(0, 8, dtype=torch.uint8).reshape(1, 8, 1)
+        high_bits = ((qh.reshape(-1, 1, 32) >> bit) & 1) << 4
+        data = (low_bits | high_bits).float()
+        result = d.unsqueeze(-1) * sc.float().unsqueeze(-1) * data \
+            - dmin.unsqueeze(-1) * mn.float().unsqueeze(-1)
+        return result.reshape(dims)
+
     def convert_q6_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         # see https://github.com/ggerganov/llama.cpp/blob
         # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2263
@@ -21,9 +21,10 @@ from accelerate.utils import set_module_tensor_to_device
 from tempfile import NamedTemporaryFile
 from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
 
-from ..gguf import GGUFFileLoader
+from ..gguf import GGUFFileLoader, GGUFQuantizedTensor
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
-from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
+from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module, \
+    replace_with_quantized_linear_for_module
 
 
 def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
@@ -57,30 +58,38 @@ def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
     def process_llama(name, tensor):
         nonlocal model
         module_name = get_llama_module_name(name)
+        is_quantized = isinstance(tensor, GGUFQuantizedTensor)
+        if is_quantized:
+            # rows of quantized blocks are reordered the same as rows of values
+            tensor = tensor.data
         if 'q_proj' in module_name:
             # gguf weight needs to reshape for q_proj
             head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
+            tensor = tensor.reshape(n_head, head // n_head // 2, 2, *hd_size) \
+                .swapaxes(1, 2) \
+                .reshape(tensor.shape)
         elif 'k_proj' in module_name:
             # gguf weight needs to reshape for k_proj
             head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head_kv,
-                                                       head // n_head_kv // 2,
-                                                       2,
-                                                       *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
+            tensor = tensor.reshape(n_head_kv, head // n_head_kv // 2, 2, *hd_size) \
+                .swapaxes(1, 2) \
+                .reshape(tensor.shape)
+        if is_quantized:
+            model = replace_with_quantized_linear_for_module(model, qtype, module_name, tensor)
         else:
             set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
-        model = replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
+            model = replace_with_low_bit_linear_for_module(model, qtype=qtype,
+                                                           module_name=module_name)
+
+    def passthrough_llama(name, gguf_qtype, dims):
+        # linear weights already quantized to the target qtype are used without dequantization,
+        # our kernels require in_features to be a multiple of 64
+        module_name = get_llama_module_name(name)
+        return gguf_qtype == qtype and dims[1] % 64 == 0 and module_name is not None and \
+            module_name.endswith(("_proj.weight", "lm_head.weight"))
+
     tensor_loader = loader.tensor_loader
-    tensor_loader.load_while_process(process_llama)
+    tensor_loader.load_while_process(process_llama, passthrough=passthrough_llama)
 
     # see https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
     from transformers.convert_slow_tokenizer import import_protobuf
@@ -17,11 +17,122 @@
 
 import torch
 
-from .models.utils import init_fp8_kv_cache, append_fp8_kv_cache
+from .models.utils import init_fp8_kv_cache, append_fp8_kv_cache, update_kv_cache
+from .models.utils import get_attention_sink_window, get_attention_sink_evict_length, \
+    evict_kv_cache, shift_rotary_keys, trim_attention_sink_mask
 from typing import Optional, Dict, Tuple, Any
 from transformers.cache_utils import DynamicCache
 
 
+class DynamicNormalCache(DynamicCache):
+    """
+    A DynamicCache whose layers are preallocated and appended in place.
+
+    The caches are allocated for the `max_new_tokens` of the generation if it is known,
+    and otherwise reallocated with a geometrically growing length, see `update_kv_cache`.
+    """
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+
+        # Update the cache
+        if len(self.key_cache) <= layer_idx:
+            k_cache, v_cache = update_kv_cache(None, None, key_states, value_states)
+            self.key_cache.append(k_cache)
+            self.value_cache.append(v_cache)
+        else:
+            k_cache, v_cache = update_kv_cache(self.key_cache[layer_idx],
+                                               self.value_cache[layer_idx],
+                                               key_states, value_states)
+            self.key_cache[layer_idx] = k_cache
+            self.value_cache[layer_idx] = v_cache
+
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values=None) -> "DynamicNormalCache":
+        cache = cls()
+        if past_key_values is not None:
+            # the legacy caches are kept as they are, and only reallocated
+            # when they have no room for new tokens
+            for key_states, value_states in past_key_values:
+                cache.key_cache.append(key_states)
+                cache.value_cache.append(value_states)
+            if len(cache.key_cache) > 0:
+                cache.seen_tokens = cache.key_cache[0].shape[-2]
+        return cache
+
+
+def evict_attention_sink_cache(
+    model,
+    past_key_values: DynamicCache,
+    attention_mask: Optional[torch.Tensor],
+    position_ids: Optional[torch.LongTensor],
+    seq_length: int,
+):
+    """
+    Evict the kv cache of a llama-like decoder model before its forward, if the attention
+    sink is enabled by `from_pretrained`. The first `sink_size` tokens and the most recent
+    `window_size` tokens are kept (https://arxiv.org/abs/2309.17453), and the cached keys
+    are re-rotated to their positions in the cache.
+
+    :param model: the decoder model, e.g. a `LlamaModel`.
+    :param past_key_values: the cache to evict in place.
+    :param attention_mask: the 2D attention mask of all the seen and new tokens, or None.
+    :param position_ids: the positions of the new tokens among all the seen tokens, or None.
+    :param seq_length: number of the new tokens.
+    :return: the attention mask and position ids of the evicted cache and the new tokens.
+    """
+    attention_sink = get_attention_sink_window(model.config)
+    if attention_sink is None or past_key_values is None:
+        return attention_mask, position_ids
+    if len(past_key_values.key_cache) == 0:
+        return attention_mask, position_ids
+    sink_size, window_size = attention_sink
+
+    cache_length = past_key_values.get_seq_length()
+    if attention_mask is not None and attention_mask.dim() == 2:
+        # the caller may have counted only the cached tokens as seen
+        num_evicted = attention_mask.size(-1) - seq_length - cache_length
+    else:
+        num_evicted = past_key_values.seen_tokens - cache_length
+
+    num_to_evict = get_attention_sink_evict_length(cache_length, seq_length,
+                                                   sink_size, window_size)
+    if num_to_evict > 0:
+        rotary_emb = model.layers[0].self_attn.rotary_emb
+        inv_freq = rotary_emb.inv_freq
+        rope_scaling = getattr(model.config, "rope_scaling", None)
+        if rope_scaling is not None and rope_scaling.get("type", None) == "linear":
+            inv_freq = inv_freq / rope_scaling["factor"]
+        angles = inv_freq.float() * num_to_evict
+        cos, sin = angles.cos(), angles.sin()
+
+        def rotate_fn(keys, shift):
+            return shift_rotary_keys(keys, cos.to(keys.device), sin.to(keys.device))
+
+        for idx in range(len(past_key_values.key_cache)):
+            past_key_values.key_cache[idx] = evict_kv_cache(past_key_values.key_cache[idx],
+                                                            sink_size, num_to_evict, rotate_fn)
+            past_key_values.value_cache[idx] = evict_kv_cache(past_key_values.value_cache[idx],
+                                                              sink_size, num_to_evict)
+        num_evicted += num_to_evict
+
+    if num_evicted > 0:
+        attention_mask = trim_attention_sink_mask(attention_mask, sink_size, num_evicted)
+        if position_ids is not None:
+            position_ids = position_ids - num_evicted
+    return attention_mask, position_ids
+
+
 class DynamicFp8Cache(DynamicCache):
     def update(
         self,
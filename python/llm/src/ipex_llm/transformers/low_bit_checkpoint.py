@@ -0,0 +1,195 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A native container for low-bit checkpoints which can be memory-mapped.
+#
+# Layout of the file:
+#   magic (8 bytes) | header length (8 bytes, little-endian) | JSON header |
+#   padding | tensor data, every tensor starting at a page aligned offset.
+#
+# The header maps every state dict key to the dtype, shape, offset and size of
+# its data, as well as the qtype and logical shape of quantized weights.
+# The data is stored uncompressed, so loading only maps the file and wraps
+# every tensor around the mapped bytes with `torch.frombuffer`.
+
+import json
+import mmap
+import os
+import struct
+
+import torch
+
+from ipex_llm.utils.common import invalidInputError
+from .low_bit_linear import FP4Params
+from .utils import logger
+
+LOW_BIT_WEIGHTS_NAME = "bigdl_low_bit_model.bin"
+LOW_BIT_MAGIC = b"BIGDLLB1"
+LOW_BIT_VERSION = 1
+ALIGNMENT = mmap.PAGESIZE
+
+_DTYPE_TO_STR = {
+    torch.float32: "float32",
+    torch.float16: "float16",
+    torch.bfloat16: "bfloat16",
+    torch.float64: "float64",
+    torch.uint8: "uint8",
+    torch.int8: "int8",
+    torch.int16: "int16",
+    torch.int32: "int32",
+    torch.int64: "int64",
+    torch.bool: "bool",
+}
+_STR_TO_DTYPE = {v: k for k, v in _DTYPE_TO_STR.items()}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_low_bit_checkpoint(state_dict, save_directory):
+    """Write `state_dict` of a low-bit model to `save_directory`."""
+    tensors = {}
+    entries = []
+    # Tied weights share their data in the file.
+    offsets = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        invalidInputError(tensor.dtype in _DTYPE_TO_STR,
+                          f"Unsupported dtype {tensor.dtype} of {name} in low-bit checkpoint.")
+        qtype = getattr(tensor, "qtype", None)
+        shape = getattr(tensor, "_shape", None)
+        tensor = tensor.detach().cpu()
+        nbytes = tensor.numel() * tensor.element_size()
+        storage_key = (tensor.data_ptr(), nbytes, tensor.dtype)
+        info = {
+            "dtype": _DTYPE_TO_STR[tensor.dtype],
+            "shape": list(tensor.shape),
+            "nbytes": nbytes,
+        }
+        if qtype is not None:
+            info["qtype"] = qtype
+            info["_shape"] = list(shape) if shape is not None else None
+        if nbytes > 0 and storage_key in offsets:
+            info["offset"] = offsets[storage_key]
+        else:
+            info["offset"] = offset
+            offsets[storage_key] = offset
+            entries.append((offset, tensor))
+            offset = _align(offset + nbytes)
+        tensors[name] = info
+
+    header = json.dumps({"version": LOW_BIT_VERSION,
+                         "alignment": ALIGNMENT,
+                         "tensors": tensors}).encode("utf-8")
+    data_start = _align(len(LOW_BIT_MAGIC) + 8 + len(header))
+
+    path = os.path.join(save_directory, LOW_BIT_WEIGHTS_NAME)
+    with open(path, "wb") as f:
+        f.write(LOW_BIT_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for tensor_offset, tensor in entries:
+            f.seek(data_start + tensor_offset)
+            if tensor.numel() > 0:
+                data = tensor.data.contiguous().reshape(-1).view(torch.uint8)
+                f.write(memoryview(data.numpy()))
+        f.truncate(data_start + offset)
+    return path
+
+
+def load_low_bit_checkpoint(checkpoint_file):
+    """Map a low-bit checkpoint and return its tensors without copying them.
+
+    :return: a dict mapping every key to a tuple of the tensor and its qtype
+             and logical shape, both None for tensors which are not quantized.
+    """
+    with open(checkpoint_file, "rb") as f:
+        magic = f.read(len(LOW_BIT_MAGIC))
+        invalidInputError(magic == LOW_BIT_MAGIC,
+                          f"{checkpoint_file} is not a low-bit checkpoint.")
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        invalidInputError(header["version"] <= LOW_BIT_VERSION,
+                          f"Unsupported low-bit checkpoint version {header['version']}, "
+                          "please upgrade ipex-llm.")
+        # A private mapping shares the page cache with every process loading
+        # this file, and pages are only copied if a tensor is written to.
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = len(LOW_BIT_MAGIC) + 8 + header_len
+    data_start = (data_start + header["alignment"] - 1) // header["alignment"] \
+        * header["alignment"]
+    result = {}
+    for name, info in header["tensors"].items():
+        dtype = _STR_TO_DTYPE[info["dtype"]]
+        if info["nbytes"] == 0:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(buffer, dtype=torch.uint8, count=info["nbytes"],
+                                      offset=data_start + info["offset"])
+            tensor = tensor.view(dtype).reshape(info["shape"])
+        result[name] = (tensor, info.get("qtype", None), info.get("_shape", None))
+    return result
+
+
+def get_low_bit_checkpoint_dtype(checkpoint_file):
+    """Return the dtype of the first floating point tensor of a low-bit checkpoint."""
+    with open(checkpoint_file, "rb") as f:
+        f.seek(len(LOW_BIT_MAGIC))
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    for info in header["tensors"].values():
+        if "qtype" not in info and _STR_TO_DTYPE[info["dtype"]].is_floating_point:
+            return _STR_TO_DTYPE[info["dtype"]]
+    return torch.float32
+
+
+def load_low_bit_state_dict_into_model(model, checkpoint_file):
+    """Point the parameters and buffers of `model` at the mapped checkpoint.
+
+    `model` is expected to be converted by `ggml_convert_low_bit` already,
+    its parameters may be on the meta device.
+    """
+    state_dict = load_low_bit_checkpoint(checkpoint_file)
+    for name, (tensor, qtype, shape) in state_dict.items():
+        module_name, _, attr = name.rpartition(".")
+        try:
+            module = model.get_submodule(module_name)
+        except AttributeError:
+            logger.warning(f"Unexpected key {name} in low-bit checkpoint.")
+            continue
+        if attr in module._parameters:
+            old_param = module._parameters[attr]
+            if isinstance(old_param, FP4Params):
+                # The qtype of mixed-precision (mixed_fp4/mixed_fp8) weights is
+                # only decided at quantization, so the saved one takes priority.
+                new_param = FP4Params(data=tensor,
+                                      requires_grad=False,
+                                      quantized=True,
+                                      _shape=tuple(shape) if shape is not None
+                                      else old_param._shape,
+                                      qtype=qtype if qtype is not None
+                                      else old_param.qtype,
+                                      in_features=old_param.in_features,
+                                      enable_xetla=old_param.enable_xetla)
+            else:
+                new_param = torch.nn.Parameter(tensor, requires_grad=False)
+            module._parameters[attr] = new_param
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+        else:
+            logger.warning(f"Unexpected key {name} in low-bit checkpoint.")
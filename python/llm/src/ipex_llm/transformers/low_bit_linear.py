@@ -44,6 +44,9 @@
 from typing import Optional, TypeVar, Union, overload
 from ipex_llm.utils.common import invalidInputError
 import os
+import threading
+import weakref
+from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 from torch import Tensor, device, dtype, nn
@@ -60,6 +63,9 @@ import ctypes
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 
 TORCH_LINEAR_THRESHOLD = int(os.getenv("BIGDL_LLM_LINEAR_THRESHOLD", "512"))
+# Memory budget (MB) of the dequantized weight cache, 0 disables it.
+DEQUANT_CACHE_MB = int(os.getenv("BIGDL_LLM_DEQUANT_CACHE_MB", "0"))
+DEQUANT_CACHE_BF16 = os.getenv("BIGDL_LLM_DEQUANT_CACHE_BF16", "0") == "1"
 SYM_INT4 = ggml_tensor_qtype["sym_int4"]
 ASYM_INT4 = ggml_tensor_qtype["asym_int4"]
 SYM_INT8 = ggml_tensor_qtype["sym_int8"]
@@ -484,6 +490,96 @@ class MatMulLowBit(torch.autograd.Function):
         return grad_A, grad_weight, None
 
 
+class DequantWeightCache:
+    """LRU cache of the dequantized weights of CPU int4 linears.
+
+    Large-batch int4 linears on CPU dequantize their whole weight on every call.
+    With this cache, a layer is dequantized once and kept until the budget is
+    exceeded, evicting the least recently used layers first. Weights can be
+    stored in bf16 to halve the memory, at the cost of an upcast per call.
+    """
+
+    def __init__(self, budget_bytes: int = 0, use_bf16: bool = False):
+        self.budget_bytes = budget_bytes
+        self.dtype = torch.bfloat16 if use_bf16 else torch.float32
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Mapping: id(layer) -> (weak reference to layer, weight data_ptr, weight).
+        self._entries = OrderedDict()
+        # Reentrant, as the weakref callback may run from a GC inside the lock.
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0
+
+    def configure(self, budget_mb: int, use_bf16: bool = False):
+        with self._lock:
+            self.budget_bytes = budget_mb * 1024 ** 2
+            self.dtype = torch.bfloat16 if use_bf16 else torch.float32
+            self._clear()
+
+    def get(self, layer, dequantize):
+        """Return the dequantized weight of `layer`, calling `dequantize` on a miss."""
+        key = id(layer)
+        data_ptr = layer.weight.data.data_ptr()
+        with self._lock:
+            entry = self._entries.get(key)
+            # The weight may have been replaced since it was cached.
+            if entry is not None and entry[1] == data_ptr:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        weight = dequantize().to(self.dtype)
+        weight_bytes = weight.numel() * weight.element_size()
+        if weight_bytes > self.budget_bytes:
+            return weight
+        with self._lock:
+            self._pop(key)
+            while self.used_bytes + weight_bytes > self.budget_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.used_bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+            layer_ref = weakref.ref(layer, lambda _, key=key: self.remove(key))
+            self._entries[key] = (layer_ref, data_ptr, weight)
+            self.used_bytes += weight_bytes
+        return weight
+
+    def remove(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry[2].numel() * entry[2].element_size()
+
+    def _clear(self):
+        self._entries.clear()
+        self.used_bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "num_layers": len(self._entries),
+                "used_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+            }
+
+
+dequant_weight_cache = DequantWeightCache(DEQUANT_CACHE_MB * 1024 ** 2, DEQUANT_CACHE_BF16)
+
+
 class MatMulLowBitCPU(torch.autograd.Function):
 
     @staticmethod
@@ -651,7 +747,16 @@ class LowBitLinear(nn.Linear):
                 # convert if necessary, and compute a linear result
                 if is_server() and (not is_spr()) and \
                         self.qtype == SYM_INT4 and x_2d.shape[0] >= TORCH_LINEAR_THRESHOLD:
-                    x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape, self.weight_length)
+                    if dequant_weight_cache.enabled:
+                        x0_fp32 = dequant_weight_cache.get(
+                            self,
+                            lambda: ggml_int4_convert_fp32(x0, self.weight_shape,
+                                                           self.weight_length))
+                        if x0_fp32.dtype != torch.float32:
+                            x0_fp32 = x0_fp32.float()
+                    else:
+                        x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape,
+                                                         self.weight_length)
                     result = F.linear(x, x0_fp32)
                 else:
                     # Weight does not need a convert
@@ -48,6 +48,7 @@ from ipex_llm.transformers.gguf.api import load_gguf_model
 import torch
 import warnings
 import copy
+import os
 from .utils import logger
 
 patched_training_mode = None
@@ -64,11 +65,24 @@ def save_low_bit(self, *args, **kwargs):
     origin_device = self.device
     self.to('cpu')
 
+    # Save in the native low-bit format, which load_low_bit could memory-map
+    # instead of deserializing, so processes loading it share the page cache.
+    mmap_format = kwargs.pop('mmap_format', False)
     kwargs['safe_serialization'] = False
 
     architectures = getattr(self.config, "architectures", None)
     model_type = getattr(self.config, "model_type", None)
-    self.save_pretrained(*args, **kwargs)
+    from .low_bit_checkpoint import LOW_BIT_WEIGHTS_NAME, save_low_bit_checkpoint
+    if mmap_format:
+        os.makedirs(args[0], exist_ok=True)
+        save_low_bit_checkpoint(self.state_dict(), args[0])
+    else:
+        self.save_pretrained(*args, **kwargs)
+        # load_low_bit prefers the memory-mapped format, so a file of it left by
+        # an earlier save to the same directory would shadow the weights saved now
+        low_bit_checkpoint_file = os.path.join(args[0], LOW_BIT_WEIGHTS_NAME)
+        if os.path.isfile(low_bit_checkpoint_file):
+            os.remove(low_bit_checkpoint_file)
 
     if architectures:
         self.config.update({"architectures": architectures})
@@ -80,7 +94,6 @@ def save_low_bit(self, *args, **kwargs):
         self.generation_config.save_pretrained(args[0])
 
     import json
-    import os
     # We conveniently save all the keys of the model to have them on hand,
     # so that when using 'low_cpumem load',
     # it's not necessary to load the entire model to extract its keys
@@ -98,6 +111,39 @@ def _load_pre():
     GPTJModel.__init__ = gptj_model_new_init
 
 
+def _set_attention_sink(model, attention_sink_size, attention_window_size, optimize_model):
+    if attention_window_size is None:
+        # a saved low-bit model may have been loaded with the attention sink
+        if getattr(model.config, "bigdl_attention_window_size", None) is not None:
+            model.config.update({"bigdl_attention_window_size": None})
+        return
+
+    invalidInputError(attention_window_size > 0 and attention_sink_size >= 0,
+                      "`attention_window_size` should be positive and `attention_sink_size` "
+                      f"non-negative, but got {attention_window_size} and {attention_sink_size}.")
+    invalidInputError(optimize_model,
+                      "The attention sink is only supported with `optimize_model=True`.")
+    if os.environ.get("BIGDL_QUANTIZE_KV_CACHE", None) == "1":
+        warnings.warn("The attention sink doesn't support the fp8 kv cache, "
+                      "BIGDL_QUANTIZE_KV_CACHE=1 is ignored and the fp16 kv cache is used.")
+    from packaging import version
+    model_type = model.config.model_type
+    if model_type in ["llama", "mistral", "qwen2"]:
+        supported = version.parse(transformers.__version__) >= version.parse("4.36.0")
+    elif model_type == "chatglm":
+        # chatglm2-6b and chatglm3-6b, but not their 32k versions
+        supported = getattr(model.config, "padded_vocab_size", None) == 65024 and \
+            not hasattr(model.config, "rope_ratio")
+    else:
+        supported = False
+    invalidInputError(supported,
+                      f"The attention sink is not supported for {model_type} with transformers "
+                      f"{transformers.__version__}, it supports llama, mistral and qwen2 with "
+                      "transformers >= 4.36.0, and chatglm2/chatglm3.")
+    model.config.update({"bigdl_attention_sink_size": attention_sink_size,
+                         "bigdl_attention_window_size": attention_window_size})
+
+
 class _BaseAutoModelClass:
     HF_MODEL = None
 
@@ -128,6 +174,10 @@ class _BaseAutoModelClass:
                                        conducting model optimizations. Default to be ``None``.
         :param speculative: boolean value, Whether to use speculative decoding.
                             Default to be ``False``.
+        :param prompt_lookup: boolean value, Whether to use speculative decoding with drafts
+                              looked up from the prompt and generated tokens (n-gram matching)
+                              instead of a draft model, which takes no extra memory.
+                              Default to be ``False``.
         :param cpu_embedding: Whether to replace the Embedding layer, may need to set it
             to ``True`` when running BigDL-LLM on GPU on Windows. Default to be ``False``.
         :param lightweight_bmm: Whether to replace the torch.bmm ops, may need to set it
@@ -139,6 +189,19 @@ class _BaseAutoModelClass:
             specify the model hub. Default to be ``'huggingface'``.
         :param embedding_qtype: str value, options are ``'q2_k'`` now. Default to be None.
             Relevant low bit optimizations will be applied to nn.Embedding layer.
+        :param streaming_load: boolean value, Whether to quantize a local checkpoint one tensor
+            at a time while reading it, so that the full-precision model is never held in memory.
+            Models which can't be loaded this way fall back to the default load.
+            Default to be ``False``.
+        :param attention_window_size: int value, Enable the attention sink (StreamingLLM) kv
+            cache, which only keeps the first ``attention_sink_size`` tokens and the most recent
+            ``attention_window_size`` tokens, so the kv cache memory and per-token latency
+            are bounded in long generations. It supports llama, mistral, qwen2
+            (transformers >= 4.36.0) and chatglm2/chatglm3 models, and always uses the fp16
+            kv cache instead of the fp8 one.
+            Default to be ``None``, which keeps all the tokens.
+        :param attention_sink_size: int value, Number of the initial tokens always kept in the
+            kv cache if ``attention_window_size`` is set. Default to be ``4``.
         :return: a model instance
         """
         pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path", None) \
@@ -172,8 +235,11 @@ class _BaseAutoModelClass:
         optimize_model = kwargs.pop("optimize_model", True)
         user_quantization_config = kwargs.pop("quantization_config", None)
         speculative = kwargs.pop("speculative", False)
+        prompt_lookup = kwargs.pop("prompt_lookup", False)
         torch_dtype = kwargs.pop("torch_dtype", None)
         embedding_qtype = kwargs.pop("embedding_qtype", None)
+        attention_sink_size = kwargs.pop("attention_sink_size", 4)
+        attention_window_size = kwargs.pop("attention_window_size", None)
 
         if user_quantization_config is not None and \
                 "BitsAndBytesConfig" in str(user_quantization_config.__class__):
@@ -318,18 +384,27 @@ class _BaseAutoModelClass:
                 kwargs["imatrix_data"] = imatrix_data
             kwargs["embedding_qtype"] = embedding_qtype
             model = cls.load_convert(q_k, optimize_model, *args, **kwargs)
+            _set_attention_sink(model, attention_sink_size, attention_window_size,
+                                optimize_model)
 
-            if speculative:
+            if speculative or prompt_lookup:
                 from .speculative import speculative_generate, clear_benchmarks
-                # load a sym_int4 model as draft model
-                draft_model = cls.load_convert('sym_int4', optimize_model, *args, **kwargs)
-                model.draft_model = draft_model
+                if speculative:
+                    # load a sym_int4 model as draft model
+                    draft_model = cls.load_convert('sym_int4', optimize_model, *args, **kwargs)
+                    model.draft_model = draft_model
+                else:
+                    # drafts are looked up from the context, no draft model is needed
+                    model.prompt_lookup = True
                 import types
                 # add speculative_generate to pretrained model dynamically
                 model.clear_benchmarks = types.MethodType(clear_benchmarks, model)
                 model.speculative_generate = types.MethodType(speculative_generate, model)
         else:
             # load default
+            invalidInputError(attention_window_size is None,
+                              "The attention sink is only supported with `load_in_4bit` "
+                              "or `load_in_low_bit`.")
             model = cls.HF_Model.from_pretrained(*args, **kwargs)
 
         return model
@@ -380,11 +455,28 @@ class _BaseAutoModelClass:
         if embedding_qtype is not None:
             embedding_qtype = ggml_tensor_qtype[embedding_qtype]
         enable_xetla = kwargs.pop("enable_xetla", False)
+        streaming_load = kwargs.pop("streaming_load", False)
         _args = copy.deepcopy(args)
         _kwargs = copy.deepcopy(kwargs)
         awq_config = None
 
-        if quant_config and quant_config.quant_method == "awq":
+        model = None
+        if streaming_load and quant_config is None:
+            from .streaming_loader import streaming_load_low_bit
+            model = streaming_load_low_bit(cls.HF_Model, qtype, optimize_model, *args,
+                                           modules_to_not_convert=modules_to_not_convert,
+                                           cpu_embedding=cpu_embedding,
+                                           lightweight_bmm=lightweight_bmm,
+                                           imatrix_data=imatrix_data,
+                                           embedding_qtype=embedding_qtype,
+                                           enable_xetla=enable_xetla,
+                                           **kwargs)
+        # weights have been quantized while being loaded
+        is_streaming_loaded = model is not None
+
+        if is_streaming_loaded:
+            pass
+        elif quant_config and quant_config.quant_method == "awq":
             # The latest transformers only support cuda version
             # This load awq ckpt logic is copied from
             # https://github.com/casper-hansen/AutoAWQ/blob/main/awq/models/base.py#L147
@@ -439,14 +531,16 @@ class _BaseAutoModelClass:
                 model = cls.HF_Model.from_pretrained(*_args, **_kwargs)
                 model.config.update({"bigdl_lcmu_enabled": False})
 
-        model = model.to("cpu")
-        model = ggml_convert_low_bit(model, qtype, optimize_model,
-                                     modules_to_not_convert=modules_to_not_convert,
-                                     cpu_embedding=cpu_embedding, lightweight_bmm=lightweight_bmm,
-                                     torch_dtype=kwargs.get("torch_dtype", 'auto'),
-                                     imatrix_data=imatrix_data,
-                                     embedding_qtype=embedding_qtype,
-                                     enable_xetla=enable_xetla,)
+        if not is_streaming_loaded:
+            model = model.to("cpu")
+            model = ggml_convert_low_bit(model, qtype, optimize_model,
+                                         modules_to_not_convert=modules_to_not_convert,
+                                         cpu_embedding=cpu_embedding,
+                                         lightweight_bmm=lightweight_bmm,
+                                         torch_dtype=kwargs.get("torch_dtype", 'auto'),
+                                         imatrix_data=imatrix_data,
+                                         embedding_qtype=embedding_qtype,
+                                         enable_xetla=enable_xetla,)
         model.config.update({"bigdl_transformers_low_bit": q_k})
 
         # enable tie_word_embeddings for MPT
@@ -473,6 +567,12 @@ class _BaseAutoModelClass:
         :param optimize_model: boolean value, Whether to further optimize the low_bit llm model.
                                Default to be True.
 
+        A ckpt saved by ``save_low_bit(path, mmap_format=True)`` is memory-mapped,
+        the low-bit weights are used in place without being copied.
+
+        ``attention_window_size`` and ``attention_sink_size`` enable the attention sink
+        kv cache as in ``from_pretrained``.
+
         :return: a model instance
         """
         from transformers.modeling_utils import no_init_weights, get_state_dict_dtype
@@ -516,6 +616,8 @@ class _BaseAutoModelClass:
         offload_state_dict = kwargs.pop("offload_state_dict", False)
         torch_dtype = kwargs.pop("torch_dtype", "auto")
         embedding_qtype = kwargs.pop("embedding_qtype", None)
+        attention_sink_size = kwargs.pop("attention_sink_size", 4)
+        attention_window_size = kwargs.pop("attention_window_size", None)
         sharded_metadata = None
 
         config_dict, _ = PretrainedConfig.get_config_dict(pretrained_model_name_or_path)
@@ -558,10 +660,18 @@ class _BaseAutoModelClass:
         elif type(config) in cls.HF_Model._model_mapping.keys():
             model_class = _get_model_class(config, cls.HF_Model._model_mapping)
 
-        resolved_archive_file, is_sharded = extract_local_archive_file(
-            pretrained_model_name_or_path,
-            subfolder,
-            variant)
+        from .low_bit_checkpoint import LOW_BIT_WEIGHTS_NAME, get_low_bit_checkpoint_dtype, \
+            load_low_bit_state_dict_into_model
+        low_bit_checkpoint_file = os.path.join(pretrained_model_name_or_path, subfolder,
+                                               LOW_BIT_WEIGHTS_NAME)
+        use_mmap_format = os.path.isfile(low_bit_checkpoint_file)
+        if use_mmap_format:
+            resolved_archive_file, is_sharded = low_bit_checkpoint_file, False
+        else:
+            resolved_archive_file, is_sharded = extract_local_archive_file(
+                pretrained_model_name_or_path,
+                subfolder,
+                variant)
 
         if is_sharded:
             resolved_archive_file, sharded_metadata = \
@@ -586,6 +696,8 @@ class _BaseAutoModelClass:
                     else:
                         if is_sharded and "dtype" in sharded_metadata:
                             torch_dtype = sharded_metadata["dtype"]
+                        elif use_mmap_format:
+                            torch_dtype = get_low_bit_checkpoint_dtype(resolved_archive_file)
                         else:
                             one_state_dict = load_state_dict(resolved_archive_file[0])
                             torch_dtype = get_state_dict_dtype(one_state_dict)
@@ -625,7 +737,7 @@ class _BaseAutoModelClass:
 
         if is_sharded:
             loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
-        else:
+        elif not use_mmap_format:
             import os
             import json
             with open(os.path.join(pretrained_model_name_or_path,
@@ -637,31 +749,41 @@ class _BaseAutoModelClass:
         if dtype_orig is not None:
             torch.set_default_dtype(dtype_orig)
 
-        (
-            model,
-            missing_keys,
-            unexpected_keys,
-            mismatched_keys,
-            offload_index,
-            error_msgs,
-        ) = model_class._load_pretrained_model(
-            model,
-            None,
-            loaded_state_dict_keys,  # XXX: rename?
-            resolved_archive_file,
-            pretrained_model_name_or_path,
-            sharded_metadata=sharded_metadata,
-            _fast_init=_fast_init,
-            low_cpu_mem_usage=bigdl_lcmu_enabled,
-            offload_folder=offload_folder,
-            offload_state_dict=offload_state_dict,
-            dtype=torch_dtype,
-            keep_in_fp32_modules=[],
-        )
+        if use_mmap_format:
+            load_low_bit_state_dict_into_model(model, resolved_archive_file)
+        else:
+            (
+                model,
+                missing_keys,
+                unexpected_keys,
+                mismatched_keys,
+                offload_index,
+                error_msgs,
+            ) = model_class._load_pretrained_model(
+                model,
+                None,
+                loaded_state_dict_keys,  # XXX: rename?
+                resolved_archive_file,
+                pretrained_model_name_or_path,
+                sharded_metadata=sharded_metadata,
+                _fast_init=_fast_init,
+                low_cpu_mem_usage=bigdl_lcmu_enabled,
+                offload_folder=offload_folder,
+                offload_state_dict=offload_state_dict,
+                dtype=torch_dtype,
+                keep_in_fp32_modules=[],
+            )
 
         # make sure token embedding weights are still tied if needed
         model.tie_weights()
 
+        if use_mmap_format:
+            # tied weights are only restored by tie_weights
+            missing_keys = [name for name, param in model.named_parameters()
+                            if param.device.type == "meta"]
+            invalidInputError(len(missing_keys) == 0,
+                              f"Weights of {missing_keys} are missing in {resolved_archive_file}.")
+
         # Set model in evaluation mode to deactivate DropOut modules by default
         model.eval()
 
@@ -681,6 +803,7 @@ class _BaseAutoModelClass:
         # rwkv model linear layers has been rescaled
         if model.config.model_type == "rwkv":
             model.rwkv.layers_are_rescaled = True
+        _set_attention_sink(model, attention_sink_size, attention_window_size, optimize_model)
         return model
 
 
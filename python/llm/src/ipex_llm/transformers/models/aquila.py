@@ -42,14 +42,13 @@ import torch
 import torch.utils.checkpoint
 from torch import nn
 
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import extend_kv_cache, init_kv_cache, \
     append_kv_cache, is_enough_kv_cache_room_4_31
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb_no_cache_xpu
 from ipex_llm.utils.common import log4Error
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
 
 def aquila_attention_forward(
     self,
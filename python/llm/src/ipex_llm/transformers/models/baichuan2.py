@@ -24,6 +24,7 @@ import torch
 import torch.utils.checkpoint
 from torch.nn import functional as F
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_fp8_kv_cache, append_fp8_kv_cache, \
     restore_fp8_kv_cache, use_quantize_kv_cache
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, \
@@ -45,9 +46,6 @@ except ImportError:
     )
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def baichuan_13b_rms_norm_forward(self, hidden_states):
     if hidden_states.device.type == "xpu" and not (self.training and hidden_states.requires_grad):
         import linear_q4_0
@@ -37,13 +37,11 @@ from typing import Optional, Tuple
 import torch
 import torch.utils.checkpoint
 from torch.nn import functional as F
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import use_fused_layer_norm
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def dropout_add(x: torch.Tensor, residual: torch.Tensor, prob: float, training: bool):
     """
     Dropout add function
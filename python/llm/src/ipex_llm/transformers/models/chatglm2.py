@@ -22,13 +22,15 @@ import torch
 from typing import Optional, Tuple, List
 import torch.nn.functional as F
 from transformers.modeling_outputs import BaseModelOutputWithPast
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import init_fp8_kv_cache, append_fp8_kv_cache, \
     restore_fp8_kv_cache, use_quantize_kv_cache
 from ipex_llm.transformers.models.utils import use_esimd_sdp
+from ipex_llm.transformers.models.utils import get_attention_sink_window, \
+    get_attention_sink_evict_length, evict_kv_cache, shift_rotary_keys, trim_attention_sink_mask
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
 KV_CACHE_ALLOC_MIN_LENGTH = 512
 
 
@@ -134,6 +136,12 @@ def chatglm2_model_forward(
     if inputs_embeds is None:
         inputs_embeds = self.embedding(input_ids)
 
+    # Rotary positional embeddings
+    rotary_pos_emb = self.rotary_pos_emb(self.seq_length)
+    if use_cache and past_key_values:
+        past_key_values, attention_mask, position_ids = chatglm2_evict_attention_sink_cache(
+            self, past_key_values, attention_mask, position_ids, seq_length, rotary_pos_emb)
+
     if full_attention_mask is None:
         if (attention_mask is not None and not attention_mask.all()) or (
                 past_key_values and seq_length != 1):
@@ -144,8 +152,6 @@ def chatglm2_model_forward(
     use_fuse_rope = input_ids.device.type == "xpu"
     use_fuse_rope = use_fuse_rope and not self.training
 
-    # Rotary positional embeddings
-    rotary_pos_emb = self.rotary_pos_emb(self.seq_length)
     if position_ids is not None:
         rotary_pos_emb = rotary_pos_emb[position_ids]
     else:
@@ -181,10 +187,59 @@ def chatglm2_model_forward(
     )
 
 
+def chatglm2_evict_attention_sink_cache(self, past_key_values, attention_mask, position_ids,
+                                        seq_length, rotary_pos_emb):
+    """
+    Evict the kv caches of [seq_len, bsz, num_heads, head_dim] like `evict_attention_sink_cache`
+    in `ipex_llm.transformers.kv`, if the attention sink is enabled by `from_pretrained`.
+
+    :return: the evicted kv caches, and the attention mask and position ids of them
+             and the new tokens.
+    """
+    attention_sink = get_attention_sink_window(self.config)
+    if attention_sink is None:
+        return past_key_values, attention_mask, position_ids
+    sink_size, window_size = attention_sink
+
+    cache_length = past_key_values[0][0].size(0)
+    # `stream_chat` counts only the cached tokens in the attention mask and position ids
+    num_evicted = 0
+    if attention_mask is not None:
+        num_evicted = attention_mask.size(-1) - seq_length - cache_length
+
+    num_to_evict = get_attention_sink_evict_length(cache_length, seq_length,
+                                                   sink_size, window_size)
+    if num_to_evict > 0:
+        # [rot_dim // 2, 2], cos and sin of the angles at position `num_to_evict`
+        rope = rotary_pos_emb[num_to_evict]
+
+        def rotate_fn(keys, shift):
+            return shift_rotary_keys(keys, rope[:, 0].to(keys.device),
+                                     rope[:, 1].to(keys.device), interleaved=True)
+
+        new_key_values = []
+        for k_cache, v_cache in past_key_values:
+            # [seq_len, bsz, num_heads, head_dim] -> [bsz, num_heads, seq_len, head_dim]
+            k_cache = evict_kv_cache(k_cache.permute(1, 2, 0, 3), sink_size, num_to_evict,
+                                     rotate_fn)
+            v_cache = evict_kv_cache(v_cache.permute(1, 2, 0, 3), sink_size, num_to_evict)
+            new_key_values.append((k_cache.permute(2, 0, 1, 3), v_cache.permute(2, 0, 1, 3)))
+        past_key_values = tuple(new_key_values)
+        num_evicted += num_to_evict
+
+    if num_evicted > 0:
+        attention_mask = trim_attention_sink_mask(attention_mask, sink_size, num_evicted)
+        if position_ids is not None:
+            position_ids = position_ids - num_evicted
+    return past_key_values, attention_mask, position_ids
+
+
 def chatglm2_attention_forward(
     self, hidden_states, attention_mask, rotary_pos_emb, kv_cache=None, use_cache=True
 ):
-    if use_quantize_kv_cache(self.query_key_value, hidden_states.transpose(0, 1)):
+    # the config is set to the attention modules by `_optimize_post`
+    if use_quantize_kv_cache(self.query_key_value, hidden_states.transpose(0, 1),
+                             self.config):
         forward_function = chatglm2_quantized_attention_forward_8eb45c
     else:
         forward_function = chatglm2_attention_forward_8eb45c
@@ -38,13 +38,11 @@ from typing import Optional, Tuple
 import torch
 from torch.nn import functional as F
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 import warnings
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 # Copied from transformers.models.llama.modeling_llama.rotate_half
 def rotate_half(x):
     """Rotates half the hidden dims of the input."""
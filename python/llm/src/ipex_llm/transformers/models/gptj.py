@@ -19,6 +19,7 @@
 
 import torch
 from typing import Optional, Tuple, Union
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, \
     apply_rotary_pos_emb, append_kv_cache, apply_ipex_rotate_every_two
 from transformers.utils.import_utils import is_torch_fx_proxy
@@ -27,9 +28,6 @@ from transformers.models.gptj.modeling_gptj import GPTJModel
 from ipex_llm.utils.common import invalidInputError
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def _get_embed_positions(self, position_ids):
     embed_positions = self.embed_positions
     if embed_positions.device != position_ids.device:
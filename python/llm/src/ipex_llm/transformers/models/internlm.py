@@ -43,15 +43,13 @@ import torch
 import torch.utils.checkpoint
 from torch import nn
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, \
     append_kv_cache, is_enough_kv_cache_room_4_31
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb_no_cache_xpu
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def internlm_attention_forward(
     self,
     hidden_states: torch.Tensor,
@@ -39,14 +39,16 @@ from typing import Optional, Tuple, Union, List
 import math
 import os
 import torch.nn.functional as F
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import SILU
 from ipex_llm.transformers.models.utils import init_fp8_kv_cache, append_fp8_kv_cache, \
-    restore_fp8_kv_cache, use_quantize_kv_cache
+    restore_fp8_kv_cache, use_quantize_kv_cache, sdp_fp8_cpu
 from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_31, \
     apply_rotary_pos_emb, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb_no_cache_xpu
 from ipex_llm.transformers.models.utils import use_flash_attention, use_esimd_sdp
+from ipex_llm.transformers.models.utils import use_sdp_blockwise_cpu, sdp_blockwise_cpu
 from ipex_llm.transformers.models.utils import mlp_fusion_check, fp16_fusion_check
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.models.llama.modeling_llama import LlamaModel
@@ -83,8 +85,6 @@ def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
                                                            n_rep, slen, head_dim)
     return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
 
 _ipex_version = None
 
@@ -112,11 +112,20 @@ def llama_model_forward_4_36(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        evict_attention_sink_cache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
-    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids):
+    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids,
+                                           self.config):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and not isinstance(past_key_values, DynamicNormalCache):
+        past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+    if use_cache:
+        seq_length = input_ids.size(1) if input_ids is not None else inputs_embeds.size(1)
+        attention_mask, position_ids = evict_attention_sink_cache(self, past_key_values,
+                                                                  attention_mask, position_ids,
+                                                                  seq_length)
     return llama_model_forward_4_36_internal(
         self=self,
         input_ids=input_ids,
@@ -300,7 +309,7 @@ def llama_attention_forward_4_31(
     padding_mask: Optional[torch.LongTensor] = None,
     **kwargs,
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states):
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.config):
         forward_function = llama_attention_forward_4_31_quantized
     else:
         forward_function = llama_attention_forward_4_31_original
@@ -416,7 +425,10 @@ def llama_attention_forward_4_31_quantized(
         kv_seq_len = key_states.shape[-2]
         past_key_value = (key_states, value_states)
 
-        if query_states.size(2) != 1 or query_states.device.type != 'xpu':
+        if query_states.device.type == "cpu" and not output_attentions:
+            attn_output = sdp_fp8_cpu(query_states, key_states, value_states, attention_mask)
+            attn_weights = None
+        elif query_states.size(2) != 1 or query_states.device.type != 'xpu':
             key_states, value_states = restore_fp8_kv_cache(key_states, value_states,
                                                             query_states.dtype)
             # repeat k/v heads if n_kv_heads < n_heads
@@ -614,11 +626,17 @@ def llama_attention_forward_4_31_original(
 
     past_key_value = (key_states, value_states) if use_cache else None
 
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups)
-    value_states = repeat_kv(value_states, self.num_key_value_groups)
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-    if not self.training and not hidden_states.requires_grad and \
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, attention_mask):
         attn_output = F.scaled_dot_product_attention(query_states.to(device, dtype=torch.float16),
                                                      key_states.to(device, dtype=torch.float16),
@@ -878,7 +896,7 @@ def llama_attention_forward_4_36(
     use_cache: bool = False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states):
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.config):
         forward_function = llama_attention_forward_4_36_quantized
     else:
         forward_function = llama_attention_forward_4_36_original
@@ -1011,7 +1029,10 @@ def llama_attention_forward_4_36_quantized(
                                                          self.layer_idx, cache_kwargs,
                                                          new_layout=True)
         kv_seq_len = key_states.shape[-2]
-        if query_states.size(2) != 1 or query_states.device.type != 'xpu':
+        if query_states.device.type == "cpu" and not output_attentions:
+            attn_output = sdp_fp8_cpu(query_states, key_states, value_states, attention_mask)
+            attn_weights = None
+        elif query_states.size(2) != 1 or query_states.device.type != 'xpu':
             key_states, value_states = restore_fp8_kv_cache(key_states, value_states,
                                                             query_states.dtype)
             key_states = repeat_kv(key_states, self.num_key_value_groups)\
@@ -1125,7 +1146,7 @@ def llama_attention_forward_4_36_original(
         kv_seq_len += 1
         # update past_key_value's seem_tokens and kv caches.
         if self.layer_idx == 0:
-            past_key_value.seen_tokens = kv_seq_len
+            past_key_value.seen_tokens += 1
         past_key_value.key_cache[self.layer_idx] = key_states
         past_key_value.value_cache[self.layer_idx] = value_states
 
@@ -1215,48 +1236,22 @@ def llama_attention_forward_4_36_original(
                                                             cos, sin, position_ids, "llama")
 
         if past_key_value is not None:
-            # update the number of seen tokens
-            if self.layer_idx == 0:
-                past_key_value.seen_tokens += key_states.shape[-2]
-
-            # reuse k, v, self_attention
-            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`
-            if len(past_key_value.key_cache) <= self.layer_idx:
-                past_key_value.key_cache.append(key_states)
-                past_key_value.value_cache.append(value_states)
-            else:
-                cache_k = past_key_value.key_cache[self.layer_idx]
-                cache_v = past_key_value.value_cache[self.layer_idx]
-
-                if not enough_kv_room:
-                    # allocate new
-                    new_c_k, new_c_v = extend_kv_cache(bsz,
-                                                       self.num_key_value_heads,  # Support GQA
-                                                       self.head_dim,
-                                                       cache_k.size(2),
-                                                       kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
-                                                       dtype=cache_k.dtype,
-                                                       device=device)
-
-                    new_c_k[:] = cache_k
-                    new_c_v[:] = cache_v
-                    cache_k = new_c_k
-                    cache_v = new_c_v
-
-                key_states, value_states = append_kv_cache(cache_k,
-                                                           cache_v,
-                                                           key_states,
-                                                           value_states)
-
-                # update past_key_value
-                past_key_value.key_cache[self.layer_idx] = key_states
-                past_key_value.value_cache[self.layer_idx] = value_states
+            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`,
+            # the cache is reallocated when it has no room for them
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
 
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups)
-    value_states = repeat_kv(value_states, self.num_key_value_groups)
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-    if not self.training and not hidden_states.requires_grad and \
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, attention_mask):
         # now only use flash attention for first token
         attn_output = F.scaled_dot_product_attention(query_states.to(device, dtype=torch.float16),
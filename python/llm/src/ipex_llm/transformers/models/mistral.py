@@ -44,21 +44,22 @@ import torch.nn.functional as F
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.models.mistral.modeling_mistral import MistralModel
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import init_fp8_kv_cache, append_fp8_kv_cache, \
-    restore_fp8_kv_cache, use_quantize_kv_cache
+    restore_fp8_kv_cache, use_quantize_kv_cache, sdp_fp8_cpu
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb, \
     apply_rotary_pos_emb_no_cache_xpu
 from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_31, \
     is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.low_bit_linear import SYM_INT4, FP8E5, IQ2_XXS
 from ipex_llm.transformers.models.utils import use_flash_attention, use_esimd_sdp
+from ipex_llm.transformers.models.utils import use_sdp_blockwise_cpu, sdp_blockwise_cpu
 from ipex_llm.transformers.models.llama import llama_decoding_fast_path_qtype_check
 try:
     from transformers.cache_utils import Cache
 except ImportError:
     Cache = Tuple[torch.Tensor]
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
 
 
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -139,11 +140,20 @@ def mistral_model_forward_4_36(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        evict_attention_sink_cache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
-    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids):
+    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids,
+                                           self.config):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and not isinstance(past_key_values, DynamicNormalCache):
+        past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+    if use_cache:
+        seq_length = input_ids.size(1) if input_ids is not None else inputs_embeds.size(1)
+        attention_mask, position_ids = evict_attention_sink_cache(self, past_key_values,
+                                                                  attention_mask, position_ids,
+                                                                  seq_length)
     return MistralModel.forward(
         self=self,
         input_ids=input_ids,
@@ -168,7 +178,7 @@ def mistral_attention_forward(
     use_cache: bool=False,
     padding_mask: Optional[torch.Tensor]=None,
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states):
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.config):
         forward_function = mistral_attention_forward_quantized
     else:
         forward_function = mistral_attention_forward_original
@@ -308,7 +318,10 @@ def mistral_attention_forward_quantized(
         kv_seq_len = key_states.shape[-2]
         past_key_value = (key_states, value_states)
 
-        if query_states.size(2) != 1 or query_states.device.type != 'xpu':
+        if query_states.device.type == "cpu" and not output_attentions:
+            attn_output = sdp_fp8_cpu(query_states, key_states, value_states, attention_mask)
+            attn_weights = None
+        elif query_states.size(2) != 1 or query_states.device.type != 'xpu':
             key_states, value_states = restore_fp8_kv_cache(key_states, value_states,
                                                             query_states.dtype)
             attn_weights = torch.matmul(query_states, key_states.transpose(2, 3))
@@ -470,13 +483,21 @@ def mistral_attention_forward_original(
     else:
         attention_dtype = original_dtype
 
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
-                                                                     dtype=attention_dtype)
-    value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
+        value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+                                                                             dtype=attention_dtype)
 
-    if fsdp_flag:
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         attn_output = F.scaled_dot_product_attention(query_states.to(dtype=attention_dtype),
                                                      key_states,
                                                      value_states,
@@ -519,7 +540,7 @@ def mistral_attention_forward_4_36(
     use_cache: bool=False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states):
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.config):
         forward_function = mistral_attention_forward_4_36_quantized
     else:
         forward_function = mistral_attention_forward_4_36_original
@@ -664,7 +685,10 @@ def mistral_attention_forward_4_36_quantized(
                                                          self.layer_idx, cache_kwargs,
                                                          new_layout=True)
         kv_seq_len = key_states.shape[-2]
-        if query_states.size(2) != 1 or query_states.device.type != 'xpu':
+        if query_states.device.type == "cpu" and not output_attentions:
+            attn_output = sdp_fp8_cpu(query_states, key_states, value_states, attention_mask)
+            attn_weights = None
+        elif query_states.size(2) != 1 or query_states.device.type != 'xpu':
             key_states, value_states = restore_fp8_kv_cache(key_states, value_states,
                                                             query_states.dtype)
             attn_weights = torch.matmul(query_states, key_states.transpose(2, 3))
@@ -761,7 +785,7 @@ def mistral_attention_forward_4_36_original(
 
         # update past_key_value's seem_tokens and kv caches.
         if self.layer_idx == 0:
-            past_key_value.seen_tokens = kv_seq_len
+            past_key_value.seen_tokens += 1
         past_key_value.key_cache[self.layer_idx] = key_states
         past_key_value.value_cache[self.layer_idx] = value_states
 
@@ -798,40 +822,10 @@ def mistral_attention_forward_4_36_original(
                                                             cos, sin, position_ids, "mistral")
 
         if past_key_value is not None:
-            # update the number of seen tokens
-            if self.layer_idx == 0:
-                past_key_value.seen_tokens += key_states.shape[-2]
-
-            # reuse k, v, self_attention
-            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`
-            if len(past_key_value.key_cache) <= self.layer_idx:
-                past_key_value.key_cache.append(key_states)
-                past_key_value.value_cache.append(value_states)
-            else:
-                cache_k = past_key_value.key_cache[self.layer_idx]
-                cache_v = past_key_value.value_cache[self.layer_idx]
-
-                if not enough_kv_room:
-                    # allocate new
-                    new_c_k, new_c_v = extend_kv_cache(bsz,
-                                                       self.num_key_value_heads,  # Support GQA
-                                                       self.head_dim,
-                                                       cache_k.size(2),
-                                                       kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
-                                                       dtype=cache_k.dtype,
-                                                       device=device)
-
-                    new_c_k[:] = cache_k
-                    new_c_v[:] = cache_v
-                    cache_k = new_c_k
-                    cache_v = new_c_v
-
-                key_states, value_states = append_kv_cache(cache_k, cache_v,
-                                                           key_states, value_states)
-
-                # update past_key_value
-                past_key_value.key_cache[self.layer_idx] = key_states
-                past_key_value.value_cache[self.layer_idx] = value_states
+            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`,
+            # the cache is reallocated when it has no room for them
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
 
     if not self.training and not hidden_states.requires_grad:
         fsdp_flag = use_flash_attention(query_states, key_states)
@@ -842,13 +836,21 @@ def mistral_attention_forward_4_36_original(
     else:
         attention_dtype = original_dtype
 
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
-                                                                     dtype=attention_dtype)
-    value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
+        value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+                                                                             dtype=attention_dtype)
 
-    if fsdp_flag:
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         attn_output = F.scaled_dot_product_attention(query_states.to(dtype=attention_dtype),
                                                      key_states,
                                                      value_states,
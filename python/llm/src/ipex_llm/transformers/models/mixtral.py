@@ -40,7 +40,8 @@
 import math
 from typing import Optional, Tuple, Union, List
 from transformers.modeling_outputs import MoeModelOutputWithPast
-from transformers.cache_utils import Cache, DynamicCache
+from transformers.cache_utils import Cache
+from ipex_llm.transformers.kv import DynamicNormalCache
 from transformers.modeling_attn_mask_utils import (
     _prepare_4d_causal_attention_mask,
 )
@@ -50,18 +51,15 @@ from torch import nn
 import torch.nn.functional as F
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
-from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb,\
     apply_rotary_pos_emb_cache_freq_xpu, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.mistral import should_use_fuse_rope, use_decoding_fast_path
 from ipex_llm.transformers.models.utils import use_flash_attention, use_esimd_sdp
-from ipex_llm.transformers.models.utils import mlp_fusion_check, SILU
+from ipex_llm.transformers.models.utils import use_sdp_blockwise_cpu, sdp_blockwise_cpu
+from ipex_llm.transformers.models.utils import mlp_fusion_check, SILU, moe_group_forward
 from ipex_llm.transformers.low_bit_linear import IQ2_XXS
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     """
     This is the equivalent of torch.repeat_interleave(x, dim=1, repeats=n_rep).
@@ -91,38 +89,10 @@ def mixtral_moeblock_forward(self,
     routing_weights = routing_weights.to(hidden_states.dtype)
 
     if bs > 1:
-        final_hidden_states = torch.zeros(
-            (batch_size * sequence_length, hidden_dim),
-            dtype=hidden_states.dtype,
-            device=hidden_states.device
+        final_hidden_states = moe_group_forward(
+            hidden_states, routing_weights, selected_experts, self.num_experts,
+            lambda expert_idx, x, weights: self.experts[expert_idx](x, weights)
         )
-        # One hot encode the selected experts to create an expert mask
-        # this will be used to easily index which expert is going to be sollicitated
-        expert_mask = torch.nn.functional.one_hot(selected_experts,
-                                                  num_classes=self.num_experts).permute(2, 1, 0)
-
-        # Loop over all available experts in the model and perform the computation on each expert
-        for expert_idx in range(self.num_experts):
-            expert_layer = self.experts[expert_idx]
-            idx, top_x = torch.where(expert_mask[expert_idx])
-
-            if top_x.shape[0] == 0:
-                continue
-
-            # in torch it is faster to index using lists than torch tensors
-            top_x_list = top_x.tolist()
-            idx_list = idx.tolist()
-
-            # Index the correct hidden states and compute the expert hidden state for
-            # the current expert. We need to make sure to multiply the output hidden
-            # states by `routing_weights` on the corresponding tokens (top-1 and top-2)
-            current_state = hidden_states[None, top_x_list].reshape(-1, hidden_dim)
-            current_hidden_states = expert_layer(current_state,
-                                                 routing_weights[top_x_list, idx_list, None])
-
-            # However `index_add_` only support torch tensors for indexing so we'll use
-            # the `top_x` tensor here.
-            final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
     else:
         selected_experts = selected_experts[0].cpu().tolist()
         for idx in range(self.top_k):
@@ -256,42 +226,10 @@ def mixtral_attention_forward(
                                                             cos, sin, position_ids, "mixtral")
 
         if past_key_value is not None:
-            # update the number of seen tokens
-            if self.layer_idx == 0:
-                past_key_value.seen_tokens += key_states.shape[-2]
-
-            # reuse k, v, self_attention
-            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`
-            if len(past_key_value.key_cache) <= self.layer_idx:
-                past_key_value.key_cache.append(key_states)
-                past_key_value.value_cache.append(value_states)
-            else:
-                cache_k = past_key_value.key_cache[self.layer_idx]
-                cache_v = past_key_value.value_cache[self.layer_idx]
-
-                if not enough_kv_room:
-                    # allocate new
-                    new_c_k, new_c_v = extend_kv_cache(bsz,
-                                                       self.num_key_value_heads,  # Support GQA
-                                                       self.head_dim,
-                                                       cache_k.size(2),
-                                                       kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
-                                                       dtype=cache_k.dtype,
-                                                       device=device)
-
-                    new_c_k[:] = cache_k
-                    new_c_v[:] = cache_v
-                    cache_k = new_c_k
-                    cache_v = new_c_v
-
-                key_states, value_states = append_kv_cache(cache_k,
-                                                           cache_v,
-                                                           key_states,
-                                                           value_states)
-
-                # update past_key_value
-                past_key_value.key_cache[self.layer_idx] = key_states
-                past_key_value.value_cache[self.layer_idx] = value_states
+            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`,
+            # the cache is reallocated when it has no room for them
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
 
     if not self.training and not hidden_states.requires_grad:
         fsdp_flag = use_flash_attention(query_states, key_states)
@@ -302,13 +240,19 @@ def mixtral_attention_forward(
     else:
         attention_dtype = original_dtype
 
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
-                                                                     dtype=attention_dtype)
-    value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
+        value_states = repeat_kv(value_states, self.num_key_value_groups).to(device,
+                                                                             dtype=attention_dtype)
 
-    if fsdp_flag:
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+    elif fsdp_flag:
         attn_output = F.scaled_dot_product_attention(query_states.to(dtype=attention_dtype),
                                                      key_states,
                                                      value_states,
@@ -427,7 +371,7 @@ def mixtral_model_forward(
     if use_cache:
         use_legacy_cache = not isinstance(past_key_values, Cache)
         if use_legacy_cache:
-            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+            past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
         past_key_values_length = past_key_values.get_usable_length(seq_length)
 
     if position_ids is None:
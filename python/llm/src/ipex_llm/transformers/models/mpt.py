@@ -23,12 +23,10 @@ from einops import rearrange
 import math
 import torch.nn.functional as F
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import extend_kv_cache, init_kv_cache, append_kv_cache
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def mpt_multihead_attention_forward(self, x, past_key_value=None, attn_bias=None,
                                     attention_mask=None, is_causal=True,
                                     needs_weights=False, rotary_emb_w_meta_info=None,
@@ -45,15 +45,13 @@ from torch import nn
 import torch.nn.functional as F
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb,\
     apply_rotary_pos_emb_no_cache_xpu, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.mistral import should_use_fuse_rope, use_decoding_fast_path
 from ipex_llm.transformers.models.utils import use_flash_attention
-from ipex_llm.transformers.models.utils import mlp_fusion_check
-
-
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
+from ipex_llm.transformers.models.utils import mlp_fusion_check, moe_group_forward
 
 
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -87,37 +85,10 @@ def phixtral_moeblock_forward(self, hidden_states: torch.Tensor):
     routing_weights = routing_weights.to(hidden_states.dtype)
 
     if bs > 1:
-        final_hidden_states = torch.zeros(
-            (batch_size * sequence_length, hidden_dim),
-            dtype=hidden_states.dtype,
-            device=hidden_states.device
+        final_hidden_states = moe_group_forward(
+            hidden_states, routing_weights, selected_experts, num_local_experts,
+            lambda expert_idx, x, weights: self.mlp[expert_idx](x)
         )
-        # One hot encode the selected experts to create an expert mask
-        # this will be used to easily index which expert is going to be sollicitated
-        expert_mask = torch.nn.functional.one_hot(selected_experts,
-                                                  num_classes=num_local_experts).permute(2, 1, 0)
-
-        # Loop over all available experts in the model and perform the computation on each expert
-        for expert_idx in range(num_local_experts):
-            expert_layer = self.mlp[expert_idx]
-            idx, top_x = torch.where(expert_mask[expert_idx])
-
-            if top_x.shape[0] == 0:
-                continue
-
-            # in torch it is faster to index using lists than torch tensors
-            top_x_list = top_x.tolist()
-            idx_list = idx.tolist()
-
-            # Index the correct hidden states and compute the expert hidden state for
-            # the current expert. We need to make sure to multiply the output hidden
-            # states by `routing_weights` on the corresponding tokens (top-1 and top-2)
-            current_state = hidden_states[None, top_x_list].reshape(-1, hidden_dim)
-            current_hidden_states = expert_layer(current_state)
-
-            # However `index_add_` only support torch tensors for indexing so we'll use
-            # the `top_x` tensor here.
-            final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
     else:
         selected_experts = selected_experts[0].cpu().tolist()
         for idx in range(top_k):
@@ -46,13 +46,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ipex_llm.transformers.models.llama import repeat_kv
-from ipex_llm.transformers.models.utils import extend_kv_cache, append_kv_cache
-from ipex_llm.transformers.models.utils import use_quantize_kv_cache, restore_fp8_kv_cache
+from ipex_llm.transformers.models.utils import use_quantize_kv_cache, restore_fp8_kv_cache, \
+    sdp_fp8_cpu
 from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb_cache_freq_xpu
-from ipex_llm.transformers.kv import DynamicFp8Cache
+from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+    evict_attention_sink_cache
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.models.utils import use_flash_attention, use_esimd_sdp
+from ipex_llm.transformers.models.utils import use_sdp_blockwise_cpu, sdp_blockwise_cpu
 from transformers.models.qwen2.modeling_qwen2 import Qwen2Model, apply_rotary_pos_emb
 from transformers.models.qwen2.modeling_qwen2 import _prepare_4d_causal_attention_mask_for_sdpa
 from transformers.models.qwen2.modeling_qwen2 import _prepare_4d_causal_attention_mask
@@ -69,8 +71,6 @@ from transformers import logging
 
 logger = logging.get_logger(__name__)
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
 
 def should_use_fuse_rope(self, query_states, position_ids):
     use_fuse_rope = query_states.device.type == "xpu"
@@ -92,9 +92,17 @@ def qwen2_model_forward(
     return_dict: Optional[bool] = None,
 ):
     use_cache = use_cache if use_cache is not None else self.config.use_cache
-    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids):
+    if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids,
+                                           self.config):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and not isinstance(past_key_values, DynamicNormalCache):
+        past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+    if use_cache:
+        seq_length = input_ids.size(1) if input_ids is not None else inputs_embeds.size(1)
+        attention_mask, position_ids = evict_attention_sink_cache(self, past_key_values,
+                                                                  attention_mask, position_ids,
+                                                                  seq_length)
     return qwen2_model_forward_internal(
         self=self,
         input_ids=input_ids,
@@ -286,7 +294,7 @@ def qwen2_attention_forward(
     use_cache: bool = False,
     **kwargs,
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states):
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.config):
         forward_function = qwen2_attention_forward_quantized
     elif hidden_states.device.type == "cpu":
         forward_function = qwen2_sdpa_attention_forward
@@ -364,6 +372,9 @@ def qwen2_attention_forward_quantized(
         attn_output = linear_q4_0.sdp_fp8(query_states, key_states, value_states,
                                           attention_mask)
         attn_weights = None
+    elif query_states.device.type == "cpu" and not output_attentions and not self.training:
+        attn_output = sdp_fp8_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
     else:
         key, value = restore_fp8_kv_cache(key_states, value_states, query_states.dtype)
         key = repeat_kv(key, self.num_key_value_groups)
@@ -448,7 +459,7 @@ def qwen2_attention_forward_origin(
         query_states, key_states, value_states = linear_q4_0.forward_qkv_bias(*args)
         kv_seq_len += 1
         if self.layer_idx == 0:
-            past_key_value.seen_tokens = kv_seq_len
+            past_key_value.seen_tokens += 1
         past_key_value.key_cache[self.layer_idx] = key_states
         past_key_value.value_cache[self.layer_idx] = value_states
 
@@ -485,46 +496,22 @@ def qwen2_attention_forward_origin(
                                                             cos, sin, position_ids)
 
         if past_key_value is not None:
-            # update the number of seen tokens
-            if self.layer_idx == 0:
-                past_key_value.seen_tokens += key_states.shape[-2]
-
-            if len(past_key_value.key_cache) <= self.layer_idx:
-                past_key_value.key_cache.append(key_states)
-                past_key_value.value_cache.append(value_states)
-            else:
-                cache_k = past_key_value.key_cache[self.layer_idx]
-                cache_v = past_key_value.value_cache[self.layer_idx]
-
-                if not enough_kv_room:
-                    # allocate new
-                    new_c_k, new_c_v = extend_kv_cache(bsz,
-                                                       self.num_key_value_heads,  # Support GQA
-                                                       self.head_dim,
-                                                       cache_k.size(2),
-                                                       kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
-                                                       dtype=cache_k.dtype,
-                                                       device=device)
-
-                    new_c_k[:] = cache_k
-                    new_c_v[:] = cache_v
-                    cache_k = new_c_k
-                    cache_v = new_c_v
-
-                key_states, value_states = append_kv_cache(cache_k,
-                                                           cache_v,
-                                                           key_states,
-                                                           value_states)
-
-                # update past_key_value
-                past_key_value.key_cache[self.layer_idx] = key_states
-                past_key_value.value_cache[self.layer_idx] = value_states
-
-    # repeat k/v heads if n_kv_heads < n_heads
-    key_states = repeat_kv(key_states, self.num_key_value_groups)
-    value_states = repeat_kv(value_states, self.num_key_value_groups)
-
-    if not self.training and not hidden_states.requires_grad and \
+            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`,
+            # the cache is reallocated when it has no room for them
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
+
+    use_sdp_blockwise = use_sdp_blockwise_cpu(query_states, output_attentions)
+    if not use_sdp_blockwise:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+    if use_sdp_blockwise:
+        # query heads are grouped by their k/v head instead of repeating k/v heads
+        attn_output = sdp_blockwise_cpu(query_states, key_states, value_states, attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, attention_mask):
         attn_output = F.scaled_dot_product_attention(query_states.to(device, dtype=torch.float16),
                                                      key_states.to(device, dtype=torch.float16),
@@ -617,7 +604,7 @@ def qwen2_sdpa_attention_forward(
         query_states, key_states, value_states = linear_q4_0.forward_qkv_bias(*args)
         kv_seq_len += 1
         if self.layer_idx == 0:
-            past_key_value.seen_tokens = kv_seq_len
+            past_key_value.seen_tokens += 1
         past_key_value.key_cache[self.layer_idx] = key_states
         past_key_value.value_cache[self.layer_idx] = value_states
 
@@ -654,40 +641,10 @@ def qwen2_sdpa_attention_forward(
                                                             cos, sin, position_ids)
 
         if past_key_value is not None:
-            # update the number of seen tokens
-            if self.layer_idx == 0:
-                past_key_value.seen_tokens += key_states.shape[-2]
-
-            if len(past_key_value.key_cache) <= self.layer_idx:
-                past_key_value.key_cache.append(key_states)
-                past_key_value.value_cache.append(value_states)
-            else:
-                cache_k = past_key_value.key_cache[self.layer_idx]
-                cache_v = past_key_value.value_cache[self.layer_idx]
-
-                if not enough_kv_room:
-                    # allocate new
-                    new_c_k, new_c_v = extend_kv_cache(bsz,
-                                                       self.num_key_value_heads,  # Support GQA
-                                                       self.head_dim,
-                                                       cache_k.size(2),
-                                                       kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
-                                                       dtype=cache_k.dtype,
-                                                       device=device)
-
-                    new_c_k[:] = cache_k
-                    new_c_v[:] = cache_v
-                    cache_k = new_c_k
-                    cache_v = new_c_v
-
-                key_states, value_states = append_kv_cache(cache_k,
-                                                           cache_v,
-                                                           key_states,
-                                                           value_states)
-
-                # update past_key_value
-                past_key_value.key_cache[self.layer_idx] = key_states
-                past_key_value.value_cache[self.layer_idx] = value_states
+            # update `past_key_value` with `key_states` and `value_states` for layer `layer_idx`,
+            # the cache is reallocated when it has no room for them
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
 
     # repeat k/v heads if n_kv_heads < n_heads
     key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -30,13 +30,11 @@ import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
 from transformers.utils import logging
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from ipex_llm.transformers.models.utils import extend_kv_cache, init_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import rotate_half
 
 
-KV_CACHE_ALLOC_BLOCK_LENGTH = 256
-
-
 def apply_rotary_pos_emb(t, freqs):
     cos, sin = freqs
     rot_dim = freqs[0].shape[-1]
@@ -118,6 +118,46 @@ def rwkv_linear_attention_xpu(
     return out
 
 
+# Prompts are processed in chunks of this many tokens on CPU
+RWKV_PREFILL_CHUNK_SIZE = 32
+
+
+def rwkv_linear_attention_chunk(receptance, key, value, log_decay, time_first, state):
+    """
+    Compute the RWKV-5 linear attention of a chunk of L tokens at once.
+
+    For token i of the chunk, the recurrence expands to
+        out_i = r_i @ (u * k_i^T v_i + sum_{j<i} w^(i-1-j) * k_j^T v_j + w^i * state)
+    so the contributions within the chunk are a [L, L] matmul with a decay mask,
+    and the state is only read and updated once per chunk.
+
+    :param receptance: [B, H, L, S]
+    :param key: [B, H, L, S]
+    :param value: [B, H, L, S]
+    :param log_decay: log of the per-channel decay w of shape [H, S]
+    :param time_first: the per-channel bonus u of the current token of shape [H, S]
+    :param state: [B, H, S, S]
+    :return: the output of shape [B, H, L, S] and the state after the chunk.
+    """
+    L = receptance.size(2)
+    idx = torch.arange(L, device=receptance.device)
+    dist = idx[:, None] - 1 - idx[None, :]
+    # decay[h, i, j, s] = w[h, s] ^ (i - 1 - j) for j < i, else 0
+    decay = torch.exp(dist.clamp(min=0)[None, :, :, None] * log_decay[:, None, None, :])
+    decay = decay * (dist >= 0)[None, :, :, None]
+    attn = torch.einsum("bhis,hijs,bhjs->bhij", receptance, decay, key)
+    bonus = (receptance * time_first[None, :, None, :] * key).sum(dim=-1, keepdim=True)
+    out = attn @ value + bonus * value
+
+    # decay of the state to token i, and of token j to the end of the chunk
+    state_decay = torch.exp(idx[None, :, None] * log_decay[:, None, :])
+    key_decay = torch.exp((L - 1 - idx)[None, :, None] * log_decay[:, None, :])
+    out = out + (receptance * state_decay) @ state
+    state = torch.exp(L * log_decay)[:, :, None] * state
+    state = state + (key * key_decay).transpose(-2, -1) @ value
+    return out, state
+
+
 def rwkv_linear_attention_cpu(
     B,
     H,
@@ -136,22 +176,42 @@ def rwkv_linear_attention_cpu(
     ow,
     state,
 ):
-    key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2).transpose(-2, -1)
-    value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
-    receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
-    time_decay = torch.exp(-torch.exp(time_decay.float())).reshape(-1, 1, 1).reshape(n_head, -1, 1)
-    time_first = time_first.float().reshape(-1, 1, 1).reshape(n_head, -1, 1)
     lxw = lxw.float()
     lxb = lxb.float()
-    out = torch.zeros_like(key).reshape(B, T, H, S)
-    for t in range(T):
-        rt = receptance[:, :, t:t + 1, :]
-        kt = key[:, :, :, t:t + 1]
-        vt = value[:, :, t:t + 1, :]
-        at = kt @ vt
-        out[:, t] = (rt @ (time_first * at + state)).squeeze(2)
+    if T > 1:
+        key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        log_decay = -torch.exp(time_decay.float()).reshape(n_head, -1)
+        time_first = time_first.float().reshape(n_head, -1)
+        if state is None:
+            state = torch.zeros(B, H, S, S, dtype=torch.float32, device=key.device)
+        outs = []
         with torch.no_grad():
-            state = at + time_decay * state
+            for start in range(0, T, RWKV_PREFILL_CHUNK_SIZE):
+                end = min(start + RWKV_PREFILL_CHUNK_SIZE, T)
+                chunk_out, state = rwkv_linear_attention_chunk(receptance[:, :, start:end],
+                                                               key[:, :, start:end],
+                                                               value[:, :, start:end],
+                                                               log_decay, time_first, state)
+                outs.append(chunk_out)
+        out = torch.cat(outs, dim=2).transpose(1, 2)
+    else:
+        key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2).transpose(-2, -1)
+        value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        time_decay = torch.exp(-torch.exp(time_decay.float())).reshape(-1, 1, 1)
+        time_decay = time_decay.reshape(n_head, -1, 1)
+        time_first = time_first.float().reshape(-1, 1, 1).reshape(n_head, -1, 1)
+        out = torch.zeros_like(key).reshape(B, T, H, S)
+        for t in range(T):
+            rt = receptance[:, :, t:t + 1, :]
+            kt = key[:, :, :, t:t + 1]
+            vt = value[:, :, t:t + 1, :]
+            at = kt @ vt
+            out[:, t] = (rt @ (time_first * at + state)).squeeze(2)
+            with torch.no_grad():
+                state = at + time_decay * state
 
     out = out.reshape(B * T, H * S)
     out = F.group_norm(out, num_groups=H, weight=lxw, bias=lxb).reshape(B, T, H * S)
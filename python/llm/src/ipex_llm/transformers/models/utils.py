@@ -14,7 +14,10 @@
 # limitations under the License.
 #
 
+import math
 import os
+import threading
+from contextlib import contextmanager
 import torch
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
@@ -22,6 +25,12 @@ from ipex_llm.transformers.utils import get_ipex_version, get_xpu_device_type
 from ipex_llm.transformers.low_bit_linear import SYM_INT4, SYM_INT8, FP8E5, IQ2_XXS, FP4, FP8E4
 
 FP8_KV_ALLOC_LENGTH = 512
+KV_CACHE_ALLOC_BLOCK_LENGTH = 256
+# a full kv cache is reallocated for at least this many times its length,
+# so a long generation copies the cache O(log(n)) times instead of every block
+KV_CACHE_GROWTH_FACTOR = float(os.environ.get("BIGDL_KV_CACHE_GROWTH_FACTOR", "1.5"))
+# number of cached tokens attended at a time by `sdp_blockwise_cpu` and `sdp_fp8_cpu`
+SDP_BLOCK_SIZE = 256
 
 # used in fused mlp forward
 SILU = 0
@@ -33,7 +42,67 @@ def decoding_fast_path_qtype_check(proj):
     return qtype in [SYM_INT4, FP8E5, FP4]
 
 
+_kv_cache_length_hint = threading.local()
+
+
+@contextmanager
+def kv_cache_length_hint(max_length):
+    """
+    Preallocate the kv caches created within this context for `max_length` tokens,
+    e.g. the prompt length plus the `max_new_tokens` of a generation.
+    """
+    previous = getattr(_kv_cache_length_hint, "value", None)
+    _kv_cache_length_hint.value = max_length
+    try:
+        yield
+    finally:
+        _kv_cache_length_hint.value = previous
+
+
+def generate_with_kv_cache_length_hint(self, *args, **kwargs):
+    # bound in `_optimize_post` to a model whose class uses `GenerationMixin.generate`,
+    # which is called through the class, so later patches of it are kept
+    generation_config = kwargs.get("generation_config", None)
+    if generation_config is None:
+        generation_config = getattr(self, "generation_config", None)
+    max_new_tokens = kwargs.get("max_new_tokens",
+                                getattr(generation_config, "max_new_tokens", None))
+    input_ids = args[0] if len(args) > 0 else kwargs.get("inputs", kwargs.get("input_ids", None))
+    if max_new_tokens is None or not isinstance(input_ids, torch.Tensor):
+        return type(self).generate(self, *args, **kwargs)
+    max_length = input_ids.size(-1) + max_new_tokens
+    attention_sink = get_attention_sink_window(self.config)
+    if attention_sink is not None:
+        # the evicted kv caches never hold more than the sinks and the window
+        max_length = min(max_length, sum(attention_sink))
+    with kv_cache_length_hint(max_length):
+        return type(self).generate(self, *args, **kwargs)
+
+
+def get_kv_cache_alloc_length(current_length, max_length, allocated_length=0):
+    """
+    Decide the length to allocate a kv cache for.
+
+    :param current_length: number of tokens the cache must hold.
+    :param max_length: the length asked by the caller, at least `current_length`.
+    :param allocated_length: allocated length of the cache being extended, 0 for a new cache.
+    :return: the hinted length of the generation if the cache fits in it,
+             otherwise `max_length` grown geometrically from `allocated_length`.
+    """
+    hint = getattr(_kv_cache_length_hint, "value", None)
+    # an empty cache, e.g. the temporary cache of a decoding fast path, is not preallocated
+    if hint is not None and 0 < current_length <= hint:
+        return hint
+    return max(max_length, int(allocated_length * KV_CACHE_GROWTH_FACTOR))
+
+
 def init_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, dtype, device):
+    max_length = get_kv_cache_alloc_length(current_length, max_length)
+    return _alloc_kv_cache(batch_size, num_heads, head_dim, current_length, max_length,
+                           dtype, device)
+
+
+def _alloc_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, dtype, device):
     key_cache_storage = torch.empty(batch_size, num_heads,
                                     max_length, head_dim,
                                     dtype=dtype, device=device)
@@ -53,10 +122,13 @@ def init_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, d
 
 
 def extend_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, dtype, device):
+    # the number of tokens to hold is only known to be at most `max_length`
+    max_length = get_kv_cache_alloc_length(max_length, max_length, current_length)
     # empty cache to reduce gpu memory
     if device.type == 'xpu':
         torch.xpu.empty_cache()
-    return init_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, dtype, device)
+    return _alloc_kv_cache(batch_size, num_heads, head_dim, current_length, max_length,
+                           dtype, device)
 
 
 def append_kv_cache(cache_k, cache_v, key_states, value_states):
@@ -71,7 +143,125 @@ def append_kv_cache(cache_k, cache_v, key_states, value_states):
     return new_cache_k, new_cache_v
 
 
-def use_quantize_kv_cache(linear: torch.nn.Module, x: torch.Tensor) -> bool:
+def update_kv_cache(cache_k, cache_v, key_states, value_states):
+    """
+    Append key/value states to a kv cache, the cache is created or reallocated
+    if it has no room for them.
+
+    :param cache_k: keys of shape [bsz, num_heads, cache_len, head_dim], or None to create
+           a new cache.
+    :param cache_v: values of the same shape as `cache_k`, or None.
+    :param key_states: [bsz, num_heads, seq_len, head_dim]
+    :param value_states: [bsz, num_heads, seq_len, head_dim]
+    :return: the key/value cache including the new states.
+    """
+    bsz, num_heads, seq_len, head_dim = key_states.shape
+    if cache_k is None:
+        cache_k, cache_v = init_kv_cache(bsz, num_heads, head_dim,
+                                         seq_len, seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
+                                         dtype=key_states.dtype, device=key_states.device)
+        cache_k[:] = key_states
+        cache_v[:] = value_states
+        return cache_k, cache_v
+
+    kv_seq_len = cache_k.size(2) + seq_len
+    if cache_k.stride(1) < kv_seq_len * cache_k.size(3):
+        new_cache_k, new_cache_v = extend_kv_cache(bsz, num_heads, head_dim,
+                                                   cache_k.size(2),
+                                                   kv_seq_len + KV_CACHE_ALLOC_BLOCK_LENGTH,
+                                                   dtype=cache_k.dtype, device=cache_k.device)
+        new_cache_k[:] = cache_k
+        new_cache_v[:] = cache_v
+        cache_k, cache_v = new_cache_k, new_cache_v
+    return append_kv_cache(cache_k, cache_v, key_states, value_states)
+
+
+def get_attention_sink_window(config):
+    """
+    Return the (sink_size, window_size) of the attention sink kv cache set by
+    `from_pretrained`, or None if the kv cache is not evicted.
+    """
+    window_size = getattr(config, "bigdl_attention_window_size", None)
+    if window_size is None:
+        return None
+    return getattr(config, "bigdl_attention_sink_size", 4), window_size
+
+
+def get_attention_sink_evict_length(cache_length, seq_length, sink_size, window_size):
+    """
+    Return the number of cached tokens after the sinks to evict before appending
+    `seq_length` new tokens, so the cache keeps at most `sink_size + window_size` tokens.
+    """
+    if cache_length <= sink_size or cache_length + seq_length <= sink_size + window_size:
+        return 0
+    num_evicted = cache_length + seq_length - sink_size - window_size
+    # evict at least 1/16 of the window at a time, so moving and re-rotating
+    # the window is amortized over the following tokens
+    num_evicted = max(num_evicted, window_size // 16)
+    return min(num_evicted, cache_length - sink_size)
+
+
+def evict_kv_cache(cache, sink_size, num_evicted, rotate_fn=None):
+    """
+    Remove `num_evicted` tokens following the first `sink_size` tokens of a kv cache,
+    the remaining tokens are moved forward in place, so the room of the cache is kept.
+
+    :param cache: [bsz, num_heads, cache_len, head_dim], a view of a preallocated cache.
+    :param sink_size: number of tokens kept at the beginning of the cache.
+    :param num_evicted: number of tokens to remove.
+    :param rotate_fn: called with the moved keys and `num_evicted` to re-index their
+           rotary embedding, None for values.
+    :return: the cache of `cache_len - num_evicted` tokens.
+    """
+    bsz, num_heads, cache_len, head_dim = cache.shape
+    recent = cache[:, :, sink_size + num_evicted:]
+    recent = recent.clone() if rotate_fn is None else rotate_fn(recent, num_evicted)
+    new_size = (bsz, num_heads, cache_len - num_evicted, head_dim)
+    new_cache = cache.as_strided(new_size, cache.stride(), storage_offset=cache.storage_offset())
+    new_cache[:, :, sink_size:] = recent
+    return new_cache
+
+
+def shift_rotary_keys(keys, cos, sin, interleaved=False):
+    """
+    Move keys embedded by RoPE backward by the angles of `cos` and `sin`.
+
+    :param keys: [bsz, num_heads, seq_len, head_dim]
+    :param cos: [rot_dim // 2], cosine of the angles to move, of the shifted positions
+           times the rotary frequencies.
+    :param sin: [rot_dim // 2], sine of the angles to move.
+    :param interleaved: whether the rotated pairs are interleaved like chatglm's, or the two
+           halves of the rotary dims like llama's. Only the first rot_dim dims are rotated.
+    :return: the moved keys.
+    """
+    dtype = keys.dtype
+    rot_dim = cos.size(-1) * 2
+    x, x_pass = keys[..., :rot_dim].float(), keys[..., rot_dim:]
+    cos, sin = cos.float(), sin.float()
+    if interleaved:
+        cos = torch.repeat_interleave(cos, 2)
+        sin = torch.repeat_interleave(sin, 2)
+        x = x * cos - rotate_every_two(x) * sin
+    else:
+        cos = torch.cat((cos, cos))
+        sin = torch.cat((sin, sin))
+        x = x * cos - rotate_half(x) * sin
+    return torch.cat((x.to(dtype), x_pass), dim=-1)
+
+
+def trim_attention_sink_mask(attention_mask, sink_size, num_evicted):
+    """Remove the columns of the `num_evicted` tokens after the sinks from a 2D attention mask."""
+    if attention_mask is None or attention_mask.dim() != 2 or num_evicted == 0:
+        return attention_mask
+    return torch.cat((attention_mask[:, :sink_size],
+                      attention_mask[:, sink_size + num_evicted:]), dim=-1)
+
+
+def use_quantize_kv_cache(linear: torch.nn.Module, x: torch.Tensor, config=None) -> bool:
+    if config is not None and get_attention_sink_window(config) is not None:
+        # keys of the fp8 kv cache would be restored, re-rotated and truncated to fp8 again
+        # at every eviction of the attention sink, so the fp16 kv cache is used with it
+        return False
     if os.environ.get("BIGDL_QUANTIZE_KV_CACHE", None) is not None:
         return os.environ["BIGDL_QUANTIZE_KV_CACHE"] == "1"
     else:
@@ -85,8 +275,10 @@ def kv_cache_device_check(x: torch.Tensor) -> bool:
         (get_xpu_device_type(x) == "arc" and 1 < x.size(0) and x.size(0) < 8)
 
 
-def init_fp8_kv_cache(batch_size, num_heads, current_length, head_dim, device, new_layout=False):
-    max_length = current_length + FP8_KV_ALLOC_LENGTH
+def init_fp8_kv_cache(batch_size, num_heads, current_length, head_dim, device, new_layout=False,
+                      allocated_length=0):
+    max_length = get_kv_cache_alloc_length(current_length, current_length + FP8_KV_ALLOC_LENGTH,
+                                           allocated_length)
 
     k_cache_storage = torch.empty(batch_size, num_heads, max_length, head_dim,
                                   dtype=torch.uint8, device=device)
@@ -114,7 +306,8 @@ def append_fp8_kv_cache(k_cache, v_cache, key, value, new_layout=False):
 
     if k_cache.stride(1) < new_length * k_cache.size(3):
         new_k_cache, new_v_cache = init_fp8_kv_cache(batch_size, num_heads, new_length,
-                                                     head_dim, key.device, new_layout)
+                                                     head_dim, key.device, new_layout,
+                                                     k_cache.stride(1) // head_dim)
         new_k_cache = new_k_cache.as_strided(new_size, new_k_cache.stride(), storage_offset=0)
         new_v_cache = new_v_cache.as_strided(new_size, new_v_cache.stride(), storage_offset=0)
         new_k_cache[:, :, :cur_length, :] = k_cache
@@ -142,6 +335,92 @@ def restore_fp8_kv_cache(k_cache, v_cache, dtype):
     return new_k_cache.to(dtype=dtype), new_v_cache.to(dtype=dtype)
 
 
+def use_sdp_blockwise_cpu(query, output_attentions):
+    # `sdp_blockwise_cpu` doesn't return the attention weights,
+    # and it updates the scores in place, which can't be back propagated
+    return query.device.type == "cpu" and not output_attentions and not query.requires_grad
+
+
+def _sdp_blockwise(query, num_kv_heads, kv_len, get_kv_block, attention_mask, block_size):
+    bsz, num_heads, q_len, head_dim = query.shape
+    n_rep = num_heads // num_kv_heads
+    # the query heads sharing a k/v head are stacked as rows of one matmul:
+    # [bsz, num_kv_heads, n_rep * q_len, head_dim]
+    query = query.float().reshape(bsz, num_kv_heads, n_rep * q_len, head_dim) / \
+        math.sqrt(head_dim)
+    if attention_mask is not None:
+        attention_mask = attention_mask.float().unsqueeze(1)
+
+    min_value = torch.finfo(torch.float32).min
+    max_score = torch.full((bsz, num_kv_heads, n_rep, q_len, 1), min_value,
+                           dtype=torch.float32, device=query.device)
+    denom = torch.zeros_like(max_score)
+    out = torch.zeros((bsz, num_kv_heads, n_rep, q_len, head_dim),
+                      dtype=torch.float32, device=query.device)
+    for start in range(0, kv_len, block_size):
+        end = min(start + block_size, kv_len)
+        key, value = get_kv_block(start, end)
+        scores = (query @ key.transpose(-1, -2)).view(bsz, num_kv_heads, n_rep, q_len, -1)
+        if attention_mask is not None:
+            scores.add_(attention_mask[..., start:end])
+        new_max = torch.maximum(max_score, scores.amax(dim=-1, keepdim=True))
+        scale = torch.exp(max_score - new_max)
+        # scores are not used any more, reuse them for the probs
+        probs = scores.sub_(new_max).exp_()
+        denom.mul_(scale).add_(probs.sum(dim=-1, keepdim=True))
+        block_out = probs.view(bsz, num_kv_heads, n_rep * q_len, -1) @ value
+        out.mul_(scale).add_(block_out.view(out.shape))
+        max_score = new_max
+    out.div_(denom)
+    return out.view(bsz, num_heads, q_len, head_dim)
+
+
+def sdp_blockwise_cpu(query, key, value, attention_mask, block_size=SDP_BLOCK_SIZE):
+    """
+    Attention on CPU without repeating K/V heads for GQA.
+
+    Query heads are grouped by the K/V head they share, and K/V are attended
+    `block_size` tokens at a time with the softmax computed online across
+    blocks, so neither the repeated K/V nor the full attention weights are
+    materialized.
+
+    :param query: [bsz, num_heads, q_len, head_dim]
+    :param key: [bsz, num_kv_heads, kv_len, head_dim]
+    :param value: [bsz, num_kv_heads, kv_len, head_dim]
+    :param attention_mask: additive mask of shape [bsz, 1, q_len, kv_len] or None.
+    :return: the attention output of shape [bsz, num_heads, q_len, head_dim].
+    """
+    def get_kv_block(start, end):
+        return key[:, :, start:end].float(), value[:, :, start:end].float()
+
+    attn_output = _sdp_blockwise(query, key.size(1), key.size(2), get_kv_block,
+                                 attention_mask, block_size)
+    return attn_output.to(value.dtype)
+
+
+def sdp_fp8_cpu(query, k_cache, v_cache, attention_mask, block_size=SDP_BLOCK_SIZE):
+    """
+    Attention over a fp8 KV cache on CPU, without restoring the whole cache.
+
+    The cache is dequantized `block_size` tokens at a time, and attended the
+    same way as `sdp_blockwise_cpu`.
+
+    :param query: [bsz, num_heads, q_len, head_dim]
+    :param k_cache: fp8 keys of shape [bsz, num_kv_heads, kv_len, head_dim]
+    :param v_cache: fp8 values of shape [bsz, num_kv_heads, kv_len, head_dim]
+    :param attention_mask: additive mask of shape [bsz, 1, q_len, kv_len] or None.
+    :return: the attention output of shape [bsz, num_heads, q_len, head_dim], in the
+        dtype of `query`.
+    """
+    def get_kv_block(start, end):
+        return restore_fp8_kv_cache(k_cache[:, :, start:end], v_cache[:, :, start:end],
+                                    torch.float32)
+
+    attn_output = _sdp_blockwise(query, k_cache.size(1), k_cache.size(2), get_kv_block,
+                                 attention_mask, block_size)
+    return attn_output.to(query.dtype)
+
+
 def rotate_half(x):
     """Rotates half the hidden dims of the input."""
     x1 = x[..., :x.shape[-1] // 2]
@@ -392,3 +671,41 @@ def fp16_fusion_check(proj, x, training):
     if device_type != "pvc":
         return False
     return True
+
+
+def moe_group_forward(hidden_states, routing_weights, selected_experts, num_experts,
+                      expert_forward):
+    """
+    Run the experts of a MoE block on a batch of tokens, grouped by expert.
+
+    :param hidden_states: input of shape [num_tokens, hidden_dim].
+    :param routing_weights: weights of the selected experts of shape [num_tokens, top_k].
+    :param selected_experts: ids of the selected experts of shape [num_tokens, top_k].
+    :param num_experts: number of experts of the MoE block.
+    :param expert_forward: callable taking an expert id, the tokens routed to that expert and
+           their routing weights of shape [n, 1], returning the weighted expert output.
+    :return: the sum of the weighted outputs of the selected experts of every token.
+    """
+    num_tokens, hidden_dim = hidden_states.shape
+    top_k = selected_experts.size(-1)
+    flat_experts = selected_experts.reshape(-1)
+    # sort the (token, expert) pairs by expert once, then the tokens of every expert are
+    # a contiguous slice, and experts only need one host sync to get their token counts
+    order = torch.argsort(flat_experts)
+    counts = torch.bincount(flat_experts, minlength=num_experts).tolist()
+    sorted_states = hidden_states.index_select(0, order // top_k)
+    sorted_weights = routing_weights.reshape(-1, 1).index_select(0, order)
+
+    sorted_outputs = torch.empty_like(sorted_states)
+    start = 0
+    for expert_idx, count in enumerate(counts):
+        if count == 0:
+            continue
+        end = start + count
+        sorted_outputs[start:end] = expert_forward(expert_idx, sorted_states[start:end],
+                                                   sorted_weights[start:end])
+        start = end
+
+    outputs = torch.empty_like(sorted_outputs)
+    outputs[order] = sorted_outputs
+    return outputs.view(num_tokens, top_k, hidden_dim).sum(dim=1)
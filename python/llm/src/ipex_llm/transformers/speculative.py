@@ -22,10 +22,12 @@
 import torch
 import time
 import os
+import sys
 import copy
 import logging
 import transformers
 from packaging import version
+from contextlib import contextmanager
 from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
 from transformers import top_k_top_p_filtering, GenerationConfig, \
     LogitsProcessorList, StoppingCriteriaList
@@ -52,7 +54,7 @@ def generate(
     streamer: Optional["BaseStreamer"] = None,
     **kwargs,
 ):
-    if hasattr(self, "draft_model"):
+    if hasattr(self, "draft_model") or getattr(self, "prompt_lookup", False):
         from ipex_llm.transformers.convert import get_enable_ipex
         _enable_ipex = get_enable_ipex()
         if _enable_ipex and inputs.size(1) < 256:
@@ -62,9 +64,11 @@ def generate(
             )
             for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                         'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                        'th_batch_num']:
+                        'th_batch_num', 'max_matching_ngram_size', 'tree_top_k',
+                        'max_tree_nodes']:
                 value = kwargs.pop(var, None)
-            del self.draft_model
+            if hasattr(self, "draft_model"):
+                del self.draft_model
             return original_generate(self,
                                      inputs=inputs,
                                      generation_config=generation_config,
@@ -81,12 +85,14 @@ def generate(
         for var in ['max_new_tokens', 'max_step_draft', 'th_stop_draft', 'do_sample',
                     'top_k', 'top_p', 'temperature', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'repetition_penalty',
-                    'attention_mask', 'min_step_draft']:
+                    'attention_mask', 'min_step_draft', 'max_matching_ngram_size',
+                    'tree_top_k', 'max_tree_nodes']:
             value = kwargs.pop(var, None)
             if value is not None:
                 new_speculative_kwargs[var] = value
         return self.speculative_generate(inputs=inputs,
-                                         draft_model=self.draft_model,
+                                         draft_model=getattr(self, "draft_model", None),
+                                         streamer=streamer,
                                          **new_speculative_kwargs)
     else:
         return original_generate(self,
@@ -140,6 +146,29 @@ def multinomial_sample_one_no_sync(probs_sort):
     return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int64)
 
 
+def prompt_lookup_draft(input_ids, max_matching_ngram_size, num_draft_tokens):
+    """
+    Draft tokens without a draft model, by matching the last n-gram of `input_ids`
+    (prompt and generated tokens) against its earlier content.
+
+    The tokens following the latest earlier occurrence of the longest matched n-gram,
+    of at most `max_matching_ngram_size` tokens, are proposed.
+    Return at most `num_draft_tokens` tokens, or an empty tensor if nothing matches.
+    """
+    seq_len = input_ids.size(0)
+    if num_draft_tokens <= 0:
+        return input_ids[:0]
+    for ngram_size in range(min(max_matching_ngram_size, seq_len - 1), 0, -1):
+        ngram = input_ids[-ngram_size:]
+        # windows of all earlier positions, the trailing n-gram itself is excluded
+        windows = input_ids[:-1].unfold(0, ngram_size, 1)
+        matches = (windows == ngram).all(dim=-1).nonzero()
+        if matches.size(0) > 0:
+            start = matches[-1].item() + ngram_size
+            return input_ids[start:start + num_draft_tokens]
+    return input_ids[:0]
+
+
 def clear_benchmarks(self):
     self.first_token_time = 0
     self.generate_time = []
@@ -452,8 +481,14 @@ def speculative_generate(self,
                          min_step_draft=3,
                          generation_config: Optional[GenerationConfig] = None,
                          attention_mask=None,
+                         max_matching_ngram_size=2,
+                         tree_top_k=1,
+                         max_tree_nodes=16,
+                         streamer: Optional["BaseStreamer"] = None,
                          **sampling_kwargs):
-    invalidInputError(draft_model is not None,
+    # Without a draft model, drafts are looked up from the prompt and generated tokens
+    use_prompt_lookup = draft_model is None
+    invalidInputError(not use_prompt_lookup or getattr(self, "prompt_lookup", False),
                       "Draft model should be provided.")
     # min_step_draft >= 1. Since the max_step_draft may adjust,
     # min_step_draft can > max_step_draft
@@ -520,8 +555,10 @@ def speculative_generate(self,
     # 5. Prepare `input_ids` which will be used for auto-regressive generation
     input_ids = inputs_tensor if model_input_name == "input_ids" else model_kwargs.pop("input_ids")
 
-    # if streamer is not None:
-    #     streamer.put(input_ids.cpu())
+    if streamer is not None:
+        invalidInputError(input_ids.size(0) == 1,
+                          "Streamer in speculative decoding only supports batch size 1.")
+        streamer.put(input_ids.cpu())
 
     input_ids_length = input_ids.shape[-1]
 
@@ -543,6 +580,25 @@ def speculative_generate(self,
         **model_kwargs,
     )
 
+    if input_ids.size(0) > 1:
+        invalidInputError(tree_top_k <= 1,
+                          "Tree speculative decoding only supports batch size 1.")
+        if attention_mask is not None and attention_mask.size(0) != input_ids.size(0):
+            attention_mask = attention_mask.repeat_interleave(
+                generation_config.num_return_sequences, dim=0)
+        return _speculative_generate_batch(self, input_ids, attention_mask, draft_model,
+                                           generation_config, logits_processor,
+                                           max_new_tokens, max_step_draft, th_stop_draft,
+                                           auto_th_stop_draft, auto_parameters, hf_adjust,
+                                           min_step_draft, max_matching_ngram_size)
+
+    if tree_top_k > 1:
+        return _speculative_generate_tree(self, input_ids, attention_mask, draft_model,
+                                          generation_config, logits_processor,
+                                          max_new_tokens, max_step_draft, th_stop_draft,
+                                          auto_th_stop_draft, auto_parameters, hf_adjust,
+                                          tree_top_k, max_tree_nodes, streamer)
+
     step = 0
     step_draft = 0
     step_verify = 0
@@ -569,8 +625,8 @@ def speculative_generate(self,
                               Llama, Baichuan2, Mistral, ChatGLM and Qwen models currently.")
         if "chatglm" in self.config.model_type:
             global query_group_size
-            query_group_size = draft_model.config.num_attention_heads // \
-                draft_model.config.multi_query_group_num
+            query_group_size = self.config.num_attention_heads // \
+                self.config.multi_query_group_num
 
     tmp_matchness = 0
     e2e_tic = 0.0
@@ -595,7 +651,8 @@ def speculative_generate(self,
         if step >= max_new_tokens:
             break
 
-        if step == 0:
+        first_token = step == 0
+        if first_token:
             # first token use full model
             tic = time.time()
             output = self(input_ids=current_input_ids,
@@ -627,6 +684,31 @@ def speculative_generate(self,
             toc = time.time()
             self.first_token_time = toc - tic
             e2e_tic = time.time()
+        elif use_prompt_lookup:
+            tic = time.time()
+            if self.device.type == 'xpu':
+                past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
+                                                                        max_step_draft,
+                                                                        max_new_tokens - step + 40,
+                                                                        self.config.model_type)
+            # Draft number + step < max output token number
+            num_draft_tokens = min(max_step_draft, max_new_tokens - step - 1)
+            if auto_th_stop_draft:
+                # draft less when recent drafts are seldom accepted
+                num_draft_tokens = min(num_draft_tokens,
+                                       max(min_step_draft, round(tmp_matchness * max_step_draft)))
+            history_ids = torch.cat((input_ids, generate_ids[:, :step]), dim=-1)
+            draft_tokens = prompt_lookup_draft(history_ids[0], max_matching_ngram_size,
+                                               num_draft_tokens)
+            drafted_n_tokens = draft_tokens.size(0)
+            step_draft = drafted_n_tokens - 1
+            draft_generate_ids[:, 0] = current_input_ids
+            draft_generate_ids[:, 1:drafted_n_tokens + 1] = draft_tokens
+            random_probs = None
+            if generation_config.do_sample:
+                random_probs = torch.rand(max_step_draft, device=self.device, dtype=self.dtype)
+            toc = time.time()
+            self.draft_time.append(toc - tic)
         else:
             draft_current_input_ids = current_input_ids
             # Target model KV cache to draft model
@@ -767,6 +849,8 @@ def speculative_generate(self,
             toc = time.time()
             self.draft_time.append(toc - tic)
             drafted_n_tokens = step_draft + 1
+
+        if not first_token:
             # raft input + raft completion
             drafted_input_ids = draft_generate_ids[:, :drafted_n_tokens+1]
             self.draft_num.append(drafted_n_tokens)
@@ -891,7 +975,13 @@ def speculative_generate(self,
 
             if generation_config.do_sample:
                 draft_tokens = drafted_input_ids[:, 1:].squeeze(0)
-                draft_probs = torch.stack(draft_prob_list).squeeze((1, 2))
+                if use_prompt_lookup:
+                    # looked up drafts are proposed with probability 1
+                    vocab_size = target_probs.size(-1)
+                    draft_probs = torch.nn.functional.one_hot(draft_tokens, vocab_size)
+                    draft_probs = draft_probs.to(target_probs.dtype)
+                else:
+                    draft_probs = torch.stack(draft_prob_list).squeeze((1, 2))
 
                 # q: target prob, p: draft prob
                 # q >= p: always accept draft token
@@ -971,7 +1061,7 @@ def speculative_generate(self,
                         ]
 
             # Each iter assign new_matched kv_cache to past_key_values1
-            if self.device.type == 'cpu' and (not _enable_ipex):
+            if self.device.type == 'cpu' and (not _enable_ipex) and (not use_prompt_lookup):
                 _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
                                                     original_draft_past_key_values,
                                                     _enable_ipex)
@@ -986,7 +1076,8 @@ def speculative_generate(self,
             self.n_drafted += drafted_n_tokens
             step_verify += 1
 
-            if auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
+            if auto_th_stop_draft and step_verify % auto_parameters[0] == 0 and \
+                    drafted_n_tokens > 0:
                 tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
                     (1-auto_parameters[1])*((max_matched - 1)/drafted_n_tokens)
                 if tmp_matchness < auto_parameters[2]:
@@ -1010,13 +1101,685 @@ def speculative_generate(self,
         if generation_config.eos_token_id in output_ids_list:
             idx = output_ids_list.index(generation_config.eos_token_id)
             step -= (len(output_ids_list) - idx - 1)
+            if streamer is not None:
+                streamer.put(output_ids[:, :idx + 1].cpu())
             break
+        if streamer is not None:
+            # push the accepted tokens within max_new_tokens
+            n_exceeded = max(0, step - max_new_tokens)
+            streamer.put(output_ids[:, :output_ids.size(1) - n_exceeded].cpu())
 
     step = min(step, max_new_tokens)
     e2e_toc = time.time()
     self.n_token_generated = step
     self.e2e_time_without_first = e2e_toc - e2e_tic
 
+    if streamer is not None:
+        streamer.end()
+
+    generate_ids = torch.cat([input_ids, generate_ids[:, :step]], dim=-1)
+
+    return generate_ids
+
+
+# Model types whose KV cache is laid out as [bsz, num_heads, seq_len, head_dim] and
+# whose forward takes per-row position_ids, as required by batched speculative decoding
+_BATCHED_MODEL_TYPES = ["llama", "mistral", "gptj"]
+
+
+def _extend_past_key_values_storage_cpu(past_key_values_storage, cur_len, min_len, extend_len):
+    if past_key_values_storage[0][0].size(2) >= min_len:
+        return past_key_values_storage
+    new_past_key_values_storage = []
+    for k, v in past_key_values_storage:
+        bsz, num_heads, _, head_dim = k.shape
+        new_k = torch.ones(bsz, num_heads, min_len + extend_len, head_dim, dtype=torch.float32)
+        new_v = torch.ones(bsz, num_heads, min_len + extend_len, head_dim, dtype=torch.float32)
+        new_k[:, :, :cur_len, :] = k[:, :, :cur_len, :]
+        new_v[:, :, :cur_len, :] = v[:, :, :cur_len, :]
+        new_past_key_values_storage.append((new_k, new_v))
+    return new_past_key_values_storage
+
+
+def _process_logits_batch(logits_processor, row_ids, logits):
+    # row_ids is a list of the tokens of each row before `logits`
+    for i, ids in enumerate(row_ids):
+        logits[i:i+1] = logits_processor(ids.unsqueeze(0), logits[i:i+1])
+    return logits
+
+
+def _speculative_generate_batch(self, input_ids, attention_mask, draft_model,
+                                generation_config, logits_processor,
+                                max_new_tokens, max_step_draft, th_stop_draft,
+                                auto_th_stop_draft, auto_parameters, hf_adjust,
+                                min_step_draft, max_matching_ngram_size):
+    # Each row drafts and accepts its own number of tokens. The KV cache stays a single
+    # tensor: rows accepting less than the longest accepted row leave the KV of their
+    # rejected drafts in place, which is masked out in `attention_mask`, and the position
+    # of every token is counted from the unmasked ones. Rows which finished are masked
+    # from then on and drop out of drafting and acceptance.
+    invalidInputError(self.config.model_type in _BATCHED_MODEL_TYPES,
+                      f"Speculative decoding with batch size > 1 only supports "
+                      f"{_BATCHED_MODEL_TYPES} models currently.")
+    from ipex_llm.transformers.convert import get_enable_ipex
+    invalidInputError(not get_enable_ipex(),
+                      "Speculative decoding with IPEX-LLM only supports batch size 1.")
+
+    use_prompt_lookup = draft_model is None
+    do_sample = generation_config.do_sample
+    bsz, input_len = input_ids.shape
+    device = self.device
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    attention_mask = attention_mask.to(device=device, dtype=torch.long)
+    prompt_mask = attention_mask.bool()
+
+    eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = []
+    elif not isinstance(eos_token_id, list):
+        eos_token_id = [eos_token_id]
+    eos_token_id = torch.tensor(eos_token_id, dtype=torch.long, device=device)
+    pad_token_id = generation_config.pad_token_id
+    pad_token_id = pad_token_id if pad_token_id is not None else 0
+
+    draft_gen_length = max_step_draft + 6 if hf_adjust else max_step_draft + 1
+    generate_ids = torch.full([bsz, max_new_tokens], pad_token_id,
+                              dtype=torch.long, device=device)
+    draft_generate_ids = torch.zeros([bsz, draft_gen_length], dtype=torch.long, device=device)
+    # number of tokens generated by each row
+    n_generated = torch.zeros(bsz, dtype=torch.long, device=device)
+    finished = torch.zeros(bsz, dtype=torch.bool, device=device)
+    row_max_step_draft = torch.full([bsz], max_step_draft, dtype=torch.long, device=device)
+    row_th_stop_draft = torch.full([bsz], th_stop_draft, dtype=torch.float32, device=device)
+    tmp_matchness = torch.zeros(bsz, dtype=torch.float32, device=device)
+    past_key_values_storage = []
+    step_verify = 0
+
+    def row_tokens(i):
+        return torch.cat((input_ids[i][prompt_mask[i]], generate_ids[i, :n_generated[i]]))
+
+    def sample_tokens(logits):
+        if do_sample:
+            probs = logits_to_probs(logits,
+                                    top_k=generation_config.top_k,
+                                    top_p=generation_config.top_p,
+                                    temperature=generation_config.temperature)
+            return multinomial_sample_one_no_sync(probs).squeeze(-1), probs
+        return greedy(logits), None
+
+    self.clear_benchmarks()
+
+    if device.type == 'xpu':
+        torch.xpu.empty_cache()
+
+    # first token use full model
+    tic = time.time()
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    output = self(input_ids=input_ids,
+                  attention_mask=attention_mask,
+                  position_ids=position_ids,
+                  past_key_values=None,
+                  return_dict=True,
+                  use_cache=True)
+    logits = logits_processor(input_ids, output['logits'][:, -1, :])
+    output_ids, _ = sample_tokens(logits)
+    generate_ids[:, 0] = output_ids
+    n_generated += 1
+    current_input_ids = output_ids.unsqueeze(-1)
+    past_key_values = output['past_key_values']
+    finished |= torch.isin(output_ids, eos_token_id) | (n_generated >= max_new_tokens)
+    if device.type == 'xpu':
+        torch.xpu.synchronize()
+    toc = time.time()
+    self.first_token_time = toc - tic
+    e2e_tic = time.time()
+
+    while not finished.all():
+        tic = time.time()
+        cur_len = past_key_values[0][0].size(2)
+        # Draft number + generated number < max output token number
+        max_drafts = torch.minimum(row_max_step_draft, max_new_tokens - n_generated - 1)
+        max_drafts = max_drafts.clamp(min=0).masked_fill(finished, 0)
+        drafted_n_tokens = torch.zeros(bsz, dtype=torch.long, device=device)
+        draft_generate_ids[:, 0] = current_input_ids[:, 0]
+        draft_prob_list = []
+        random_probs = None
+        if do_sample:
+            random_probs = torch.rand(bsz, draft_gen_length, device=device, dtype=self.dtype)
+
+        if use_prompt_lookup:
+            for i in range(bsz):
+                num_draft_tokens = max_drafts[i].item()
+                if auto_th_stop_draft:
+                    # draft less when recent drafts of this row are seldom accepted
+                    num_draft_tokens = min(num_draft_tokens, max(min_step_draft, round(
+                        tmp_matchness[i].item() * row_max_step_draft[i].item())))
+                draft_tokens = prompt_lookup_draft(row_tokens(i), max_matching_ngram_size,
+                                                   num_draft_tokens)
+                drafted_n_tokens[i] = draft_tokens.size(0)
+                draft_generate_ids[i, 1:draft_tokens.size(0) + 1] = draft_tokens
+        elif max_drafts.max() > 0:
+            if device.type == 'cpu':
+                if len(past_key_values_storage) == 0:
+                    past_key_values_storage = \
+                        _prepare_past_key_values_storage_cpu(self, past_key_values,
+                                                             max_new_tokens)
+                # masked rejected drafts take space in the KV cache as well
+                past_key_values_storage = \
+                    _extend_past_key_values_storage_cpu(past_key_values_storage, cur_len,
+                                                        cur_len + draft_gen_length + 1,
+                                                        max_new_tokens)
+                draft_past_key_values = \
+                    _prepare_draft_past_key_values_cpu(self, past_key_values,
+                                                       past_key_values_storage, False)
+                original_draft_past_key_values = draft_past_key_values
+            else:
+                past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
+                                                                        draft_gen_length,
+                                                                        max_new_tokens + 40,
+                                                                        self.config.model_type)
+                draft_past_key_values = past_key_values
+            draft_current_input_ids = current_input_ids
+            draft_attention_mask = attention_mask
+            drafting = max_drafts > 0
+            # Draft model auto-regressively generate tokens, every row stops
+            # drafting when its prob is less than its th_stop_draft
+            for step_draft in range(max_drafts.max().item()):
+                draft_attention_mask = torch.cat((draft_attention_mask,
+                                                  draft_attention_mask.new_ones(bsz, 1)), dim=-1)
+                draft_output = draft_model(input_ids=draft_current_input_ids,
+                                           past_key_values=draft_past_key_values,
+                                           attention_mask=draft_attention_mask,
+                                           position_ids=draft_attention_mask.sum(-1, keepdim=True)
+                                           - 1,
+                                           return_dict=True,
+                                           use_cache=True)
+                logits = draft_output['logits'][:, -1, :]
+                logits = _process_logits_batch(logits_processor,
+                                               [torch.cat((row_tokens(i),
+                                                           draft_generate_ids[i, 1:step_draft+1]))
+                                                for i in range(bsz)],
+                                               logits)
+                if do_sample:
+                    # deepmind_sample expects logits of [bsz, seq_len, vocab_size]
+                    draft_output_ids, draft_probs, draft_output_probs = deepmind_sample(
+                        logits.unsqueeze(1),
+                        return_probs=True,
+                        top_k=generation_config.top_k,
+                        top_p=generation_config.top_p,
+                        temperature=generation_config.temperature)
+                    draft_output_ids = draft_output_ids.squeeze(-1)
+                    draft_output_probs = draft_output_probs.squeeze(-1)
+                    draft_prob_list.append(draft_probs)
+                else:
+                    draft_output_ids, draft_output_probs = greedy(logits, return_probs=True)
+                draft_generate_ids[:, step_draft+1] = draft_output_ids
+                drafted_n_tokens += drafting.long()
+                draft_current_input_ids = draft_output_ids.unsqueeze(-1)
+                draft_past_key_values = draft_output['past_key_values']
+                th_random = 1 if random_probs is None else random_probs[:, step_draft]
+                stop_draft = ((draft_output_probs < row_th_stop_draft) & (th_random > 0.3) &
+                              (drafted_n_tokens >= min_step_draft)) | \
+                    (drafted_n_tokens >= max_drafts)
+                drafting &= ~stop_draft
+                if not drafting.any():
+                    break
+        if device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.draft_time.append(toc - tic)
+
+        # Target model verify drafts of all rows, rows drafted less than others
+        # verify extra tokens which are never accepted
+        tic = time.time()
+        n_verify = drafted_n_tokens.max().item() + 1
+        drafted_input_ids = draft_generate_ids[:, :n_verify]
+        verify_attention_mask = torch.cat((attention_mask,
+                                           attention_mask.new_ones(bsz, n_verify)), dim=-1)
+        position_ids = verify_attention_mask.cumsum(-1)[:, -n_verify:] - 1
+        output = self(input_ids=drafted_input_ids,
+                      past_key_values=past_key_values,
+                      attention_mask=verify_attention_mask,
+                      position_ids=position_ids,
+                      return_dict=True,
+                      use_cache=True)
+        logits = output['logits']
+        past_key_values = output['past_key_values']
+        for i in range(bsz):
+            if finished[i]:
+                continue
+            tokens = row_tokens(i)
+            for j in range(drafted_n_tokens[i].item() + 1):
+                logits[i, j:j+1] = logits_processor(
+                    torch.cat((tokens, drafted_input_ids[i, 1:j+1])).unsqueeze(0),
+                    logits[i, j:j+1])
+        if not do_sample:
+            output_ids = greedy(logits)
+        if device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.verify_time.append(toc - tic)
+        self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
+
+        # Accept tokens of every row
+        accepted = torch.zeros(bsz, dtype=torch.long, device=device)
+        accepted_ids = []
+        for i in range(bsz):
+            if finished[i]:
+                accepted_ids.append(None)
+                continue
+            n_drafted = drafted_n_tokens[i].item()
+            draft_tokens = drafted_input_ids[i, 1:n_drafted + 1]
+            if do_sample:
+                target_probs = logits_to_probs(logits[i, :n_drafted + 1],
+                                               top_k=generation_config.top_k,
+                                               top_p=generation_config.top_p,
+                                               temperature=generation_config.temperature)
+                if use_prompt_lookup:
+                    # looked up drafts are proposed with probability 1
+                    draft_probs = torch.nn.functional.one_hot(draft_tokens,
+                                                              target_probs.size(-1))
+                    draft_probs = draft_probs.to(target_probs.dtype)
+                elif n_drafted > 0:
+                    draft_probs = torch.stack([probs[i] for probs in
+                                               draft_prob_list[:n_drafted]])
+                else:
+                    draft_probs = target_probs[:0]
+                # q: target prob, p: draft prob, q/p prob to accept draft token
+                p = draft_probs[torch.arange(0, n_drafted), draft_tokens]
+                q = target_probs[torch.arange(0, n_drafted), draft_tokens]
+                accept_draft_prob = torch.minimum(torch.ones(()), q / p)
+                rejected_locations = (random_probs[i, :n_drafted] > accept_draft_prob).nonzero()
+                if rejected_locations.shape[0] == 0:
+                    last_token = multinomial_sample_one_no_sync(target_probs[-1])
+                    row_output_ids = torch.cat([draft_tokens, last_token])
+                else:
+                    n_matched = rejected_locations[0].item()
+                    resample_prob = target_probs[n_matched] - draft_probs[n_matched]
+                    resample_prob = torch.where(resample_prob > 0, resample_prob, 0.0)
+                    resample_prob = resample_prob / resample_prob.sum()
+                    next_token = multinomial_sample_one_no_sync(resample_prob)
+                    row_output_ids = torch.cat([draft_tokens[:n_matched], next_token])
+            else:
+                # Drafts start from [1, k], verified output start from [0, k - 1]
+                n_matched = ((output_ids[i, :n_drafted] != draft_tokens).cumsum(-1) == 0)
+                n_matched = n_matched.sum().item()
+                row_output_ids = output_ids[i, :n_matched + 1]
+            # Stop on eos and remove content after eos
+            is_eos = torch.isin(row_output_ids, eos_token_id).nonzero()
+            if is_eos.size(0) > 0:
+                row_output_ids = row_output_ids[:is_eos[0].item() + 1]
+                finished[i] = True
+            accepted[i] = row_output_ids.size(0)
+            accepted_ids.append(row_output_ids)
+
+        # Roll back the KV cache: keep up to the longest accepted row,
+        # and mask the rejected part of every other row
+        max_accepted = accepted.max().item()
+        past_key_values = [(k[:, :, :cur_len + max_accepted], v[:, :, :cur_len + max_accepted])
+                           for k, v in past_key_values]
+        new_attention_mask = torch.arange(max_accepted, device=device).unsqueeze(0) < \
+            accepted.unsqueeze(-1)
+        attention_mask = torch.cat((attention_mask, new_attention_mask.long()), dim=-1)
+        if device.type == 'cpu' and len(past_key_values_storage) > 0 and \
+                not use_prompt_lookup and max_drafts.max() > 0:
+            _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
+                                                original_draft_past_key_values)
+        elif device.type == 'cpu' and len(past_key_values_storage) > 0:
+            # the storage is kept in sync even if the draft model was not run
+            past_key_values_storage = \
+                _extend_past_key_values_storage_cpu(past_key_values_storage, cur_len,
+                                                    cur_len + max_accepted, max_new_tokens)
+            for (k, v), (storage_k, storage_v) in zip(past_key_values, past_key_values_storage):
+                storage_k[:, :, cur_len:cur_len + max_accepted] = \
+                    k[:, :, cur_len:].to(torch.float32)
+                storage_v[:, :, cur_len:cur_len + max_accepted] = \
+                    v[:, :, cur_len:].to(torch.float32)
+
+        for i, row_output_ids in enumerate(accepted_ids):
+            if row_output_ids is None:
+                continue
+            n = n_generated[i].item()
+            generate_ids[i, n:n + row_output_ids.size(0)] = row_output_ids
+            current_input_ids[i, 0] = row_output_ids[-1]
+        active = accepted > 0
+        n_generated += accepted
+        finished |= n_generated >= max_new_tokens
+        step_verify += 1
+
+        # remove one generated by the base model
+        self.draft_num.append(drafted_n_tokens[active].tolist())
+        self.accept_num.append(accepted[active].tolist())
+        self.n_matched += (accepted[active] - 1).sum().item()
+        self.n_drafted += drafted_n_tokens[active].sum().item()
+
+        if auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
+            updated = active & (drafted_n_tokens > 0)
+            matchness = (accepted - 1).float() / drafted_n_tokens.clamp(min=1)
+            tmp_matchness = torch.where(updated, auto_parameters[1] * tmp_matchness +
+                                        (1 - auto_parameters[1]) * matchness, tmp_matchness)
+            new_th_stop_draft = torch.where(
+                tmp_matchness < auto_parameters[2],
+                row_th_stop_draft + auto_parameters[3],
+                torch.where(drafted_n_tokens == row_max_step_draft, row_th_stop_draft,
+                            row_th_stop_draft - auto_parameters[3]))
+            row_th_stop_draft = torch.where(updated, auto_parameters[4] * row_th_stop_draft +
+                                            (1 - auto_parameters[4]) * new_th_stop_draft,
+                                            row_th_stop_draft)
+
+        if hf_adjust:
+            all_matched = (accepted - 1) == row_max_step_draft
+            row_max_step_draft = torch.where(
+                active,
+                torch.where(all_matched, (row_max_step_draft + 1).clamp(max=draft_gen_length - 1),
+                            (row_max_step_draft - 1).clamp(min=1)),
+                row_max_step_draft)
+
+    e2e_toc = time.time()
+    self.n_token_generated = n_generated.max().item()
+    self.e2e_time_without_first = e2e_toc - e2e_tic
+
+    generate_ids = torch.cat([input_ids, generate_ids[:, :n_generated.max().item()]], dim=-1)
+
+    return generate_ids
+
+
+# Model types whose attention mask can be replaced by a token tree mask
+_TREE_MODEL_TYPES = ["llama", "mistral"]
+
+
+def _tree_ancestors(parents):
+    # ancestors[i, j] is True if node j is node i or one of its ancestors,
+    # parents[i] < i for every node but the root
+    ancestors = torch.eye(len(parents), dtype=torch.bool)
+    for i in range(1, len(parents)):
+        ancestors[i] |= ancestors[parents[i]]
+    return ancestors
+
+
+@contextmanager
+def _tree_attention_mask(model, tree_mask):
+    """
+    Make the last `tree_mask.size(0)` tokens of the forwards of `model` in this context
+    only attend to the last `tree_mask.size(1)` tokens where `tree_mask` is True,
+    e.g. to their ancestors in a token tree. Past tokens keep the original mask.
+    """
+    def apply_tree_mask(mask, input_shape, inputs_embeds, past_key_values_length):
+        bsz, q_len = input_shape
+        if mask is None:
+            # sdpa returns None for a causal mask without padding
+            mask = torch.zeros(bsz, 1, q_len, q_len + past_key_values_length,
+                               dtype=inputs_embeds.dtype, device=inputs_embeds.device)
+        else:
+            mask = mask.clone()
+        n_tree = tree_mask.size(1)
+        mask[..., -n_tree:] = mask[..., -n_tree:].masked_fill(~tree_mask.to(mask.device),
+                                                              torch.finfo(mask.dtype).min)
+        return mask
+
+    def wrap(prepare_mask):
+        def prepare_tree_mask(attention_mask, input_shape, inputs_embeds,
+                              past_key_values_length, *args, **kwargs):
+            mask = prepare_mask(attention_mask, input_shape, inputs_embeds,
+                                past_key_values_length, *args, **kwargs)
+            return apply_tree_mask(mask, input_shape, inputs_embeds, past_key_values_length)
+        return prepare_tree_mask
+
+    base_model = model.base_model
+    if hasattr(base_model, "_prepare_decoder_attention_mask"):
+        # transformers < 4.36
+        base_model._prepare_decoder_attention_mask = \
+            wrap(base_model._prepare_decoder_attention_mask)
+        try:
+            yield
+        finally:
+            del base_model._prepare_decoder_attention_mask
+    else:
+        module = sys.modules[type(base_model).__module__]
+        originals = {}
+        for name in ["_prepare_4d_causal_attention_mask",
+                     "_prepare_4d_causal_attention_mask_for_sdpa"]:
+            if hasattr(module, name):
+                originals[name] = getattr(module, name)
+                setattr(module, name, wrap(originals[name]))
+        try:
+            yield
+        finally:
+            for name, prepare_mask in originals.items():
+                setattr(module, name, prepare_mask)
+
+
+def _speculative_generate_tree(self, input_ids, attention_mask, draft_model,
+                               generation_config, logits_processor,
+                               max_new_tokens, max_step_draft, th_stop_draft,
+                               auto_th_stop_draft, auto_parameters, hf_adjust,
+                               tree_top_k, max_tree_nodes, streamer=None):
+    # The draft model drafts a token tree level by level: a node follows the top-1
+    # token of the draft model if its prob is at least th_stop_draft, and branches
+    # into the top-k tokens otherwise, keeping the max_tree_nodes most likely paths.
+    # The target model verifies all nodes in one forward with a tree mask,
+    # and the longest path matching its outputs is accepted.
+    invalidInputError(draft_model is not None,
+                      "Tree speculative decoding needs a draft model.")
+    invalidInputError(self.config.model_type in _TREE_MODEL_TYPES,
+                      f"Tree speculative decoding only supports {_TREE_MODEL_TYPES} "
+                      f"models currently.")
+    invalidInputError(not generation_config.do_sample,
+                      "Tree speculative decoding only supports greedy search.")
+    from ipex_llm.transformers.convert import get_enable_ipex
+    invalidInputError(not get_enable_ipex(),
+                      "Tree speculative decoding does not support IPEX-LLM.")
+
+    device = self.device
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    attention_mask = attention_mask.to(device=device, dtype=torch.long)
+    eos_token_id = generation_config.eos_token_id
+    if not isinstance(eos_token_id, list):
+        eos_token_id = [eos_token_id]
+
+    draft_gen_length = max_step_draft + 6 if hf_adjust else max_step_draft + 1
+    generate_ids = torch.empty([1, max_new_tokens + draft_gen_length],
+                               dtype=torch.long, device=device)
+    past_key_values_storage = []
+    tmp_matchness = 0
+    step_verify = 0
+
+    self.clear_benchmarks()
+
+    if device.type == 'xpu':
+        torch.xpu.empty_cache()
+
+    # first token use full model
+    tic = time.time()
+    output = self(input_ids=input_ids,
+                  attention_mask=attention_mask,
+                  return_dict=True,
+                  use_cache=True)
+    logits = logits_processor(input_ids, output['logits'][:, -1, :])
+    generate_ids[:, 0] = greedy(logits)
+    past_key_values = output['past_key_values']
+    step = 1
+    if streamer is not None:
+        streamer.put(generate_ids[:, :1].cpu())
+    if device.type == 'xpu':
+        torch.xpu.synchronize()
+    toc = time.time()
+    self.first_token_time = toc - tic
+    e2e_tic = time.time()
+
+    while step < max_new_tokens and generate_ids[0, step - 1].item() not in eos_token_id:
+        cur_len = past_key_values[0][0].size(2)
+        history_ids = torch.cat((input_ids, generate_ids[:, :step]), dim=-1)
+        if device.type == 'cpu':
+            if len(past_key_values_storage) == 0:
+                past_key_values_storage = \
+                    _prepare_past_key_values_storage_cpu(self, past_key_values, max_new_tokens)
+            past_key_values_storage = \
+                _extend_past_key_values_storage_cpu(past_key_values_storage, cur_len,
+                                                    cur_len + max_tree_nodes, max_new_tokens)
+            draft_past_key_values = \
+                _prepare_draft_past_key_values_cpu(self, past_key_values,
+                                                   past_key_values_storage, False)
+            original_draft_past_key_values = draft_past_key_values
+        else:
+            past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
+                                                                    max_tree_nodes,
+                                                                    max_new_tokens - step + 40,
+                                                                    self.config.model_type)
+            draft_past_key_values = past_key_values
+
+        # Draft a token tree, node 0 is the current token
+        tic = time.time()
+        max_depth = min(max_step_draft, max_new_tokens - step - 1)
+        tokens = [generate_ids[0, step - 1].item()]
+        parents = [-1]
+        depths = [0]
+        path_probs = [1.0]
+        frontier = [0]
+        n_fed = 0
+        while len(frontier) > 0 and depths[frontier[0]] < max_depth and \
+                len(tokens) < max_tree_nodes:
+            ancestors = _tree_ancestors(parents)
+            n_nodes = len(tokens)
+            draft_attention_mask = torch.cat((attention_mask,
+                                              attention_mask.new_ones(1, n_nodes)), dim=-1)
+            position_ids = torch.tensor([depths[n_fed:]], dtype=torch.long, device=device)
+            with _tree_attention_mask(draft_model, ancestors[n_fed:, :n_nodes]):
+                draft_output = draft_model(input_ids=torch.tensor([tokens[n_fed:]],
+                                                                  device=device),
+                                           past_key_values=draft_past_key_values,
+                                           attention_mask=draft_attention_mask,
+                                           position_ids=position_ids + cur_len,
+                                           return_dict=True,
+                                           use_cache=True)
+            draft_past_key_values = draft_output['past_key_values']
+            logits = draft_output['logits'][0]
+            candidates = []
+            for i, node in enumerate(frontier):
+                path = [tokens[n] for n in ancestors[node].nonzero().flatten().tolist()[1:]]
+                path_ids = torch.cat((history_ids[0], torch.tensor(path, dtype=torch.long,
+                                                                   device=device)))
+                node_logits = logits_processor(path_ids.unsqueeze(0), logits[i:i+1])
+                top_probs, top_ids = node_logits.softmax(-1)[0].topk(tree_top_k)
+                # branch only where the draft model is unsure
+                width = 1 if top_probs[0].item() >= th_stop_draft else tree_top_k
+                for j in range(width):
+                    candidates.append((path_probs[node] * top_probs[j].item(), node,
+                                       top_ids[j].item()))
+            n_fed = n_nodes
+            candidates.sort(key=lambda candidate: -candidate[0])
+            frontier = []
+            for path_prob, parent, token in candidates[:max_tree_nodes - n_nodes]:
+                frontier.append(len(tokens))
+                tokens.append(token)
+                parents.append(parent)
+                depths.append(depths[parent] + 1)
+                path_probs.append(path_prob)
+        if device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.draft_time.append(toc - tic)
+
+        # Target model verify the whole tree in one forward
+        tic = time.time()
+        n_nodes = len(tokens)
+        ancestors = _tree_ancestors(parents)
+        verify_attention_mask = torch.cat((attention_mask,
+                                           attention_mask.new_ones(1, n_nodes)), dim=-1)
+        position_ids = torch.tensor([depths], dtype=torch.long, device=device) + cur_len
+        with _tree_attention_mask(self, ancestors):
+            output = self(input_ids=torch.tensor([tokens], device=device),
+                          past_key_values=past_key_values,
+                          attention_mask=verify_attention_mask,
+                          position_ids=position_ids,
+                          return_dict=True,
+                          use_cache=True)
+        logits = output['logits']
+        past_key_values = output['past_key_values']
+        for n in range(n_nodes):
+            path = [tokens[m] for m in ancestors[n].nonzero().flatten().tolist()[1:]]
+            path_ids = torch.cat((history_ids[0], torch.tensor(path, dtype=torch.long,
+                                                               device=device)))
+            logits[:, n, :] = logits_processor(path_ids.unsqueeze(0), logits[:, n, :])
+        output_ids = greedy(logits)[0].tolist()
+        if device.type == 'xpu':
+            torch.xpu.synchronize()
+            if extend_kv:
+                torch.xpu.empty_cache()
+        toc = time.time()
+        self.verify_time.append(toc - tic)
+        self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
+
+        # Accept the longest path following the outputs of the target model
+        children = {(parents[n], tokens[n]): n for n in range(1, n_nodes)}
+        accepted_path = [0]
+        while (accepted_path[-1], output_ids[accepted_path[-1]]) in children:
+            accepted_path.append(children[(accepted_path[-1], output_ids[accepted_path[-1]])])
+        accepted_ids = [tokens[n] for n in accepted_path[1:]] + [output_ids[accepted_path[-1]]]
+        max_matched = len(accepted_path)
+        self.draft_num.append(n_nodes - 1)
+        self.accept_num.append(max_matched)
+
+        # Move the KV of the accepted path after the past and drop the rest
+        path_index = torch.tensor(accepted_path, device=device) + cur_len
+        new_len = cur_len + max_matched
+        for k, v in past_key_values:
+            k[:, :, cur_len:new_len] = k[:, :, path_index]
+            v[:, :, cur_len:new_len] = v[:, :, path_index]
+        past_key_values = [(k[:, :, :new_len], v[:, :, :new_len]) for k, v in past_key_values]
+        attention_mask = torch.cat((attention_mask,
+                                    attention_mask.new_ones(1, max_matched)), dim=-1)
+        if device.type == 'cpu':
+            _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
+                                                original_draft_past_key_values)
+
+        # Stop on eos and remove content after eos
+        for i, token in enumerate(accepted_ids):
+            if token in eos_token_id:
+                accepted_ids = accepted_ids[:i + 1]
+                break
+        generate_ids[0, step:step + len(accepted_ids)] = torch.tensor(accepted_ids,
+                                                                      device=device)
+        step += len(accepted_ids)
+        if streamer is not None:
+            streamer.put(torch.tensor([accepted_ids]))
+
+        # remove one generated by the base model
+        drafted_depth = max(depths)
+        self.n_matched += max_matched - 1
+        self.n_drafted += n_nodes - 1
+        step_verify += 1
+
+        if auto_th_stop_draft and step_verify % auto_parameters[0] == 0 and drafted_depth > 0:
+            # a higher th_stop_draft branches at more nodes
+            tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
+                (1-auto_parameters[1])*((max_matched - 1)/drafted_depth)
+            if tmp_matchness < auto_parameters[2]:
+                new_th_stop_draft = th_stop_draft+auto_parameters[3]
+            else:
+                if drafted_depth == max_step_draft:
+                    new_th_stop_draft = th_stop_draft
+                else:
+                    new_th_stop_draft = th_stop_draft - auto_parameters[3]
+            th_stop_draft = auto_parameters[4] * th_stop_draft + \
+                (1-auto_parameters[4]) * new_th_stop_draft
+
+        if hf_adjust:
+            if (max_matched - 1) == max_step_draft:
+                max_step_draft = min(draft_gen_length - 1, max_step_draft + 1)
+            else:
+                max_step_draft = max(1, max_step_draft - 1)
+
+    step = min(step, max_new_tokens)
+    e2e_toc = time.time()
+    self.n_token_generated = step
+    self.e2e_time_without_first = e2e_toc - e2e_tic
+
+    if streamer is not None:
+        streamer.end()
+
     generate_ids = torch.cat([input_ids, generate_ids[:, :step]], dim=-1)
 
     return generate_ids
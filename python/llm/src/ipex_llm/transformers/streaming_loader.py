@@ -0,0 +1,265 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Load a Hugging Face checkpoint into a low-bit model one tensor at a time.
+#
+# The model is created on the meta device and converted by
+# `ggml_convert_low_bit` before any weight is read. Every tensor of the
+# checkpoint is then quantized as soon as it is read and its full-precision
+# data dropped, so the peak memory is about the size of the low-bit model plus
+# the few layers being quantized, instead of the full-precision model.
+
+import json
+import os
+
+import torch
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+WEIGHTS_NAME = "pytorch_model.bin"
+WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+
+# `_optimize_pre` rewrites the full-precision weights of these models before
+# they are quantized, which cannot be done one tensor at a time.
+_UNSUPPORTED_MODEL_TYPES = ["rwkv", "baichuan", "yuan", "bert", "qwen"]
+
+# kwargs of `from_pretrained` which only matter to loading a checkpoint as a whole
+_LOADING_KWARGS = ["low_cpu_mem_usage", "device_map", "cache_dir", "force_download",
+                   "resume_download", "proxies", "local_files_only", "token", "use_auth_token",
+                   "revision", "use_safetensors", "_fast_init", "offload_folder",
+                   "offload_state_dict"]
+# kwargs of `from_pretrained` which choose other checkpoint files
+_CHECKPOINT_KWARGS = ["subfolder", "variant", "from_tf", "from_flax"]
+
+
+def get_checkpoint_files(pretrained_model_name_or_path):
+    """Return the local checkpoint shards of a model, or None if there are none."""
+    if not os.path.isdir(pretrained_model_name_or_path):
+        return None
+    for index_name, weights_name in [(SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME),
+                                     (WEIGHTS_INDEX_NAME, WEIGHTS_NAME)]:
+        index_file = os.path.join(pretrained_model_name_or_path, index_name)
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as f:
+                weight_map = json.load(f)["weight_map"]
+            return [os.path.join(pretrained_model_name_or_path, shard)
+                    for shard in sorted(set(weight_map.values()))]
+        weights_file = os.path.join(pretrained_model_name_or_path, weights_name)
+        if os.path.isfile(weights_file):
+            return [weights_file]
+    return None
+
+
+def iter_checkpoint_tensors(checkpoint_file):
+    """Yield the (name, tensor) pairs of a checkpoint shard one at a time."""
+    if checkpoint_file.endswith(".safetensors"):
+        from safetensors import safe_open
+        with safe_open(checkpoint_file, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+    else:
+        try:
+            # only tensors being read are paged in
+            state_dict = torch.load(checkpoint_file, map_location="cpu", mmap=True)
+        except TypeError:
+            # torch < 2.1 reads the whole shard
+            state_dict = torch.load(checkpoint_file, map_location="cpu")
+        for name in list(state_dict.keys()):
+            yield name, state_dict.pop(name)
+
+
+def _get_checkpoint_dtype(checkpoint_file):
+    """Return the dtype of the first floating point tensor of a checkpoint shard."""
+    for _, tensor in iter_checkpoint_tensors(checkpoint_file):
+        if tensor.is_floating_point():
+            return tensor.dtype
+    return torch.float32
+
+
+def _resolve_key(name, model_keys, prefix):
+    if name in model_keys:
+        return name
+    if prefix and f"{prefix}.{name}" in model_keys:
+        return f"{prefix}.{name}"
+    if prefix and name.startswith(f"{prefix}.") and name[len(prefix) + 1:] in model_keys:
+        return name[len(prefix) + 1:]
+    return None
+
+
+def _set_tensor(model, name, tensor, dtype, quantizer):
+    module_name, _, attr = name.rpartition(".")
+    _set_module_tensor(model.get_submodule(module_name), attr, tensor, dtype, quantizer)
+
+
+def _set_module_tensor(module, attr, tensor, dtype, quantizer):
+    from .low_bit_linear import FP4Params, LowBitLinear
+    if attr in module._buffers:
+        old_buffer = module._buffers[attr]
+        module._buffers[attr] = tensor.to(old_buffer.dtype) if old_buffer is not None \
+            else tensor
+        return
+    old_param = module._parameters[attr]
+    if isinstance(old_param, FP4Params):
+        qtype = old_param.qtype
+        # converting on the meta device resolves the mixed qtypes to their
+        # fallback, the actual one is chosen when quantizing real weights
+        if isinstance(module, LowBitLinear) and \
+                module.qtype in [ggml_tensor_qtype["mixed_fp4"], ggml_tensor_qtype["mixed_fp8"]]:
+            qtype = module.qtype
+        if tensor.is_floating_point():
+            # quantize the same data as loading the model in `dtype` as a whole
+            tensor = tensor.to(dtype)
+        param = FP4Params(data=tensor,
+                          requires_grad=False,
+                          quantized=False,
+                          _shape=None,
+                          qtype=qtype,
+                          imatrix=old_param.imatrix,
+                          in_features=old_param.in_features,
+                          enable_xetla=old_param.enable_xetla)
+        module._parameters[attr] = param
+        if quantizer is not None:
+            quantizer.submit(param)
+        else:
+            param.quantize("cpu")
+    else:
+        if tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        module._parameters[attr] = torch.nn.Parameter(tensor,
+                                                      requires_grad=old_param.requires_grad)
+
+
+def streaming_load_low_bit(hf_model_cls, qtype, optimize_model,
+                           pretrained_model_name_or_path, *model_args,
+                           modules_to_not_convert=None, cpu_embedding=False,
+                           lightweight_bmm=False, imatrix_data=None,
+                           embedding_qtype=None, enable_xetla=False, **kwargs):
+    """
+    Load a low-bit model by quantizing the checkpoint one tensor at a time.
+
+    :return: the low-bit model, or None if this model can't be loaded in a streaming way,
+             in which case it should be loaded as a whole.
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig
+    from transformers.generation.configuration_utils import GenerationConfig
+    from .convert import ggml_convert_low_bit, convert_bigdl_other_module, _optimize_post, \
+        _ParallelQuantizer
+
+    checkpoint_files = get_checkpoint_files(pretrained_model_name_or_path)
+    if checkpoint_files is None:
+        logger.info("Streaming load only supports local checkpoints, "
+                    "will fall back to load the whole model.")
+        return None
+    if qtype in [ggml_tensor_qtype["fp16"], ggml_tensor_qtype["bf16"]]:
+        return None
+
+    # there is no way to pass positional arguments to the model through `from_config`
+    invalidInputError(len(model_args) == 0,
+                      "Positional model arguments are not supported by `streaming_load`, "
+                      "please pass them as keyword arguments.")
+    if any(kwargs.get(name, None) for name in _CHECKPOINT_KWARGS):
+        logger.info(f"Streaming load doesn't support {_CHECKPOINT_KWARGS}, "
+                    "will fall back to load the whole model.")
+        return None
+    kwargs = {k: v for k, v in kwargs.items() if k not in _LOADING_KWARGS}
+    trust_remote_code = kwargs.pop("trust_remote_code", None)
+    torch_dtype = kwargs.pop("torch_dtype", "auto")
+    config = kwargs.pop("config", None)
+    if config is None:
+        # like `from_pretrained`, the kwargs which are attributes of the config update
+        # the config, and the rest are passed to the model
+        config, kwargs = AutoConfig.from_pretrained(pretrained_model_name_or_path,
+                                                    return_unused_kwargs=True,
+                                                    trust_remote_code=trust_remote_code,
+                                                    **kwargs)
+    if config.model_type in _UNSUPPORTED_MODEL_TYPES:
+        logger.info(f"Streaming load is not supported for {config.model_type}, "
+                    "will fall back to load the whole model.")
+        return None
+
+    # the dtype the checkpoint is loaded in, resolved as `from_pretrained` does
+    load_dtype = torch_dtype
+    if load_dtype == "auto":
+        load_dtype = getattr(config, "torch_dtype", None) or \
+            _get_checkpoint_dtype(checkpoint_files[0])
+        if isinstance(load_dtype, str):
+            load_dtype = getattr(torch, load_dtype)
+
+    with init_empty_weights():
+        model = hf_model_cls.from_config(config, trust_remote_code=trust_remote_code,
+                                         torch_dtype=load_dtype, **kwargs)
+    model = ggml_convert_low_bit(model, qtype, optimize_model=False, device="meta",
+                                 modules_to_not_convert=modules_to_not_convert,
+                                 cpu_embedding=cpu_embedding, torch_dtype=torch_dtype,
+                                 imatrix_data=imatrix_data,
+                                 embedding_qtype=embedding_qtype,
+                                 enable_xetla=enable_xetla)
+
+    model_keys = set(model.state_dict().keys())
+    prefix = getattr(model, "base_model_prefix", "")
+    unexpected_keys = []
+    quantizer = _ParallelQuantizer.create()
+    try:
+        for checkpoint_file in checkpoint_files:
+            for name, tensor in iter_checkpoint_tensors(checkpoint_file):
+                key = _resolve_key(name, model_keys, prefix)
+                if key is None:
+                    unexpected_keys.append(name)
+                    continue
+                _set_tensor(model, key, tensor, load_dtype, quantizer)
+                del tensor
+    finally:
+        failed = quantizer.wait() if quantizer is not None else None
+    if failed is not None:
+        failed.result()
+    if len(unexpected_keys) > 0:
+        logger.warning(f"Some weights of the checkpoint were not used: {unexpected_keys}")
+
+    from .low_bit_linear import FP4Params
+    output_embeddings = model.get_output_embeddings()
+    input_embeddings = model.get_input_embeddings()
+    if getattr(config, "tie_word_embeddings", False) and output_embeddings is not None and \
+            isinstance(output_embeddings.weight, FP4Params) and \
+            output_embeddings.weight.device.type == "meta" and \
+            not isinstance(input_embeddings.weight, FP4Params):
+        # a low-bit lm_head is quantized from its own copy of the tied embedding
+        _set_module_tensor(output_embeddings, "weight", input_embeddings.weight.data.clone(),
+                           load_dtype, None)
+    else:
+        model.tie_weights()
+    missing_keys = [name for name, param in model.named_parameters()
+                    if param.device.type == "meta"]
+    invalidInputError(len(missing_keys) == 0,
+                      f"Weights of {missing_keys} are missing in {pretrained_model_name_or_path}.")
+    # same as `ggml_convert_low_bit` converting a model on cpu
+    convert_bigdl_other_module(model, torch.float32 if torch_dtype == "auto" else torch_dtype)
+
+    if optimize_model:
+        model = _optimize_post(model, lightweight_bmm)
+    model.eval()
+
+    if model.can_generate():
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(
+                pretrained_model_name_or_path)
+        except (OSError, TypeError):
+            pass
+    return model
@@ -39,6 +39,8 @@ from ipex_llm.utils.common import invalidInputError
 
 logger = init_logger(__name__)
 
+_GB = 1 << 30
+
 
 class ModelConfig:
     """Configuration for the model.
@@ -180,8 +182,14 @@ class ModelConfig:
         # FIXME(woosuk): This may not be true for all models.
         return self.hf_config.hidden_size // self.hf_config.num_attention_heads
 
-    def get_num_kv_heads(self, parallel_config: "ParallelConfig") -> int:
+    def get_num_kv_heads(self, parallel_config: Optional["ParallelConfig"] = None) -> int:
         """Returns the number of KV heads per GPU worker."""
+        # bigdl-llm change start
+        # summary: parallel_config is removed, so default to a single worker
+        tensor_parallel_size = 1
+        if parallel_config is not None:
+            tensor_parallel_size = parallel_config.tensor_parallel_size
+        # bigdl-llm change end
         # For GPTBigCode & Falcon:
         # Note: for falcon, when new_decoder_architecture is True, the
         # multi_query flag is ignored and we use n_head_kv for the number of
@@ -198,22 +206,67 @@ class ModelConfig:
         # For Falcon:
         if getattr(self.hf_config, "n_head_kv", None) is not None:
             return (self.hf_config.n_head_kv //
-                    parallel_config.tensor_parallel_size)
+                    tensor_parallel_size)
         if getattr(self.hf_config, "num_kv_heads", None) is not None:
             return (self.hf_config.num_kv_heads //
-                    parallel_config.tensor_parallel_size)
+                    tensor_parallel_size)
         # For LLaMA-2:
         if getattr(self.hf_config, "num_key_value_heads", None) is not None:
             return (self.hf_config.num_key_value_heads //
-                    parallel_config.tensor_parallel_size)
+                    tensor_parallel_size)
         total_num_attention_heads = self.hf_config.num_attention_heads
-        return total_num_attention_heads // parallel_config.tensor_parallel_size
+        return total_num_attention_heads // tensor_parallel_size
 
-    def get_num_layers(self, parallel_config: "ParallelConfig") -> int:
+    def get_num_layers(self, parallel_config: Optional["ParallelConfig"] = None) -> int:
         total_num_hidden_layers = self.hf_config.num_hidden_layers
+        if parallel_config is None:
+            return total_num_hidden_layers
         return total_num_hidden_layers // parallel_config.pipeline_parallel_size
 
 
+class CacheConfig:
+    """Configuration for the paged KV cache.
+
+    Args:
+        block_size: Size of a cache block in number of tokens.
+        kv_cache_space: Size of the CPU memory (GiB) reserved for the KV cache blocks.
+        enable_paged_kv_cache: Whether to store the KV cache in fixed-size blocks
+            addressed through per-sequence block tables. If False, the per-sequence
+            KV tensors are re-batched by the model wrapper at every step.
+        enable_prefix_caching: Whether the computed blocks of a prompt are reused
+            by later prompts starting with the same tokens.
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        kv_cache_space: int,
+        enable_paged_kv_cache: bool = False,
+        enable_prefix_caching: bool = False,
+    ) -> None:
+        self.block_size = block_size
+        self.kv_cache_space_bytes = kv_cache_space * _GB
+        self.enable_paged_kv_cache = enable_paged_kv_cache
+        self.enable_prefix_caching = enable_prefix_caching
+        self._verify_args()
+
+        # Will be set after profiling.
+        self.num_cpu_blocks = None
+
+    def _verify_args(self) -> None:
+        if self.block_size <= 0:
+            invalidInputError(False,
+                              f"block_size ({self.block_size}) must be positive.")
+        if self.kv_cache_space_bytes <= 0:
+            invalidInputError(False,
+                              "kv_cache_space must be positive, got "
+                              f"{self.kv_cache_space_bytes // _GB} GiB.")
+        if self.enable_prefix_caching and not self.enable_paged_kv_cache:
+            invalidInputError(False,
+                              "Prefix caching shares KV cache blocks, "
+                              "please also set --enable-paged-kv-cache.")
+
+
 _STR_DTYPE_TO_TORCH_DTYPE = {
     "half": torch.float16,
     "float16": torch.float16,
@@ -386,6 +439,11 @@ class SchedulerConfig:
             iteration.
         max_model_len: Maximum length of a sequence (including prompt
             and generated text).
+        enable_mixed_batching: Whether new prompts and running decodes are
+            batched in the same iteration. max_num_batched_tokens is then the
+            token budget shared by both.
+        prefill_chunk_size: If set, prompts are prefilled in chunks of at most
+            this many tokens over several iterations. Requires mixed batching.
     """
 
     def __init__(
@@ -393,6 +451,8 @@ class SchedulerConfig:
         max_num_batched_tokens: Optional[int],
         max_num_seqs: int,
         max_model_len: int,
+        enable_mixed_batching: bool = False,
+        prefill_chunk_size: Optional[int] = None,
     ) -> None:
         if max_num_batched_tokens is not None:
             self.max_num_batched_tokens = max_num_batched_tokens
@@ -402,10 +462,21 @@ class SchedulerConfig:
             self.max_num_batched_tokens = max(max_model_len, 2048)
         self.max_num_seqs = max_num_seqs
         self.max_model_len = max_model_len
+        self.enable_mixed_batching = enable_mixed_batching
+        self.prefill_chunk_size = prefill_chunk_size
         self._verify_args()
 
     def _verify_args(self) -> None:
-        if self.max_num_batched_tokens < self.max_model_len:
+        if self.prefill_chunk_size is not None:
+            invalidInputError(self.prefill_chunk_size > 0,
+                              "prefill_chunk_size must be positive.")
+            invalidInputError(self.enable_mixed_batching,
+                              "Chunked prefill interleaves prompt chunks with decodes, "
+                              "please also set --enable-mixed-batching.")
+        # With chunked prefill, long prompts no longer need to fit into a
+        # single iteration.
+        if (self.prefill_chunk_size is None
+                and self.max_num_batched_tokens < self.max_model_len):
             invalidInputError(
                 f"max_num_batched_tokens ({self.max_num_batched_tokens}) is "
                 f"smaller than max_model_len ({self.max_model_len}). "
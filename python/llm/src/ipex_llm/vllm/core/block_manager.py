@@ -0,0 +1,353 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Some parts of this file is adapted from
+# https://github.com/vllm-project/vllm/blob/v0.2.1.post1/vllm/core/block_manager.py
+# which is licensed under Apache License 2.0
+#
+# Copyright 2023 The vLLM team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# bigdl-llm Intel specified code change
+#
+"""A block manager that manages token blocks."""
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ipex_llm.vllm.sequence import Sequence, SequenceGroup, SequenceStatus
+from ipex_llm.utils.common import invalidInputError
+
+
+class PhysicalTokenBlock:
+    """Represents the state of a block in the KV cache."""
+
+    def __init__(
+        self,
+        block_number: int,
+        block_size: int,
+    ) -> None:
+        self.block_number = block_number
+        self.block_size = block_size
+
+        self.ref_count = 0
+        # Hash of the tokens up to and including this block, set for the full
+        # prompt blocks when prefix caching is enabled.
+        self.block_hash: Optional[int] = None
+        # Whether the KV of the block has been written by a finished step.
+        self.computed = False
+
+    def __repr__(self) -> str:
+        return (f'PhysicalTokenBlock(block_number={self.block_number}, '
+                f'ref_count={self.ref_count}, '
+                f'block_hash={self.block_hash}, '
+                f'computed={self.computed})')
+
+
+# Mapping: logical block number -> physical block.
+BlockTable = List[PhysicalTokenBlock]
+
+
+class BlockAllocator:
+    """Manages free physical token blocks.
+
+    This class maintains a list of free blocks and allocates a block when
+    requested. When a block is freed, its reference count is decremented. If
+    the reference count becomes zero, the block is added back to the free list.
+
+    bigdl-llm change start
+    summary: with prefix caching, a computed block with a hash is not returned
+    to the free list once unreferenced. It is kept in an LRU evictor so that a
+    later sequence with the same prefix can reuse it, and is only recycled when
+    the free list runs out.
+    bigdl-llm change end
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        num_blocks: int,
+        enable_caching: bool = False,
+    ) -> None:
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.enable_caching = enable_caching
+
+        # Initialize the free blocks.
+        self.free_blocks: BlockTable = []
+        for i in range(num_blocks):
+            block = PhysicalTokenBlock(block_number=i, block_size=block_size)
+            self.free_blocks.append(block)
+
+        # Mapping: block hash -> block, whether in use or evictable.
+        self.cached_blocks: Dict[int, PhysicalTokenBlock] = {}
+        # Unreferenced cached blocks, least recently used first.
+        self.evictor: "OrderedDict[int, PhysicalTokenBlock]" = OrderedDict()
+
+    def allocate(self, block_hash: Optional[int] = None) -> PhysicalTokenBlock:
+        if block_hash is not None:
+            block = self.cached_blocks.get(block_hash)
+            if block is not None:
+                if block.ref_count == 0:
+                    del self.evictor[block_hash]
+                block.ref_count += 1
+                return block
+
+        if self.free_blocks:
+            block = self.free_blocks.pop()
+        elif self.evictor:
+            _, block = self.evictor.popitem(last=False)
+            del self.cached_blocks[block.block_hash]
+        else:
+            invalidInputError(False, "Out of memory! No free blocks are available.")
+        block.ref_count = 1
+        block.block_hash = block_hash
+        block.computed = False
+        if block_hash is not None:
+            self.cached_blocks[block_hash] = block
+        return block
+
+    def free(self, block: PhysicalTokenBlock) -> None:
+        if block.ref_count == 0:
+            invalidInputError(False, f"Double free! {block} is already freed.")
+        block.ref_count -= 1
+        if block.ref_count == 0:
+            if block.block_hash is not None and block.computed:
+                self.evictor[block.block_hash] = block
+                return
+            if block.block_hash is not None:
+                del self.cached_blocks[block.block_hash]
+                block.block_hash = None
+            self.free_blocks.append(block)
+
+    def get_cached_block(self, block_hash: int) -> Optional[PhysicalTokenBlock]:
+        return self.cached_blocks.get(block_hash)
+
+    def get_num_free_blocks(self) -> int:
+        # Evictable blocks are recycled on demand, so they count as free.
+        return len(self.free_blocks) + len(self.evictor)
+
+
+class BlockSpaceManager:
+    """Manages the mapping between logical and physical token blocks.
+
+    bigdl-llm change start
+    summary: only the CPU KV cache is managed here. Swapping between devices is
+    not supported, so preempted sequences are always recomputed.
+    With prefix caching, every full prompt block is keyed on the hash of the
+    tokens up to its end, so that a prompt starting with the same tokens as an
+    earlier one shares its computed blocks and skips their prefill. Shared
+    blocks are copied before a sequence writes into them.
+    bigdl-llm change end
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        num_cpu_blocks: int,
+        watermark: float = 0.01,
+        enable_caching: bool = False,
+    ) -> None:
+        self.block_size = block_size
+        self.num_total_cpu_blocks = num_cpu_blocks
+
+        self.watermark = watermark
+        invalidInputError(watermark >= 0.0, "watermark should not be negative")
+        self.watermark_blocks = int(watermark * num_cpu_blocks)
+
+        self.enable_caching = enable_caching
+        self.cpu_allocator = BlockAllocator(block_size, num_cpu_blocks, enable_caching)
+        # Mapping: seq_id -> BlockTable.
+        self.block_tables: Dict[int, BlockTable] = {}
+
+        # Number of full prompt blocks looked up in and reused from the cache.
+        self.num_prefix_cache_queries = 0
+        self.num_prefix_cache_hits = 0
+
+    def get_num_required_blocks(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def can_ever_allocate(self, seq_group: SequenceGroup) -> bool:
+        seq = seq_group.get_seqs(status=SequenceStatus.WAITING)[0]
+        num_required_blocks = self.get_num_required_blocks(seq.get_len())
+        return num_required_blocks <= self.num_total_cpu_blocks - self.watermark_blocks
+
+    def can_allocate(self, seq_group: SequenceGroup) -> bool:
+        # FIXME(woosuk): Here we assume that all sequences in the group share
+        # the same prompt. This may not be true for preempted sequences.
+        seq = seq_group.get_seqs(status=SequenceStatus.WAITING)[0]
+        num_required_blocks = self.get_num_required_blocks(seq.get_len())
+        num_free_cpu_blocks = self.cpu_allocator.get_num_free_blocks()
+        # Use watermark to avoid frequent cache eviction.
+        return (num_free_cpu_blocks - num_required_blocks >=
+                self.watermark_blocks)
+
+    def _get_block_hashes(self, seq: Sequence) -> List[int]:
+        # One hash per full block, chained so that it covers the whole prefix.
+        token_ids = seq.get_token_ids()
+        block_hashes = []
+        block_hash = None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block_hash = hash((block_hash, tuple(token_ids[start:start + self.block_size])))
+            block_hashes.append(block_hash)
+        return block_hashes
+
+    def get_num_cached_tokens(self, seq: Sequence) -> int:
+        """Number of leading prompt tokens whose KV can be reused from the cache."""
+        if not self.enable_caching:
+            return 0
+        num_cached_blocks = 0
+        for block_hash in self._get_block_hashes(seq):
+            block = self.cpu_allocator.get_cached_block(block_hash)
+            if block is None or not block.computed:
+                break
+            num_cached_blocks += 1
+        # The last token is always computed to produce the logits.
+        return min(num_cached_blocks * self.block_size, seq.get_len() - 1)
+
+    def allocate(
+        self,
+        seq_group: SequenceGroup,
+        blocks_to_copy: Optional[Dict[int, List[int]]] = None,
+    ) -> None:
+        # NOTE: Here we assume that all sequences in the group have the same
+        # prompt.
+        seqs = seq_group.get_seqs(status=SequenceStatus.WAITING)
+        num_required_blocks = self.get_num_required_blocks(seqs[0].get_len())
+        num_cached_tokens = self.get_num_cached_tokens(seqs[0])
+        block_hashes = self._get_block_hashes(seqs[0]) if self.enable_caching else []
+
+        # Allocate new physical token blocks that will store the prompt tokens.
+        block_table: BlockTable = []
+        for logical_idx in range(num_required_blocks):
+            block_hash = None
+            if logical_idx < len(block_hashes):
+                block_hash = block_hashes[logical_idx]
+            block = self.cpu_allocator.allocate(block_hash)
+            # Set the reference counts of the token blocks.
+            block.ref_count += len(seqs) - 1
+            block_table.append(block)
+
+        if self.enable_caching:
+            num_cached_blocks = (num_cached_tokens + self.block_size - 1) // self.block_size
+            self.num_prefix_cache_queries += len(block_hashes)
+            self.num_prefix_cache_hits += num_cached_blocks
+            if num_cached_tokens % self.block_size != 0:
+                # The whole prompt is cached, but its last token is recomputed
+                # into the last cached block, which must not be shared.
+                self._copy_on_write(block_table, num_cached_blocks - 1, len(seqs),
+                                    blocks_to_copy)
+
+        # Assign the block table for each sequence.
+        for seq in seqs:
+            self.block_tables[seq.seq_id] = block_table.copy()
+            seq.data.update_num_computed_tokens(num_cached_tokens)
+
+    def _copy_on_write(
+        self,
+        block_table: BlockTable,
+        logical_idx: int,
+        num_refs: int,
+        blocks_to_copy: Optional[Dict[int, List[int]]],
+    ) -> None:
+        # Move num_refs references of the block to a private copy of it.
+        block = block_table[logical_idx]
+        if block.ref_count == num_refs:
+            return
+        new_block = self.cpu_allocator.allocate()
+        new_block.ref_count = num_refs
+        for _ in range(num_refs):
+            self.cpu_allocator.free(block)
+        block_table[logical_idx] = new_block
+        invalidInputError(blocks_to_copy is not None,
+                          "blocks_to_copy is required to copy a shared block.")
+        blocks_to_copy.setdefault(block.block_number, []).append(new_block.block_number)
+
+    def can_append_slot(self, seq_group: SequenceGroup) -> bool:
+        # Simple heuristic: If there is at least one free block
+        # for each sequence, we can append.
+        num_free_cpu_blocks = self.cpu_allocator.get_num_free_blocks()
+        num_seqs = seq_group.num_seqs(status=SequenceStatus.RUNNING)
+        return num_seqs <= num_free_cpu_blocks
+
+    def append_slot(
+        self,
+        seq: Sequence,
+        blocks_to_copy: Optional[Dict[int, List[int]]] = None,
+    ) -> None:
+        """Allocate a physical slot for the token whose KV will be written next."""
+        block_table = self.block_tables[seq.seq_id]
+        # The last token of the sequence is the one fed to the model in the
+        # next step, so the table must cover the whole sequence.
+        if len(block_table) * self.block_size < seq.get_len():
+            while len(block_table) * self.block_size < seq.get_len():
+                block_table.append(self.cpu_allocator.allocate())
+            return
+        # The slot lies in the last block, which may be shared with another
+        # sequence.
+        self._copy_on_write(block_table, len(block_table) - 1, 1, blocks_to_copy)
+
+    def mark_blocks_as_computed(self, seq: Sequence) -> None:
+        """Mark the blocks holding the computed tokens of the sequence reusable."""
+        if not self.enable_caching:
+            return
+        block_table = self.block_tables[seq.seq_id]
+        num_full_blocks = seq.data.get_num_computed_tokens() // self.block_size
+        # Blocks are computed in order, so stop at the first marked one.
+        for block in reversed(block_table[:num_full_blocks]):
+            if block.computed:
+                break
+            block.computed = True
+
+    def get_prefix_cache_hit_rate(self) -> float:
+        if self.num_prefix_cache_queries == 0:
+            return 0.0
+        return self.num_prefix_cache_hits / self.num_prefix_cache_queries
+
+    def _free_block_table(self, block_table: BlockTable) -> None:
+        # Free the last blocks first, so that the evictor recycles the end of a
+        # cached prefix before its beginning, which the rest depends on.
+        for block in reversed(block_table):
+            self.cpu_allocator.free(block)
+
+    def free(self, seq: Sequence) -> None:
+        if seq.seq_id not in self.block_tables:
+            # Already freed or haven't been scheduled yet.
+            return
+        block_table = self.block_tables[seq.seq_id]
+        self._free_block_table(block_table)
+        del self.block_tables[seq.seq_id]
+
+    def reset(self) -> None:
+        for block_table in self.block_tables.values():
+            self._free_block_table(block_table)
+        self.block_tables.clear()
+
+    def get_block_table(self, seq: Sequence) -> List[int]:
+        block_table = self.block_tables[seq.seq_id]
+        return [block.block_number for block in block_table]
+
+    def get_num_free_cpu_blocks(self) -> int:
+        return self.cpu_allocator.get_num_free_blocks()
@@ -38,7 +38,8 @@ import enum
 import time
 from typing import Dict, Iterable, List, Optional, Tuple, Union
 
-from ipex_llm.vllm.config import SchedulerConfig
+from ipex_llm.vllm.config import CacheConfig, SchedulerConfig
+from ipex_llm.vllm.core.block_manager import BlockSpaceManager
 from ipex_llm.vllm.core.policy import PolicyFactory
 from ipex_llm.vllm.logger import init_logger
 from ipex_llm.vllm.sequence import SequenceData, SequenceStatus
@@ -73,6 +74,11 @@ class SchedulerOutputs:
         num_batched_tokens: int,
         ignored_seq_groups: List[SequenceGroup],
         finished_seqs: List[int],
+        num_prompt_groups: int = 0,
+        num_prompt_tokens: int = 0,
+        partial_prefill_groups: Optional[List[SequenceGroup]] = None,
+        token_chunk_sizes: Optional[Dict[str, int]] = None,
+        blocks_to_copy: Optional[Dict[int, List[int]]] = None,
     ) -> None:
         # bigdl-llm change start
         # Summary: we are removing block table related arguments
@@ -83,11 +89,28 @@ class SchedulerOutputs:
         self.num_batched_tokens = num_batched_tokens
         self.ignored_seq_groups = ignored_seq_groups
         self.finished_seqs = finished_seqs
+        # With mixed batching, the first num_prompt_groups scheduled groups are
+        # prompts and the rest are decodes.
+        self.num_prompt_groups = num_prompt_groups
+        self.num_prompt_tokens = num_prompt_tokens
+        # With chunked prefill, the prompts fed to the model in this step
+        # without being sampled from, as their prefill is not complete yet.
+        self.partial_prefill_groups = partial_prefill_groups or []
+        # Request id -> number of tokens each sequence of the group feeds to
+        # the model in this step. Only set with mixed batching.
+        self.token_chunk_sizes = token_chunk_sizes or {}
+        # Source block -> blocks to copy it to before the model runs, for the
+        # shared blocks a sequence is about to write into.
+        self.blocks_to_copy = blocks_to_copy or {}
         # bigdl-llm change end
 
+    def is_prompt(self, index: int) -> bool:
+        return self.prompt_run or index < self.num_prompt_groups
+
     def is_empty(self) -> bool:
         # NOTE: We do not consider the ignored sequence groups.
-        return (not self.scheduled_seq_groups and not self.finished_seqs)
+        return (not self.scheduled_seq_groups and not self.partial_prefill_groups
+                and not self.finished_seqs)
 
 
 class FixedWindowScheduler:
@@ -96,10 +119,15 @@ class FixedWindowScheduler:
         self,
         scheduler_config: SchedulerConfig,
         kv_cache: Optional,
+        cache_config: Optional[CacheConfig] = None,
     ) -> None:
         self.scheduler_config = scheduler_config
-        self.prompt_limit = min(self.scheduler_config.max_model_len,
-                                self.scheduler_config.max_num_batched_tokens)
+        if self.scheduler_config.prefill_chunk_size is not None:
+            # A chunked prompt does not have to fit into one step.
+            self.prompt_limit = self.scheduler_config.max_model_len
+        else:
+            self.prompt_limit = min(self.scheduler_config.max_model_len,
+                                    self.scheduler_config.max_num_batched_tokens)
 
         # bigdl-llm change start
         # summary: cache_config is removed as we are not implementing the pagetable structure
@@ -118,6 +146,21 @@ class FixedWindowScheduler:
         self.kv_cache = kv_cache
         # Co(gc): We no longer have the swapped space as we are not deciding which to swap
         self.swapped: List[SequenceGroup] = []
+        # With the paged KV cache, requests are admitted according to the free
+        # cache blocks and preempted by recomputation when the blocks run out.
+        self.block_manager = None
+        if cache_config is not None and cache_config.enable_paged_kv_cache:
+            self.block_manager = BlockSpaceManager(
+                block_size=cache_config.block_size,
+                num_cpu_blocks=cache_config.num_cpu_blocks,
+                enable_caching=cache_config.enable_prefix_caching,
+            )
+        # Mixing prompts and decodes in one step relies on the packed batches of
+        # the paged KV cache.
+        invalidInputError(not scheduler_config.enable_mixed_batching
+                          or self.block_manager is not None,
+                          "Mixed batching requires the paged KV cache, "
+                          "please also set --enable-paged-kv-cache.")
         # bigdl-llm change end
 
     def add_seq_group(self, seq_group: SequenceGroup) -> None:
@@ -151,7 +194,155 @@ class FixedWindowScheduler:
     def get_num_unfinished_seq_groups(self) -> int:
         return len(self.waiting) + len(self.running)
 
+    def _reserve_decode_slots(
+        self,
+        now: float,
+        blocks_to_copy: Dict[int, List[int]],
+    ) -> List[SequenceGroup]:
+        self.running = self.policy.sort_by_priority(now, self.running)
+
+        # Reserve new token slots for the running sequence groups.
+        running: List[SequenceGroup] = []
+        preempted: List[SequenceGroup] = []
+        while self.running:
+            seq_group = self.running.pop(0)
+            while not self._can_append_slot(seq_group):
+                if self.running:
+                    # Preempt the lowest-priority sequence groups.
+                    victim_seq_group = self.running.pop(-1)
+                    self._preempt(victim_seq_group, preemption_mode=PreemptionMode.RECOMPUTE)
+                    preempted.append(victim_seq_group)
+                else:
+                    # No other sequence groups can be preempted.
+                    # Preempt the current sequence group.
+                    self._preempt(seq_group, preemption_mode=PreemptionMode.RECOMPUTE)
+                    preempted.append(seq_group)
+                    break
+            else:
+                # Append new slots to the sequence group.
+                self._append_slot(seq_group, blocks_to_copy)
+                running.append(seq_group)
+        self.running = running
+        return preempted
+
+    def _schedule_mixed(self) -> SchedulerOutputs:
+        # bigdl-llm change start
+        # summary: one step carries the running decodes together with new prompts.
+        # The decodes reserve their slots first so that admitting prompts never
+        # stalls them, and the prompts fill what is left of the token budget.
+        # With chunked prefill, a prompt is fed at most prefill_chunk_size tokens
+        # per step and stays in the running queue until its last chunk, which is
+        # the only one sampled from. Prompts come first in the output, matching
+        # the order the worker and the sampler lay out a batch in.
+        now = time.monotonic()
+        ignored_seq_groups: List[SequenceGroup] = []
+        finished_seqs: List[int] = self.cleaned.copy()
+        self.cleaned = []
+        chunk_size = self.scheduler_config.prefill_chunk_size
+        token_chunk_sizes: Dict[str, int] = {}
+        blocks_to_copy: Dict[int, List[int]] = {}
+
+        preempted = self._reserve_decode_slots(now, blocks_to_copy)
+        decodes = [seq_group for seq_group in self.running
+                   if not self._is_prefilling(seq_group)]
+        num_decode_tokens = 0
+        for seq_group in decodes:
+            token_chunk_sizes[seq_group.request_id] = 1
+            num_decode_tokens += seq_group.num_seqs(status=SequenceStatus.RUNNING)
+        token_budget = self.scheduler_config.max_num_batched_tokens - num_decode_tokens
+        num_curr_seqs = sum(seq_group.get_max_num_running_seqs()
+                            for seq_group in self.running)
+
+        partial_prefills: List[SequenceGroup] = []
+        prompts: List[SequenceGroup] = []
+        num_prompt_tokens = 0
+
+        def schedule_prompt_chunk(seq_group: SequenceGroup) -> None:
+            nonlocal num_prompt_tokens
+            seq = seq_group.get_seqs(status=SequenceStatus.RUNNING)[0]
+            num_uncomputed_tokens = seq.data.get_num_uncomputed_tokens()
+            num_new_tokens = min(num_uncomputed_tokens, token_budget - num_prompt_tokens)
+            if chunk_size is not None:
+                num_new_tokens = min(num_new_tokens, chunk_size)
+            token_chunk_sizes[seq_group.request_id] = num_new_tokens
+            num_prompt_tokens += num_new_tokens
+            if num_new_tokens < num_uncomputed_tokens:
+                partial_prefills.append(seq_group)
+            else:
+                prompts.append(seq_group)
+
+        # Continue the prompts whose prefill was started in earlier steps.
+        prefilling = [seq_group for seq_group in self.running
+                      if self._is_prefilling(seq_group)]
+        for seq_group in prefilling:
+            if num_prompt_tokens >= token_budget:
+                break
+            schedule_prompt_chunk(seq_group)
+
+        # Preempted sequence groups were just put back to the waiting queue, do
+        # not admit anything before some blocks are freed.
+        while self.waiting and not preempted:
+            seq_group = self.waiting[0]
+
+            invalidInputError(seq_group.num_seqs() == 1,
+                              "Waiting sequence group should have only one prompt "
+                              "sequence.")
+            seq = seq_group.get_seqs()[0]
+            num_new_tokens = seq.get_len()
+            if (num_new_tokens > self.prompt_limit
+                    or not self.block_manager.can_ever_allocate(seq_group)):
+                logger.warning(
+                    f"Input prompt ({num_new_tokens} tokens) is too long"
+                    f" and exceeds limit of {self.prompt_limit} or the KV cache blocks")
+                for seq in seq_group.get_seqs():
+                    seq.status = SequenceStatus.FINISHED_IGNORED
+                ignored_seq_groups.append(seq_group)
+                self.waiting.pop(0)
+                continue
+
+            # A cached prefix is not computed again.
+            num_new_tokens -= self.block_manager.get_num_cached_tokens(seq)
+            if chunk_size is not None:
+                # Only a first chunk of the prompt has to fit into this step.
+                if num_prompt_tokens >= token_budget:
+                    break
+            elif num_prompt_tokens + num_new_tokens > token_budget:
+                # Prompts are packed without padding, so only real tokens count.
+                break
+            num_new_seqs = seq_group.get_max_num_running_seqs()
+            if (num_curr_seqs + num_new_seqs >
+                    self.scheduler_config.max_num_seqs):
+                break
+            if not self.block_manager.can_allocate(seq_group):
+                break
+
+            seq_group = self.waiting.pop(0)
+            # The blocks of the whole prompt are reserved up front, its chunks
+            # are written into them step by step.
+            self._allocate(seq_group, blocks_to_copy)
+            for seq in seq_group.get_seqs():
+                seq.status = SequenceStatus.RUNNING
+            num_curr_seqs += num_new_seqs
+            self.running.append(seq_group)
+            schedule_prompt_chunk(seq_group)
+
+        return SchedulerOutputs(
+            scheduled_seq_groups=prompts + decodes,
+            prompt_run=False,
+            num_batched_tokens=num_prompt_tokens + num_decode_tokens,
+            ignored_seq_groups=ignored_seq_groups,
+            finished_seqs=finished_seqs,
+            num_prompt_groups=len(prompts),
+            num_prompt_tokens=num_prompt_tokens,
+            partial_prefill_groups=partial_prefills,
+            token_chunk_sizes=token_chunk_sizes,
+            blocks_to_copy=blocks_to_copy,
+        )
+        # bigdl-llm change end
+
     def _schedule(self) -> SchedulerOutputs:
+        if self.scheduler_config.enable_mixed_batching:
+            return self._schedule_mixed()
 
         # Fix the current time.
         now = time.monotonic()
@@ -164,6 +355,7 @@ class FixedWindowScheduler:
         num_curr_seqs = sum(seq_group.get_max_num_running_seqs()
                             for seq_group in self.running)
         num_batched_tokens = 0
+        blocks_to_copy: Dict[int, List[int]] = {}
         # logger.info(f"swap: {self.swapped}, wait: {self.waiting}, run: {self.running}")
 
         if not self.swapped:
@@ -191,12 +383,20 @@ class FixedWindowScheduler:
                     continue
 
                 # bigdl-llm change start
-                # summary: removing block_manager related logic.
-                # TODO(gc): If you can manage to make block_manager work,
-                #  then this will be fine.
-                # If the sequence group cannot be allocated, stop.
-                # if not self.block_manager.can_allocate(seq_group):
-                #     break
+                # summary: block_manager is only used with the paged KV cache.
+                if self.block_manager is not None:
+                    if not self.block_manager.can_ever_allocate(seq_group):
+                        logger.warning(
+                            f"Input prompt ({num_prompt_tokens} tokens) is too long"
+                            " and cannot fit into the KV cache blocks")
+                        for seq in seq_group.get_seqs():
+                            seq.status = SequenceStatus.FINISHED_IGNORED
+                        ignored_seq_groups.append(seq_group)
+                        self.waiting.pop(0)
+                        continue
+                    # If the sequence group cannot be allocated, stop.
+                    if not self.block_manager.can_allocate(seq_group):
+                        break
                 # bigdl-llm change end
 
                 # If the number of batched tokens exceeds the limit, stop.
@@ -214,14 +414,14 @@ class FixedWindowScheduler:
                     break
 
                 seq_group = self.waiting.pop(0)
+                # bigdl-llm change start
+                # summary: block_manager is only used with the paged KV cache.
+                self._allocate(seq_group, blocks_to_copy)
+                # bigdl-llm change end
                 for seq in seq_group.get_seqs():
                     seq.status = SequenceStatus.RUNNING
                 # Co(gc): Only updated the seq_lens when all check passes
                 seq_lens = new_seq_lens
-                # bigdl-llm change start
-                # summary: removing block_manager related logic.
-                # self._allocate(seq_group)
-                # bigdl-llm change end
                 self.running.append(seq_group)
                 num_batched_tokens += num_prompt_tokens
                 num_curr_seqs += num_new_seqs
@@ -234,34 +434,13 @@ class FixedWindowScheduler:
                     num_batched_tokens=len(seq_lens) * max(seq_lens) if seq_lens else 0,
                     ignored_seq_groups=ignored_seq_groups,
                     finished_seqs=finished_seqs,
+                    token_chunk_sizes=self._get_token_chunk_sizes(scheduled),
+                    blocks_to_copy=blocks_to_copy,
                 )
                 return scheduler_outputs
 
         # Now consider all the requests in decoding stage
-        self.running = self.policy.sort_by_priority(now, self.running)
-
-        # Reserve new token slots for the running sequence groups.
-        running: List[SequenceGroup] = []
-        preempted: List[SequenceGroup] = []
-        while self.running:
-            seq_group = self.running.pop(0)
-            # while self.seq_ability < 0:
-            #     if self.running:
-            #         # Preempt the lowest-priority sequence groups.
-            #         victim_seq_group = self.running.pop(-1)
-            #         self._preempt(victim_seq_group)
-            #         preempted.append(victim_seq_group)
-            #     else:
-            #         # No other sequence groups can be preempted.
-            #         # Preempt the current sequence group.
-            #         self._preempt(seq_group)
-            #         preempted.append(seq_group)
-            #         break
-            # else:
-            #     # Append new slots to the sequence group.
-            #     # self._append_slot(seq_group, blocks_to_copy)
-            running.append(seq_group)
-        self.running = running
+        self._reserve_decode_slots(now, blocks_to_copy)
 
         # TODO (txy): inplement below methods
         # # Swap in the sequence groups in the SWAPPED state if possible.
@@ -304,6 +483,8 @@ class FixedWindowScheduler:
             num_batched_tokens=num_batched_tokens,
             ignored_seq_groups=[],
             finished_seqs=finished_seqs,
+            token_chunk_sizes=self._get_token_chunk_sizes(self.running),
+            blocks_to_copy=blocks_to_copy,
         )
         return scheduler_outputs
 
@@ -315,17 +496,31 @@ class FixedWindowScheduler:
 
         # Create input data structures.
         seq_group_metadata_list: List[SequenceGroupMetadata] = []
-        for seq_group in scheduler_outputs.scheduled_seq_groups:
+        # Partial prefills go first: they are prompts that are not sampled from.
+        num_partial_prefills = len(scheduler_outputs.partial_prefill_groups)
+        seq_groups = (scheduler_outputs.partial_prefill_groups
+                      + scheduler_outputs.scheduled_seq_groups)
+        for i, seq_group in enumerate(seq_groups):
+            do_sample = i >= num_partial_prefills
+            is_prompt = not do_sample or scheduler_outputs.is_prompt(i - num_partial_prefills)
             seq_data: Dict[int, List[SequenceData]] = {}
+            block_tables: Optional[Dict[int, List[int]]] = None
+            if self.block_manager is not None:
+                block_tables = {}
             for seq in seq_group.get_seqs(status=SequenceStatus.RUNNING):
                 seq_id = seq.seq_id
                 seq_data[seq_id] = seq.data
+                if block_tables is not None:
+                    block_tables[seq_id] = self.block_manager.get_block_table(seq)
 
             seq_group_metadata = SequenceGroupMetadata(
                 request_id=seq_group.request_id,
-                is_prompt=scheduler_outputs.prompt_run,
+                is_prompt=is_prompt,
                 seq_data=seq_data,
                 sampling_params=seq_group.sampling_params,
+                block_tables=block_tables,
+                token_chunk_size=scheduler_outputs.token_chunk_sizes.get(seq_group.request_id),
+                do_sample=do_sample,
             )
             seq_group_metadata_list.append(seq_group_metadata)
         return seq_group_metadata_list, scheduler_outputs
@@ -336,6 +531,8 @@ class FixedWindowScheduler:
         # summary: The original code free the block in block_manager.
         # now, we added it into a list to pass to worker in the next model_execute stage.
         self.cleaned.append(seq.seq_id)
+        if self.block_manager is not None:
+            self.block_manager.free(seq)
         for i in range(len(self.kv_cache)):
             for j in range(2):
                 if not self.kv_cache[i][j].get(seq.seq_id) is None:
@@ -351,6 +548,65 @@ class FixedWindowScheduler:
             if not seq_group.is_finished()
         ]
 
+    def update_num_computed_tokens(self, scheduler_outputs: SchedulerOutputs) -> None:
+        """Record the tokens computed by a finished step.
+
+        Chunked prompts continue where their last chunk ended, and the blocks
+        filled in the step become reusable by the prefix cache.
+        """
+        for seq_group in (scheduler_outputs.partial_prefill_groups
+                          + scheduler_outputs.scheduled_seq_groups):
+            token_chunk_size = scheduler_outputs.token_chunk_sizes.get(seq_group.request_id)
+            if token_chunk_size is None:
+                continue
+            for seq in seq_group.get_seqs(status=SequenceStatus.RUNNING):
+                seq.data.update_num_computed_tokens(token_chunk_size)
+                self.block_manager.mark_blocks_as_computed(seq)
+
+    def _get_token_chunk_sizes(self, seq_groups: List[SequenceGroup]) -> Dict[str, int]:
+        # Without mixed batching, every scheduled sequence feeds all its
+        # uncomputed tokens: the prompt after its cached prefix, or the last
+        # sampled token.
+        if self.block_manager is None:
+            return {}
+        return {
+            seq_group.request_id: seq_group.get_seqs(
+                status=SequenceStatus.RUNNING)[0].data.get_num_uncomputed_tokens()
+            for seq_group in seq_groups
+        }
+
+    def _allocate(
+        self,
+        seq_group: SequenceGroup,
+        blocks_to_copy: Dict[int, List[int]],
+    ) -> None:
+        if self.block_manager is not None:
+            self.block_manager.allocate(seq_group, blocks_to_copy)
+
+    def _is_prefilling(self, seq_group: SequenceGroup) -> bool:
+        # A running sequence normally has only its last sampled token left to
+        # feed, more means the rest of its prompt is still to be prefilled.
+        seq = seq_group.get_seqs(status=SequenceStatus.RUNNING)[0]
+        return seq.data.get_num_uncomputed_tokens() > 1
+
+    def _can_append_slot(self, seq_group: SequenceGroup) -> bool:
+        if self.block_manager is None:
+            return True
+        if self._is_prefilling(seq_group):
+            # The blocks of the whole prompt were allocated on admission.
+            return True
+        return self.block_manager.can_append_slot(seq_group)
+
+    def _append_slot(
+        self,
+        seq_group: SequenceGroup,
+        blocks_to_copy: Dict[int, List[int]],
+    ) -> None:
+        if self.block_manager is None or self._is_prefilling(seq_group):
+            return
+        for seq in seq_group.get_seqs(status=SequenceStatus.RUNNING):
+            self.block_manager.append_slot(seq, blocks_to_copy)
+
     def _preempt(
         self,
         seq_group: SequenceGroup,
@@ -388,7 +644,9 @@ class FixedWindowScheduler:
         # len(seqs) should be 1
         for seq in seqs:
             seq.status = SequenceStatus.WAITING
-            # self.block_manager.free(seq)
+            seq.data.reset_num_computed_tokens()
+            if self.block_manager is not None:
+                self.block_manager.free(seq)
             if not self.kv_cache[0][0].get(seq.seq_id) is None:
                 for i in range(len(self.kv_cache)):
                     for j in range(2):
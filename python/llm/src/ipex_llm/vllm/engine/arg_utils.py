@@ -38,7 +38,7 @@ import argparse
 import dataclasses
 from dataclasses import dataclass
 from typing import Optional, Tuple
-from ipex_llm.vllm.config import ModelConfig, SchedulerConfig
+from ipex_llm.vllm.config import CacheConfig, ModelConfig, SchedulerConfig
 
 
 @dataclass
@@ -72,6 +72,11 @@ class EngineArgs:
     # summary: add device option
     device: Optional[str] = 'cpu'
     load_in_low_bit: str = 'sym_int4'
+    enable_paged_kv_cache: bool = False
+    kv_cache_space: int = 4  # GiB
+    enable_mixed_batching: bool = False
+    prefill_chunk_size: Optional[int] = None
+    enable_prefix_caching: bool = False
     # bigdl-llm change end
 
     def __post_init__(self):
@@ -217,6 +222,33 @@ class EngineArgs:
                             type=str,
                             default='sym_int4',
                             help='low_bit_quantization')
+        parser.add_argument('--enable-paged-kv-cache',
+                            action='store_true',
+                            help='store the KV cache in fixed-size blocks '
+                            'addressed through per-sequence block tables '
+                            '(CPU only)')
+        parser.add_argument('--kv-cache-space',
+                            type=int,
+                            default=EngineArgs.kv_cache_space,
+                            help='CPU memory (GiB) reserved for the paged KV '
+                            'cache blocks')
+        parser.add_argument('--enable-mixed-batching',
+                            action='store_true',
+                            help='batch new prompts together with the running '
+                            'decodes in one iteration, within the '
+                            'max-num-batched-tokens budget (requires '
+                            '--enable-paged-kv-cache)')
+        parser.add_argument('--prefill-chunk-size',
+                            type=int,
+                            default=EngineArgs.prefill_chunk_size,
+                            help='prefill prompts in chunks of at most this '
+                            'many tokens, interleaved with the running decodes '
+                            '(requires --enable-mixed-batching)')
+        parser.add_argument('--enable-prefix-caching',
+                            action='store_true',
+                            help='reuse the KV cache blocks of a shared prompt '
+                            'prefix across requests (requires '
+                            '--enable-paged-kv-cache)')
 
         return parser
 
@@ -228,22 +260,27 @@ class EngineArgs:
         engine_args = cls(**{attr: getattr(args, attr) for attr in attrs})
         return engine_args
 
-    def create_engine_configs(self, ) -> Tuple[ModelConfig, SchedulerConfig]:
+    def create_engine_configs(self, ) -> Tuple[ModelConfig, CacheConfig, SchedulerConfig]:
         model_config = ModelConfig(self.model, self.tokenizer,
                                    self.tokenizer_mode, self.trust_remote_code,
                                    self.download_dir, self.load_format,
                                    self.dtype, self.seed, self.revision,
                                    self.tokenizer_revision, self.max_model_len,
                                    self.quantization, self.device, self.load_in_low_bit)
+        cache_config = CacheConfig(self.block_size, self.kv_cache_space,
+                                   self.enable_paged_kv_cache,
+                                   self.enable_prefix_caching)
         scheduler_config = SchedulerConfig(self.max_num_batched_tokens,
                                            self.max_num_seqs,
-                                           model_config.max_model_len)
+                                           model_config.max_model_len,
+                                           self.enable_mixed_batching,
+                                           self.prefill_chunk_size)
         # bigdl-llm change start
         # summary: remove parallel config + cache config
         # parallel_config = ParallelConfig(self.pipeline_parallel_size,
         #                                  self.tensor_parallel_size, False)
         # bigdl-llm change end
-        return model_config, scheduler_config
+        return model_config, cache_config, scheduler_config
 
 
 @dataclass
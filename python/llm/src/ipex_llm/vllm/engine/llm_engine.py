@@ -38,7 +38,7 @@
 import time
 from typing import TYPE_CHECKING, Any, Iterable, List, Optional, Tuple, Union, Dict
 
-from ipex_llm.vllm.config import ModelConfig, SchedulerConfig
+from ipex_llm.vllm.config import CacheConfig, ModelConfig, SchedulerConfig
 from ipex_llm.vllm.core.scheduler import SchedulerOutputs, FixedWindowScheduler
 from ipex_llm.vllm.engine.arg_utils import EngineArgs
 from ipex_llm.vllm.logger import init_logger
@@ -95,6 +95,7 @@ class LLMEngine:
     def __init__(
         self,
         model_config: ModelConfig,
+        cache_config: CacheConfig,
         # parallel_config: ParallelConfig,
         scheduler_config: SchedulerConfig,
         # distributed_init_method: str,
@@ -121,11 +122,13 @@ class LLMEngine:
             f"quantization={model_config.quantization}, "
             f"seed={model_config.seed}), "
             f"device={model_config.device}, "
-            f"load_in_low_bit={model_config.load_in_low_bit}"
+            f"load_in_low_bit={model_config.load_in_low_bit}, "
+            f"enable_paged_kv_cache={cache_config.enable_paged_kv_cache}"
         )
         # TODO(woosuk): Print more configs in debug mode.
 
         self.model_config = model_config
+        self.cache_config = cache_config
         # self.parallel_config = parallel_config
         self.scheduler_config = scheduler_config
         self.log_stats = log_stats
@@ -144,8 +147,13 @@ class LLMEngine:
         # Create the parallel GPU workers.
         self._init_workers()
 
+        # Profile the memory usage and initialize the paged KV cache.
+        if self.cache_config.enable_paged_kv_cache:
+            self._init_cache()
+
         # Co(gc): we create a fixed scheduler
-        self.scheduler = FixedWindowScheduler(scheduler_config, kv_cache=self.kv_cache)
+        self.scheduler = FixedWindowScheduler(scheduler_config, kv_cache=self.kv_cache,
+                                              cache_config=cache_config)
 
         # Logging.
         self.last_logging_time = 0.0
@@ -181,6 +189,35 @@ class LLMEngine:
             get_all_outputs=True,
         )
 
+    def _init_cache(self) -> None:
+        """Profiles the memory usage and initializes the paged KV cache."""
+        # Get the maximum number of blocks that can be allocated on CPU.
+        num_blocks = self._run_workers(
+            "get_num_available_blocks",
+            get_all_outputs=True,
+            block_size=self.cache_config.block_size,
+            kv_cache_space_bytes=self.cache_config.kv_cache_space_bytes,
+        )
+
+        # Since we use a shared centralized controller, we take the minimum
+        # number of blocks across all workers to make sure all the memory
+        # operators can be applied to all workers.
+        num_cpu_blocks = min(num_blocks)
+        logger.info(f"# CPU blocks: {num_cpu_blocks}")
+        if num_cpu_blocks <= 0:
+            invalidInputError(False,
+                              "No available memory for the cache blocks. "
+                              "Try increasing `kv_cache_space` when "
+                              "initializing the engine.")
+        max_seq_blocks = -(-self.model_config.max_model_len // self.cache_config.block_size)
+        if num_cpu_blocks < max_seq_blocks:
+            logger.warning(f"{num_cpu_blocks} KV cache blocks cannot hold a sequence "
+                           f"of max_model_len ({self.model_config.max_model_len}) tokens.")
+        self.cache_config.num_cpu_blocks = num_cpu_blocks
+
+        # Initialize the cache.
+        self._run_workers("init_cache_engine", cache_config=self.cache_config)
+
     def _verify_args(self) -> None:
         self.model_config.verify_with_parallel_config(self.parallel_config)
         # Co(gc): this simply checks if the swap is too large or not
@@ -518,6 +555,12 @@ class LLMEngine:
     def _process_model_outputs(
         self, output: SamplerOutput, scheduler_outputs: SchedulerOutputs
     ) -> List[RequestOutput]:
+        # bigdl-llm change start
+        # summary: record how far the KV of every sequence fed in this step goes.
+        if self.scheduler.block_manager is not None:
+            self.scheduler.update_num_computed_tokens(scheduler_outputs)
+        # bigdl-llm change end
+
         # Update the scheduled sequence groups with the model outputs.
         scheduled_seq_groups = scheduler_outputs.scheduled_seq_groups
         for seq_group, samples in zip(scheduled_seq_groups, output):
@@ -536,7 +579,8 @@ class LLMEngine:
         if self.log_stats:
             # Log the system stats.
             self._log_system_stats(
-                scheduler_outputs.prompt_run, scheduler_outputs.num_batched_tokens
+                scheduler_outputs.prompt_run, scheduler_outputs.num_batched_tokens,
+                scheduler_outputs.num_prompt_tokens
             )
         return request_outputs
 
@@ -559,7 +603,7 @@ class LLMEngine:
             seq_group_metadata_list=seq_group_metadata_list,
             blocks_to_swap_in={},
             blocks_to_swap_out={},
-            blocks_to_copy={},
+            blocks_to_copy=scheduler_outputs.blocks_to_copy,
             finished_seqs=scheduler_outputs.finished_seqs,
         )
 
@@ -569,13 +613,17 @@ class LLMEngine:
         self,
         prompt_run: bool,
         num_batched_tokens: int,
+        num_prompt_tokens: int = 0,
     ) -> None:
         now = time.monotonic()
         # Log the number of batched input tokens.
         if prompt_run:
             self.num_prompt_tokens.append((now, num_batched_tokens))
         else:
-            self.num_generation_tokens.append((now, num_batched_tokens))
+            # A mixed step also carries the prompt tokens of newly admitted requests.
+            if num_prompt_tokens > 0:
+                self.num_prompt_tokens.append((now, num_prompt_tokens))
+            self.num_generation_tokens.append((now, num_batched_tokens - num_prompt_tokens))
 
         elapsed_time = now - self.last_logging_time
         if elapsed_time < _LOGGING_INTERVAL_SEC:
@@ -623,6 +671,21 @@ class LLMEngine:
 
         # bigdl-llm change end
 
+        cache_usage_msg = ""
+        block_manager = self.scheduler.block_manager
+        if block_manager is not None:
+            total_num_cpu_blocks = self.cache_config.num_cpu_blocks
+            num_free_cpu_blocks = block_manager.get_num_free_cpu_blocks()
+            num_used_cpu_blocks = total_num_cpu_blocks - num_free_cpu_blocks
+            cpu_cache_usage = num_used_cpu_blocks / total_num_cpu_blocks
+            cache_usage_msg = f"CPU KV cache usage: {cpu_cache_usage * 100:.1f}%"
+            if block_manager.enable_caching:
+                hit_rate = block_manager.get_prefix_cache_hit_rate()
+                num_hits = block_manager.num_prefix_cache_hits
+                num_misses = block_manager.num_prefix_cache_queries - num_hits
+                cache_usage_msg += (f", Prefix cache hit rate: {hit_rate * 100:.1f}% "
+                                    f"({num_hits} hits, {num_misses} misses)")
+
         logger.info(
             "Avg prompt throughput: "
             f"{avg_prompt_throughput:.1f} tokens/s, "
@@ -630,6 +693,7 @@ class LLMEngine:
             f"{avg_generation_throughput:.1f} tokens/s, "
             f"Running: {len(self.scheduler.running)} reqs, "
             f"Pending: {len(self.scheduler.waiting)} reqs, "
+            f"{cache_usage_msg}"
         )
         self.last_logging_time = now
 
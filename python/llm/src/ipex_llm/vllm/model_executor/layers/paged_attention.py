@@ -0,0 +1,228 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from typing import List
+
+import torch
+
+# Number of cached tokens attended per step of the online softmax.
+_PARTITION_SIZE = 512
+
+
+class PagedAttentionGroup:
+    """Sequences of a batch attended together by one `paged_attention` call.
+
+    Decoding sequences are grouped apart from prompts so that one long prompt
+    does not pad every decoding sequence up to its length.
+
+    Args:
+        token_indices: Index of every query token in the packed batch, laid out
+            as a right-padded [num_seqs, max_query_len] tensor.
+        positions: Absolute position of every query token, -1 for padding.
+        block_tables: Physical block numbers of every sequence, padded with 0.
+        context_lens: Number of cached tokens of every sequence after this step.
+    """
+
+    def __init__(
+        self,
+        token_indices: torch.Tensor,
+        positions: torch.Tensor,
+        block_tables: torch.Tensor,
+        context_lens: torch.Tensor,
+    ) -> None:
+        self.token_indices = token_indices
+        self.positions = positions
+        self.block_tables = block_tables
+        self.context_lens = context_lens
+        self.valid = positions >= 0
+
+
+class PagedAttentionMetadata:
+    """Addressing information of a batch for the paged KV cache.
+
+    The tokens of all sequences are packed into a single [1, num_tokens] row,
+    so that prompts and decoding tokens can share one forward pass.
+
+    Args:
+        positions: [1, num_tokens] absolute position of every token.
+        slot_mapping: [1, num_tokens] cache slot (block_number * block_size +
+            block_offset) the KV of every token is written to.
+        last_token_indices: Index of the last token of every sequence.
+        max_context_len: Maximum number of cached tokens after this step.
+        attn_groups: The groups attention is computed for.
+    """
+
+    def __init__(
+        self,
+        positions: torch.Tensor,
+        slot_mapping: torch.Tensor,
+        last_token_indices: torch.Tensor,
+        max_context_len: int,
+        attn_groups: List[PagedAttentionGroup],
+    ) -> None:
+        self.positions = positions
+        self.slot_mapping = slot_mapping
+        self.last_token_indices = last_token_indices
+        self.max_context_len = max_context_len
+        self.attn_groups = attn_groups
+
+    def __repr__(self) -> str:
+        return (f"PagedAttentionMetadata("
+                f"num_tokens={self.positions.size(-1)}, "
+                f"max_context_len={self.max_context_len}, "
+                f"num_attn_groups={len(self.attn_groups)})")
+
+
+class PagedKVCache:
+    """One layer of the paged KV cache, passed to attention as `past_key_value`."""
+
+    def __init__(
+        self,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        metadata: PagedAttentionMetadata,
+    ) -> None:
+        self.key_cache = key_cache
+        self.value_cache = value_cache
+        self.metadata = metadata
+
+    def write(self, key: torch.Tensor, value: torch.Tensor) -> None:
+        write_to_paged_cache(key, value, self.key_cache, self.value_cache,
+                             self.metadata.slot_mapping)
+
+    def attend(self, query: torch.Tensor, scale: float) -> torch.Tensor:
+        # query: [1, num_heads, num_tokens, head_size]
+        packed_query = query[0]
+        output = torch.empty_like(packed_query)
+        for group in self.metadata.attn_groups:
+            # [num_heads, num_seqs, max_query_len, head_size]
+            #   -> [num_seqs, num_heads, max_query_len, head_size]
+            group_query = packed_query[:, group.token_indices].transpose(0, 1)
+            group_output = paged_attention(group_query, self.key_cache, self.value_cache,
+                                           group.block_tables, group.context_lens,
+                                           group.positions, scale)
+            group_output = group_output.transpose(0, 1)[:, group.valid]
+            output[:, group.token_indices[group.valid]] = group_output
+        return output.unsqueeze(0)
+
+
+def write_to_paged_cache(
+    key: torch.Tensor,
+    value: torch.Tensor,
+    key_cache: torch.Tensor,
+    value_cache: torch.Tensor,
+    slot_mapping: torch.Tensor,
+) -> None:
+    # key/value: [batch_size, num_kv_heads, query_len, head_size]
+    # key_cache/value_cache: [num_blocks, num_kv_heads, block_size, head_size]
+    num_kv_heads, head_size = key.size(1), key.size(3)
+    block_size = key_cache.size(2)
+    slots = slot_mapping.flatten()
+    valid = slots >= 0
+    slots = slots[valid]
+    block_numbers = torch.div(slots, block_size, rounding_mode="floor")
+    block_offsets = slots % block_size
+    key = key.transpose(1, 2).reshape(-1, num_kv_heads, head_size)[valid]
+    value = value.transpose(1, 2).reshape(-1, num_kv_heads, head_size)[valid]
+    key_cache[block_numbers, :, block_offsets] = key.to(key_cache.dtype)
+    value_cache[block_numbers, :, block_offsets] = value.to(value_cache.dtype)
+
+
+def paged_attention(
+    query: torch.Tensor,
+    key_cache: torch.Tensor,
+    value_cache: torch.Tensor,
+    block_tables: torch.Tensor,
+    context_lens: torch.Tensor,
+    positions: torch.Tensor,
+    scale: float,
+) -> torch.Tensor:
+    """Causal attention over the KV stored in the blocks of every sequence.
+
+    The cached tokens are visited a partition of blocks at a time with an online
+    softmax, so only O(partition) scores are alive and the KV of a sequence is
+    never re-assembled into a contiguous tensor. Query heads sharing one KV head
+    are grouped by reshaping, so grouped-query KV is never duplicated.
+
+    Args:
+        query: [batch_size, num_heads, query_len, head_size]
+        key_cache: [num_blocks, num_kv_heads, block_size, head_size]
+        value_cache: [num_blocks, num_kv_heads, block_size, head_size]
+        block_tables: [batch_size, max_num_blocks_per_seq]
+        context_lens: [batch_size]
+        positions: [batch_size, query_len], -1 for padding tokens.
+        scale: Scaling applied to the attention scores.
+
+    Returns:
+        Attention output of shape [batch_size, num_heads, query_len, head_size].
+    """
+    bsz, num_heads, q_len, head_size = query.shape
+    num_kv_heads, block_size = key_cache.size(1), key_cache.size(2)
+    n_rep = num_heads // num_kv_heads
+
+    # [bsz, num_kv_heads, n_rep * q_len, head_size]
+    grouped_query = query.reshape(bsz, num_kv_heads, n_rep * q_len, head_size)
+    grouped_query = grouped_query.to(torch.float32) * scale
+    # [bsz, 1, n_rep * q_len, 1]
+    query_positions = positions.repeat(1, n_rep)[:, None, :, None]
+
+    max_num_blocks = (int(context_lens.max()) + block_size - 1) // block_size
+    blocks_per_partition = max(1, _PARTITION_SIZE // block_size)
+
+    rows = n_rep * q_len
+    acc = torch.zeros(bsz, num_kv_heads, rows, head_size,
+                      dtype=torch.float32, device=query.device)
+    row_max = torch.full((bsz, num_kv_heads, rows, 1), float("-inf"),
+                         dtype=torch.float32, device=query.device)
+    row_sum = torch.zeros(bsz, num_kv_heads, rows, 1,
+                          dtype=torch.float32, device=query.device)
+
+    for start in range(0, max_num_blocks, blocks_per_partition):
+        end = min(start + blocks_per_partition, max_num_blocks)
+        table = block_tables[:, start:end]
+        num_tokens = (end - start) * block_size
+        # [bsz, num_blocks, num_kv_heads, block_size, head_size]
+        #   -> [bsz, num_kv_heads, num_tokens, head_size]
+        keys = key_cache[table].transpose(1, 2).reshape(bsz, num_kv_heads,
+                                                        num_tokens, head_size)
+        values = value_cache[table].transpose(1, 2).reshape(bsz, num_kv_heads,
+                                                            num_tokens, head_size)
+
+        scores = torch.matmul(grouped_query, keys.to(torch.float32).transpose(2, 3))
+        key_positions = torch.arange(start * block_size, end * block_size,
+                                     device=query.device)
+        # Slots past the context length always lie after the query position.
+        mask = key_positions[None, None, None, :] > query_positions
+        scores.masked_fill_(mask, float("-inf"))
+
+        new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+        # Rows without any visible key yet keep a finite reference point.
+        safe_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+        probs = torch.exp(scores - safe_max)
+        correction = torch.exp(row_max - safe_max)
+        row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+        acc = acc * correction + torch.matmul(probs, values.to(torch.float32))
+        row_max = new_max
+
+    # Padding queries see no key and produce zeros.
+    acc = acc / row_sum.clamp_min(torch.finfo(torch.float32).tiny)
+    return acc.reshape(bsz, num_heads, q_len, head_size).to(query.dtype)
+
+
+def pad_block_tables(block_tables: List[List[int]]) -> List[List[int]]:
+    max_num_blocks = max(len(block_table) for block_table in block_tables)
+    return [block_table + [0] * (max_num_blocks - len(block_table))
+            for block_table in block_tables]
@@ -23,6 +23,7 @@ from typing import Optional, Tuple, List, Type, Dict
 from ipex_llm.vllm.sequence import SequenceOutputs, SequenceGroupMetadata
 from ipex_llm.vllm.model_executor.layers.bigdl_sampler import BigDLSampler
 from ipex_llm.vllm.model_executor.models.bigdl_model import BigDLModelForCausalLM
+from ipex_llm.vllm.model_executor.models.bigdl_model import last_token_logits
 from ipex_llm.vllm.logger import init_logger
 import math
 import time
@@ -208,7 +209,13 @@ class BigDLChatGLMForCausalLM(BigDLModelForCausalLM):
             torch.xpu.empty_cache()
         st_timestamp = time.perf_counter()
 
-        outputs = self.model.forward(**kwargs)
+        # ChatGLM-6B names its output projection lm_head, ChatGLM2/3 output_layer, and
+        # both are applied to [seq_len, batch_size, hidden_size] hidden states.
+        lm_head = getattr(self.model, "lm_head", None)
+        if lm_head is None:
+            lm_head = self.model.transformer.output_layer
+        with last_token_logits(lm_head, seq_dim=0):
+            outputs = self.model.forward(**kwargs)
         # tmp = torch.xpu.memory_stats()
         # logger.info(f"0: {tmp['allocated_bytes.all.current']}")
         # self.last_seq_ids = cur_seq_ids[:]
@@ -23,7 +23,11 @@ from typing import Optional, Tuple, List, Type, Dict
 from ipex_llm.vllm.sequence import SequenceOutputs, SequenceGroupMetadata
 from ipex_llm.vllm.model_executor.layers.bigdl_sampler import BigDLSampler
 from ipex_llm.vllm.model_executor.models.bigdl_model import BigDLModelForCausalLM
+from ipex_llm.vllm.model_executor.models.bigdl_model import last_token_logits
+from ipex_llm.vllm.model_executor.layers.paged_attention import PagedKVCache
 from ipex_llm.vllm.logger import init_logger
+from ipex_llm.transformers.models.utils import apply_rotary_pos_emb
+from ipex_llm.utils.common import invalidInputError
 import math
 import time
 from ipex_llm.vllm.model_executor.input_metadata import InputMetadata
@@ -56,6 +60,46 @@ enable_vllm_se_batching = vllm_selective_batching is not None
 enable_vllm_se_batching = enable_vllm_se_batching and vllm_selective_batching.lower() == "true"
 
 
+def llama_attention_paged_forward(
+    self,
+    hidden_states: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.LongTensor] = None,
+    past_key_value: Optional[PagedKVCache] = None,
+    output_attentions: bool = False,
+    use_cache: bool = False,
+    **kwargs,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+    # The new KV is written into the cache blocks in place and attention reads
+    # the whole context through the block tables, so nothing is returned as
+    # present key values.
+    bsz, q_len, _ = hidden_states.size()
+
+    query_states = self.q_proj(hidden_states)
+    key_states = self.k_proj(hidden_states)
+    value_states = self.v_proj(hidden_states)
+
+    query_states = query_states.view(bsz, q_len,
+                                     self.num_heads, self.head_dim).transpose(1, 2)
+    key_states = key_states.view(bsz, q_len,
+                                 self.num_key_value_heads, self.head_dim).transpose(1, 2)
+    value_states = value_states.view(bsz, q_len,
+                                     self.num_key_value_heads, self.head_dim).transpose(1, 2)
+
+    kv_seq_len = past_key_value.metadata.max_context_len
+    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+    query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
+                                                    cos, sin, position_ids, "llama")
+
+    past_key_value.write(key_states, value_states)
+    attn_output = past_key_value.attend(query_states, 1 / math.sqrt(self.head_dim))
+
+    attn_output = attn_output.transpose(1, 2).contiguous()
+    attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    attn_output = self.o_proj(attn_output)
+    return attn_output, None, None
+
+
 class BigDLLlamaForCausalLM(BigDLModelForCausalLM):
 
     def __init__(
@@ -113,6 +157,49 @@ class BigDLLlamaForCausalLM(BigDLModelForCausalLM):
         self.pad_token_id = config.pad_token_id
         self.max_seq_limit = max_model_len
 
+    def init_paged_kv_cache(self, block_size: int) -> None:
+        invalidInputError(self.device.type == 'cpu',
+                          "Paged KV cache is only supported on CPU for now.")
+        from ipex_llm.transformers.convert import convert_forward
+        attention_class = type(self.model.model.layers[0].self_attn)
+        convert_forward(self.model, attention_class, llama_attention_paged_forward)
+        self.block_size = block_size
+        self.enable_paged_kv_cache = True
+
+    # kv_cache in the format [(key_blocks, value_blocks) for _ in range(num_layers)]
+    # each of shape [num_blocks, num_kv_heads, block_size, head_dim]
+    def paged_forward(
+        self,
+        seq_group_meta_data_lists: List[SequenceGroupMetadata],
+        kv_cache: List[Tuple[torch.Tensor, torch.Tensor]],
+        input_metadata: InputMetadata,
+    ):
+        input_ids, metadata = self.prepare_paged_inputs(seq_group_meta_data_lists)
+        position_ids = metadata.positions.clamp(min=0)
+
+        st_timestamp = time.perf_counter()
+        model = self.model.model
+        hidden_states = model.embed_tokens(input_ids)
+        for layer_idx, decoder_layer in enumerate(model.layers):
+            key_blocks, value_blocks = kv_cache[layer_idx]
+            layer_outputs = decoder_layer(
+                hidden_states,
+                position_ids=position_ids,
+                past_key_value=PagedKVCache(key_blocks, value_blocks, metadata),
+                use_cache=False,
+            )
+            hidden_states = layer_outputs[0]
+        hidden_states = model.norm(hidden_states)
+        if metadata.last_token_indices.numel() == 0:
+            # Only prompt chunks before their last one, nothing to sample.
+            return []
+
+        # Only the last token of every sequence is sampled from, gather them
+        # before the vocabulary projection.
+        hidden_states = hidden_states[0, metadata.last_token_indices]
+        logits = self.model.lm_head(hidden_states)
+        return self.sampler(logits, input_metadata, st_timestamp)
+
     # GC: Note for selective batching
     # KV_CACHE in the format of num_layers x 2 x (seq_id -> torch.Tensor)
     # past_key_values in the format of num_layers x len(seq_id) x (2 x torch.Tensor)
@@ -126,6 +213,9 @@ class BigDLLlamaForCausalLM(BigDLModelForCausalLM):
         kv_cache: Optional[List[List[Dict]]] = None,
         input_metadata: Optional[InputMetadata] = None,
     ) -> Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]:
+        if self.enable_paged_kv_cache:
+            return self.paged_forward(seq_group_meta_data_lists, kv_cache, input_metadata)
+
         num_layers = self.model.config.num_hidden_layers
         # One for key, one for value
         decoder_kv_size = 2
@@ -245,7 +335,8 @@ class BigDLLlamaForCausalLM(BigDLModelForCausalLM):
         if self.device.type == 'xpu':
             torch.xpu.empty_cache()
         st_timestamp = time.perf_counter()
-        outputs = self.model.forward(**kwargs)
+        with last_token_logits(self.model.lm_head):
+            outputs = self.model.forward(**kwargs)
         # tmp = torch.xpu.memory_stats()
         # logger.info(f"0: {tmp['allocated_bytes.all.current']}")
         # self.last_seq_ids = cur_seq_ids[:]
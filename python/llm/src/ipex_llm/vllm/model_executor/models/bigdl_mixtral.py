@@ -23,6 +23,7 @@ from typing import Optional, Tuple, List, Type, Dict
 from ipex_llm.vllm.sequence import SequenceOutputs, SequenceGroupMetadata
 from ipex_llm.vllm.model_executor.layers.bigdl_sampler import BigDLSampler
 from ipex_llm.vllm.model_executor.models.bigdl_model import BigDLModelForCausalLM
+from ipex_llm.vllm.model_executor.models.bigdl_model import last_token_logits
 from ipex_llm.vllm.logger import init_logger
 import math
 import time
@@ -203,7 +204,8 @@ class BigDLMixtralForCausalLM(BigDLModelForCausalLM):
         if self.device.type == 'xpu':
             torch.xpu.empty_cache()
         st_timestamp = time.perf_counter()
-        outputs = self.model.forward(**kwargs)
+        with last_token_logits(self.model.lm_head):
+            outputs = self.model.forward(**kwargs)
         # tmp = torch.xpu.memory_stats()
         # logger.info(f"0: {tmp['allocated_bytes.all.current']}")
         # self.last_seq_ids = cur_seq_ids[:]
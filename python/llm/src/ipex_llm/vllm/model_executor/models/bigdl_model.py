@@ -16,12 +16,17 @@
 
 import torch
 from torch import nn
+from contextlib import contextmanager
 from typing import Optional, Tuple, List, Type, Dict
 from transformers import LlamaConfig
 
 from ipex_llm.vllm.sequence import SequenceOutputs, SequenceGroupMetadata
 from ipex_llm.transformers.models.utils import extend_kv_cache
+from ipex_llm.vllm.model_executor.layers.paged_attention import PagedAttentionGroup
+from ipex_llm.vllm.model_executor.layers.paged_attention import PagedAttentionMetadata
+from ipex_llm.vllm.model_executor.layers.paged_attention import pad_block_tables
 from ipex_llm.vllm.logger import init_logger
+from ipex_llm.utils.common import invalidInputError
 
 logger = init_logger(__name__)
 
@@ -51,6 +56,26 @@ def _pad_kv_cache_view(t: torch.Tensor, len: int,
         return t
 
 
+@contextmanager
+def last_token_logits(lm_head: nn.Module, seq_dim: int = 1):
+    """Feed only the last position of the hidden states to `lm_head`.
+
+    Prompts are left-padded, so the last position holds the final real token
+    of every sequence and is the only one sampled from. Skipping the others
+    saves a [batch, seq_len, vocab_size] GEMM on every prefill.
+    """
+    def hook(module, args):
+        hidden_states = args[0]
+        last = hidden_states.narrow(seq_dim, hidden_states.size(seq_dim) - 1, 1)
+        return (last,) + tuple(args[1:])
+
+    handle = lm_head.register_forward_pre_hook(hook)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
 class BigDLModelForCausalLM(nn.Module):
 
     def __init__(
@@ -76,6 +101,8 @@ class BigDLModelForCausalLM(nn.Module):
         self.max_seq_limit = max_model_len
         self.last_kv_cache = None
         self.last_seq_ids = None
+        self.enable_paged_kv_cache = False
+        self.block_size = None
 
     def _set_last_kv_cache(self, last_kv_cache):
         self.last_kv_cache = last_kv_cache
@@ -193,6 +220,88 @@ class BigDLModelForCausalLM(nn.Module):
                 kv_cache[i][0][cur_seq_ids[j]] = self.last_kv_cache[i][j][0]
                 kv_cache[i][1][cur_seq_ids[j]] = self.last_kv_cache[i][j][1]
 
+    def init_paged_kv_cache(self, block_size: int) -> None:
+        """Switch the model to read and write its KV cache through block tables."""
+        invalidInputError(False,
+                          f"Paged KV cache is not supported for {type(self).__name__} yet.")
+
+    def prepare_paged_inputs(
+        self,
+        seq_group_meta_data_lists: List[SequenceGroupMetadata],
+    ) -> Tuple[torch.Tensor, PagedAttentionMetadata]:
+        # The tokens of all sequences, prompts and decodes alike, are packed into
+        # one [1, num_tokens] row, so no padding reaches the linear layers.
+        block_size = self.block_size
+        input_ids = []
+        positions = []
+        slot_mapping = []
+        last_token_indices = []
+        # Decoding sequences and prompts are attended in separate groups.
+        decode_seqs = []
+        prompt_seqs = []
+        for seq_group_meta_data in seq_group_meta_data_lists:
+            seq_id = next(iter(seq_group_meta_data.seq_data))
+            seq_data = seq_group_meta_data.seq_data[seq_id]
+            if seq_group_meta_data.is_prompt:
+                # A chunked prompt continues after its already cached tokens.
+                start_pos = seq_data.get_num_computed_tokens()
+                end_pos = seq_data.get_len()
+                if seq_group_meta_data.token_chunk_size is not None:
+                    end_pos = start_pos + seq_group_meta_data.token_chunk_size
+                tokens = seq_data.get_token_ids()[start_pos:end_pos]
+            else:
+                tokens = [seq_data.get_last_token_id()]
+                start_pos = seq_data.get_len() - 1
+            block_table = seq_group_meta_data.block_tables[seq_id]
+            seq_positions = list(range(start_pos, start_pos + len(tokens)))
+            token_indices = list(range(len(input_ids), len(input_ids) + len(tokens)))
+
+            input_ids.extend(tokens)
+            positions.extend(seq_positions)
+            slot_mapping.extend(block_table[pos // block_size] * block_size + pos % block_size
+                                for pos in seq_positions)
+            if seq_group_meta_data.do_sample:
+                last_token_indices.append(token_indices[-1])
+            seqs = prompt_seqs if seq_group_meta_data.is_prompt else decode_seqs
+            seqs.append((token_indices, seq_positions, block_table))
+
+        attn_groups = [self._make_paged_attention_group(seqs)
+                       for seqs in (decode_seqs, prompt_seqs) if seqs]
+        metadata = PagedAttentionMetadata(
+            positions=torch.tensor([positions], dtype=torch.long, device=self.device),
+            slot_mapping=torch.tensor([slot_mapping], dtype=torch.long, device=self.device),
+            last_token_indices=torch.tensor(last_token_indices, dtype=torch.long,
+                                            device=self.device),
+            max_context_len=max(positions) + 1,
+            attn_groups=attn_groups,
+        )
+        return torch.tensor([input_ids], device=self.device), metadata
+
+    def _make_paged_attention_group(
+        self,
+        seqs: List[Tuple[List[int], List[int], List[int]]],
+    ) -> PagedAttentionGroup:
+        # Right-pad the query tokens of the group, padding points at token 0 and
+        # is marked by position -1.
+        max_query_len = max(len(token_indices) for token_indices, _, _ in seqs)
+        token_indices = []
+        positions = []
+        block_tables = []
+        context_lens = []
+        for seq_token_indices, seq_positions, block_table in seqs:
+            num_pads = max_query_len - len(seq_token_indices)
+            token_indices.append(seq_token_indices + [0] * num_pads)
+            positions.append(seq_positions + [-1] * num_pads)
+            block_tables.append(block_table)
+            context_lens.append(seq_positions[-1] + 1)
+        return PagedAttentionGroup(
+            token_indices=torch.tensor(token_indices, dtype=torch.long, device=self.device),
+            positions=torch.tensor(positions, dtype=torch.long, device=self.device),
+            block_tables=torch.tensor(pad_block_tables(block_tables), dtype=torch.long,
+                                      device=self.device),
+            context_lens=torch.tensor(context_lens, dtype=torch.long, device=self.device),
+        )
+
     def forward(
         self,
         seq_group_meta_data_lists: List[SequenceGroupMetadata],
@@ -87,6 +87,7 @@ class SequenceData:
         prompt_token_ids: The token IDs of the prompt.
         output_token_ids: The token IDs of the output.
         cumulative_logprob: The cumulative log probability of the output.
+        num_computed_tokens: The number of tokens whose KV is in the cache.
     """
 
     def __init__(
@@ -99,6 +100,7 @@ class SequenceData:
         self.created_timestamp = time.perf_counter()
         self.updated_timestamp = self.created_timestamp
         self.last_token_latency = 0.0
+        self.num_computed_tokens = 0
 
     def append_token_id(self, token_id: int, logprob: float) -> None:
         self.output_token_ids.append(token_id)
@@ -127,6 +129,19 @@ class SequenceData:
     def get_last_token_latency(self) -> float:
         return self.last_token_latency
 
+    def get_num_computed_tokens(self) -> int:
+        return self.num_computed_tokens
+
+    def update_num_computed_tokens(self, num_new_computed_tokens: int) -> None:
+        self.num_computed_tokens += num_new_computed_tokens
+
+    def get_num_uncomputed_tokens(self) -> int:
+        return self.get_len() - self.num_computed_tokens
+
+    def reset_num_computed_tokens(self) -> None:
+        """Called when the KV of the sequence is dropped and must be recomputed."""
+        self.num_computed_tokens = 0
+
     def __repr__(self) -> str:
         return (f"SequenceData("
                 f"prompt_token_ids={self.prompt_token_ids}, "
@@ -332,6 +347,12 @@ class SequenceGroupMetadata:
         is_prompt: Whether the request is at prompt stage.
         seq_data: The sequence data. (Seq id -> sequence data)
         sampling_params: The sampling parameters used to generate the outputs.
+        block_tables: The block tables. (Seq id -> list of physical block
+            numbers), only set when the paged KV cache is enabled.
+        token_chunk_size: The number of tokens computed in this step, starting
+            from the already computed ones. None for the whole prompt.
+        do_sample: Whether the next token is sampled. False for the chunks of a
+            prompt before its last one.
     """
 
     def __init__(
@@ -340,11 +361,17 @@ class SequenceGroupMetadata:
         is_prompt: bool,
         seq_data: Dict[int, SequenceData],
         sampling_params: SamplingParams,
+        block_tables: Optional[Dict[int, List[int]]] = None,
+        token_chunk_size: Optional[int] = None,
+        do_sample: bool = True,
     ) -> None:
         self.request_id = request_id
         self.is_prompt = is_prompt
         self.seq_data = seq_data
         self.sampling_params = sampling_params
+        self.block_tables = block_tables
+        self.token_chunk_size = token_chunk_size
+        self.do_sample = do_sample
 
 
 class SequenceOutputs:
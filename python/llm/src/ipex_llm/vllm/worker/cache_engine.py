@@ -0,0 +1,138 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Some parts of this file is adapted from
+# https://github.com/vllm-project/vllm/blob/v0.2.1.post1/vllm/worker/cache_engine.py
+# which is licensed under Apache License 2.0
+#
+# Copyright 2023 The vLLM team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# bigdl-llm Intel specified code change
+#
+"""CacheEngine class for managing the KV cache."""
+from typing import Dict, List, Tuple
+
+import torch
+
+from ipex_llm.vllm.config import CacheConfig, ModelConfig
+from ipex_llm.vllm.logger import init_logger
+
+logger = init_logger(__name__)
+
+KVCache = Tuple[torch.Tensor, torch.Tensor]
+
+
+class CacheEngine:
+    """Manages the KV cache.
+
+    This class is responsible for initializing and managing the paged KV cache.
+    bigdl-llm change start
+    summary: there is no GPU cache and no swap space. The blocks live in host
+    memory and each layer owns one key and one value tensor of shape
+    [num_blocks, num_kv_heads, block_size, head_size].
+    bigdl-llm change end
+    """
+
+    def __init__(
+        self,
+        cache_config: CacheConfig,
+        model_config: ModelConfig,
+        dtype: torch.dtype,
+        device: str = "cpu",
+    ) -> None:
+        self.cache_config = cache_config
+        self.model_config = model_config
+
+        self.head_size = model_config.get_head_size()
+        self.num_layers = model_config.get_num_layers()
+        self.num_heads = model_config.get_num_kv_heads()
+        self.dtype = dtype
+        self.device = device
+
+        self.block_size = cache_config.block_size
+        self.num_cpu_blocks = cache_config.num_cpu_blocks
+
+        # Initialize the cache.
+        self.cpu_cache = self.allocate_cpu_cache()
+
+    def get_kv_block_shape(self) -> Tuple[int, int, int]:
+        return (
+            self.num_heads,
+            self.block_size,
+            self.head_size,
+        )
+
+    def allocate_cpu_cache(self) -> List[KVCache]:
+        cpu_cache: List[KVCache] = []
+        block_shape = self.get_kv_block_shape()
+        for _ in range(self.num_layers):
+            # The blocks are zero-initialized: attention masks out stale slots,
+            # but masked slots still take part in the weighted sum of values.
+            key_blocks = torch.zeros(
+                size=(self.num_cpu_blocks, *block_shape),
+                dtype=self.dtype,
+                device=self.device,
+            )
+            value_blocks = torch.zeros(
+                size=(self.num_cpu_blocks, *block_shape),
+                dtype=self.dtype,
+                device=self.device,
+            )
+            cpu_cache.append((key_blocks, value_blocks))
+        logger.info(f"Allocated {self.num_cpu_blocks} KV cache blocks of "
+                    f"{self.block_size} tokens for {self.num_layers} layers.")
+        return cpu_cache
+
+    def copy(self, src_to_dsts: Dict[int, List[int]]) -> None:
+        src_blocks = []
+        dst_blocks = []
+        for src, dsts in src_to_dsts.items():
+            src_blocks.extend([src] * len(dsts))
+            dst_blocks.extend(dsts)
+        for key_blocks, value_blocks in self.cpu_cache:
+            key_blocks[dst_blocks] = key_blocks[src_blocks]
+            value_blocks[dst_blocks] = value_blocks[src_blocks]
+
+    @staticmethod
+    def get_cache_block_size(
+        block_size: int,
+        model_config: ModelConfig,
+        dtype: torch.dtype,
+    ) -> int:
+        head_size = model_config.get_head_size()
+        num_heads = model_config.get_num_kv_heads()
+        num_layers = model_config.get_num_layers()
+
+        key_cache_block = block_size * num_heads * head_size
+        value_cache_block = key_cache_block
+        total = num_layers * (key_cache_block + value_cache_block)
+        dtype_size = _get_dtype_size(dtype)
+        return dtype_size * total
+
+
+def _get_dtype_size(dtype: torch.dtype) -> int:
+    return torch.tensor([], dtype=dtype).element_size()
@@ -40,13 +40,14 @@ import warnings
 import numpy as np
 import random
 
-from ipex_llm.vllm.config import ModelConfig, SchedulerConfig
+from ipex_llm.vllm.config import CacheConfig, ModelConfig, SchedulerConfig
 from ipex_llm.vllm.model_executor.model_loader import get_model
 from ipex_llm.vllm.model_executor.input_metadata import InputMetadata
 from ipex_llm.vllm.sampling_params import SamplingParams
 from ipex_llm.vllm.sequence import SequenceData, SamplerOutput, SequenceGroupMetadata
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.vllm.model_executor.utils import set_random_seed
+from ipex_llm.vllm.worker.cache_engine import CacheEngine
 
 
 class Worker:
@@ -122,6 +123,20 @@ class Worker:
         set_random_seed(self.model_config.seed)
         self.model = get_model(self.model_config)
 
+    @torch.inference_mode()
+    def get_num_available_blocks(self, block_size: int, kv_cache_space_bytes: int) -> int:
+        """Returns the number of paged KV cache blocks fitting in kv_cache_space_bytes."""
+        cache_block_size = CacheEngine.get_cache_block_size(
+            block_size, self.model_config, self.model.dtype)
+        return int(kv_cache_space_bytes // cache_block_size)
+
+    def init_cache_engine(self, cache_config: CacheConfig) -> None:
+        self.cache_config = cache_config
+        self.block_size = cache_config.block_size
+        self.cache_engine = CacheEngine(self.cache_config, self.model_config,
+                                        self.model.dtype)
+        self.model.init_paged_kv_cache(self.block_size)
+
     def _prepare_inputs(
         self,
         seq_group_metadata_list: List[SequenceGroupMetadata],
@@ -136,6 +151,11 @@ class Worker:
         for seq_group_metadata in seq_group_metadata_list:
             if not seq_group_metadata.is_prompt:
                 continue
+            # bigdl-llm change start
+            # summary: a prompt chunk before the last one has nothing to sample.
+            if not seq_group_metadata.do_sample:
+                continue
+            # bigdl-llm change end
 
             seq_ids = list(seq_group_metadata.seq_data.keys())
             sampling_params = seq_group_metadata.sampling_params
@@ -283,6 +303,11 @@ class Worker:
         #     cache_events = None
         if finished_seqs:
             self.clean_finished_seqs(finished_seqs)
+        # bigdl-llm change start
+        # summary: shared blocks are copied before the model writes into them.
+        if blocks_to_copy and self.cache_engine is not None:
+            self.cache_engine.copy(blocks_to_copy)
+        # bigdl-llm change end
 
         # if self.model_config.device == 'xpu':
         #     import intel_extension_for_pytorch as ipex
@@ -301,9 +326,13 @@ class Worker:
         if True:
             input_tokens, input_positions, input_metadata = self._prepare_inputs(
                 seq_group_metadata_list)
+            if self.cache_engine is not None:
+                kv_cache = self.cache_engine.cpu_cache
+            else:
+                kv_cache = self.kv_cache
             output = self.model(
                 seq_group_meta_data_lists=seq_group_metadata_list,
-                kv_cache=self.kv_cache, input_metadata=input_metadata)
+                kv_cache=kv_cache, input_metadata=input_metadata)
             return output
         else:
             # Prepare input tensors.
@@ -0,0 +1,167 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+import torch
+import pytest
+
+from ipex_llm.transformers.models.utils import init_kv_cache, append_kv_cache, \
+    get_attention_sink_evict_length, evict_kv_cache, shift_rotary_keys, \
+    trim_attention_sink_mask, use_quantize_kv_cache, rotate_half, rotate_every_two
+
+
+HEAD_DIM = 64
+BASE = 10000
+
+
+def inv_freq(rot_dim):
+    return 1.0 / (BASE ** (torch.arange(0, rot_dim, 2).float() / rot_dim))
+
+
+def rope(x, positions, interleaved=False):
+    # x: [bsz, num_heads, seq_len, head_dim]
+    rot_dim = HEAD_DIM // 2 if interleaved else HEAD_DIM
+    angles = positions[:, None].float() * inv_freq(rot_dim)
+    if interleaved:
+        cos = torch.repeat_interleave(angles.cos(), 2, -1)
+        sin = torch.repeat_interleave(angles.sin(), 2, -1)
+        x_rot = x[..., :rot_dim].float()
+        x_rot = x_rot * cos + rotate_every_two(x_rot) * sin
+        return torch.cat((x_rot.to(x.dtype), x[..., rot_dim:]), dim=-1)
+    cos = torch.cat((angles.cos(), angles.cos()), -1)
+    sin = torch.cat((angles.sin(), angles.sin()), -1)
+    return (x.float() * cos + rotate_half(x.float()) * sin).to(x.dtype)
+
+
+def attention(query, key, value):
+    scores = query.float() @ key.float().transpose(-1, -2) / HEAD_DIM ** 0.5
+    return scores.softmax(-1) @ value.float()
+
+
+class TestAttentionSink(unittest.TestCase):
+
+    def _stream(self, dtype, interleaved, sink_size=4, window_size=32, num_tokens=200):
+        """
+        Append tokens one at a time to an evicted kv cache, and compare the attention of
+        the last token with the attention recomputed over the kept tokens.
+        """
+        torch.manual_seed(0)
+        bsz, num_heads = 1, 2
+        raw_keys = torch.randn(bsz, num_heads, num_tokens, HEAD_DIM)
+        values = torch.randn(bsz, num_heads, num_tokens, HEAD_DIM).to(dtype)
+        rot_dim = HEAD_DIM // 2 if interleaved else HEAD_DIM
+
+        k_cache, v_cache = init_kv_cache(bsz, num_heads, HEAD_DIM, 0, sink_size + window_size,
+                                         dtype, torch.device("cpu"))
+        kept = []
+        num_evictions = 0
+        for i in range(num_tokens):
+            num_evicted = get_attention_sink_evict_length(k_cache.size(2), 1,
+                                                          sink_size, window_size)
+            if num_evicted > 0:
+                angles = inv_freq(rot_dim) * num_evicted
+
+                def rotate_fn(keys, shift):
+                    return shift_rotary_keys(keys, angles.cos(), angles.sin(), interleaved)
+
+                k_cache = evict_kv_cache(k_cache, sink_size, num_evicted, rotate_fn)
+                v_cache = evict_kv_cache(v_cache, sink_size, num_evicted)
+                kept = kept[:sink_size] + kept[sink_size + num_evicted:]
+                num_evictions += 1
+            # new tokens are embedded at their positions in the cache
+            position = torch.tensor([k_cache.size(2)])
+            key = rope(raw_keys[:, :, i:i + 1].to(dtype), position, interleaved)
+            k_cache, v_cache = append_kv_cache(k_cache, v_cache, key, values[:, :, i:i + 1])
+            kept.append(i)
+            self.assertLessEqual(k_cache.size(2), sink_size + window_size)
+
+        self.assertGreater(num_evictions, 16)
+        kept = torch.tensor(kept)
+        self.assertTrue(torch.equal(kept[:sink_size], torch.arange(sink_size)))
+        self.assertEqual(kept[-1].item(), num_tokens - 1)
+
+        positions = torch.arange(kept.size(0))
+        expected_keys = rope(raw_keys[:, :, kept].to(dtype), positions, interleaved)
+        query = rope(torch.randn(bsz, num_heads, 1, HEAD_DIM), positions[-1:], interleaved)
+        output = attention(query, k_cache, v_cache)
+        expected = attention(query, expected_keys, values[:, :, kept])
+        return output, expected
+
+    def test_evict_fp32(self):
+        output, expected = self._stream(torch.float32, interleaved=False)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-4))
+
+    def test_evict_fp16(self):
+        output, expected = self._stream(torch.float16, interleaved=False)
+        self.assertTrue(torch.allclose(output, expected, atol=5e-3))
+
+    def test_evict_fp16_interleaved(self):
+        output, expected = self._stream(torch.float16, interleaved=True)
+        self.assertTrue(torch.allclose(output, expected, atol=5e-3))
+
+    def test_evict_keeps_cache_room(self):
+        k_cache, _ = init_kv_cache(1, 2, HEAD_DIM, 40, 100, torch.float32, torch.device("cpu"))
+        evicted = evict_kv_cache(k_cache, 4, 8)
+        self.assertEqual(evicted.size(2), 32)
+        self.assertEqual(evicted.stride(), k_cache.stride())
+        self.assertEqual(evicted.data_ptr(), k_cache.data_ptr())
+
+    def test_trim_attention_mask(self):
+        attention_mask = torch.arange(10).unsqueeze(0)
+        trimmed = trim_attention_sink_mask(attention_mask, 2, 3)
+        self.assertEqual(trimmed.tolist(), [[0, 1, 5, 6, 7, 8, 9]])
+        self.assertIs(trim_attention_sink_mask(attention_mask, 2, 0), attention_mask)
+
+    def test_fp16_kv_cache_fallback(self):
+        linear = torch.nn.Linear(HEAD_DIM, HEAD_DIM)
+        x = torch.randn(1, 1, HEAD_DIM)
+        config = SimpleNamespace(bigdl_attention_sink_size=4, bigdl_attention_window_size=32)
+        with mock.patch.dict(os.environ, {"BIGDL_QUANTIZE_KV_CACHE": "1"}):
+            self.assertTrue(use_quantize_kv_cache(linear, x))
+            self.assertTrue(use_quantize_kv_cache(linear, x, SimpleNamespace()))
+            self.assertFalse(use_quantize_kv_cache(linear, x, config))
+
+    def test_fp16_kv_cache_fallback_llama(self):
+        # the attention sink of llama needs transformers 4.36
+        pytest.importorskip("transformers.cache_utils")
+        from transformers import LlamaConfig, LlamaForCausalLM
+        from ipex_llm import optimize_model
+        from ipex_llm.transformers.model import _set_attention_sink
+        config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4)
+        torch.manual_seed(0)
+        model = optimize_model(LlamaForCausalLM(config).eval())
+        input_ids = torch.randint(3, 256, (1, 8))
+        with mock.patch.dict(os.environ, {"BIGDL_QUANTIZE_KV_CACHE": "1"}):
+            with torch.inference_mode():
+                output = model(input_ids, use_cache=True)
+            self.assertEqual(output.past_key_values[0][0].dtype, torch.uint8)
+            with pytest.warns(UserWarning, match="fp16 kv cache"):
+                _set_attention_sink(model, 4, 32, True)
+            with torch.inference_mode():
+                output = model(input_ids, use_cache=True)
+                output = model(input_ids[:, :1], past_key_values=output.past_key_values,
+                               use_cache=True)
+            self.assertEqual(output.past_key_values[0][0].dtype, torch.float32)
+            self.assertEqual(output.past_key_values[0][0].size(2), 9)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,115 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import math
+import unittest
+import torch
+import pytest
+
+from ipex_llm.transformers.models.utils import sdp_blockwise_cpu, sdp_fp8_cpu, \
+    init_fp8_kv_cache, append_fp8_kv_cache, restore_fp8_kv_cache
+
+
+BSZ = 2
+NUM_HEADS = 8
+NUM_KV_HEADS = 2
+HEAD_DIM = 32
+BLOCK_SIZE = 64
+
+
+def sdp_reference(query, key, value, attention_mask):
+    n_rep = query.size(1) // key.size(1)
+    key = key.float().repeat_interleave(n_rep, dim=1)
+    value = value.float().repeat_interleave(n_rep, dim=1)
+    scores = query.float() @ key.transpose(-1, -2) / math.sqrt(query.size(-1))
+    if attention_mask is not None:
+        scores = scores + attention_mask.float()
+    return torch.softmax(scores, dim=-1) @ value
+
+
+def causal_mask(q_len, kv_len, padding=0, dtype=torch.float32):
+    """Additive causal mask, the first `padding` tokens of the second sequence are padded."""
+    min_value = torch.finfo(dtype).min
+    mask = torch.zeros(BSZ, 1, q_len, kv_len, dtype=dtype)
+    future = torch.arange(kv_len)[None, :] > torch.arange(kv_len - q_len, kv_len)[:, None]
+    mask.masked_fill_(future, min_value)
+    mask[1, :, :, :padding] = min_value
+    return mask
+
+
+class TestSDPBlockwise(unittest.TestCase):
+
+    def _compare(self, q_len, kv_len, attention_mask, dtype=torch.float32, atol=1e-5):
+        torch.manual_seed(0)
+        query = torch.randn(BSZ, NUM_HEADS, q_len, HEAD_DIM, dtype=dtype)
+        key = torch.randn(BSZ, NUM_KV_HEADS, kv_len, HEAD_DIM, dtype=dtype)
+        value = torch.randn(BSZ, NUM_KV_HEADS, kv_len, HEAD_DIM, dtype=dtype)
+        output = sdp_blockwise_cpu(query, key, value, attention_mask, block_size=BLOCK_SIZE)
+        expected = sdp_reference(query, key, value, attention_mask)
+        self.assertEqual(output.shape, query.shape)
+        self.assertEqual(output.dtype, dtype)
+        self.assertTrue(torch.allclose(output.float(), expected, atol=atol))
+
+    def test_prefill(self):
+        # not ending on a block boundary
+        self._compare(150, 150, causal_mask(150, 150, padding=10))
+
+    def test_decode(self):
+        self._compare(1, 200, causal_mask(1, 200, padding=70))
+
+    def test_no_mask(self):
+        self._compare(3, 100, None)
+
+    def test_bfloat16(self):
+        self._compare(20, 150, causal_mask(20, 150, padding=5, dtype=torch.bfloat16),
+                      dtype=torch.bfloat16, atol=2e-2)
+
+
+class TestSDPFP8(unittest.TestCase):
+
+    def _compare(self, q_len, kv_len, attention_mask, new_layout, dtype=torch.float32,
+                 atol=1e-5):
+        torch.manual_seed(0)
+        query = torch.randn(BSZ, NUM_HEADS, q_len, HEAD_DIM, dtype=dtype)
+        k_cache, v_cache = init_fp8_kv_cache(BSZ, NUM_KV_HEADS, 0, HEAD_DIM, query.device,
+                                             new_layout)
+        # filled by a prompt then token by token, as in generation
+        for length in [kv_len - 2, 1, 1]:
+            key = torch.randn(BSZ, NUM_KV_HEADS, length, HEAD_DIM)
+            value = torch.randn(BSZ, NUM_KV_HEADS, length, HEAD_DIM)
+            k_cache, v_cache = append_fp8_kv_cache(k_cache, v_cache, key, value, new_layout)
+        output = sdp_fp8_cpu(query, k_cache, v_cache, attention_mask, block_size=BLOCK_SIZE)
+        key, value = restore_fp8_kv_cache(k_cache, v_cache, torch.float32)
+        expected = sdp_reference(query, key, value, attention_mask)
+        self.assertEqual(output.shape, query.shape)
+        # the output goes into o_proj, whose weight is converted to the dtype of its input
+        self.assertEqual(output.dtype, dtype)
+        self.assertTrue(torch.allclose(output.float(), expected, atol=atol))
+
+    def test_fp8_decode(self):
+        self._compare(1, 200, causal_mask(1, 200, padding=3), new_layout=False)
+
+    def test_fp8_prefill_new_layout(self):
+        self._compare(130, 130, causal_mask(130, 130), new_layout=True)
+
+    def test_fp8_bfloat16(self):
+        self._compare(1, 200, causal_mask(1, 200, padding=3, dtype=torch.bfloat16),
+                      new_layout=False, dtype=torch.bfloat16, atol=2e-2)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
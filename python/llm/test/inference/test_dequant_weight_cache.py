@@ -0,0 +1,140 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import gc
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import torch
+import pytest
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.low_bit_linear import DequantWeightCache, dequant_weight_cache, \
+    TORCH_LINEAR_THRESHOLD
+from ipex_llm.transformers.convert import ggml_convert_low_bit
+
+
+class FakeLayer:
+    def __init__(self, numel=16):
+        self.weight = SimpleNamespace(data=torch.randn(numel))
+
+
+class TestDequantWeightCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = DequantWeightCache(budget_bytes=1024)
+        layer = FakeLayer()
+        calls = []
+
+        def dequantize():
+            calls.append(1)
+            return torch.ones(4, 4)
+
+        first = cache.get(layer, dequantize)
+        second = cache.get(layer, dequantize)
+        self.assertIs(first, second)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["used_bytes"], 64)
+
+    def test_invalidate_replaced_weight(self):
+        cache = DequantWeightCache(budget_bytes=1024)
+        layer = FakeLayer()
+        cache.get(layer, lambda: torch.zeros(4, 4))
+        layer.weight.data = torch.randn(16)
+        weight = cache.get(layer, lambda: torch.ones(4, 4))
+        self.assertTrue(torch.equal(weight, torch.ones(4, 4)))
+        self.assertEqual(cache.stats()["misses"], 2)
+        self.assertEqual(cache.stats()["num_layers"], 1)
+        self.assertEqual(cache.stats()["used_bytes"], 64)
+
+    def test_remove_freed_layer(self):
+        cache = DequantWeightCache(budget_bytes=1024)
+        layer = FakeLayer()
+        cache.get(layer, lambda: torch.zeros(4, 4))
+        del layer
+        gc.collect()
+        self.assertEqual(cache.stats()["num_layers"], 0)
+        self.assertEqual(cache.stats()["used_bytes"], 0)
+
+    def test_lru_eviction(self):
+        # room for two 4x4 float32 weights
+        cache = DequantWeightCache(budget_bytes=128)
+        layers = [FakeLayer() for _ in range(3)]
+        cache.get(layers[0], lambda: torch.zeros(4, 4))
+        cache.get(layers[1], lambda: torch.zeros(4, 4))
+        cache.get(layers[0], lambda: torch.zeros(4, 4))
+        cache.get(layers[2], lambda: torch.zeros(4, 4))
+        # layers[1] is the least recently used
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cache.get(layers[0], lambda: torch.zeros(4, 4))
+        self.assertEqual(cache.stats()["hits"], 2)
+        cache.get(layers[1], lambda: torch.zeros(4, 4))
+        self.assertEqual(cache.stats()["misses"], 4)
+        self.assertLessEqual(cache.stats()["used_bytes"], 128)
+
+    def test_weight_over_budget(self):
+        cache = DequantWeightCache(budget_bytes=32)
+        weight = cache.get(FakeLayer(), lambda: torch.ones(4, 4))
+        self.assertTrue(torch.equal(weight, torch.ones(4, 4)))
+        self.assertEqual(cache.stats()["num_layers"], 0)
+
+    def test_bf16(self):
+        cache = DequantWeightCache(budget_bytes=1024, use_bf16=True)
+        layer = FakeLayer()
+        weight = cache.get(layer, lambda: torch.ones(4, 4))
+        self.assertEqual(weight.dtype, torch.bfloat16)
+        self.assertEqual(cache.stats()["used_bytes"], 32)
+
+
+class TestLowBitLinearDequantCache(unittest.TestCase):
+
+    def tearDown(self):
+        dequant_weight_cache.configure(0)
+
+    def _forward(self, model, x):
+        # the dequantized path is taken for large batches on non-SPR servers
+        with mock.patch("ipex_llm.utils.isa_checker.is_server", return_value=True), \
+                mock.patch("ipex_llm.utils.isa_checker.is_spr", return_value=False), \
+                torch.inference_mode():
+            return model(x)
+
+    def test_same_output(self):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(128, 64), torch.nn.Linear(64, 32)).eval()
+        model = ggml_convert_low_bit(model, ggml_tensor_qtype["sym_int4"],
+                                     optimize_model=False)
+        x = torch.randn(TORCH_LINEAR_THRESHOLD, 128)
+        expected = self._forward(model, x)
+
+        dequant_weight_cache.configure(1)
+        output = self._forward(model, x)
+        self.assertEqual(dequant_weight_cache.stats()["misses"], 2)
+        self.assertTrue(torch.equal(output, expected))
+        output = self._forward(model, x)
+        self.assertEqual(dequant_weight_cache.stats()["hits"], 2)
+        self.assertTrue(torch.equal(output, expected))
+
+        dequant_weight_cache.configure(1, use_bf16=True)
+        output = self._forward(model, x)
+        self.assertEqual(output.dtype, torch.float32)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-2))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,167 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import threading
+import unittest
+from types import SimpleNamespace
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.generation.logits_process import LogitsProcessorList
+from transformers.generation.streamers import BaseStreamer
+from ipex_llm.serving.fastchat.ipex_llm_worker import BatchingEngine, BatchRequest
+
+
+class TokenCollector(BaseStreamer):
+    def __init__(self):
+        self.tokens = []
+        self.ended = threading.Event()
+
+    def put(self, value):
+        self.tokens += value.reshape(-1).tolist()
+
+    def end(self):
+        self.ended.set()
+
+
+def greedy(model, prompt, max_new_tokens):
+    input_ids = torch.tensor([prompt])
+    with torch.inference_mode():
+        for _ in range(max_new_tokens):
+            next_token = model(input_ids).logits[:, -1].argmax(-1, keepdim=True)
+            input_ids = torch.cat((input_ids, next_token), dim=-1)
+    return input_ids[0, len(prompt):].tolist()
+
+
+class TestBatchingEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256,
+                             pad_token_id=0, bos_token_id=1, eos_token_id=2)
+        torch.manual_seed(0)
+        cls.model = LlamaForCausalLM(config).eval()
+        cls.tokenizer = SimpleNamespace(pad_token_id=0)
+
+    def _request(self, prompt, max_new_tokens, stop_token_ids=()):
+        return BatchRequest(torch.tensor(prompt), TokenCollector(), max_new_tokens,
+                            list(stop_token_ids), LogitsProcessorList(), do_sample=False)
+
+    def _step(self, engine, new_requests=()):
+        # one iteration of `BatchingEngine._loop`
+        with torch.inference_mode():
+            if len(new_requests) > 0:
+                engine._prefill(list(new_requests))
+            else:
+                engine._decode()
+            engine._evict()
+
+    def test_prefill_merge(self):
+        # the background loop waits for submitted requests, the steps are run here
+        engine = BatchingEngine(self.model, self.tokenizer, max_batch_size=4)
+        prompts = [[1, 5, 6], [1, 7, 8, 9, 10, 11, 12], [1, 13]]
+        max_new_tokens = 6
+        requests = [self._request(prompt, max_new_tokens) for prompt in prompts]
+        self._step(engine, requests[:1])
+        self._step(engine)
+        # a longer request left-pads the running batch
+        self._step(engine, requests[1:2])
+        self.assertEqual(engine.input_ids.shape, (2, len(prompts[1]) + 1))
+        self.assertEqual(engine.attention_mask.sum(-1).tolist(),
+                         [len(prompts[0]) + 1, len(prompts[1])])
+        # a shorter request is left-padded to the running batch
+        self._step(engine, requests[2:])
+        self.assertEqual(engine.input_ids.size(0), 3)
+        self.assertEqual(engine.attention_mask[2].sum().item(), len(prompts[2]))
+        for past_key_value in engine.past_key_values:
+            for kv in past_key_value:
+                self.assertEqual(kv.size(0), 3)
+                self.assertEqual(kv.size(2), engine.attention_mask.size(1))
+        while len(engine.requests) > 0:
+            self._step(engine)
+        for prompt, request in zip(prompts, requests):
+            self.assertTrue(request.streamer.ended.is_set())
+            self.assertEqual(request.output_ids, greedy(self.model, prompt, max_new_tokens))
+            self.assertEqual(request.streamer.tokens, request.output_ids)
+
+    def test_evict(self):
+        engine = BatchingEngine(self.model, self.tokenizer, max_batch_size=4)
+        prompts = [[1, 5, 6, 7, 8, 9, 10, 11], [1, 12, 13]]
+        requests = [self._request(prompts[0], 2), self._request(prompts[1], 6)]
+        self._step(engine, requests)
+        self._step(engine)
+        # the first request is finished and evicted with the padding of the second one
+        self.assertTrue(requests[0].streamer.ended.is_set())
+        self.assertFalse(requests[1].streamer.ended.is_set())
+        self.assertEqual(engine.requests, requests[1:])
+        self.assertTrue(bool(engine.attention_mask.all()))
+        self.assertEqual(engine.input_ids[0].tolist(),
+                         prompts[1] + requests[1].output_ids)
+        for past_key_value in engine.past_key_values:
+            for kv in past_key_value:
+                self.assertEqual(kv.shape[:3], (1, 4, len(prompts[1]) + 1))
+        while len(engine.requests) > 0:
+            self._step(engine)
+        self.assertIsNone(engine.past_key_values)
+        for prompt, request in zip(prompts, requests):
+            self.assertEqual(request.output_ids,
+                             greedy(self.model, prompt, request.max_new_tokens))
+
+    def test_cancel(self):
+        engine = BatchingEngine(self.model, self.tokenizer, max_batch_size=4)
+        requests = [self._request([1, 5, 6], 6), self._request([1, 7, 8], 6)]
+        self._step(engine, requests)
+        engine.cancel(requests[0])
+        self._step(engine)
+        self.assertTrue(requests[0].streamer.ended.is_set())
+        self.assertEqual(len(requests[0].output_ids), 2)
+        self.assertEqual(engine.requests, requests[1:])
+
+    def test_stop_token(self):
+        engine = BatchingEngine(self.model, self.tokenizer, max_batch_size=4)
+        prompts = [[1, 5, 6], [1, 7, 8]]
+        expected = [greedy(self.model, prompt, 6) for prompt in prompts]
+        # the first request stops at its third token, the other one is not stopped by it
+        stop_token = expected[0][2]
+        requests = [self._request(prompts[0], 6, stop_token_ids=[stop_token]),
+                    self._request(prompts[1], 6)]
+        self._step(engine, requests)
+        while len(engine.requests) > 0:
+            self._step(engine)
+        self.assertEqual(requests[0].output_ids,
+                         expected[0][:expected[0].index(stop_token) + 1])
+        self.assertEqual(requests[1].output_ids, expected[1])
+
+    def test_submit(self):
+        engine = BatchingEngine(self.model, self.tokenizer, max_batch_size=2)
+        prompts = [[1, 5, 6], [1, 7, 8, 9, 10], [1, 11, 12, 13]]
+        streamers = [TokenCollector() for _ in prompts]
+        requests = [engine.submit(torch.tensor([prompt]), streamer, max_new_tokens=5,
+                                  stop_token_ids=[])
+                    for prompt, streamer in zip(prompts, streamers)]
+        for prompt, request, streamer in zip(prompts, requests, streamers):
+            self.assertTrue(streamer.ended.wait(timeout=60))
+            # the prompt, then the generated tokens
+            self.assertEqual(streamer.tokens, prompt + request.output_ids)
+            self.assertEqual(request.output_ids, greedy(self.model, prompt, 5))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,316 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+import numpy as np
+import torch
+import pytest
+
+from ipex_llm.transformers.convert import ggml_convert_low_bit, \
+    replace_with_quantized_linear_for_module
+from ipex_llm.transformers.gguf.gguf import GGUFTensorLoader, GGUFQuantizedTensor, \
+    GGUF_PASSTHROUGH_QTYPES
+from ipex_llm.transformers.low_bit_linear import LowBitLinear
+
+
+# The reference dequantizations below are line by line ports of the dequantize_row_*
+# routines of https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c,
+# each of them takes the bytes of one block and returns its values.
+
+def half(block, offset):
+    return np.float32(block[offset:offset + 2].view(np.float16)[0])
+
+
+def ref_q4_0(block):
+    d, qs = half(block, 0), block[2:18]
+    y = np.zeros(32, dtype=np.float32)
+    for j in range(16):
+        y[j] = ((int(qs[j]) & 0xF) - 8) * d
+        y[j + 16] = ((int(qs[j]) >> 4) - 8) * d
+    return y
+
+
+def ref_q4_1(block):
+    d, m, qs = half(block, 0), half(block, 2), block[4:20]
+    y = np.zeros(32, dtype=np.float32)
+    for j in range(16):
+        y[j] = (int(qs[j]) & 0xF) * d + m
+        y[j + 16] = (int(qs[j]) >> 4) * d + m
+    return y
+
+
+def ref_q5_0(block):
+    d, qh, qs = half(block, 0), int(block[2:6].view(np.uint32)[0]), block[6:22]
+    y = np.zeros(32, dtype=np.float32)
+    for j in range(16):
+        xh_0 = ((qh >> j) << 4) & 0x10
+        xh_1 = (qh >> (j + 12)) & 0x10
+        y[j] = (((int(qs[j]) & 0xF) | xh_0) - 16) * d
+        y[j + 16] = (((int(qs[j]) >> 4) | xh_1) - 16) * d
+    return y
+
+
+def ref_q5_1(block):
+    d, m = half(block, 0), half(block, 2)
+    qh, qs = int(block[4:8].view(np.uint32)[0]), block[8:24]
+    y = np.zeros(32, dtype=np.float32)
+    for j in range(16):
+        xh_0 = ((qh >> j) << 4) & 0x10
+        xh_1 = (qh >> (j + 12)) & 0x10
+        y[j] = ((int(qs[j]) & 0xF) | xh_0) * d + m
+        y[j + 16] = ((int(qs[j]) >> 4) | xh_1) * d + m
+    return y
+
+
+def ref_q8_0(block):
+    return block[2:34].view(np.int8).astype(np.float32) * half(block, 0)
+
+
+def ref_q2_k(block):
+    scales, q, d, dmin = block[:16], block[16:80], half(block, 80), half(block, 82)
+    y = []
+    i = 0
+    for n in range(0, 256, 128):
+        shift = 0
+        for j in range(4):
+            for k in (0, 16):
+                sc = int(scales[i])
+                i += 1
+                dl, ml = d * (sc & 0xF), dmin * (sc >> 4)
+                for l in range(16):
+                    y.append(dl * ((int(q[n // 4 + k + l]) >> shift) & 3) - ml)
+            shift += 2
+    return np.array(y, dtype=np.float32)
+
+
+def ref_q3_k(block):
+    hm, q, d_all = block[:32], block[32:96], half(block, 108)
+    kmask1, kmask2 = 0x03030303, 0x0f0f0f0f
+    aux = [int(a) for a in block[96:108].view(np.uint32)] + [0]
+    tmp = aux[2]
+    aux[2] = ((aux[0] >> 4) & kmask2) | (((tmp >> 4) & kmask1) << 4)
+    aux[3] = ((aux[1] >> 4) & kmask2) | (((tmp >> 6) & kmask1) << 4)
+    aux[0] = (aux[0] & kmask2) | (((tmp >> 0) & kmask1) << 4)
+    aux[1] = (aux[1] & kmask2) | (((tmp >> 2) & kmask1) << 4)
+    scales = np.array(aux, dtype=np.uint32).view(np.int8)
+    y = []
+    i = 0
+    m = 1
+    for n in range(0, 256, 128):
+        shift = 0
+        for j in range(4):
+            for k in (0, 16):
+                dl = d_all * (int(scales[i]) - 32)
+                i += 1
+                for l in range(16):
+                    value = (int(q[n // 4 + k + l]) >> shift) & 3
+                    value -= 0 if int(hm[k + l]) & m else 4
+                    y.append(dl * value)
+            shift += 2
+            m <<= 1
+    return np.array(y, dtype=np.float32)
+
+
+def get_scale_min_k4(j, q):
+    if j < 4:
+        return int(q[j]) & 63, int(q[j + 4]) & 63
+    return (int(q[j + 4]) & 0xF) | ((int(q[j - 4]) >> 6) << 4), \
+        (int(q[j + 4]) >> 4) | ((int(q[j]) >> 6) << 4)
+
+
+def ref_q4_k(block):
+    d, dmin, scales, q = half(block, 0), half(block, 2), block[4:16], block[16:144]
+    y = []
+    for i, j in enumerate(range(0, 256, 64)):
+        sc, m = get_scale_min_k4(2 * i, scales)
+        d1, m1 = d * sc, dmin * m
+        sc, m = get_scale_min_k4(2 * i + 1, scales)
+        d2, m2 = d * sc, dmin * m
+        ql = q[32 * i:32 * i + 32]
+        y += [d1 * (int(ql[l]) & 0xF) - m1 for l in range(32)]
+        y += [d2 * (int(ql[l]) >> 4) - m2 for l in range(32)]
+    return np.array(y, dtype=np.float32)
+
+
+def ref_q5_k(block):
+    d, dmin, scales = half(block, 0), half(block, 2), block[4:16]
+    qh, q = block[16:48], block[48:176]
+    y = []
+    u1, u2 = 1, 2
+    for i, j in enumerate(range(0, 256, 64)):
+        sc, m = get_scale_min_k4(2 * i, scales)
+        d1, m1 = d * sc, dmin * m
+        sc, m = get_scale_min_k4(2 * i + 1, scales)
+        d2, m2 = d * sc, dmin * m
+        ql = q[32 * i:32 * i + 32]
+        y += [d1 * ((int(ql[l]) & 0xF) + (16 if int(qh[l]) & u1 else 0)) - m1
+              for l in range(32)]
+        y += [d2 * ((int(ql[l]) >> 4) + (16 if int(qh[l]) & u2 else 0)) - m2
+              for l in range(32)]
+        u1 <<= 2
+        u2 <<= 2
+    return np.array(y, dtype=np.float32)
+
+
+def ref_q6_k(block):
+    ql, qh, sc, d = block[:128], block[128:192], block[192:208].view(np.int8), half(block, 208)
+    y = np.zeros(256, dtype=np.float32)
+    for n in range(2):
+        y_n, ql_n, qh_n, sc_n = y[128 * n:], ql[64 * n:], qh[32 * n:], sc[8 * n:]
+        for l in range(32):
+            i = l // 16
+            q1 = ((int(ql_n[l]) & 0xF) | (((int(qh_n[l]) >> 0) & 3) << 4)) - 32
+            q2 = ((int(ql_n[l + 32]) & 0xF) | (((int(qh_n[l]) >> 2) & 3) << 4)) - 32
+            q3 = ((int(ql_n[l]) >> 4) | (((int(qh_n[l]) >> 4) & 3) << 4)) - 32
+            q4 = ((int(ql_n[l + 32]) >> 4) | (((int(qh_n[l]) >> 6) & 3) << 4)) - 32
+            y_n[l] = d * int(sc_n[i]) * q1
+            y_n[l + 32] = d * int(sc_n[i + 2]) * q2
+            y_n[l + 64] = d * int(sc_n[i + 4]) * q3
+            y_n[l + 96] = d * int(sc_n[i + 6]) * q4
+    return y
+
+
+# qtype: (block size in bytes, values per block, offsets of the fp16 scales, reference)
+GGUF_QTYPES = {
+    2: (18, 32, [0], ref_q4_0),
+    3: (20, 32, [0, 2], ref_q4_1),
+    6: (22, 32, [0], ref_q5_0),
+    7: (24, 32, [0, 2], ref_q5_1),
+    8: (34, 32, [0], ref_q8_0),
+    10: (84, 256, [80, 82], ref_q2_k),
+    11: (110, 256, [108], ref_q3_k),
+    12: (144, 256, [0, 2], ref_q4_k),
+    13: (176, 256, [0, 2], ref_q5_k),
+    14: (210, 256, [208], ref_q6_k),
+}
+
+
+def random_blocks(qtype, num_blocks, rng):
+    """Random blocks of `qtype`, with small positive scales so that values are finite."""
+    block_size, _, scale_offsets, _ = GGUF_QTYPES[qtype]
+    blocks = rng.integers(0, 256, size=(num_blocks, block_size), dtype=np.uint8)
+    for offset in scale_offsets:
+        scales = rng.uniform(0.001, 0.05, size=(num_blocks, 1)).astype(np.float16)
+        blocks[:, offset:offset + 2] = scales.view(np.uint8)
+    return blocks
+
+
+class TestGGUFTensorLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, blocks):
+        path = os.path.join(self.tmp_dir, "tensors.bin")
+        with open(path, "wb") as f:
+            f.write(blocks.tobytes())
+        return path
+
+    def _loader(self, blocks, qtype, dims):
+        tensor_infos = SimpleNamespace(infos=[("blk.0.attn_q.weight", len(dims), dims, qtype, 0)],
+                                       base_offset=0)
+        return GGUFTensorLoader(self._write(blocks), tensor_infos)
+
+    def _compare_dequantize(self, qtype):
+        rng = np.random.default_rng(qtype)
+        _, block_ne, _, reference = GGUF_QTYPES[qtype]
+        dims = [4, 2 * block_ne]
+        blocks = random_blocks(qtype, 8, rng)
+        expected = np.concatenate([reference(block) for block in blocks])
+        loader = self._loader(blocks, qtype, dims)
+        (name, tensor), = list(loader)
+        self.assertEqual(list(tensor.shape), dims)
+        # q4_0 to q8_0 are dequantized to float16
+        rtol = 1e-3 if tensor.dtype == torch.float16 else 1e-5
+        np.testing.assert_allclose(tensor.float().reshape(-1).numpy(), expected,
+                                   rtol=rtol, atol=1e-6)
+
+    def test_dequantize_q4_0(self):
+        self._compare_dequantize(2)
+
+    def test_dequantize_q4_1(self):
+        self._compare_dequantize(3)
+
+    def test_dequantize_q5_0(self):
+        self._compare_dequantize(6)
+
+    def test_dequantize_q5_1(self):
+        self._compare_dequantize(7)
+
+    def test_dequantize_q8_0(self):
+        self._compare_dequantize(8)
+
+    def test_dequantize_q2_k(self):
+        self._compare_dequantize(10)
+
+    def test_dequantize_q3_k(self):
+        self._compare_dequantize(11)
+
+    def test_dequantize_q4_k(self):
+        self._compare_dequantize(12)
+
+    def test_dequantize_q5_k(self):
+        self._compare_dequantize(13)
+
+    def test_dequantize_q6_k(self):
+        self._compare_dequantize(14)
+
+    def test_passthrough(self):
+        out_features, in_features = 64, 128
+        x = torch.randn(4, in_features)
+        for qtype in GGUF_PASSTHROUGH_QTYPES:
+            rng = np.random.default_rng(qtype)
+            _, block_ne, _, reference = GGUF_QTYPES[qtype]
+            blocks = random_blocks(qtype, out_features * in_features // block_ne, rng)
+            weight = torch.from_numpy(np.concatenate([reference(block) for block in blocks]))
+            weight = weight.reshape(out_features, in_features)
+            loader = self._loader(blocks, qtype, [out_features, in_features])
+            tensors = []
+            loader.load_while_process(lambda name, tensor: tensors.append(tensor),
+                                      passthrough=lambda name, qtype, dims: True)
+
+            model = torch.nn.Sequential(torch.nn.Linear(in_features, out_features, bias=False))
+            if loader.can_pass_through(qtype):
+                self.assertIsInstance(tensors[0], GGUFQuantizedTensor)
+                model = replace_with_quantized_linear_for_module(model.eval(), qtype, "0.weight",
+                                                                 tensors[0].data.clone())
+                atol = 1e-2
+            else:
+                # blocks of another size are dequantized, to be quantized again
+                self.assertNotIsInstance(tensors[0], GGUFQuantizedTensor)
+                self.assertTrue(torch.allclose(tensors[0].float(), weight, rtol=1e-3))
+                model[0].weight.data = tensors[0].float().clone()
+                model = ggml_convert_low_bit(model.eval(), qtype, optimize_model=False)
+                # requantized into larger blocks
+                atol = 1e-1
+            self.assertIsInstance(model[0], LowBitLinear)
+            with torch.inference_mode():
+                output = model(x)
+            expected = x @ weight.t()
+            self.assertTrue(torch.allclose(output, expected,
+                                           atol=atol * expected.abs().max().item()), qtype)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
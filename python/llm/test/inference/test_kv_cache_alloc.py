@@ -0,0 +1,156 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from ipex_llm import optimize_model
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH, \
+    KV_CACHE_GROWTH_FACTOR, get_kv_cache_alloc_length, kv_cache_length_hint, \
+    init_kv_cache, update_kv_cache
+
+
+BSZ, NUM_HEADS, HEAD_DIM = 1, 2, 16
+
+
+def allocated_length(cache):
+    return cache.stride(1) // cache.size(3)
+
+
+def tiny_llama():
+    config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4,
+                         max_position_embeddings=256,
+                         pad_token_id=0, bos_token_id=1, eos_token_id=2)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+
+class TestKVCacheAlloc(unittest.TestCase):
+
+    def test_growth(self):
+        # a new cache is allocated for the asked length
+        self.assertEqual(get_kv_cache_alloc_length(10, 10 + KV_CACHE_ALLOC_BLOCK_LENGTH),
+                         10 + KV_CACHE_ALLOC_BLOCK_LENGTH)
+        # a full cache grows geometrically, or by the asked length if that is more
+        self.assertEqual(get_kv_cache_alloc_length(1000, 1000, 1000),
+                         int(1000 * KV_CACHE_GROWTH_FACTOR))
+        self.assertEqual(get_kv_cache_alloc_length(2000, 2000, 1000), 2000)
+
+    def test_reallocations(self):
+        # appending tokens one by one reallocates the cache O(log(n)) times
+        num_tokens = 4096
+        keys = torch.randn(BSZ, NUM_HEADS, num_tokens, HEAD_DIM)
+        values = torch.randn(BSZ, NUM_HEADS, num_tokens, HEAD_DIM)
+        k_cache, v_cache = update_kv_cache(None, None, keys[:, :, :1], values[:, :, :1])
+        num_reallocations = 0
+        for i in range(1, num_tokens):
+            data_ptr = k_cache.data_ptr()
+            k_cache, v_cache = update_kv_cache(k_cache, v_cache,
+                                               keys[:, :, i:i + 1], values[:, :, i:i + 1])
+            num_reallocations += k_cache.data_ptr() != data_ptr
+        self.assertLessEqual(num_reallocations, 8)
+        self.assertTrue(torch.equal(k_cache, keys))
+        self.assertTrue(torch.equal(v_cache, values))
+
+    def test_hint(self):
+        with kv_cache_length_hint(1000):
+            self.assertEqual(get_kv_cache_alloc_length(10, 10 + KV_CACHE_ALLOC_BLOCK_LENGTH),
+                             1000)
+            k_cache, _ = init_kv_cache(BSZ, NUM_HEADS, HEAD_DIM, 10, 20,
+                                       torch.float32, torch.device("cpu"))
+            self.assertEqual(allocated_length(k_cache), 1000)
+            # an empty cache, e.g. a temporary one, and a cache over the hint are not hinted
+            self.assertEqual(get_kv_cache_alloc_length(0, 20), 20)
+            self.assertEqual(get_kv_cache_alloc_length(1200, 1200, 1000),
+                             int(1000 * KV_CACHE_GROWTH_FACTOR))
+            with kv_cache_length_hint(50):
+                self.assertEqual(get_kv_cache_alloc_length(10, 20), 50)
+            self.assertEqual(get_kv_cache_alloc_length(10, 20), 1000)
+        self.assertEqual(get_kv_cache_alloc_length(10, 20), 20)
+
+    def test_generate_hint(self):
+        model = optimize_model(tiny_llama())
+        prompt_length, max_new_tokens = 7, 300
+        input_ids = torch.randint(3, 256, (1, prompt_length))
+        caches = []
+
+        def record_cache(module, args, output):
+            caches.append(output.past_key_values[0][0])
+
+        handle = model.register_forward_hook(record_cache)
+        with torch.inference_mode():
+            output = model.generate(input_ids, max_new_tokens=max_new_tokens,
+                                    min_new_tokens=max_new_tokens, do_sample=False)
+        handle.remove()
+        self.assertEqual(output.size(1), prompt_length + max_new_tokens)
+        # the cache is allocated once for the prompt and all new tokens
+        self.assertEqual(len(set(cache.data_ptr() for cache in caches)), 1)
+        self.assertEqual(allocated_length(caches[0]), prompt_length + max_new_tokens)
+
+        # without `max_new_tokens` the cache grows as usual
+        caches.clear()
+        handle = model.register_forward_hook(record_cache)
+        with torch.inference_mode():
+            model.generate(input_ids, max_length=prompt_length + 2, do_sample=False)
+        handle.remove()
+        self.assertEqual(allocated_length(caches[0]), prompt_length + KV_CACHE_ALLOC_BLOCK_LENGTH)
+
+    def test_own_generate_kept(self):
+        class OwnGenerateLlama(LlamaForCausalLM):
+            def generate(self, *args, **kwargs):
+                return "own"
+
+        model = OwnGenerateLlama(tiny_llama().config)
+        model = optimize_model(model)
+        self.assertNotIn("generate", vars(model))
+        self.assertEqual(model.generate(torch.ones(1, 2, dtype=torch.long)), "own")
+
+    def test_dynamic_normal_cache(self):
+        pytest.importorskip("transformers.cache_utils")
+        from ipex_llm.transformers.kv import DynamicNormalCache
+
+        num_layers, num_tokens = 2, 300
+        keys = torch.randn(num_layers, BSZ, NUM_HEADS, num_tokens, HEAD_DIM)
+        values = torch.randn(num_layers, BSZ, NUM_HEADS, num_tokens, HEAD_DIM)
+        cache = DynamicNormalCache()
+        for start, end in [(0, 5)] + [(i, i + 1) for i in range(5, num_tokens)]:
+            for layer_idx in range(num_layers):
+                k, v = cache.update(keys[layer_idx, :, :, start:end],
+                                    values[layer_idx, :, :, start:end], layer_idx)
+                self.assertTrue(torch.equal(k, keys[layer_idx, :, :, :end]))
+                self.assertTrue(torch.equal(v, values[layer_idx, :, :, :end]))
+            self.assertEqual(cache.get_seq_length(), end)
+        # the prefill is allocated with a block of room, then grown geometrically
+        self.assertGreater(allocated_length(cache.key_cache[0]), num_tokens)
+
+        # the legacy caches are kept until they have no room
+        legacy = tuple((keys[i, :, :, :5].clone(), values[i, :, :, :5].clone())
+                       for i in range(num_layers))
+        cache = DynamicNormalCache.from_legacy_cache(legacy)
+        self.assertEqual(cache.get_seq_length(), 5)
+        self.assertIs(cache.key_cache[0], legacy[0][0])
+        k, v = cache.update(keys[0, :, :, 5:6], values[0, :, :, 5:6], 0)
+        self.assertTrue(torch.equal(k, keys[0, :, :, :6]))
+        self.assertTrue(torch.equal(v, values[0, :, :, :6]))
+        self.assertGreaterEqual(allocated_length(k), 6 + KV_CACHE_ALLOC_BLOCK_LENGTH)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
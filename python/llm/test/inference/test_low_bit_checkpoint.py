@@ -0,0 +1,89 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import unittest
+import shutil
+import tempfile
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers.low_bit_checkpoint import LOW_BIT_WEIGHTS_NAME
+
+
+class TestLowBitCheckpoint(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_path = tempfile.mkdtemp()
+        config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        torch.manual_seed(0)
+        LlamaForCausalLM(config).save_pretrained(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_path)
+
+    def setUp(self):
+        self.save_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.save_path)
+
+    def _assert_same_model(self, model, loaded_model):
+        state_dict = model.state_dict()
+        loaded_state_dict = loaded_model.state_dict()
+        self.assertEqual(state_dict.keys(), loaded_state_dict.keys())
+        for name, tensor in state_dict.items():
+            self.assertTrue(torch.equal(loaded_state_dict[name], tensor), name)
+        input_ids = torch.tensor([[1, 5, 6, 7, 8]])
+        with torch.inference_mode():
+            logits = model(input_ids).logits
+            loaded_logits = loaded_model(input_ids).logits
+        self.assertTrue(torch.equal(logits, loaded_logits))
+
+    def test_mmap_format(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, load_in_low_bit="sym_int4")
+        model.save_low_bit(self.save_path, mmap_format=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.save_path, LOW_BIT_WEIGHTS_NAME)))
+        loaded_model = AutoModelForCausalLM.load_low_bit(self.save_path)
+        self._assert_same_model(model, loaded_model)
+
+    def test_pickle_format(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, load_in_low_bit="sym_int8")
+        model.save_low_bit(self.save_path)
+        self.assertFalse(os.path.exists(os.path.join(self.save_path, LOW_BIT_WEIGHTS_NAME)))
+        loaded_model = AutoModelForCausalLM.load_low_bit(self.save_path)
+        self._assert_same_model(model, loaded_model)
+
+    def test_overwrite_mmap_format(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, load_in_low_bit="sym_int4")
+        model.save_low_bit(self.save_path, mmap_format=True)
+        # the checkpoint saved later in the pickle format is the one loaded
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, load_in_low_bit="sym_int8")
+        model.save_low_bit(self.save_path)
+        self.assertFalse(os.path.exists(os.path.join(self.save_path, LOW_BIT_WEIGHTS_NAME)))
+        loaded_model = AutoModelForCausalLM.load_low_bit(self.save_path)
+        self._assert_same_model(model, loaded_model)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
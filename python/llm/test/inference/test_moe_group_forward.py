@@ -0,0 +1,95 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+import torch.nn.functional as F
+import pytest
+
+from ipex_llm.transformers.models.utils import moe_group_forward
+
+
+class Expert(torch.nn.Module):
+    def __init__(self, hidden_dim, intermediate_dim):
+        super().__init__()
+        self.w1 = torch.nn.Linear(hidden_dim, intermediate_dim, bias=False)
+        self.w2 = torch.nn.Linear(intermediate_dim, hidden_dim, bias=False)
+
+    def forward(self, x, routing_weights):
+        return routing_weights * self.w2(F.silu(self.w1(x)))
+
+
+def per_expert_loop(hidden_states, routing_weights, selected_experts, experts):
+    # the loop of the original Mixtral MoE block, one expert at a time
+    final_hidden_states = torch.zeros_like(hidden_states)
+    expert_mask = F.one_hot(selected_experts, num_classes=len(experts)).permute(2, 1, 0)
+    for expert_idx, expert_layer in enumerate(experts):
+        idx, top_x = torch.where(expert_mask[expert_idx])
+        if top_x.shape[0] == 0:
+            continue
+        current_state = hidden_states[top_x]
+        current_hidden_states = expert_layer(current_state, routing_weights[top_x, idx, None])
+        final_hidden_states.index_add_(0, top_x, current_hidden_states)
+    return final_hidden_states
+
+
+class TestMoEGroupForward(unittest.TestCase):
+
+    def _compare(self, num_tokens, num_experts, top_k, normalize, dtype=torch.float32):
+        torch.manual_seed(num_tokens + num_experts + top_k)
+        hidden_dim = 32
+        experts = torch.nn.ModuleList(Expert(hidden_dim, 64) for _ in range(num_experts))
+        experts = experts.to(dtype)
+        gate = torch.nn.Linear(hidden_dim, num_experts, bias=False).to(dtype)
+        hidden_states = torch.randn(num_tokens, hidden_dim, dtype=dtype)
+
+        routing_weights = F.softmax(gate(hidden_states), dim=1, dtype=torch.float)
+        routing_weights, selected_experts = torch.topk(routing_weights, top_k, dim=-1)
+        if normalize:
+            routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
+        routing_weights = routing_weights.to(dtype)
+
+        with torch.inference_mode():
+            expected = per_expert_loop(hidden_states, routing_weights, selected_experts,
+                                       experts)
+            output = moe_group_forward(hidden_states, routing_weights, selected_experts,
+                                       num_experts,
+                                       lambda expert_idx, x, weights:
+                                       experts[expert_idx](x, weights))
+        self.assertEqual(output.dtype, dtype)
+        self.assertEqual(output.shape, expected.shape)
+        atol = 1e-5 if dtype == torch.float32 else 2e-2
+        self.assertTrue(torch.allclose(output, expected, atol=atol))
+
+    def test_mixtral(self):
+        # top 2 of 8 experts, the routing weights normalized
+        self._compare(num_tokens=37, num_experts=8, top_k=2, normalize=True)
+
+    def test_qwen2_moe(self):
+        # top 4 of 60 experts without normalization, many experts get no token
+        self._compare(num_tokens=13, num_experts=60, top_k=4, normalize=False)
+
+    def test_single_token(self):
+        self._compare(num_tokens=1, num_experts=8, top_k=2, normalize=True)
+
+    def test_bfloat16(self):
+        self._compare(num_tokens=37, num_experts=8, top_k=2, normalize=True,
+                      dtype=torch.bfloat16)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,84 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import threading
+import time
+import unittest
+import pytest
+
+from ipex_llm.transformers.convert import _ParallelQuantizer
+
+
+class FakeParams:
+    lock = threading.Lock()
+    inflight_bytes = 0
+    max_inflight_bytes = 0
+
+    def __init__(self, numel, error=None):
+        self._numel = numel
+        self.error = error
+        self.quantized = False
+
+    def numel(self):
+        return self._numel
+
+    def quantize(self, device):
+        cls = FakeParams
+        with cls.lock:
+            cls.inflight_bytes += self._numel * 4
+            cls.max_inflight_bytes = max(cls.max_inflight_bytes, cls.inflight_bytes)
+        time.sleep(0.01)
+        with cls.lock:
+            cls.inflight_bytes -= self._numel * 4
+        if self.error is not None:
+            raise self.error
+        self.quantized = True
+
+
+class TestParallelQuantizer(unittest.TestCase):
+
+    def setUp(self):
+        FakeParams.inflight_bytes = 0
+        FakeParams.max_inflight_bytes = 0
+
+    def test_max_inflight_bytes(self):
+        quantizer = _ParallelQuantizer(num_threads=8, max_inflight_bytes=3000)
+        params = [FakeParams(250) for _ in range(32)]
+        # larger than the limit, quantized alone
+        params.append(FakeParams(1000))
+        for p in params:
+            quantizer.submit(p)
+        self.assertIsNone(quantizer.wait())
+        self.assertTrue(all(p.quantized for p in params))
+        self.assertLessEqual(FakeParams.max_inflight_bytes, 4000)
+
+    def test_wait_keeps_error(self):
+        quantizer = _ParallelQuantizer(num_threads=4, max_inflight_bytes=1 << 20)
+        quantizer.submit(FakeParams(16, error=ValueError("quantize")))
+        failed = None
+        with pytest.raises(KeyError):
+            try:
+                # the error of loading isn't replaced by the error of quantizing
+                raise KeyError("load")
+            finally:
+                failed = quantizer.wait()
+        with pytest.raises(ValueError):
+            failed.result()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
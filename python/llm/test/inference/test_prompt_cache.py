@@ -0,0 +1,254 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import ctypes
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import deque
+import numpy as np
+import pytest
+
+from ipex_llm.ggml.model.logits_buffer import LogitsBuffer
+from ipex_llm.ggml.model.prompt_cache import PromptStateCache, TokenTrie
+
+
+class FakeState:
+    def __init__(self, eval_tokens, eval_logits, native_state, native_state_size):
+        self.eval_tokens = eval_tokens
+        self.eval_logits = eval_logits
+        self.native_state = native_state
+        self.native_state_size = native_state_size
+
+
+class FakeCache(PromptStateCache):
+    def _get_native_state(self, state):
+        return state.native_state, state.native_state_size
+
+    def _make_state(self, eval_tokens, eval_logits, native_state, native_state_size):
+        return FakeState(eval_tokens, eval_logits, native_state, native_state_size)
+
+
+def make_state(tokens, size=16, n_vocab=4):
+    native_state = (ctypes.c_uint8 * size)(*[(tokens[0] + i) % 256 for i in range(size)])
+    eval_logits = LogitsBuffer(maxlen=32)
+    eval_logits.extend(np.arange(len(tokens) * n_vocab, dtype=np.float32)
+                       .reshape(len(tokens), n_vocab))
+    return FakeState(deque(tokens, maxlen=32), eval_logits, native_state, size)
+
+
+class TestTokenTrie(unittest.TestCase):
+
+    def test_longest_prefix(self):
+        trie = TokenTrie()
+        trie.insert((1, 2, 3))
+        trie.insert((1, 2, 4, 5))
+        self.assertEqual(trie.longest_prefix([1, 2, 4, 5, 6]), ((1, 2, 4, 5), 4))
+        self.assertEqual(trie.longest_prefix([1, 2, 9])[1], 2)
+        self.assertEqual(trie.longest_prefix([7]), (None, 0))
+        trie.remove((1, 2, 4, 5))
+        self.assertEqual(trie.longest_prefix([1, 2, 4, 5]), ((1, 2, 3), 2))
+        trie.remove((1, 2, 3))
+        self.assertEqual(trie.longest_prefix([1, 2, 3]), (None, 0))
+
+
+class TestPromptStateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_lru_eviction(self):
+        cache = FakeCache(capacity_bytes=32)
+        cache[(1, 2)] = make_state([1, 2])
+        cache[(3, 4)] = make_state([3, 4])
+        self.assertIsNotNone(cache.get([1, 2, 5]))
+        cache[(5, 6)] = make_state([5, 6])
+        # (3, 4) is the least recently used
+        self.assertIsNone(cache.get([3, 4]))
+        self.assertIn([1, 2], cache)
+        self.assertEqual(cache.cache_size, 32)
+
+    def test_spill_and_reload(self):
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "a"})
+        state = make_state([1, 2, 3])
+        cache[(1, 2, 3)] = state
+        cache[(4, 5)] = make_state([4, 5])
+
+        # a new cache of the same model hits the spilled state
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "a"})
+        loaded = cache.get([1, 2, 3, 4])
+        self.assertIsNotNone(loaded)
+        self.assertEqual(list(loaded.eval_tokens), [1, 2, 3])
+        self.assertEqual(bytes(loaded.native_state), bytes(state.native_state))
+        np.testing.assert_array_equal(np.stack(list(loaded.eval_logits)),
+                                      np.stack(list(state.eval_logits)))
+
+    def _index(self, cache):
+        with open(os.path.join(cache._spill_folder, "index.json")) as f:
+            return json.load(f)
+
+    def test_spill_eval_tokens(self):
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "a"})
+        # the last sampled token of the key is not evaluated
+        cache[(1, 2, 3, 4)] = make_state([1, 2, 3])
+        cache[(5, 6)] = make_state([5, 6])
+        self.assertEqual([entry["key"] for entry in self._index(cache)], [[1, 2, 3, 4]])
+        self.assertNotIn("eval_tokens", self._index(cache)[0])
+        loaded = cache.get([1, 2, 3, 4])
+        self.assertEqual(list(loaded.eval_tokens), [1, 2, 3])
+        self.assertEqual(loaded.eval_tokens.maxlen, 32)
+
+        # eval tokens truncated to the context can't be restored
+        state = make_state([8, 9])
+        state.eval_tokens = deque([1, 2, 3, 4], maxlen=2)
+        cache[(1, 2, 3, 4, 7)] = state
+        cache[(10, 11)] = make_state([10, 11])
+        self.assertNotIn([1, 2, 3, 4, 7], [entry["key"] for entry in self._index(cache)])
+
+    def test_spill_lru_order(self):
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "a"})
+        for key in [(1, 2), (3, 4), (5, 6)]:
+            cache[key] = make_state(list(key))
+        index = self._index(cache)
+        self.assertEqual([entry["key"] for entry in index], [[1, 2], [3, 4]])
+        # hits don't rewrite the index
+        self.assertIsNotNone(cache.get([1, 2]))
+        self.assertEqual(self._index(cache), index)
+        cache.close()
+        self.assertEqual([entry["key"] for entry in self._index(cache)], [[3, 4], [1, 2]])
+
+        # a cache with room for one spilled state keeps the most recently hit one
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir,
+                          spill_capacity_bytes=16)
+        cache.set_namespace({"model_path": "a"})
+        self.assertIsNone(cache.get([3, 4]))
+        self.assertIsNotNone(cache.get([1, 2]))
+
+    def test_spill_namespace(self):
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "a"})
+        cache[(1, 2, 3)] = make_state([1, 2, 3])
+        cache[(4, 5)] = make_state([4, 5])
+
+        # states of another model are never returned
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache.set_namespace({"model_path": "b"})
+        self.assertIsNone(cache.get([1, 2, 3]))
+        cache.set_namespace({"model_path": "a"})
+        self.assertIsNotNone(cache.get([1, 2, 3]))
+
+        # neither are the states cached in memory before switching the model
+        cache.set_namespace({"model_path": "b"})
+        self.assertIsNone(cache.get([4, 5]))
+
+    def test_no_spill_without_namespace(self):
+        cache = FakeCache(capacity_bytes=16, spill_dir=self.spill_dir)
+        cache[(1, 2, 3)] = make_state([1, 2, 3])
+        cache[(4, 5)] = make_state([4, 5])
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+
+class TestLogitsBuffer(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        buffer = LogitsBuffer(maxlen=3)
+        expected = deque(maxlen=3)
+        for start in range(0, 20, 4):
+            logits = np.arange(start * 2, (start + 4) * 2, dtype=np.float32).reshape(4, 2)
+            buffer.extend(logits[:start % 5 + 1])
+            expected.extend(logits[:start % 5 + 1])
+            self.assertEqual(len(buffer), len(expected))
+            for row, expected_row in zip(buffer, expected):
+                np.testing.assert_array_equal(row, expected_row)
+        np.testing.assert_array_equal(buffer[-1], expected[-1])
+        np.testing.assert_array_equal(buffer.pop(), expected.pop())
+        self.assertEqual(len(buffer), len(expected))
+
+    def test_wraparound(self):
+        buffer = LogitsBuffer(maxlen=4)
+        buffer.extend(np.arange(6, dtype=np.float32).reshape(3, 2))
+        # the second row wraps around to the start of the matrix
+        buffer.extend(np.arange(6, 10, dtype=np.float32).reshape(2, 2))
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual([row.tolist() for row in buffer],
+                         [[2, 3], [4, 5], [6, 7], [8, 9]])
+        buffer.extend(np.arange(10, 16, dtype=np.float32).reshape(3, 2))
+        self.assertEqual([row.tolist() for row in buffer],
+                         [[8, 9], [10, 11], [12, 13], [14, 15]])
+
+    def test_indexing(self):
+        buffer = LogitsBuffer(maxlen=3)
+        buffer.extend(np.arange(10, dtype=np.float32).reshape(5, 2))
+        self.assertEqual(buffer[0].tolist(), [4, 5])
+        self.assertEqual(buffer[2].tolist(), [8, 9])
+        self.assertEqual(buffer[-1].tolist(), [8, 9])
+        self.assertEqual(buffer[-3].tolist(), [4, 5])
+        for index in [3, -4]:
+            with self.assertRaises(RuntimeError):
+                buffer[index]
+        # rows are views of the buffer
+        buffer[1][0] = -1
+        self.assertEqual(buffer[1].tolist(), [-1, 7])
+        with self.assertRaises(RuntimeError):
+            LogitsBuffer(maxlen=3)[0]
+
+    def test_extend_larger_than_maxlen(self):
+        buffer = LogitsBuffer(maxlen=3)
+        buffer.extend(np.zeros((1, 2), dtype=np.float32))
+        # only the last maxlen rows are kept
+        buffer.extend(np.arange(14, dtype=np.float32).reshape(7, 2))
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual([row.tolist() for row in buffer], [[8, 9], [10, 11], [12, 13]])
+        buffer.extend(np.arange(6, dtype=np.float32).reshape(3, 2))
+        self.assertEqual([row.tolist() for row in buffer], [[0, 1], [2, 3], [4, 5]])
+        with self.assertRaises(RuntimeError):
+            buffer.extend(np.zeros((1, 3), dtype=np.float32))
+
+    def test_maxlen(self):
+        buffer = LogitsBuffer(maxlen=2)
+        for i in range(5):
+            buffer.extend(np.full((1, 2), i, dtype=np.float32))
+            self.assertEqual(len(buffer), min(i + 1, 2))
+        self.assertEqual([row[0] for row in buffer], [3, 4])
+        self.assertEqual(buffer.pop().tolist(), [4, 4])
+        self.assertEqual(len(buffer), 1)
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(list(buffer), [])
+        buffer.extend(np.full((3, 2), 5, dtype=np.float32))
+        self.assertEqual(len(buffer), 2)
+
+    def test_copy(self):
+        buffer = LogitsBuffer(maxlen=4)
+        buffer.extend(np.ones((2, 3), dtype=np.float32))
+        copied = buffer.copy()
+        buffer.extend(np.zeros((3, 3), dtype=np.float32))
+        self.assertEqual(len(copied), 2)
+        np.testing.assert_array_equal(copied[0], np.ones(3, dtype=np.float32))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,103 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+import pytest
+
+from ipex_llm.transformers.models.rwkv5 import rwkv_linear_attention_chunk, \
+    rwkv_linear_attention_cpu, RWKV_PREFILL_CHUNK_SIZE
+
+
+def recurrence(receptance, key, value, log_decay, time_first, state):
+    # token by token: out_t = r_t @ (u * k_t^T v_t + state), state = k_t^T v_t + w * state
+    decay = torch.exp(log_decay)[:, :, None]
+    outs = []
+    for t in range(receptance.size(2)):
+        kv = key[:, :, t, :, None] @ value[:, :, t, None, :]
+        outs.append(receptance[:, :, t, None, :] @ (time_first[:, :, None] * kv + state))
+        state = kv + decay * state
+    return torch.cat(outs, dim=2), state
+
+
+class TestRWKV5Chunk(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.B, self.H, self.S = 2, 3, 8
+
+    def _inputs(self, T):
+        B, H, S = self.B, self.H, self.S
+        receptance, key, value = (torch.randn(B, H, T, S) for _ in range(3))
+        # per-channel decays spread over (0, 1)
+        time_decay = torch.randn(H, S)
+        time_first = torch.randn(H, S)
+        state = torch.randn(B, H, S, S)
+        return receptance, key, value, time_decay, time_first, state
+
+    def test_chunk(self):
+        for T in [1, 5, RWKV_PREFILL_CHUNK_SIZE]:
+            receptance, key, value, time_decay, time_first, state = self._inputs(T)
+            log_decay = -torch.exp(time_decay)
+            out, new_state = rwkv_linear_attention_chunk(receptance, key, value, log_decay,
+                                                         time_first, state)
+            expected_out, expected_state = recurrence(receptance, key, value, log_decay,
+                                                      time_first, state)
+            self.assertEqual(out.shape, (self.B, self.H, T, self.S))
+            self.assertTrue(torch.allclose(out, expected_out, atol=1e-4), T)
+            self.assertTrue(torch.allclose(new_state, expected_state, atol=1e-4), T)
+
+    def test_prefill(self):
+        # several chunks and a partial one, against the decoding path one token at a time
+        B, H, S = self.B, self.H, self.S
+        T = 2 * RWKV_PREFILL_CHUNK_SIZE + 7
+        receptance, key, value, time_decay, time_first, state = self._inputs(T)
+        # [B, T, H * S] as in the attention block
+        receptance, key, value = (x.transpose(1, 2).reshape(B, T, H * S)
+                                  for x in (receptance, key, value))
+        gate = torch.randn(B, T, H * S)
+        lxw, lxb = torch.randn(H * S), torch.randn(H * S)
+        ow = torch.nn.Linear(H * S, H * S, bias=False)
+
+        def attention(start, end, state):
+            return rwkv_linear_attention_cpu(B, H, S, end - start, H, receptance,
+                                             time_decay, time_first,
+                                             receptance[:, start:end], key[:, start:end],
+                                             value[:, start:end], gate[:, start:end],
+                                             lxw, lxb, ow, state)
+
+        with torch.inference_mode():
+            out, new_state = attention(0, T, state.clone())
+            expected_outs = []
+            expected_state = state.clone()
+            for t in range(T):
+                expected_out, expected_state = attention(t, t + 1, expected_state)
+                expected_outs.append(expected_out)
+        expected_out = torch.cat(expected_outs, dim=1)
+        self.assertEqual(out.shape, (B, T, H * S))
+        self.assertTrue(torch.allclose(out, expected_out, atol=1e-3))
+        self.assertTrue(torch.allclose(new_state, expected_state, atol=1e-3))
+
+        # without an initial state
+        with torch.inference_mode():
+            out, _ = attention(0, T, None)
+            expected_out, _ = attention(0, 1, torch.zeros(B, H, S, S))
+        self.assertTrue(torch.allclose(out[:, :1], expected_out, atol=1e-4))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,240 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import shutil
+import tempfile
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.generation.streamers import BaseStreamer
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers.speculative import deepmind_sample, original_generate, \
+    prompt_lookup_draft, _tree_ancestors, _tree_attention_mask
+
+
+def save_tiny_llama(path):
+    config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4,
+                         max_position_embeddings=256,
+                         pad_token_id=0, bos_token_id=1, eos_token_id=2)
+    torch.manual_seed(0)
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+class TokenCollector(BaseStreamer):
+    """Collects the streamed tokens, like TextIteratorStreamer without the decoding."""
+
+    def __init__(self):
+        self.chunks = []
+        self.ended = False
+        self.put_after_end = False
+
+    def put(self, value):
+        self.put_after_end |= self.ended
+        self.chunks.append(value.reshape(-1).tolist())
+
+    def end(self):
+        self.put_after_end |= self.ended
+        self.ended = True
+
+
+class TestSpeculative(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_path = tempfile.mkdtemp()
+        save_tiny_llama(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_path)
+
+    def test_deepmind_sample_batch(self):
+        bsz, vocab_size = 3, 256
+        logits = torch.randn(bsz, 1, vocab_size)
+        output_ids, prob_list, probs = deepmind_sample(logits, return_probs=True)
+        self.assertEqual(output_ids.squeeze(-1).shape, (bsz,))
+        self.assertEqual(prob_list.shape, (bsz, vocab_size))
+        expected = logits.softmax(-1)[torch.arange(bsz), 0, output_ids.squeeze(-1)]
+        self.assertTrue(torch.allclose(probs.squeeze(-1), expected))
+
+    def _generate_batch(self, model, do_sample):
+        # the first row is left padded
+        input_ids = torch.tensor([[0, 0, 5, 6, 7, 8],
+                                  [9, 10, 11, 12, 13, 14]])
+        attention_mask = (input_ids != 0).long()
+        max_new_tokens = 8
+        with torch.inference_mode():
+            output = model.generate(input_ids, attention_mask=attention_mask,
+                                    max_new_tokens=max_new_tokens, do_sample=do_sample,
+                                    th_stop_draft=0.6, min_step_draft=1)
+            self.assertEqual(output.size(0), 2)
+            self.assertLessEqual(output.size(1), input_ids.size(1) + max_new_tokens)
+            self.assertTrue(torch.equal(output[:, :input_ids.size(1)], input_ids))
+            if do_sample:
+                return
+            # every row follows the greedy outputs of the target model for that row alone
+            for row_ids, row_mask, row_output in zip(input_ids, attention_mask, output):
+                row_ids = row_ids[row_mask.bool()].unsqueeze(0)
+                expected = original_generate(model, row_ids, max_new_tokens=max_new_tokens,
+                                             do_sample=False)
+                new_tokens = row_output[input_ids.size(1):]
+                expected_new_tokens = expected[0, row_ids.size(1):]
+                self.assertTrue(torch.equal(new_tokens[:expected_new_tokens.size(0)],
+                                            expected_new_tokens))
+
+    def test_speculative_batch_draft_model_sample(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     speculative=True)
+        self._generate_batch(model, do_sample=True)
+
+    def test_speculative_batch_draft_model_greedy(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     speculative=True)
+        self._generate_batch(model, do_sample=False)
+
+    def test_prompt_lookup_draft(self):
+        input_ids = torch.tensor([5, 6, 7, 8, 9, 6, 7, 10, 11, 6, 7])
+        # the latest earlier occurrence of the longest n-gram "6 7" is followed by "10 11"
+        self.assertEqual(prompt_lookup_draft(input_ids, 2, 3).tolist(), [10, 11, 6])
+        self.assertEqual(prompt_lookup_draft(input_ids, 2, 1).tolist(), [10])
+        # "8 7" never occurred before, the unigram "7" did
+        input_ids = torch.tensor([5, 6, 7, 9, 8, 7])
+        self.assertEqual(prompt_lookup_draft(input_ids, 2, 2).tolist(), [9, 8])
+        # the draft is cut at the end of the context
+        input_ids = torch.tensor([5, 6, 7, 5, 6])
+        self.assertEqual(prompt_lookup_draft(input_ids, 3, 4).tolist(), [7, 5, 6])
+        # nothing matches
+        self.assertEqual(prompt_lookup_draft(torch.tensor([5, 6, 7]), 2, 4).numel(), 0)
+        self.assertEqual(prompt_lookup_draft(torch.tensor([5, 6, 5]), 2, 0).numel(), 0)
+
+    def test_prompt_lookup_greedy(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     prompt_lookup=True)
+        self.assertFalse(hasattr(model, "draft_model"))
+        # a repetitive prompt, so that drafts are found in it
+        input_ids = torch.tensor([[1] + [5, 6, 7, 8, 9] * 4])
+        max_new_tokens = 16
+        with torch.inference_mode():
+            output = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                    th_stop_draft=0.6, max_step_draft=4)
+            expected = original_generate(model, input_ids, max_new_tokens=max_new_tokens,
+                                         do_sample=False)
+        self.assertTrue(torch.equal(output, expected))
+        self.assertGreater(model.n_drafted, 0)
+
+    def _check_streamer(self, model, **kwargs):
+        input_ids = torch.tensor([[1] + [5, 6, 7, 8, 9] * 4])
+        streamer = TokenCollector()
+        with torch.inference_mode():
+            output = model.generate(input_ids, max_new_tokens=16, do_sample=False,
+                                    streamer=streamer, **kwargs)
+        self.assertTrue(streamer.ended)
+        self.assertFalse(streamer.put_after_end)
+        # the prompt comes first and once, then every generated token once
+        self.assertEqual(streamer.chunks[0], input_ids[0].tolist())
+        self.assertTrue(all(len(chunk) > 0 for chunk in streamer.chunks))
+        self.assertEqual(sum(streamer.chunks, []), output[0].tolist())
+
+    def test_streamer(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     speculative=True)
+        self._check_streamer(model, th_stop_draft=0.6)
+        self._check_streamer(model, th_stop_draft=0.9, tree_top_k=2, max_tree_nodes=8)
+
+    def test_streamer_prompt_lookup(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     prompt_lookup=True)
+        self._check_streamer(model, max_step_draft=4)
+
+    def test_tree_ancestors(self):
+        # 0 -> 1 -> 3, 0 -> 2 -> 4
+        ancestors = _tree_ancestors([-1, 0, 0, 1, 2])
+        expected = torch.tensor([[1, 0, 0, 0, 0],
+                                 [1, 1, 0, 0, 0],
+                                 [1, 0, 1, 0, 0],
+                                 [1, 1, 0, 1, 0],
+                                 [1, 0, 1, 0, 1]], dtype=torch.bool)
+        self.assertTrue(torch.equal(ancestors, expected))
+
+    def test_tree_attention_mask(self):
+        model = LlamaForCausalLM.from_pretrained(self.model_path).eval()
+        prompt = [1, 5, 6, 7]
+        tokens, parents, depths = [8, 9, 10, 11, 12], [-1, 0, 0, 1, 2], [0, 1, 1, 2, 2]
+        ancestors = _tree_ancestors(parents)
+        with torch.inference_mode():
+            causal_logits = model(torch.tensor([prompt + tokens])).logits
+            output = model(torch.tensor([prompt]), use_cache=True)
+            with _tree_attention_mask(model, ancestors):
+                tree_logits = model(torch.tensor([tokens]),
+                                    past_key_values=output.past_key_values,
+                                    attention_mask=torch.ones(1, len(prompt) + len(tokens),
+                                                              dtype=torch.long),
+                                    position_ids=torch.tensor([depths]) + len(prompt)).logits
+            # every node sees the same as the end of its path alone
+            for n in range(len(tokens)):
+                path = [tokens[m] for m in ancestors[n].nonzero().flatten().tolist()]
+                logits = model(torch.tensor([prompt + path])).logits
+                self.assertTrue(torch.allclose(tree_logits[0, n], logits[0, -1], atol=1e-4))
+            # the causal mask is restored
+            logits = model(torch.tensor([prompt + tokens])).logits
+        self.assertTrue(torch.equal(logits, causal_logits))
+
+    def test_speculative_tree_greedy(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                     optimize_model=True,
+                                                     torch_dtype=torch.bfloat16,
+                                                     load_in_low_bit="bf16",
+                                                     speculative=True)
+        input_ids = torch.tensor([[1, 5, 6, 7, 8]])
+        max_new_tokens = 12
+        with torch.inference_mode():
+            output = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                    th_stop_draft=0.9, tree_top_k=2, max_tree_nodes=8)
+            expected = original_generate(model, input_ids, max_new_tokens=max_new_tokens,
+                                         do_sample=False)
+            # the accepted paths follow the greedy outputs of the target model
+            self.assertTrue(torch.equal(output, expected))
+            self.assertGreater(model.n_matched, 0)
+            # only greedy search of a single sequence is supported
+            with pytest.raises(RuntimeError):
+                model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=True,
+                               tree_top_k=2)
+            with pytest.raises(RuntimeError):
+                model.generate(input_ids.repeat(2, 1), max_new_tokens=max_new_tokens,
+                               do_sample=False, tree_top_k=2)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
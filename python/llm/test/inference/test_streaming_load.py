@@ -0,0 +1,85 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import shutil
+import tempfile
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from ipex_llm.transformers import AutoModelForCausalLM
+
+
+class TestStreamingLoad(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_path = tempfile.mkdtemp()
+        config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4,
+                             max_position_embeddings=256)
+        torch.manual_seed(0)
+        # config.torch_dtype is float16
+        LlamaForCausalLM(config).half().save_pretrained(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_path)
+
+    def _compare(self, **kwargs):
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, load_in_4bit=True,
+                                                     **kwargs)
+        streaming_model = AutoModelForCausalLM.from_pretrained(self.model_path,
+                                                               load_in_4bit=True,
+                                                               streaming_load=True,
+                                                               **kwargs)
+        params = dict(model.named_parameters())
+        streaming_params = dict(streaming_model.named_parameters())
+        self.assertEqual(params.keys(), streaming_params.keys())
+        for name, param in params.items():
+            self.assertEqual(streaming_params[name].dtype, param.dtype, name)
+
+        input_ids = torch.tensor([[1, 5, 6, 7, 8]])
+        with torch.inference_mode():
+            logits = model(input_ids).logits
+            streaming_logits = streaming_model(input_ids).logits
+        self.assertTrue(torch.allclose(logits, streaming_logits, atol=1e-3))
+        return streaming_model
+
+    def test_streaming_load_auto_dtype(self):
+        model = self._compare()
+        # the modules which are not quantized are kept in float32 on cpu
+        self.assertEqual(model.model.norm.weight.dtype, torch.float32)
+        self.assertEqual(model.model.embed_tokens.weight.dtype, torch.float32)
+
+    def test_streaming_load_torch_dtype(self):
+        model = self._compare(torch_dtype=torch.bfloat16)
+        self.assertEqual(model.model.norm.weight.dtype, torch.bfloat16)
+
+    def test_streaming_load_config_kwargs(self):
+        model = self._compare(use_cache=False)
+        self.assertFalse(model.config.use_cache)
+
+    def test_streaming_load_reject_model_args(self):
+        with pytest.raises(RuntimeError):
+            AutoModelForCausalLM.from_pretrained(self.model_path, None, load_in_4bit=True,
+                                                 streaming_load=True)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,152 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import time
+import unittest
+import pytest
+
+from ipex_llm.vllm.core.block_manager import BlockSpaceManager
+from ipex_llm.vllm.sampling_params import SamplingParams
+from ipex_llm.vllm.sequence import Sequence, SequenceGroup
+
+
+BLOCK_SIZE = 4
+
+
+def make_seq_group(seq_id, token_ids):
+    seq = Sequence(seq_id, "prompt", list(token_ids))
+    return SequenceGroup(str(seq_id), [seq], SamplingParams(), time.monotonic())
+
+
+def compute(block_manager, seq_group):
+    # the model computes the whole prompt in a step
+    seq = seq_group.get_seqs()[0]
+    seq.data.update_num_computed_tokens(seq.data.get_num_uncomputed_tokens())
+    block_manager.mark_blocks_as_computed(seq)
+
+
+class TestBlockSpaceManager(unittest.TestCase):
+
+    def test_allocate_and_free(self):
+        block_manager = BlockSpaceManager(BLOCK_SIZE, num_cpu_blocks=8, watermark=0)
+        seq_group = make_seq_group(0, range(10))
+        seq = seq_group.get_seqs()[0]
+        self.assertTrue(block_manager.can_allocate(seq_group))
+        block_manager.allocate(seq_group)
+        self.assertEqual(len(block_manager.get_block_table(seq)), 3)
+        self.assertEqual(block_manager.get_num_free_cpu_blocks(), 5)
+
+        # slots of the last block are used before allocating a new one
+        for token_id in range(2):
+            seq.append_token_id(token_id, {token_id: 0.0})
+            block_manager.append_slot(seq)
+        self.assertEqual(len(block_manager.get_block_table(seq)), 3)
+        seq.append_token_id(0, {0: 0.0})
+        block_manager.append_slot(seq)
+        self.assertEqual(len(block_manager.get_block_table(seq)), 4)
+
+        block_manager.free(seq)
+        self.assertEqual(block_manager.get_num_free_cpu_blocks(), 8)
+        # freeing again is a no-op
+        block_manager.free(seq)
+        self.assertEqual(block_manager.get_num_free_cpu_blocks(), 8)
+
+    def test_can_ever_allocate(self):
+        block_manager = BlockSpaceManager(BLOCK_SIZE, num_cpu_blocks=4, watermark=0)
+        self.assertTrue(block_manager.can_ever_allocate(make_seq_group(0, range(16))))
+        self.assertFalse(block_manager.can_ever_allocate(make_seq_group(1, range(17))))
+
+    def test_double_free(self):
+        block_manager = BlockSpaceManager(BLOCK_SIZE, num_cpu_blocks=4, watermark=0)
+        block = block_manager.cpu_allocator.allocate()
+        block_manager.cpu_allocator.free(block)
+        with pytest.raises(RuntimeError):
+            block_manager.cpu_allocator.free(block)
+
+
+class TestPrefixCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.block_manager = BlockSpaceManager(BLOCK_SIZE, num_cpu_blocks=8, watermark=0,
+                                               enable_caching=True)
+
+    def test_share_prefix_blocks(self):
+        first = make_seq_group(0, range(10))
+        self.block_manager.allocate(first)
+        compute(self.block_manager, first)
+
+        # the first 2 full blocks are shared
+        second = make_seq_group(1, list(range(8)) + [100, 101, 102])
+        seq = second.get_seqs()[0]
+        self.assertEqual(self.block_manager.get_num_cached_tokens(seq), 8)
+        self.block_manager.allocate(second)
+        first_table = self.block_manager.get_block_table(first.get_seqs()[0])
+        second_table = self.block_manager.get_block_table(seq)
+        self.assertEqual(first_table[:2], second_table[:2])
+        self.assertNotEqual(first_table[2], second_table[2])
+        self.assertEqual(seq.data.get_num_computed_tokens(), 8)
+        self.assertEqual(self.block_manager.get_prefix_cache_hit_rate(), 0.5)
+
+    def test_uncomputed_blocks_not_shared(self):
+        first = make_seq_group(0, range(10))
+        self.block_manager.allocate(first)
+        second = make_seq_group(1, range(10))
+        self.assertEqual(self.block_manager.get_num_cached_tokens(second.get_seqs()[0]), 0)
+
+    def test_reuse_freed_blocks(self):
+        first = make_seq_group(0, range(8))
+        self.block_manager.allocate(first)
+        compute(self.block_manager, first)
+        self.block_manager.free(first.get_seqs()[0])
+        # cached blocks are kept, but count as free
+        self.assertEqual(self.block_manager.get_num_free_cpu_blocks(), 8)
+
+        second = make_seq_group(1, range(12))
+        seq = second.get_seqs()[0]
+        self.assertEqual(self.block_manager.get_num_cached_tokens(seq), 8)
+
+        # the cached blocks are recycled, least recently used first, once the
+        # free blocks run out
+        third = make_seq_group(2, range(200, 228))
+        self.block_manager.allocate(third)
+        self.assertEqual(self.block_manager.get_num_cached_tokens(seq), 4)
+        self.block_manager.free(third.get_seqs()[0])
+        fourth = make_seq_group(3, range(300, 332))
+        self.block_manager.allocate(fourth)
+        self.assertEqual(self.block_manager.get_num_cached_tokens(seq), 0)
+
+    def test_copy_on_write_cached_prompt(self):
+        first = make_seq_group(0, range(8))
+        self.block_manager.allocate(first)
+        compute(self.block_manager, first)
+
+        # the last token of a fully cached prompt is computed again, into a private
+        # copy of the last block
+        second = make_seq_group(1, range(8))
+        seq = second.get_seqs()[0]
+        self.assertEqual(self.block_manager.get_num_cached_tokens(seq), 7)
+        blocks_to_copy = {}
+        self.block_manager.allocate(second, blocks_to_copy)
+        first_table = self.block_manager.get_block_table(first.get_seqs()[0])
+        second_table = self.block_manager.get_block_table(seq)
+        self.assertEqual(first_table[0], second_table[0])
+        self.assertEqual(blocks_to_copy, {first_table[1]: [second_table[1]]})
+        self.assertEqual(seq.data.get_num_uncomputed_tokens(), 1)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,104 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import math
+import unittest
+import torch
+import pytest
+
+from ipex_llm.vllm.model_executor.layers.paged_attention import paged_attention, \
+    write_to_paged_cache, pad_block_tables
+
+
+NUM_HEADS = 8
+NUM_KV_HEADS = 2
+HEAD_SIZE = 16
+BLOCK_SIZE = 16
+
+
+def dense_attention(query, key, value, positions, scale):
+    # query: [num_heads, q_len, head_size], key/value: [num_kv_heads, kv_len, head_size]
+    n_rep = query.size(0) // key.size(0)
+    key = key.repeat_interleave(n_rep, dim=0)
+    value = value.repeat_interleave(n_rep, dim=0)
+    scores = query @ key.transpose(-1, -2) * scale
+    mask = torch.arange(key.size(1))[None, :] > positions[:, None]
+    scores.masked_fill_(mask, float("-inf"))
+    return torch.softmax(scores, dim=-1) @ value
+
+
+class TestPagedAttention(unittest.TestCase):
+
+    def _compare(self, context_lens, query_lens, dtype=torch.float32, atol=1e-4):
+        torch.manual_seed(0)
+        num_blocks = sum(math.ceil(n / BLOCK_SIZE) for n in context_lens) + 4
+        key_cache = torch.zeros(num_blocks, NUM_KV_HEADS, BLOCK_SIZE, HEAD_SIZE, dtype=dtype)
+        value_cache = torch.zeros_like(key_cache)
+        # the blocks of the sequences are scattered over the cache
+        free_blocks = torch.randperm(num_blocks).tolist()
+
+        max_query_len = max(query_lens)
+        bsz = len(context_lens)
+        query = torch.randn(bsz, NUM_HEADS, max_query_len, HEAD_SIZE, dtype=dtype)
+        positions = torch.full((bsz, max_query_len), -1, dtype=torch.long)
+        block_tables, keys, values = [], [], []
+        for i, (context_len, query_len) in enumerate(zip(context_lens, query_lens)):
+            num_seq_blocks = math.ceil(context_len / BLOCK_SIZE)
+            block_table = [free_blocks.pop() for _ in range(num_seq_blocks)]
+            block_tables.append(block_table)
+            key = torch.randn(1, NUM_KV_HEADS, context_len, HEAD_SIZE, dtype=dtype)
+            value = torch.randn(1, NUM_KV_HEADS, context_len, HEAD_SIZE, dtype=dtype)
+            slot_mapping = torch.tensor([block_table[j // BLOCK_SIZE] * BLOCK_SIZE +
+                                         j % BLOCK_SIZE for j in range(context_len)])
+            write_to_paged_cache(key, value, key_cache, value_cache, slot_mapping)
+            keys.append(key[0])
+            values.append(value[0])
+            # the queries are the last tokens of the sequence, right padded
+            positions[i, :query_len] = torch.arange(context_len - query_len, context_len)
+
+        scale = 1 / math.sqrt(HEAD_SIZE)
+        output = paged_attention(query, key_cache, value_cache,
+                                 torch.tensor(pad_block_tables(block_tables)),
+                                 torch.tensor(context_lens), positions, scale)
+        self.assertEqual(output.shape, query.shape)
+        self.assertEqual(output.dtype, dtype)
+        for i, query_len in enumerate(query_lens):
+            expected = dense_attention(query[i, :, :query_len].float(), keys[i].float(),
+                                       values[i].float(), positions[i, :query_len], scale)
+            self.assertTrue(torch.allclose(output[i, :, :query_len].float(), expected,
+                                           atol=atol))
+            # padding queries produce zeros
+            self.assertTrue(torch.all(output[i, :, query_len:] == 0))
+
+    def test_decode(self):
+        self._compare(context_lens=[5, 33, 16], query_lens=[1, 1, 1])
+
+    def test_prefill(self):
+        # a whole prompt, a chunk after a cached prefix and a single token
+        self._compare(context_lens=[20, 40, 7], query_lens=[20, 9, 1])
+
+    def test_multiple_partitions(self):
+        # longer than a partition of 512 tokens, not ending on a block boundary
+        self._compare(context_lens=[1100, 300], query_lens=[3, 1])
+
+    def test_bfloat16(self):
+        self._compare(context_lens=[600, 10], query_lens=[4, 2], dtype=torch.bfloat16,
+                      atol=2e-2)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
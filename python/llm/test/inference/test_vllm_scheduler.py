@@ -0,0 +1,129 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import time
+import unittest
+import pytest
+
+from ipex_llm.vllm.config import CacheConfig, SchedulerConfig
+from ipex_llm.vllm.core.scheduler import FixedWindowScheduler
+from ipex_llm.vllm.sampling_params import SamplingParams
+from ipex_llm.vllm.sequence import Sequence, SequenceGroup, SequenceStatus
+
+
+def make_scheduler(max_num_batched_tokens, prefill_chunk_size=None, max_model_len=256,
+                   enable_prefix_caching=False, num_cpu_blocks=256):
+    scheduler_config = SchedulerConfig(max_num_batched_tokens, max_num_seqs=8,
+                                       max_model_len=max_model_len, enable_mixed_batching=True,
+                                       prefill_chunk_size=prefill_chunk_size)
+    cache_config = CacheConfig(block_size=4, kv_cache_space=1, enable_paged_kv_cache=True,
+                               enable_prefix_caching=enable_prefix_caching)
+    cache_config.num_cpu_blocks = num_cpu_blocks
+    return FixedWindowScheduler(scheduler_config, [[{}, {}]], cache_config)
+
+
+def add_request(scheduler, request_id, prompt_len):
+    seq = Sequence(request_id, "prompt", list(range(prompt_len)))
+    scheduler.add_seq_group(SequenceGroup(str(request_id), [seq], SamplingParams(max_tokens=8),
+                                          time.monotonic()))
+
+
+def finish_step(scheduler, outputs):
+    """Emulate the engine running a step and sampling a token."""
+    scheduler.update_num_computed_tokens(outputs)
+    for seq_group in outputs.scheduled_seq_groups:
+        for seq in seq_group.get_seqs(status=SequenceStatus.RUNNING):
+            seq.append_token_id(1, {1: 0.0})
+
+
+def step(scheduler):
+    metadata_list, outputs = scheduler.schedule()
+    finish_step(scheduler, outputs)
+    return {metadata.request_id: (metadata.is_prompt, metadata.token_chunk_size,
+                                  metadata.do_sample)
+            for metadata in metadata_list}, outputs
+
+
+class TestMixedBatching(unittest.TestCase):
+
+    def test_token_budget(self):
+        # a prompt waits until it fits into the token budget left by the decodes
+        scheduler = make_scheduler(32, max_model_len=32)
+        add_request(scheduler, 0, 20)
+        add_request(scheduler, 1, 20)
+        scheduled, _ = step(scheduler)
+        self.assertEqual(scheduled, {"0": (True, 20, True)})
+        scheduled, _ = step(scheduler)
+        self.assertEqual(scheduled, {"0": (False, 1, True), "1": (True, 20, True)})
+
+
+class TestChunkedPrefill(unittest.TestCase):
+
+    def test_chunked_prefill(self):
+        scheduler = make_scheduler(32, prefill_chunk_size=16)
+        add_request(scheduler, 0, 5)
+        add_request(scheduler, 1, 70)
+        add_request(scheduler, 2, 8)
+
+        steps = [step(scheduler) for _ in range(6)]
+        for _, outputs in steps:
+            self.assertLessEqual(outputs.num_batched_tokens, 32)
+
+        # the long prompt doesn't hold back the short ones
+        scheduled, _ = steps[0]
+        self.assertEqual(scheduled, {"0": (True, 5, True), "1": (True, 16, False),
+                                     "2": (True, 8, True)})
+        # its chunks are interleaved with the decodes, only the last one is sampled from
+        prompt_chunks = []
+        for scheduled, _ in steps[1:5]:
+            self.assertEqual(scheduled["0"], (False, 1, True))
+            self.assertEqual(scheduled["2"], (False, 1, True))
+            prompt_chunks.append(scheduled["1"])
+        self.assertEqual(prompt_chunks, [(True, 16, False)] * 3 + [(True, 6, True)])
+        scheduled, _ = steps[5]
+        self.assertEqual(scheduled["1"], (False, 1, True))
+
+    def test_chunked_prefill_cached_prefix(self):
+        scheduler = make_scheduler(32, prefill_chunk_size=16, enable_prefix_caching=True)
+        add_request(scheduler, 0, 40)
+        for _ in range(3):
+            step(scheduler)
+        # the cached prefix of 40 tokens is not prefilled again
+        add_request(scheduler, 1, 44)
+        scheduled, _ = step(scheduler)
+        self.assertEqual(scheduled["1"], (True, 4, True))
+
+    def test_preempt_by_recompute(self):
+        scheduler = make_scheduler(64, prefill_chunk_size=16, num_cpu_blocks=6)
+        add_request(scheduler, 0, 8)
+        add_request(scheduler, 1, 8)
+        for _ in range(8):
+            metadata_list, outputs = scheduler.schedule()
+            for metadata in metadata_list:
+                for seq_id, block_table in metadata.block_tables.items():
+                    # every token fed to the model has a slot
+                    self.assertGreaterEqual(len(block_table) * 4,
+                                            metadata.seq_data[seq_id].get_len())
+            finish_step(scheduler, outputs)
+        # the preempted request is put back to wait and computed from scratch
+        self.assertEqual(len(scheduler.waiting), 1)
+        seq = scheduler.waiting[0].get_seqs()[0]
+        self.assertEqual(seq.data.get_num_computed_tokens(), 0)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,160 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+import pytest
+
+from ipex_llm.langchain.embeddings import TransformersEmbeddings
+from ipex_llm.langchain.embeddings.cache import EmbeddingCache
+
+
+class FakeEmbedder:
+    """Embeds a text into its length and first character, counting the embedded texts."""
+
+    def __init__(self, offset=0.0):
+        self.offset = offset
+        self.embedded = []
+
+    def __call__(self, texts):
+        self.embedded += texts
+        return [[len(text) + self.offset, ord(text[0]), 0.5] for text in texts]
+
+
+def expected_embedding(text, offset=0.0):
+    return np.float16([len(text) + offset, ord(text[0]), 0.5]).astype(np.float32).tolist()
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_hit_and_miss(self):
+        cache = EmbeddingCache(self.cache_folder, {"model_id": "a"})
+        embed_fn = FakeEmbedder()
+        texts = ["apple", "banana", "apple", "cherry"]
+        self.assertEqual(cache.embed_documents(texts, embed_fn),
+                         [expected_embedding(text) for text in texts])
+        # duplicated texts are embedded once
+        self.assertEqual(embed_fn.embedded, ["apple", "banana", "cherry"])
+
+        texts = ["cherry", "date", "banana"]
+        self.assertEqual(cache.embed_documents(texts, embed_fn),
+                         [expected_embedding(text) for text in texts])
+        self.assertEqual(embed_fn.embedded[3:], ["date"])
+        self.assertEqual(cache.get(["date", "elderberry"])[1], None)
+
+        # the cache persists across instances, e.g. in another process
+        cache = EmbeddingCache(self.cache_folder, {"model_id": "a"})
+        embed_fn = FakeEmbedder()
+        texts = ["apple", "banana", "cherry", "date"]
+        self.assertEqual(cache.embed_documents(texts, embed_fn),
+                         [expected_embedding(text) for text in texts])
+        self.assertEqual(embed_fn.embedded, [])
+
+    def test_namespace(self):
+        cache_a = EmbeddingCache(self.cache_folder, {"model_id": "a", "pooling": "mean"})
+        cache_b = EmbeddingCache(self.cache_folder, {"pooling": "mean", "model_id": "b"})
+        self.assertNotEqual(cache_a.folder, cache_b.folder)
+        cache_a.embed_documents(["apple"], FakeEmbedder())
+        embed_fn = FakeEmbedder(offset=1.0)
+        self.assertEqual(cache_b.embed_documents(["apple"], embed_fn),
+                         [expected_embedding("apple", offset=1.0)])
+        self.assertEqual(embed_fn.embedded, ["apple"])
+        # the order of the keys doesn't matter
+        cache = EmbeddingCache(self.cache_folder, {"pooling": "mean", "model_id": "a"})
+        self.assertEqual(cache.folder, cache_a.folder)
+        self.assertEqual(cache.get(["apple"])[0].tolist(), expected_embedding("apple"))
+
+    def test_transformers_namespace(self):
+        model_path = os.path.join(self.cache_folder, "model")
+        os.makedirs(model_path)
+        with open(os.path.join(model_path, "model.safetensors"), "wb") as f:
+            f.write(b"0" * 16)
+        embeddings = TransformersEmbeddings(model=None, tokenizer=None, model_id=model_path)
+        namespace = embeddings.get_embedding_cache_namespace()
+        self.assertEqual(namespace["model_path"], os.path.abspath(model_path))
+        self.assertEqual(namespace["pooling"], "mean")
+        # the checkpoint is replaced in place
+        with open(os.path.join(model_path, "model.safetensors"), "wb") as f:
+            f.write(b"1" * 32)
+        self.assertNotEqual(embeddings.get_embedding_cache_namespace(), namespace)
+        # another process, from another working directory
+        cwd = os.getcwd()
+        os.chdir(self.cache_folder)
+        try:
+            relative_embeddings = TransformersEmbeddings(model=None, tokenizer=None,
+                                                         model_id="model")
+            self.assertEqual(relative_embeddings.get_embedding_cache_namespace(),
+                             embeddings.get_embedding_cache_namespace())
+        finally:
+            os.chdir(cwd)
+
+    def _touch(self, cache, texts):
+        # entries used at the same time may be evicted in any order
+        time.sleep(0.01)
+        return cache.get(texts)
+
+    def test_eviction(self):
+        cache = EmbeddingCache(self.cache_folder, {"model_id": "a"}, max_entries=3)
+        embed_fn = FakeEmbedder()
+        for text in ["apple", "banana", "cherry"]:
+            self._touch(cache, [])
+            cache.embed_documents([text], embed_fn)
+        self._touch(cache, ["apple"])
+        self._touch(cache, [])
+        cache.embed_documents(["date"], embed_fn)
+        # banana is the least recently used
+        self.assertEqual([e is None for e in cache.get(["apple", "banana", "cherry", "date"])],
+                         [False, True, False, False])
+        # at most max_entries of the texts added at once are kept
+        cache.put(["e1", "e2", "e3", "e4"], np.ones((4, 3)))
+        cached = [e is not None for e in cache.get(["e1", "e2", "e3", "e4", "apple"])]
+        self.assertEqual(cached, [False, True, True, True, False])
+
+    def test_row_reuse(self):
+        cache = EmbeddingCache(self.cache_folder, {"model_id": "a"}, max_entries=2)
+        embed_fn = FakeEmbedder()
+        for text in ["apple", "banana", "cherry"]:
+            self._touch(cache, [])
+            cache.embed_documents([text], embed_fn)
+        # the rows evicted by a writer are only reused by the next ones, so the matrix
+        # holds one more row than max_entries when texts are added one by one
+        self.assertEqual(cache._get_meta("num_rows"), "3")
+        matrix_size = os.path.getsize(cache.matrix_path)
+        for text in ["date", "elderberry", "fig"]:
+            self._touch(cache, [])
+            self.assertEqual(cache.embed_documents([text], embed_fn),
+                             [expected_embedding(text)])
+        self.assertEqual(cache._get_meta("num_rows"), "3")
+        self.assertEqual(os.path.getsize(cache.matrix_path), matrix_size)
+        embed_fn = FakeEmbedder()
+        self.assertEqual(cache.embed_documents(["elderberry", "fig"], embed_fn),
+                         [expected_embedding("elderberry"), expected_embedding("fig")])
+        self.assertEqual(embed_fn.embedded, [])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,113 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+import pytest
+
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from ipex_llm.langchain.embeddings import TransformersEmbeddings
+from ipex_llm.langchain.embeddings.transformersembeddings import TransformersBgeEmbeddings
+
+
+def save_tiny_model(path):
+    vocab = {"<pad>": 0, "<unk>": 1, **{f"w{i}": i + 2 for i in range(254)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>",
+                            unk_token="<unk>").save_pretrained(path)
+    config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4,
+                         max_position_embeddings=256, pad_token_id=0)
+    torch.manual_seed(0)
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+def random_texts(num_texts, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(f"w{rng.randrange(254)}" for _ in range(rng.randint(1, 40)))
+            for _ in range(num_texts)]
+
+
+class TestTransformersEmbeddings(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_path = tempfile.mkdtemp()
+        save_tiny_model(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_path)
+
+    def _embed_one_by_one(self, embeddings, texts, pooling):
+        # the path before texts were batched: one forward for every text
+        results = []
+        for text in texts:
+            input_ids = embeddings.tokenizer.encode(text, return_tensors="pt")
+            with torch.inference_mode():
+                hidden_states = embeddings.model(input_ids, return_dict=False)[0]
+            if pooling == "mean":
+                results.append(hidden_states[0].mean(dim=0).numpy())
+            else:
+                results.append(torch.nn.functional.normalize(hidden_states[:, 0], p=2,
+                                                             dim=1)[0].numpy())
+        return np.stack(results)
+
+    def _check_embed_documents(self, cls, pooling, **kwargs):
+        embeddings = cls.from_model_id(self.model_path, **kwargs)
+        # two sort windows, so that texts are reordered within and across batches
+        texts = random_texts(2 * embeddings.batch_size * 16 - 3)
+        expected = self._embed_one_by_one(embeddings, texts, pooling)
+        results = np.array(embeddings.embed_documents(texts))
+        self.assertEqual(results.shape, expected.shape)
+        # in the same order: int4 linears of batched inputs round a bit differently,
+        # far less than the embeddings of different texts differ
+        np.testing.assert_allclose(results, expected, atol=1e-2)
+        np.testing.assert_allclose(embeddings.embed_query(texts[5]), expected[5], atol=1e-2)
+
+    def test_embed_documents(self):
+        self._check_embed_documents(TransformersEmbeddings, "mean", batch_size=4)
+
+    def test_embed_documents_bge(self):
+        self._check_embed_documents(TransformersBgeEmbeddings, "cls", batch_size=4)
+
+    def test_tokenizer_workers(self):
+        embeddings = TransformersEmbeddings.from_model_id(self.model_path, batch_size=2,
+                                                          num_tokenizer_workers=2)
+        texts = random_texts(3 * 2 * 16 + 1)
+        windows = list(embeddings._tokenize_windows(texts))
+        self.assertEqual([len(window) for window in windows], [32, 32, 32, 1])
+        self.assertEqual(sum(windows, []),
+                         [embeddings.tokenizer.encode(text) for text in texts])
+
+    def test_embed_batch(self):
+        embeddings = TransformersEmbeddings.from_model_id(self.model_path)
+        input_ids_list = [embeddings.tokenizer.encode(text) for text in random_texts(5)]
+        results = embeddings.embed_batch(input_ids_list)
+        for input_ids, result in zip(input_ids_list, results):
+            np.testing.assert_allclose(result, embeddings.embed_batch([input_ids])[0],
+                                       rtol=1e-4, atol=1e-4)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -17,9 +17,29 @@ fi
 export OMP_NUM_THREADS=$THREAD_NUM
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformers_api.py -v
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_optimize_model_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_speculative.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_attention_sink.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_prompt_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_streaming_load.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_parallel_quantize.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_gguf_tensor_loader.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_vllm_block_manager.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_vllm_scheduler.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_vllm_paged_attention.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_blockwise_sdp.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_dequant_weight_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_low_bit_checkpoint.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_moe_group_forward.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_rwkv5_chunk.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_kv_cache_alloc.py -v
+python -m pip install "fschat==0.2.36"
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_fastchat_batching.py -v
 
 python -m pip install transformers==4.34.0
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformesr_api_434.py -v
+python -m pip install transformers==4.36.2
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_kv_cache_alloc.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_attention_sink.py -v
 python -m pip install transformers==4.31.0
 
 now=$(date "+%s")